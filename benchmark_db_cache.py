@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк кэша db.py на нагрузке "много меню, мало записей":
+каждый ответ бота читает состояние пользователя (подписка, автопродление, форма),
+а небольшая доля событий - запись (оплата, переключение автопродления), после которой кэш инвалидируется.
+
+Сравниваются две стратегии инвалидации:
+- глобальная: _clear_cache() после каждой записи (как было раньше)
+- по тегу пользователя: invalidate_user_cache(telegram_id)
+
+Запуск: python benchmark_db_cache.py [количество_ответов] [доля_записей]
+Работает на временной базе, рабочую bot.db не трогает
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+# Временная БД подставляется ДО импорта db, т.к. DB_PATH читается при импорте
+_tmp_dir = tempfile.mkdtemp(prefix="bench_db_cache_")
+os.environ["DB_PATH"] = os.path.join(_tmp_dir, "bench.db")
+
+import db  # noqa: E402
+
+USERS_COUNT = 5000
+ACTIVE_USERS = 500  # Пользователи, которые сейчас общаются с ботом (остальные - редко)
+REPLIES = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+WRITE_RATIO = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+
+
+async def seed() -> None:
+    """Заполняет временную БД пользователями и подписками"""
+    await db.init_db()
+    now = datetime.now(timezone.utc)
+    async with db.db_write() as conn:
+        await conn.executemany(
+            "INSERT INTO users (telegram_id, username, created_at, form_filled) VALUES (?, ?, ?, 1)",
+            [(i, f"user{i}", now.isoformat()) for i in range(USERS_COUNT)]
+        )
+        await conn.executemany(
+            "INSERT INTO subscriptions (telegram_id, expires_at, starts_at) VALUES (?, ?, ?)",
+            [(i, (now + timedelta(days=i % 60 - 30)).isoformat(), now.isoformat()) for i in range(USERS_COUNT)]
+        )
+
+
+def pick_user(rng: random.Random) -> int:
+    """90% ответов приходится на активных пользователей"""
+    if rng.random() < 0.9:
+        return rng.randrange(ACTIVE_USERS)
+    return rng.randrange(USERS_COUNT)
+
+
+async def menu_reply(telegram_id: int) -> None:
+    """Чтения, которые делает построение меню / ответ бота"""
+    await db.is_form_filled(telegram_id)
+    await db.get_subscription_expires_at(telegram_id)
+    await db.is_auto_renewal_enabled(telegram_id)
+    await db.get_subscription_starts_at(telegram_id)
+
+
+async def run(name: str, invalidate) -> None:
+    db._cache.clear()
+    db._cache.hits = db._cache.misses = db._cache.evictions = db._cache.expirations = db._cache.invalidations = 0
+    rng = random.Random(42)
+    writes = 0
+
+    started = time.perf_counter()
+    for _ in range(REPLIES):
+        telegram_id = pick_user(rng)
+        if rng.random() < WRITE_RATIO:
+            # Запись без побочных эффектов на данные: повторно сохраняем текущее значение автопродления
+            async with db.db_write() as conn:
+                await conn.execute(
+                    "UPDATE subscriptions SET auto_renewal_enabled = auto_renewal_enabled WHERE telegram_id = ?",
+                    (telegram_id,)
+                )
+            invalidate(telegram_id)
+            writes += 1
+        await menu_reply(telegram_id)
+    total = time.perf_counter() - started
+
+    stats = db.get_cache_stats()
+    print(
+        f"  {name:<22} hit rate {stats['hit_rate'] * 100:6.2f}% | промахов (запросов к БД) {stats['misses']:7d} | "
+        f"вытеснений {stats['evictions']:5d} | записей {writes:5d} | {REPLIES / total:8.0f} ответов/с"
+    )
+
+
+async def main() -> None:
+    print("=" * 100)
+    print(f"📊 БЕНЧМАРК КЭША ({REPLIES} ответов, доля записей {WRITE_RATIO:.1%}, {USERS_COUNT} пользователей)")
+    print("=" * 100)
+    await db.init_pool()
+    await seed()
+    print(f"✅ Временная БД заполнена ({db.DB_PATH})")
+
+    await run("глобальная очистка", lambda telegram_id: db._clear_cache())
+    await run("инвалидация по тегу", db.invalidate_user_cache)
+
+    await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк пула соединений БД: сравнивает задержку одного вызова
+при подключении на каждый запрос (старый вариант) и через пул из db.py
+
+Запуск: python benchmark_db_pool.py [количество_вызовов] [параллельность]
+Работает на временной базе, рабочую bot.db не трогает
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+# Временная БД подставляется ДО импорта db, т.к. DB_PATH читается при импорте
+_tmp_dir = tempfile.mkdtemp(prefix="bench_db_pool_")
+os.environ["DB_PATH"] = os.path.join(_tmp_dir, "bench.db")
+
+import aiosqlite  # noqa: E402
+import db  # noqa: E402
+
+USERS_COUNT = 5000
+CALLS = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+CONCURRENCY = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+QUERY = "SELECT expires_at FROM subscriptions WHERE telegram_id = ?"
+
+
+async def seed() -> None:
+    """Заполняет временную БД пользователями и подписками"""
+    await db.init_db()
+    now = datetime.now(timezone.utc)
+    async with db.db_write() as conn:
+        await conn.executemany(
+            "INSERT INTO users (telegram_id, username, created_at) VALUES (?, ?, ?)",
+            [(i, f"user{i}", now.isoformat()) for i in range(USERS_COUNT)]
+        )
+        await conn.executemany(
+            "INSERT INTO subscriptions (telegram_id, expires_at, starts_at) VALUES (?, ?, ?)",
+            [(i, (now + timedelta(days=i % 60 - 30)).isoformat(), now.isoformat()) for i in range(USERS_COUNT)]
+        )
+
+
+async def lookup_connect_per_query(telegram_id: int):
+    """Старый вариант: новое соединение на каждый запрос"""
+    async with aiosqlite.connect(db.DB_PATH) as conn:
+        cur = await conn.execute(QUERY, (telegram_id,))
+        return await cur.fetchone()
+
+
+async def lookup_pooled(telegram_id: int):
+    """Новый вариант: соединение для чтения из пула"""
+    async with db.db_read() as conn:
+        cur = await conn.execute(QUERY, (telegram_id,))
+        return await cur.fetchone()
+
+
+async def measure(name: str, lookup, parallel: int) -> None:
+    """Замеряет задержку каждого вызова и общую пропускную способность"""
+    latencies = []
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def one_call(i: int):
+        async with semaphore:
+            started = time.perf_counter()
+            await lookup(i % USERS_COUNT)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one_call(i) for i in range(CALLS)))
+    total = time.perf_counter() - started
+
+    latencies.sort()
+    mean_ms = sum(latencies) / len(latencies) * 1000
+    p50_ms = latencies[len(latencies) // 2] * 1000
+    p95_ms = latencies[int(len(latencies) * 0.95)] * 1000
+    print(
+        f"  {name:<24} среднее {mean_ms:7.3f} мс | p50 {p50_ms:7.3f} мс | "
+        f"p95 {p95_ms:7.3f} мс | {CALLS / total:8.0f} вызовов/с"
+    )
+
+
+async def main() -> None:
+    print("=" * 80)
+    print(f"📊 БЕНЧМАРК ПУЛА СОЕДИНЕНИЙ ({CALLS} вызовов, параллельность {CONCURRENCY})")
+    print("=" * 80)
+    await db.init_pool()
+    await seed()
+    print(f"✅ Временная БД заполнена: {USERS_COUNT} пользователей ({db.DB_PATH})")
+
+    for parallel in (1, CONCURRENCY):
+        print(f"\n🔍 Параллельных вызовов: {parallel}")
+        await measure("connect на каждый запрос", lookup_connect_per_query, parallel)
+        await measure("пул соединений", lookup_pooled, parallel)
+
+    await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
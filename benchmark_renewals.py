@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Симуляция массового истечения подписок: N пользователей с автопродлением истекают одновременно
+(как все бонусные подписки в BONUS_WEEK_END_DATE) и обрабатываются renewal_engine.
+
+Проходит настоящий путь webhook_app._process_expired_subscription -> attempt_auto_renewal с записью
+во временную БД; внешние вызовы заменены заглушками с задержкой:
+- ЮKassa: создание автоплатежа возвращает pending, результат приходит "webhook'ом" через payment_waiters;
+- Telegram: отправка сообщений, создание ссылок и бан.
+
+Сравнивается последовательная обработка (как было - параллельность 1, оценка по выборке)
+и параллельная с AUTO_RENEWAL_CONCURRENCY (или значениями из аргументов).
+
+Запуск: python benchmark_renewals.py [пользователей] [параллельность ...]
+Работает на временной базе, рабочую bot.db не трогает
+"""
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+# Временная БД подставляется ДО импорта db/webhook_app, т.к. DB_PATH читается при импорте
+_tmp_dir = tempfile.mkdtemp(prefix="bench_renewals_")
+os.environ["DB_PATH"] = os.path.join(_tmp_dir, "bench.db")
+
+import db  # noqa: E402
+import webhook_app  # noqa: E402
+import yookassa_async  # noqa: E402
+from config import AUTO_RENEWAL_CONCURRENCY  # noqa: E402
+from epoch_columns import now_ms, to_epoch_ms  # noqa: E402
+from payment_waiters import payment_waiters  # noqa: E402
+from renewal_engine import RenewalEngine  # noqa: E402
+
+USERS = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+CONCURRENCY_LEVELS = [int(arg) for arg in sys.argv[2:]] or [AUTO_RENEWAL_CONCURRENCY]
+SEQUENTIAL_SAMPLE = 30  # Пользователей для оценки последовательной обработки
+
+YOOKASSA_LATENCY_SECONDS = 0.15  # Ответ API на создание платежа
+WEBHOOK_DELAY_SECONDS = 0.2  # Через сколько после создания приходит payment.succeeded/canceled
+TELEGRAM_LATENCY_SECONDS = 0.03  # Один вызов Bot API
+FAILURE_RATIO = 0.1  # Доля отклоненных автоплатежей
+
+_rng = random.Random(42)
+_statuses: dict[str, str] = {}  # Статусы платежей "в ЮKassa" для заглушки get_payment_status
+
+
+# ================== ЗАГЛУШКИ ВНЕШНИХ API ==================
+async def fake_create_auto_payment(amount_rub, description, customer_email, telegram_user_id, payment_method_id):
+    await asyncio.sleep(YOOKASSA_LATENCY_SECONDS)
+    payment_id = f"bench-{uuid.uuid4().hex}"
+    status = "canceled" if _rng.random() < FAILURE_RATIO else "succeeded"
+    _statuses[payment_id] = "pending"
+    asyncio.get_running_loop().call_later(WEBHOOK_DELAY_SECONDS, _complete_payment, payment_id, status)
+    return payment_id, "pending"
+
+
+def _complete_payment(payment_id: str, status: str) -> None:
+    _statuses[payment_id] = status
+    payment_waiters.resolve(payment_id, status)
+
+
+async def fake_get_payment_status(payment_id):
+    await asyncio.sleep(YOOKASSA_LATENCY_SECONDS)
+    return _statuses.get(payment_id, "canceled")
+
+
+async def fake_find_payment(payment_id):
+    await asyncio.sleep(YOOKASSA_LATENCY_SECONDS)
+    return SimpleNamespace(id=payment_id, status="canceled", cancellation_details=None)
+
+
+async def fake_telegram_call(*args, **kwargs):
+    await asyncio.sleep(TELEGRAM_LATENCY_SECONDS)
+    return True
+
+
+async def fake_create_invite_link(*args, **kwargs):
+    await asyncio.sleep(TELEGRAM_LATENCY_SECONDS)
+    return f"https://t.me/+{uuid.uuid4().hex[:16]}"
+
+
+def install_stubs() -> None:
+    yookassa_async.create_auto_payment = fake_create_auto_payment
+    yookassa_async.get_payment_status = fake_get_payment_status
+    webhook_app.find_payment = fake_find_payment
+    webhook_app.safe_send_message = fake_telegram_call
+    webhook_app.safe_create_invite_link = fake_create_invite_link
+    webhook_app.bot = SimpleNamespace(ban_chat_member=fake_telegram_call, unban_chat_member=fake_telegram_call)
+
+
+# ================== ДАННЫЕ ==================
+async def seed(first_id: int, count: int) -> list[int]:
+    """Пользователи с истекшей (только что) подпиской, автопродлением и успешной оплатой в прошлом"""
+    now = datetime.now(timezone.utc)
+    expires_at = now - timedelta(seconds=1)
+    starts_at = expires_at - timedelta(days=30)
+    ids = list(range(first_id, first_id + count))
+    async with db.db_write() as conn:
+        await conn.executemany(
+            "INSERT INTO users (telegram_id, username, created_at, form_filled) VALUES (?, ?, ?, 1)",
+            [(i, f"user{i}", starts_at.isoformat()) for i in ids]
+        )
+        await conn.executemany(
+            "INSERT INTO subscriptions (telegram_id, expires_at, starts_at, expires_at_ms, starts_at_ms, "
+            "auto_renewal_enabled, saved_payment_method_id) VALUES (?, ?, ?, ?, ?, 1, ?)",
+            [(i, expires_at.isoformat(), starts_at.isoformat(), to_epoch_ms(expires_at), to_epoch_ms(starts_at), f"pm-{i}")
+             for i in ids]
+        )
+        await conn.executemany(
+            "INSERT INTO payments (telegram_id, payment_id, status, created_at, created_at_ms) VALUES (?, ?, 'succeeded', ?, ?)",
+            [(i, f"initial-{i}", starts_at.isoformat(), to_epoch_ms(starts_at)) for i in ids]
+        )
+    return ids
+
+
+async def expired_rows(ids: list[int]) -> list:
+    wanted = set(ids)
+    return [row for row in await webhook_app.get_expired_subscriptions() if row[0] in wanted]
+
+
+async def count_renewed(ids: list[int]) -> int:
+    async with db.db_read() as conn:
+        cur = await conn.execute(
+            "SELECT COUNT(*) FROM subscriptions WHERE telegram_id BETWEEN ? AND ? AND expires_at_ms > ?",
+            (ids[0], ids[-1], now_ms())
+        )
+        return (await cur.fetchone())[0]
+
+
+# ================== ПРОГОН ==================
+async def run(concurrency: int, ids: list[int]) -> float:
+    """Ставит всех пользователей в движок одновременно; возвращает пропускную способность (пользователей/с)"""
+    engine = RenewalEngine(concurrency, name=f"бенчмарк x{concurrency}")
+    rows = await expired_rows(ids)
+    done_after: list[float] = []
+
+    async def job(telegram_id):
+        await webhook_app._process_expired_subscription(telegram_id)
+        done_after.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    for row in rows:
+        engine.submit(row[0], lambda telegram_id=row[0]: job(telegram_id))
+    await engine.join()
+    total = time.perf_counter() - started
+
+    done_after.sort()
+    renewed = await count_renewed(ids)
+    rate = len(rows) / total
+    p50 = statistics.median(done_after)
+    p95 = done_after[int(len(done_after) * 0.95) - 1]
+    print(
+        f"  параллельность {concurrency:4d}: {len(rows):6d} пользователей за {total:7.1f} с | {rate:7.1f} польз./с | "
+        f"готовность p50 {p50:7.1f} с, p95 {p95:7.1f} с, последний {done_after[-1]:7.1f} с | "
+        f"продлено {renewed}, ошибок {engine.failed}"
+    )
+    return rate
+
+
+async def main() -> None:
+    print("=" * 120)
+    print(
+        f"📊 СИМУЛЯЦИЯ МАССОВОГО ИСТЕЧЕНИЯ: {USERS} подписок одновременно "
+        f"(ЮKassa {YOOKASSA_LATENCY_SECONDS * 1000:.0f} мс + webhook {WEBHOOK_DELAY_SECONDS * 1000:.0f} мс, "
+        f"Telegram {TELEGRAM_LATENCY_SECONDS * 1000:.0f} мс, отказов {FAILURE_RATIO:.0%})"
+    )
+    print("=" * 120)
+    install_stubs()
+    await db.init_pool()
+    await db.init_db()
+    # Подробные логи обработки каждого пользователя не нужны
+    logging.disable(logging.WARNING)
+
+    next_id = 1
+    sample_ids = await seed(next_id, SEQUENTIAL_SAMPLE)
+    next_id += SEQUENTIAL_SAMPLE
+    sequential_rate = await run(1, sample_ids)
+    print(f"  → последовательно все {USERS} заняли бы ~{USERS / sequential_rate / 60:.0f} мин")
+
+    for concurrency in CONCURRENCY_LEVELS:
+        ids = await seed(next_id, USERS)
+        next_id += USERS
+        rate = await run(concurrency, ids)
+        print(f"  → ускорение относительно последовательной обработки: x{rate / sequential_rate:.1f}")
+
+    logging.disable(logging.NOTSET)
+    await db.close_pool()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк старта точек входа: время импорта (python -X importtime) и пиковый RSS процесса
+- bot: import bot + первое меню пользователя (main_menu), как при первом сообщении после старта polling;
+- webhook_app: import webhook_app.
+Каждый замер - отдельный процесс на временной БД с фиктивными ключами (сеть не используется).
+Показывается, какие тяжелые модули оказались загружены.
+
+С --baseline <git-ревизия> та же ревизия выгружается (git archive) во временный каталог
+и замеряется рядом с текущим деревом - "до" и "после".
+
+Запуск: python benchmark_startup.py [--runs N] [--baseline REV]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ("webhook_app", "fastapi", "starlette", "jinja2", "openpyxl", "yookassa", "smtplib", "email.mime")
+
+ENTRY_POINTS = {
+    "bot": """
+import asyncio
+import bot
+async def first_menu():
+    await bot.init_pool()
+    await bot.init_db()
+    await bot.main_menu(1)
+    await bot.close_pool()
+asyncio.run(first_menu())
+""",
+    "webhook_app": "import webhook_app\n",
+}
+
+REPORT = """
+import json, resource, sys
+print("BENCH" + json.dumps({
+    "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "modules": len(sys.modules),
+    "heavy": sorted(m for m in %r if m in sys.modules),
+}))
+""" % (HEAVY_MODULES,)
+
+
+def _env(tree: str) -> dict:
+    tmp_dir = tempfile.mkdtemp(prefix="bench_startup_")
+    env = dict(os.environ)
+    env.update({
+        "BOT_TOKEN": "123456:bench",
+        "CHANNEL_ID": "-1000000000001",
+        "YOOKASSA_SHOP_ID": "bench",
+        "YOOKASSA_SECRET_KEY": "bench",
+        "DB_PATH": os.path.join(tmp_dir, "bench.db"),
+        "BOT_UPDATES_MODE": "polling",
+        "PYTHONPATH": tree,
+        "PYTHONDONTWRITEBYTECODE": "1",
+    })
+    return env
+
+
+def measure(tree: str, entry: str) -> dict:
+    """Один холодный старт: суммарное время импорта (мс), пиковый RSS (МБ), загруженные модули"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", ENTRY_POINTS[entry] + REPORT],
+        cwd=tree, env=_env(tree), capture_output=True, text=True, timeout=300,
+    )
+    report = next((line for line in result.stdout.splitlines() if line.startswith("BENCH")), None)
+    if report is None:
+        raise RuntimeError(f"{entry} в {tree} не запустился:\n{result.stderr[-3000:]}")
+    import_us = 0
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            self_us = line.split(":", 1)[1].split("|")[0].strip()
+            if self_us.isdigit():
+                import_us += int(self_us)
+    data = json.loads(report[len("BENCH"):])
+    data["import_ms"] = import_us / 1000
+    data["rss_mb"] = data.pop("rss_kb") / 1024
+    return data
+
+
+def bench_tree(label: str, tree: str, runs: int) -> dict:
+    results = {}
+    for entry in ENTRY_POINTS:
+        samples = [measure(tree, entry) for _ in range(runs)]
+        results[entry] = {
+            "import_ms": statistics.median(s["import_ms"] for s in samples),
+            "rss_mb": statistics.median(s["rss_mb"] for s in samples),
+            "modules": samples[-1]["modules"],
+            "heavy": samples[-1]["heavy"],
+        }
+        r = results[entry]
+        print(f"  {label:<10} {entry:<12} импорт {r['import_ms']:8.1f} мс   RSS {r['rss_mb']:7.1f} МБ   "
+              f"модулей {r['modules']:5d}   тяжелые: {', '.join(r['heavy']) or '-'}")
+    return results
+
+
+def export_revision(rev: str) -> str:
+    """Выгружает ревизию git во временный каталог (рабочее дерево не меняется)"""
+    target = tempfile.mkdtemp(prefix="bench_startup_rev_")
+    archive = subprocess.run(["git", "archive", rev], capture_output=True, check=True)
+    subprocess.run(["tar", "-x", "-C", target], input=archive.stdout, check=True)
+    return target
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3, help="Холодных стартов на точку входа (берется медиана)")
+    parser.add_argument("--baseline", help="git-ревизия для сравнения (например, HEAD~1)")
+    args = parser.parse_args()
+
+    tree = os.path.dirname(os.path.abspath(__file__))
+    print("=" * 110)
+    print(f"🚀 СТАРТ ТОЧЕК ВХОДА (медиана {args.runs} запусков, python -X importtime)")
+    print("=" * 110)
+    baseline = bench_tree(args.baseline, export_revision(args.baseline), args.runs) if args.baseline else None
+    current = bench_tree("текущее", tree, args.runs)
+    if baseline:
+        print("-" * 110)
+        for entry in ENTRY_POINTS:
+            before, after = baseline[entry], current[entry]
+            print(f"  {entry:<12} импорт {before['import_ms']:.1f} -> {after['import_ms']:.1f} мс "
+                  f"({after['import_ms'] / before['import_ms']:.0%}),   "
+                  f"RSS {before['rss_mb']:.1f} -> {after['rss_mb']:.1f} МБ ({after['rss_mb'] / before['rss_mb']:.0%})")
+    print("=" * 110)
+
+
+if __name__ == "__main__":
+    main()
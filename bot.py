@@ -1,31 +1,30 @@
 import asyncio
 import os
-import inspect
+import sys
 import aiohttp
 import aiosqlite
 import tempfile
-import smtplib
 import logging
 from datetime import datetime, timedelta, timezone
 from typing import Optional
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
-from openpyxl import Workbook, load_workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 
 from aiogram import Bot, Dispatcher
 from aiogram.filters import Command
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ChatJoinRequest, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, FSInputFile, BufferedInputFile, ContentType, WebAppInfo, ChatMemberUpdated
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ChatJoinRequest, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, BufferedInputFile, ContentType, WebAppInfo, ChatMemberUpdated
 from aiogram.enums import ChatMemberStatus
 from aiogram.enums import ChatAction
 from dotenv import load_dotenv
 
-from telegram_utils import safe_send_message, safe_send_video
+from telegram_utils import safe_send_message, install_send_scheduler, IncomingReachabilityMiddleware, TIMEOUT_LONG
+from media_registry import media_registry, KIND_VIDEO, KIND_ANIMATION, KIND_DOCUMENT
+from broadcast_engine import BroadcastEngine, create_broadcast_job, KIND_USERS, KIND_USERNAMES
 
 from db import (
     init_db,
+    init_pool,
+    close_pool,
+    db_read,
+    db_write,
     ensure_user,
     get_subscription_expires_at,
     get_subscription_starts_at,
@@ -40,12 +39,29 @@ from db import (
     delete_payment_method,
     is_user_allowed,
     get_invite_link,
-    is_form_filled,
     get_or_create_form_token,
     get_users_list,
+    get_user_state,
+    mark_user_reachable,
+    mark_user_unreachable,
+    REACHABILITY_BLOCKED,
+    set_channel_member_status,
+)
+from utils import format_datetime_moscow, format_subscription_duration
+from core import (
+    get_main_menu_for_user,
+    BTN_PAY_1,
+    BTN_MANAGE_SUB,
+    BTN_CANCEL_SUB,
+    BTN_RESUME_SUB,
+    BTN_STATUS_1,
+    BTN_ABOUT_1,
+    BTN_CHECK_1,
+    BTN_SUPPORT,
+    BTN_BONUS_WEEK,
+    BTN_BACK_TO_MENU,
+    BTN_DISABLE_AUTO_RENEWAL,
 )
-from utils import format_datetime_moscow
-from payments import create_payment, get_payment_status, get_payment_url
 from config import (
     PAYMENT_LINK_VALID_MINUTES,
     SUBSCRIPTION_DAYS,
@@ -62,28 +78,10 @@ from config import (
     dni_prazdnika,
     vremya_sms,
     BONUS_WEEK_PRICE_RUB,
-    DB_PATH,
+    TELEGRAM_BOT_MESSAGES_PER_SECOND,
+    BOT_UPDATES_MODE,
 )
 
-def format_subscription_duration(days: float) -> str:
-    """Форматирует длительность подписки: показывает минуты если < 1 дня, иначе дни"""
-    if days < 1:
-        minutes = int(days * 1440)
-        if minutes == 1:
-            return "1 минута"
-        elif 2 <= minutes <= 4:
-            return f"{minutes} минуты"
-        else:
-            return f"{minutes} минут"
-    else:
-        days_int = int(days)
-        if days_int == 1:
-            return "1 день"
-        elif 2 <= days_int <= 4:
-            return f"{days_int} дня"
-        else:
-            return f"{days_int} дней"
-
 
 def ensure_timezone_aware(dt: Optional[datetime]) -> Optional[datetime]:
     """Приводит datetime к timezone-aware (UTC), если он timezone-naive"""
@@ -117,25 +115,25 @@ CUSTOMER_EMAIL = os.getenv("PAYMENT_CUSTOMER_EMAIL", "test@example.com")
 if not TOKEN:
     raise RuntimeError("BOT_TOKEN is missing in .env")
 
-bot = Bot(token=TOKEN)
+if BOT_UPDATES_MODE == "webhook":
+    # Объединенный режим: bot.py загружает webhook_app.py при старте, бот (сессия, планировщик отправок) - общий
+    from webhook_app import bot, send_scheduler
+else:
+    bot = Bot(token=TOKEN)
+    # Все отправки бота (ответы, рассылки) идут через планировщик с лимитами Telegram,
+    # в заблокировавших бота пользователей - не уходят вовсе (user_reachability)
+    send_scheduler = install_send_scheduler(bot, TELEGRAM_BOT_MESSAGES_PER_SECOND)
+# Рассылки обновлений: персональное меню берется при отправке (main_menu определено ниже)
+broadcast_engine = BroadcastEngine(bot, menu_factory=lambda telegram_id: main_menu(telegram_id))
 dp = Dispatcher()
+# Личное сообщение или нажатие кнопки - пользователь снова доступен (снимает отметку user_reachability)
+dp.message.outer_middleware(IncomingReachabilityMiddleware())
+dp.callback_query.outer_middleware(IncomingReachabilityMiddleware())
 
-
-BTN_PAY_1 = "💳 Получить доступ"  # Показывается если нет подписки
-BTN_MANAGE_SUB = "⚙️ Управление доступом"  # Показывается если есть подписка
-BTN_CANCEL_SUB = "❌ Отменить доступ и отключить автопродление"  # Показывается в меню управления если автопродление включено
-BTN_RESUME_SUB = "▶️ Возобновить доступ"  # Показывается в меню управления если автопродление отключено
-BTN_STATUS_1 = "📊 Статус доступа"
-BTN_ABOUT_1 = "ℹ️ О проекте"
-BTN_CHECK_1 = "🔍 Проверить оплату"
-BTN_SUPPORT = "💬 Поддержка"
-BTN_FILL_FORM = "📝 Заполнить данные"  # Кнопка для заполнения формы
-
-# Кнопки для бонусной недели
-BTN_BONUS_WEEK = "🎁 Бонус в честь запуска канала Наиля Хасанова"
-BTN_BACK_TO_MENU = "◀️ Назад в меню"
-BTN_DISABLE_AUTO_RENEWAL = "❌ Отказаться от автопродления"
-BTN_REMOVE_CARD = "💳 Отвязать карту"
+# Приветственные видео /start: хэши и метаданные считаются при старте (media_registry.warm_up)
+WELCOME_VIDEO_RECORDING_PATH = os.path.join(os.path.dirname(__file__), "Video_nail_hasanov.mp4")
+WELCOME_VIDEO_PATH = os.getenv("WELCOME_VIDEO_PATH", "/opt/bot_telegram/welcome_video.mp4")
+WELCOME_VIDEO_GIF_PATH = os.getenv("WELCOME_VIDEO_GIF_PATH", "/opt/bot_telegram/welcome_video.gif")
 
 
 async def bonus_week_menu() -> ReplyKeyboardMarkup:
@@ -152,10 +150,9 @@ async def bonus_week_menu() -> ReplyKeyboardMarkup:
 
 async def main_menu(telegram_id: int = None) -> ReplyKeyboardMarkup:
     """Создает главное меню с учетом статуса доступа"""
-    # КРИТИЧЕСКИ ВАЖНО: Используем get_main_menu_for_user из webhook_app для единообразия логики
+    # КРИТИЧЕСКИ ВАЖНО: Используем get_main_menu_for_user из core.py (его же использует webhook_app) для единообразия логики
     # Это гарантирует, что меню будет одинаковым везде, включая обработку попыток автопродления
     if telegram_id:
-        from webhook_app import get_main_menu_for_user
         return await get_main_menu_for_user(telegram_id)
     
     # Если telegram_id не передан, возвращаем меню по умолчанию
@@ -175,7 +172,7 @@ async def main_menu(telegram_id: int = None) -> ReplyKeyboardMarkup:
 async def manage_subscription_menu(telegram_id: int) -> ReplyKeyboardMarkup:
     """Создает меню управления доступом с кнопкой отмены/возобновления в зависимости от статуса автопродления"""
     # Проверяем статус автопродления
-    auto_renewal_enabled = await is_auto_renewal_enabled(telegram_id)
+    auto_renewal_enabled = (await get_user_state(telegram_id)).auto_renewal_enabled
     
     # Если автопродление включено - показываем "Отменить доступ", иначе "Возобновить доступ"
     action_button = BTN_CANCEL_SUB if auto_renewal_enabled else BTN_RESUME_SUB
@@ -191,13 +188,6 @@ async def manage_subscription_menu(telegram_id: int) -> ReplyKeyboardMarkup:
     )
 
 
-async def maybe_await(func, *args, **kwargs):
-    result = func(*args, **kwargs)
-    if inspect.isawaitable(result):
-        return await result
-    return result
-
-
 async def send_typing_action(chat_id: int):
     """Показывает индикатор 'печатает...' для визуальной обратной связи"""
     try:
@@ -212,9 +202,9 @@ async def check_form_filled_and_block(telegram_id: int, message: Message) -> boo
     Проверяет, заполнена ли форма. Если нет - отправляет сообщение с кнопкой и возвращает True (блокирует действие).
     Если форма заполнена - возвращает False (разрешает действие).
     """
-    # ВСЕГДА читаем из БД (force_refresh=True) чтобы получить актуальные данные
-    # Это важно, так как webhook может обновить статус формы в другом процессе
-    form_filled = await is_form_filled(telegram_id, force_refresh=True)
+    # Читаем снимок состояния через кэш: когда webhook (другой процесс) отмечает форму заполненной,
+    # запись кэша удаляется через cache_bus
+    form_filled = (await get_user_state(telegram_id)).form_filled
     print(f"🔍 check_form_filled_and_block для {telegram_id}: form_filled={form_filled}")
     if not form_filled:
         print(f"🚫 Форма НЕ заполнена для {telegram_id}, блокируем действие")
@@ -363,6 +353,8 @@ logger_bot = logging.getLogger(__name__)
 
 async def create_daily_summary_excel_bot(rows: list) -> Optional[str]:
     """Создает Excel файл со сводкой по заполненным формам за 24 часа"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
     try:
         wb = Workbook()
         ws = wb.active
@@ -471,6 +463,11 @@ async def create_daily_summary_excel_bot(rows: list) -> Optional[str]:
 
 async def send_daily_summary_email_bot(excel_path: str, count: int) -> bool:
     """Отправляет ежедневную сводку по заполненным формам на email"""
+    import smtplib
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.base import MIMEBase
+    from email import encoders
     SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.mail.ru")
     SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
     SMTP_USER = os.getenv("SMTP_USER", "")
@@ -544,7 +541,7 @@ async def send_daily_form_summary_bot() -> bool:
         twenty_four_hours_ago = (datetime.now(timezone.utc) - timedelta(hours=24)).isoformat()
         
         # Получаем все записи за последние 24 часа
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_read() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("""
                 SELECT * FROM daily_form_submissions 
@@ -570,7 +567,7 @@ async def send_daily_form_summary_bot() -> bool:
         
         # Удаляем старые записи (старше 24 часов) после успешной отправки
         if success:
-            async with aiosqlite.connect(DB_PATH) as db:
+            async with db_write() as db:
                 await db.execute("""
                     DELETE FROM daily_form_submissions 
                     WHERE submitted_at < ?
@@ -639,6 +636,11 @@ async def cmd_send_report(message: Message):
 
 async def send_full_excel_report_bot() -> bool:
     """Генерирует и отправляет полный Excel отчет по базе данных на email"""
+    import smtplib
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.base import MIMEBase
+    from email import encoders
     try:
         # Импортируем функцию генерации отчета (синхронная)
         import sys
@@ -789,7 +791,6 @@ async def cmd_send_stat(message: Message):
 async def cmd_send_update(message: Message):
     """Команда для отправки видео-обновления всем пользователям из БД с обновлением меню"""
     import traceback
-    import asyncio
     
     try:
         # Получаем список всех пользователей
@@ -831,11 +832,6 @@ async def cmd_send_update(message: Message):
             )
             return
         
-        bot_instance = Bot(token=TOKEN)
-        success_count = 0
-        error_count = 0
-        blocked_count = 0
-        
         # Текст сообщения (как на скриншоте)
         message_text = (
             "Всем привет, Наиль Хасанов на связи! 👋\n\n"
@@ -844,62 +840,17 @@ async def cmd_send_update(message: Message):
             "Посмотрите видео и сделайте так же 🙏"
         )
         
-        # Отправляем видео с обновленным меню каждому пользователю
-        for idx, user in enumerate(users_list, 1):
-            telegram_id = user['telegram_id']
-            
-            try:
-                # Получаем актуальное меню для пользователя
-                user_menu = await main_menu(telegram_id)
-                
-                # Отправляем видео с текстом и обновленным меню
-                video_file = FSInputFile(video_path)
-                await safe_send_video(
-                    bot=bot_instance,
-                    chat_id=telegram_id,
-                    video=video_file,
-                    caption=message_text,
-                    parse_mode="HTML",
-                    reply_markup=user_menu
-                )
-                
-                success_count += 1
-                
-                # Небольшая задержка, чтобы не превысить лимиты Telegram API
-                if idx % 5 == 0:
-                    await asyncio.sleep(2)  # Задержка каждые 5 пользователей (видео тяжелое)
-                    await message.answer(
-                        f"⏳ Обработано: {idx}/{total_users} пользователей...",
-                        parse_mode="HTML"
-                    )
-                else:
-                    await asyncio.sleep(0.3)  # Небольшая задержка между сообщениями
-                    
-            except Exception as e:
-                error_msg = str(e).lower()
-                if "blocked" in error_msg or "chat not found" in error_msg or "user is deactivated" in error_msg:
-                    blocked_count += 1
-                else:
-                    error_count += 1
-                    logger_bot.warning(f"⚠️ Ошибка при отправке пользователю {telegram_id}: {e}")
-        
-        # Закрываем сессию бота
-        await bot_instance.session.close()
-        
-        # Отправляем итоговый отчет
-        result_text = (
-            f"✅ <b>Отправка обновления завершена!</b>\n\n"
-            f"📊 <b>Статистика:</b>\n"
-            f"✅ Успешно: {success_count}\n"
-            f"❌ Ошибки: {error_count}\n"
-            f"🚫 Заблокировали бота: {blocked_count}\n"
-            f"📈 Всего обработано: {total_users}\n\n"
-            f"ℹ️ <b>Примечание:</b> Сообщение отправлено всем пользователям из БД.\n"
-            f"Меню обновлено для всех получателей."
+        # Рассылка - задание в БД: отправка идет в фоне, параллельно, с продолжением после перезапуска.
+        # Прогресс и итог (успешно / заблокировали / ошибки) - в одном обновляемом сообщении
+        job_id = await create_broadcast_job(
+            kind=KIND_USERS,
+            text=message_text,
+            video_path=video_path,
+            admin_chat_id=message.chat.id,
+            recipients=[user['telegram_id'] for user in users_list],
         )
-        
-        await message.answer(result_text, parse_mode="HTML")
-        logger_bot.info(f"✅ Отправка обновления завершена: успешно={success_count}, ошибки={error_count}, заблокировали={blocked_count}")
+        broadcast_engine.start(job_id)
+        logger_bot.info(f"✅ Запущена рассылка обновления #{job_id}: {total_users} пользователей")
         
     except Exception as e:
         error_msg = str(e)
@@ -917,7 +868,7 @@ async def cmd_send_update(message: Message):
 async def cmd_send_update_from_excel(message: Message):
     """Команда для отправки обновления пользователям из Excel файла (бывшие пользователи Юнисендера)"""
     import traceback
-    import asyncio
+    from openpyxl import load_workbook
     
     try:
         # Путь к Excel файлу
@@ -969,12 +920,6 @@ async def cmd_send_update_from_excel(message: Message):
             )
             return
         
-        bot_instance = Bot(token=TOKEN)
-        success_count = 0
-        error_count = 0
-        blocked_count = 0
-        not_found_count = 0
-        
         # Текст сообщения
         message_text = (
             "Всем привет, Наиль Хасанов на связи! 👋\n\n"
@@ -983,72 +928,17 @@ async def cmd_send_update_from_excel(message: Message):
             "Посмотрите видео и сделайте так же 🙏"
         )
         
-        # Отправляем видео каждому username из Excel
-        for idx, username in enumerate(usernames, 1):
-            try:
-                # Пытаемся получить информацию о пользователе по username
-                try:
-                    chat = await bot_instance.get_chat(username)
-                    chat_id = chat.id
-                except Exception as get_chat_error:
-                    # Если не удалось получить chat, пробуем отправить напрямую по username
-                    chat_id = username
-                    logger_bot.warning(f"⚠️ Не удалось получить chat для {username}, пробую отправить напрямую: {get_chat_error}")
-                
-                # Получаем меню по умолчанию (так как не знаем telegram_id)
-                default_menu = await main_menu()
-                
-                # Отправляем видео с текстом и обновленным меню
-                video_file = FSInputFile(video_path)
-                await safe_send_video(
-                    bot=bot_instance,
-                    chat_id=chat_id,
-                    video=video_file,
-                    caption=message_text,
-                    parse_mode="HTML",
-                    reply_markup=default_menu
-                )
-                
-                success_count += 1
-                
-                # Небольшая задержка
-                if idx % 5 == 0:
-                    await asyncio.sleep(2)
-                    await message.answer(
-                        f"⏳ Обработано: {idx}/{len(usernames)} пользователей...",
-                        parse_mode="HTML"
-                    )
-                else:
-                    await asyncio.sleep(0.3)
-                    
-            except Exception as e:
-                error_msg = str(e).lower()
-                if "blocked" in error_msg or "user is deactivated" in error_msg:
-                    blocked_count += 1
-                elif "chat not found" in error_msg or "user not found" in error_msg or "username not found" in error_msg:
-                    not_found_count += 1
-                else:
-                    error_count += 1
-                    logger_bot.warning(f"⚠️ Ошибка при отправке пользователю {username}: {e}")
-        
-        # Закрываем сессию бота
-        await bot_instance.session.close()
-        
-        # Отправляем итоговый отчет
-        result_text = (
-            f"✅ <b>Отправка завершена!</b>\n\n"
-            f"📊 <b>Статистика:</b>\n"
-            f"📖 Всего в Excel: {len(usernames)}\n"
-            f"✅ Успешно отправлено: {success_count}\n"
-            f"❌ Ошибки: {error_count}\n"
-            f"🚫 Заблокировали бота: {blocked_count}\n"
-            f"🔍 Пользователь не найден: {not_found_count}\n\n"
-            f"ℹ️ <b>Примечание:</b> Отправлено всем пользователям из Excel файла.\n"
-            f"Если пользователь не найден, возможно он изменил username или удалил аккаунт."
+        # Рассылка - задание в БД (см. cmd_send_update); username'ы разрешаются в chat_id при отправке,
+        # ненайденные пользователи попадают в итог отдельно
+        job_id = await create_broadcast_job(
+            kind=KIND_USERNAMES,
+            text=message_text,
+            video_path=video_path,
+            admin_chat_id=message.chat.id,
+            recipients=usernames,
         )
-        
-        await message.answer(result_text, parse_mode="HTML")
-        logger_bot.info(f"✅ Отправка из Excel завершена: успешно={success_count}, ошибки={error_count}, заблокировали={blocked_count}, не найдено={not_found_count}")
+        broadcast_engine.start(job_id)
+        logger_bot.info(f"✅ Запущена рассылка обновления из Excel #{job_id}: {len(usernames)} username'ов")
         
     except Exception as e:
         error_msg = str(e)
@@ -1079,9 +969,9 @@ async def cmd_start(message: Message):
     
     # Путь к видео или URL
     # Приоритет: 1) локальный файл Video_nail_hasanov, 2) WELCOME_VIDEO_PATH, 3) WELCOME_VIDEO_URL
-    VIDEO_RECORDING_PATH = os.path.join(os.path.dirname(__file__), "Video_nail_hasanov.mp4")
-    VIDEO_PATH = os.getenv("WELCOME_VIDEO_PATH", "/opt/bot_telegram/welcome_video.mp4")
-    VIDEO_GIF_PATH = os.getenv("WELCOME_VIDEO_GIF_PATH", "/opt/bot_telegram/welcome_video.gif")  # GIF для авто-воспроизведения
+    VIDEO_RECORDING_PATH = WELCOME_VIDEO_RECORDING_PATH
+    VIDEO_PATH = WELCOME_VIDEO_PATH
+    VIDEO_GIF_PATH = WELCOME_VIDEO_GIF_PATH  # GIF для авто-воспроизведения
     VIDEO_URL = os.getenv("WELCOME_VIDEO_URL", None)  # Можно указать URL видео
     
     # Приоритет: сначала пробуем локальный файл (быстрее), потом URL
@@ -1188,81 +1078,46 @@ async def cmd_start(message: Message):
             file_size_mb = file_size / 1024 / 1024
             print(f"📹 Найден файл Video_nail_hasanov, размер: {file_size_mb:.1f}MB")
             
-            video_file = FSInputFile(VIDEO_RECORDING_PATH)
+            # Файл загружается в Telegram один раз, дальше отправляется по file_id (media_registry)
+            user_menu = await main_menu(message.from_user.id)
             max_video_size = MAX_VIDEO_SIZE_MB * 1024 * 1024
             
             if file_size > max_video_size:
                 print(f"⚠️ Видео слишком большое ({file_size_mb:.1f}MB), отправляю как документ")
-                await bot.send_document(
+                await media_registry.send(VIDEO_RECORDING_PATH, KIND_DOCUMENT, lambda document: bot.send_document(
                     chat_id=message.chat.id,
-                    document=video_file,
+                    document=document,
                     caption=welcome_text,
                     parse_mode="HTML",
-                    reply_markup=await main_menu(message.from_user.id),
-                )
+                    reply_markup=user_menu,
+                    request_timeout=TIMEOUT_LONG,
+                ))
                 print(f"✅ Видео отправлено как документ: {VIDEO_RECORDING_PATH}")
             else:
-                # Пытаемся получить метаданные видео для лучшего отображения
-                width = None
-                height = None
-                duration = None
-                
-                try:
-                    # Пробуем использовать ffprobe для получения метаданных (если установлен)
-                    import subprocess
-                    result = subprocess.run(
-                        ['ffprobe', '-v', 'error', '-select_streams', 'v:0', 
-                         '-show_entries', 'stream=width,height,duration', 
-                         '-of', 'json', VIDEO_RECORDING_PATH],
-                        capture_output=True,
-                        text=True,
-                        timeout=5
-                    )
-                    if result.returncode == 0:
-                        import json
-                        data = json.loads(result.stdout)
-                        if 'streams' in data and len(data['streams']) > 0:
-                            stream = data['streams'][0]
-                            width = int(stream.get('width', 0))
-                            height = int(stream.get('height', 0))
-                            duration = float(stream.get('duration', 0))
-                            print(f"📐 Получены метаданные: {width}x{height}, длительность: {duration:.1f}с")
-                except Exception as meta_error:
+                # Метаданные видео для лучшего отображения: ffprobe запускается один раз на содержимое файла
+                # (при старте бота), здесь - чтение из кэша media_registry
+                metadata = await media_registry.video_metadata(VIDEO_RECORDING_PATH)
+                if metadata is not None:
+                    width, height, duration = metadata.width, metadata.height, metadata.duration
+                else:
                     # Если ffprobe не установлен или произошла ошибка, используем значения по умолчанию
-                    print(f"ℹ️ Не удалось получить метаданные через ffprobe: {meta_error}")
                     # Для вертикального видео (9:16) используем стандартные размеры
                     # Это может помочь видео открываться на полный экран в мобильных клиентах
-                    width = 1080
-                    height = 1920
+                    width, height, duration = 1080, 1920, None
                 
                 # Отправляем видео с метаданными для лучшего отображения
-                video_params = {
-                    "chat_id": message.chat.id,
-                    "video": video_file,
-                    "caption": welcome_text,
-                    "parse_mode": "HTML",
-                    "supports_streaming": True,  # Включаем потоковое воспроизведение
-                    "reply_markup": await main_menu(message.from_user.id),
-                }
-                
-                # Добавляем метаданные, если они доступны
-                if width and height:
-                    video_params["width"] = width
-                    video_params["height"] = height
-                if duration:
-                    video_params["duration"] = int(duration)
-                
-                await safe_send_video(
-                    bot=bot,
+                await media_registry.send(VIDEO_RECORDING_PATH, KIND_VIDEO, lambda video: bot.send_video(
                     chat_id=message.chat.id,
-                    video=video_file,
+                    video=video,
                     caption=welcome_text,
                     parse_mode="HTML",
-                    reply_markup=await main_menu(message.from_user.id),
-                    width=width,
-                    height=height,
-                    duration=int(duration) if duration else None
-                )
+                    supports_streaming=True,  # Включаем потоковое воспроизведение
+                    reply_markup=user_menu,
+                    width=width or None,
+                    height=height or None,
+                    duration=int(duration) if duration else None,
+                    request_timeout=TIMEOUT_LONG,
+                ))
                 print(f"✅ Видео успешно отправлено: {VIDEO_RECORDING_PATH}")
             video_sent = True
             return  # Прерываем выполнение
@@ -1282,14 +1137,15 @@ async def cmd_start(message: Message):
             # Telegram ограничение для animation: ~50MB
             max_gif_size = 50 * 1024 * 1024  # 50MB
             if gif_size <= max_gif_size:
-                gif_file = FSInputFile(VIDEO_GIF_PATH)
-                await bot.send_animation(
+                user_menu = await main_menu(message.from_user.id)
+                await media_registry.send(VIDEO_GIF_PATH, KIND_ANIMATION, lambda animation: bot.send_animation(
                     chat_id=message.chat.id,
-                    animation=gif_file,
+                    animation=animation,
                     caption=welcome_text,
                     parse_mode="HTML",
-                    reply_markup=await main_menu(message.from_user.id),
-                )
+                    reply_markup=user_menu,
+                    request_timeout=TIMEOUT_LONG,
+                ))
                 print(f"✅ GIF анимация отправлена для авто-воспроизведения: {VIDEO_GIF_PATH}")
                 video_sent = True
                 return  # Прерываем выполнение, GIF отправлен
@@ -1307,38 +1163,32 @@ async def cmd_start(message: Message):
             file_size_mb = file_size / 1024 / 1024
             print(f"📹 Найден локальный файл видео, размер: {file_size_mb:.1f}MB")
             
-            # Создаем FSInputFile из локального файла
-            video_file = FSInputFile(VIDEO_PATH)
+            # Файл загружается в Telegram один раз, дальше отправляется по file_id (media_registry)
+            user_menu = await main_menu(message.from_user.id)
             
             # Проверяем размер - Telegram ограничение для send_video
             max_video_size = MAX_VIDEO_SIZE_MB * 1024 * 1024
             if file_size > max_video_size:
                 # Если видео слишком большое, используем send_document
                 print(f"⚠️ Видео слишком большое ({file_size_mb:.1f}MB), отправляю как документ")
-                await bot.send_document(
+                await media_registry.send(VIDEO_PATH, KIND_DOCUMENT, lambda document: bot.send_document(
                     chat_id=message.chat.id,
-                    document=video_file,
+                    document=document,
                     caption=welcome_text,
                     parse_mode="HTML",
-                    reply_markup=await main_menu(message.from_user.id),
-                )
+                    reply_markup=user_menu,
+                    request_timeout=TIMEOUT_LONG,
+                ))
                 print(f"✅ Видео отправлено как документ из файла: {VIDEO_PATH}")
             else:
                 # Отправляем как видео с оптимизацией для быстрой загрузки
                 # Получаем информацию о видео для лучшей оптимизации
                 try:
-                    import subprocess
-                    duration_cmd = f'ffprobe -v error -select_streams v:0 -show_entries stream=duration -of default=noprint_wrappers=1:nokey=1 "{VIDEO_PATH}"'
-                    duration_result = subprocess.run(duration_cmd, shell=True, capture_output=True, text=True, timeout=5)
-                    duration = int(float(duration_result.stdout.strip())) if duration_result.returncode == 0 else None
-                    
-                    width_cmd = f'ffprobe -v error -select_streams v:0 -show_entries stream=width -of default=noprint_wrappers=1:nokey=1 "{VIDEO_PATH}"'
-                    width_result = subprocess.run(width_cmd, shell=True, capture_output=True, text=True, timeout=5)
-                    width = int(width_result.stdout.strip()) if width_result.returncode == 0 else None
-                    
-                    height_cmd = f'ffprobe -v error -select_streams v:0 -show_entries stream=height -of default=noprint_wrappers=1:nokey=1 "{VIDEO_PATH}"'
-                    height_result = subprocess.run(height_cmd, shell=True, capture_output=True, text=True, timeout=5)
-                    height = int(height_result.stdout.strip()) if height_result.returncode == 0 else None
+                    # Метаданные - из кэша media_registry (ffprobe - один раз на содержимое файла)
+                    metadata = await media_registry.video_metadata(VIDEO_PATH)
+                    duration = int(metadata.duration) if metadata and metadata.duration else None
+                    width = metadata.width if metadata else None
+                    height = metadata.height if metadata else None
                     
                     # Пробуем отправить как animation (GIF) для авто-воспроизведения в Desktop
                     # Но только если видео короткое и небольшое
@@ -1351,58 +1201,44 @@ async def cmd_start(message: Message):
                     if should_try_animation:
                         try:
                             print(f"🎬 Пробую отправить как animation для авто-воспроизведения...")
-                            await bot.send_animation(
+                            await media_registry.send(VIDEO_PATH, KIND_ANIMATION, lambda animation: bot.send_animation(
                                 chat_id=message.chat.id,
-                                animation=video_file,
+                                animation=animation,
                                 caption=welcome_text,
                                 parse_mode="HTML",
-                                reply_markup=await main_menu(message.from_user.id),
-                            )
+                                reply_markup=user_menu,
+                                request_timeout=TIMEOUT_LONG,
+                            ))
                             print(f"✅ Видео отправлено как animation для авто-воспроизведения: {VIDEO_PATH}")
                             return  # Успешно отправлено как animation
                         except Exception as anim_error:
                             print(f"⚠️ Не удалось отправить как animation: {anim_error}, отправляю как обычное видео")
                     
-                    # Отправляем как обычное видео с оптимизацией
-                    video_params = {
-                        "chat_id": message.chat.id,
-                        "video": video_file,
-                        "caption": welcome_text,
-                        "parse_mode": "HTML",
-                        "supports_streaming": True,  # Включаем потоковое воспроизведение
-                        "reply_markup": await main_menu(message.from_user.id),
-                    }
-                    
-                    # Добавляем метаданные видео для лучшей оптимизации
-                    if duration:
-                        video_params["duration"] = duration
-                    if width and height:
-                        video_params["width"] = width
-                        video_params["height"] = height
-                    
-                    await safe_send_video(
-                        bot=bot,
+                    # Отправляем как обычное видео с оптимизацией (метаданные - для лучшего отображения)
+                    await media_registry.send(VIDEO_PATH, KIND_VIDEO, lambda video: bot.send_video(
                         chat_id=message.chat.id,
-                        video=video_file,
+                        video=video,
                         caption=welcome_text,
                         parse_mode="HTML",
-                        reply_markup=await main_menu(message.from_user.id),
-                        width=width,
-                        height=height,
-                        duration=duration
-                    )
+                        supports_streaming=True,  # Включаем потоковое воспроизведение
+                        reply_markup=user_menu,
+                        width=width if width and height else None,
+                        height=height if width and height else None,
+                        duration=duration or None,
+                        request_timeout=TIMEOUT_LONG,
+                    ))
                     print(f"✅ Видео успешно отправлено из файла: {VIDEO_PATH}")
                 except Exception as meta_error:
                     # Если не удалось получить метаданные, отправляем без них
                     print(f"⚠️ Не удалось получить метаданные видео: {meta_error}, отправляю без них")
-                    await safe_send_video(
-                        bot=bot,
+                    await media_registry.send(VIDEO_PATH, KIND_VIDEO, lambda video: bot.send_video(
                         chat_id=message.chat.id,
-                        video=video_file,
+                        video=video,
                         caption=welcome_text,
                         parse_mode="HTML",
-                        reply_markup=await main_menu(message.from_user.id)
-                    )
+                        reply_markup=user_menu,
+                        request_timeout=TIMEOUT_LONG,
+                    ))
                     print(f"✅ Видео успешно отправлено из файла: {VIDEO_PATH}")
             return  # Прерываем выполнение, чтобы не отправлять дублирующее сообщение
         except Exception as e:
@@ -1499,10 +1335,7 @@ async def sub_status(message: Message):
     if await check_form_filled_and_block(message.from_user.id, message):
         return
     
-    # КРИТИЧЕСКИ ВАЖНО: Очищаем кэш перед получением данных, чтобы всегда показывать актуальную информацию
-    from db import _clear_cache
-    _clear_cache()
-    
+    # Кэш актуален: изменения из webhook_app.py инвалидируют его через cache_bus
     expires_at = await get_subscription_expires_at(message.from_user.id)
     
     if not expires_at:
@@ -1515,9 +1348,6 @@ async def sub_status(message: Message):
         )
         return
 
-    # Очищаем кэш еще раз перед получением starts_at
-    _clear_cache()
-    
     now = datetime.now(timezone.utc)
     expires_at = ensure_timezone_aware(expires_at)
     if expires_at and expires_at > now:
@@ -1564,7 +1394,6 @@ async def about(message: Message):
     
     # КРИТИЧЕСКИ ВАЖНО: Используем get_main_menu_for_user из webhook_app, чтобы меню было таким же,
     # как после оплаты. Это гарантирует, что меню не изменится при нажатии "О проекте"
-    from webhook_app import get_main_menu_for_user
     
     await message.answer(
         "📖 <b>О проекте</b>\n\n"
@@ -1588,6 +1417,8 @@ async def about(message: Message):
 @dp.message(lambda m: (m.text or "").strip() == BTN_BONUS_WEEK)
 async def bonus_week_info(message: Message):
     """Обработчик кнопки 'Бонус в честь запуск канала Наиля Хасанова'"""
+    # Клиент ЮKassa (SDK yookassa) загружается при первой оплате, а не при старте бота
+    from yookassa_async import create_payment, get_payment_url
     # Проверяем, заполнена ли форма
     if await check_form_filled_and_block(message.from_user.id, message):
         return
@@ -1690,14 +1521,13 @@ async def bonus_week_info(message: Message):
     if active_payment:
         # Используем существующий платеж
         payment_id, created_at = active_payment
-        pay_url = await maybe_await(get_payment_url, payment_id)
+        pay_url = await get_payment_url(payment_id)
     else:
         # Создаем новый платеж для бонусной недели
         return_url_with_user = get_return_url(message.from_user.id)
         bonus_duration_days = dni_prazdnika / 1440  # Конвертируем минуты в дни
         
-        payment_id, pay_url = await maybe_await(
-            create_payment,
+        payment_id, pay_url = await create_payment(
             amount_rub=BONUS_WEEK_PRICE_RUB,
             description=f"Бонусная неделя: Доступ к каналу ({format_subscription_duration(bonus_duration_days)})",
             return_url=return_url_with_user,
@@ -1787,6 +1617,7 @@ async def bonus_week_pay(message: Message, is_callback: bool = False):
         message: Сообщение или callback message
         is_callback: Если True, редактируем исходное сообщение вместо отправки нового
     """
+    from yookassa_async import create_payment, get_payment_url
     await ensure_user(message.from_user.id, message.from_user.username)
     if not is_callback:
         await send_typing_action(message.chat.id)
@@ -1801,17 +1632,17 @@ async def bonus_week_pay(message: Message, is_callback: bool = False):
         return
     
     # Проверяем активную подписку
-    expires_at = await get_subscription_expires_at(message.from_user.id)
+    state = await get_user_state(message.from_user.id)
     
     now = datetime.now(timezone.utc)
-    expires_at = ensure_timezone_aware(expires_at)
+    expires_at = ensure_timezone_aware(state.expires_at)
     if expires_at and expires_at > now:
         # У пользователя уже есть активная подписка
-        starts_at = await get_subscription_starts_at(message.from_user.id)
+        starts_at = state.starts_at
         starts_str = format_datetime_moscow(starts_at) if starts_at else "неизвестно"
         expires_str = format_datetime_moscow(expires_at)
         
-        auto_renewal_enabled = await is_auto_renewal_enabled(message.from_user.id)
+        auto_renewal_enabled = state.auto_renewal_enabled
         
         if auto_renewal_enabled:
             management_text = f"⚙️ Для управления доступом нажмите кнопку «{BTN_MANAGE_SUB}»"
@@ -1840,14 +1671,13 @@ async def bonus_week_pay(message: Message, is_callback: bool = False):
     if active_payment:
         # Используем существующий платеж
         payment_id, created_at = active_payment
-        pay_url = await maybe_await(get_payment_url, payment_id)
+        pay_url = await get_payment_url(payment_id)
     else:
         # Создаем новый платеж для бонусной недели
         return_url_with_user = get_return_url(message.from_user.id)
         bonus_duration_days = dni_prazdnika / 1440  # Конвертируем минуты в дни
         
-        payment_id, pay_url = await maybe_await(
-            create_payment,
+        payment_id, pay_url = await create_payment(
             amount_rub=BONUS_WEEK_PRICE_RUB,
             description=f"Бонусная неделя: Доступ к каналу ({format_subscription_duration(bonus_duration_days)})",
             return_url=return_url_with_user,
@@ -1933,6 +1763,7 @@ async def bonus_week_pay(message: Message, is_callback: bool = False):
 # Обработчик для кнопки "Получить доступ" (когда нет подписки)
 @dp.message(lambda m: (m.text or "").strip() == BTN_PAY_1)
 async def pay(message: Message):
+    from yookassa_async import create_payment, get_payment_url
     # Проверяем, заполнена ли форма
     if await check_form_filled_and_block(message.from_user.id, message):
         return
@@ -1941,17 +1772,17 @@ async def pay(message: Message):
     await send_typing_action(message.chat.id)
 
     # ПЕРВЫМ ДЕЛОМ проверяем активную подписку
-    expires_at = await get_subscription_expires_at(message.from_user.id)
+    state = await get_user_state(message.from_user.id)
     
     now = datetime.now(timezone.utc)
-    expires_at = ensure_timezone_aware(expires_at)
+    expires_at = ensure_timezone_aware(state.expires_at)
     if expires_at and expires_at > now:
-        starts_at = await get_subscription_starts_at(message.from_user.id)
+        starts_at = state.starts_at
         starts_str = format_datetime_moscow(starts_at) if starts_at else "неизвестно"
         expires_str = format_datetime_moscow(expires_at)
         
         # Проверяем, включено ли автопродление
-        auto_renewal_enabled = await is_auto_renewal_enabled(message.from_user.id)
+        auto_renewal_enabled = state.auto_renewal_enabled
         
         # Формируем текст в зависимости от статуса автопродления
         if auto_renewal_enabled:
@@ -1979,7 +1810,7 @@ async def pay(message: Message):
     if active_payment:
         payment_id, created_at = active_payment
         # Получаем ссылку на оплату для существующего платежа
-        pay_url = await maybe_await(get_payment_url, payment_id)
+        pay_url = await get_payment_url(payment_id)
         
         if pay_url:
             pay_button = InlineKeyboardButton(text="💳 Перейти к оплате", url=pay_url)
@@ -2003,8 +1834,7 @@ async def pay(message: Message):
     
     # Пытаемся создать платеж с возможностью сохранения способа оплаты для автопродления
     # Если магазин не настроен для автоплатежей, платеж будет создан без этого параметра
-    payment_id, pay_url = await maybe_await(
-        create_payment,
+    payment_id, pay_url = await create_payment(
         amount_rub=current_price,
         description=f"Доступ к каналу ({format_subscription_duration(current_duration)})",
         return_url=return_url_with_user,
@@ -2056,6 +1886,7 @@ async def pay(message: Message):
 
 @dp.message(lambda m: (m.text or "").strip() == BTN_CHECK_1)
 async def check_payment(message: Message):
+    from yookassa_async import get_payment_status
     # Проверяем, заполнена ли форма
     if await check_form_filled_and_block(message.from_user.id, message):
         return
@@ -2074,7 +1905,7 @@ async def check_payment(message: Message):
         )
         return
 
-    status = await maybe_await(get_payment_status, payment_id)
+    status = await get_payment_status(payment_id)
     await update_payment_status(payment_id, status)
 
     if status == "succeeded":
@@ -2241,13 +2072,10 @@ async def manage_subscription(message: Message):
     user_id = message.from_user.id
     await send_typing_action(message.chat.id)
     
-    # КРИТИЧЕСКИ ВАЖНО: Очищаем кэш перед проверкой, чтобы получить актуальные данные
-    # Это особенно важно после оплаты, когда автопродление только что было включено
-    from db import _clear_cache
-    _clear_cache()
-    
-    # Проверяем, есть ли активная подписка
-    expires_at = await get_subscription_expires_at(user_id)
+    # Кэш актуален и сразу после оплаты: webhook_app.py инвалидирует записи пользователя через cache_bus
+    # Проверяем, есть ли активная подписка (снимок состояния - одним запросом)
+    state = await get_user_state(user_id)
+    expires_at = state.expires_at
     from datetime import timezone
     now = datetime.now(timezone.utc)  # Используем timezone-aware datetime для правильного расчета
     
@@ -2256,9 +2084,8 @@ async def manage_subscription(message: Message):
         expires_at = expires_at.replace(tzinfo=timezone.utc)
     
     # КРИТИЧЕСКИ ВАЖНО: Получаем количество попыток автопродления для проверки, идут ли попытки
-    from db import get_auto_renewal_attempts, is_auto_renewal_enabled
-    attempts = await get_auto_renewal_attempts(user_id)
-    auto_renewal_enabled = await is_auto_renewal_enabled(user_id)
+    attempts = state.auto_renewal_attempts
+    auto_renewal_enabled = state.auto_renewal_enabled
     
     # Проверяем, активна ли бонусная неделя и идут ли попытки автопродления
     from config import get_bonus_week_end, is_bonus_week_active
@@ -2303,7 +2130,6 @@ async def manage_subscription(message: Message):
         return
     elif not has_active_subscription:
         # Подписка истекла и попытки не идут - показываем обычное сообщение
-        from webhook_app import get_main_menu_for_user
         menu = await get_main_menu_for_user(user_id)
         await message.answer(
             "ℹ️ <b>У вас нет активного доступа</b>\n\n"
@@ -2314,7 +2140,7 @@ async def manage_subscription(message: Message):
         return
     
     # Получаем информацию о подписке
-    starts_at = await get_subscription_starts_at(user_id)
+    starts_at = state.starts_at
     starts_str = format_datetime_moscow(starts_at) if starts_at else "неизвестно"
     expires_str = format_datetime_moscow(expires_at)
     
@@ -2518,9 +2344,8 @@ async def back_to_main_menu(message: Message):
         return
     
     user_id = message.from_user.id
-    # КРИТИЧЕСКИ ВАЖНО: Используем get_main_menu_for_user из webhook_app для единообразия логики
+    # КРИТИЧЕСКИ ВАЖНО: Используем get_main_menu_for_user из core.py (его же использует webhook_app) для единообразия логики
     # Это гарантирует правильное меню во время попыток автопродления
-    from webhook_app import get_main_menu_for_user
     await message.answer(
         "📋 <b>Главное меню</b>",
         parse_mode="HTML",
@@ -2651,18 +2476,18 @@ async def cancel_subscription(message: Message):
     user_id = message.from_user.id
     await send_typing_action(message.chat.id)
     
-    # Проверяем, есть ли активная подписка
-    expires_at = await get_subscription_expires_at(user_id)
+    # Проверяем, есть ли активная подписка (снимок состояния - одним запросом)
+    state = await get_user_state(user_id)
     from datetime import timezone
     now = datetime.now(timezone.utc)
     
     # Убеждаемся, что expires_at имеет timezone для сравнения
-    expires_at = ensure_timezone_aware(expires_at)
+    expires_at = ensure_timezone_aware(state.expires_at)
     
     # КРИТИЧЕСКИ ВАЖНО: Проверяем, включено ли автопродление и идут ли попытки
-    from db import is_auto_renewal_enabled, get_auto_renewal_attempts, reset_auto_renewal_attempts
-    auto_renewal_enabled = await is_auto_renewal_enabled(user_id)
-    attempts = await get_auto_renewal_attempts(user_id)
+    from db import reset_auto_renewal_attempts
+    auto_renewal_enabled = state.auto_renewal_enabled
+    attempts = state.auto_renewal_attempts
     
     # Проверяем, идут ли попытки автопродления
     has_active_subscription = expires_at and expires_at > now
@@ -2691,14 +2516,13 @@ async def cancel_subscription(message: Message):
     card_removed = await delete_payment_method(user_id)
     
     # Очищаем кэш для обновления меню
-    from db import _clear_cache
-    _clear_cache()
+    from db import invalidate_user_cache
+    invalidate_user_cache(user_id)
     
     # Получаем информацию о подписке
     expires_str = format_datetime_moscow(expires_at) if expires_at else "неизвестно"
     
     # Получаем актуальное меню после отключения автопродления
-    from webhook_app import get_main_menu_for_user
     updated_menu = await get_main_menu_for_user(user_id)
     
     # Формируем сообщение об отвязке карты
@@ -2922,6 +2746,7 @@ async def approve_join_request(join_request: ChatJoinRequest):
                 # У пользователя есть активная подписка - одобряем заявку
                 try:
                     await join_request.approve()
+                    await set_channel_member_status(user_id, ChatMemberStatus.MEMBER, "join_request")
                     print(f"✅ Автоматически одобрена заявка от пользователя {user_id} (активная подписка до {expires_at})")
                 except Exception as e:
                     print(f"❌ Ошибка при одобрении заявки от {user_id}: {e}")
@@ -2939,6 +2764,7 @@ async def approve_join_request(join_request: ChatJoinRequest):
             if await is_user_allowed(user_id):
                 try:
                     await join_request.approve()
+                    await set_channel_member_status(user_id, ChatMemberStatus.MEMBER, "join_request")
                     print(f"✅ Автоматически одобрена заявка от пользователя {user_id} (старый способ проверки)")
                 except Exception as e:
                     print(f"❌ Ошибка при одобрении заявки от {user_id}: {e}")
@@ -2950,6 +2776,19 @@ async def approve_join_request(join_request: ChatJoinRequest):
                     print(f"⚠️ Ошибка при отклонении заявки от {user_id}: {e}")
 
 
+# Пользователь заблокировал / разблокировал бота - обновляем user_reachability
+@dp.my_chat_member()
+async def on_my_chat_member_update(update: ChatMemberUpdated):
+    """Доступность личного чата: kicked - бот заблокирован, member - снова можно писать"""
+    if update.chat.type != "private":
+        return
+    status = update.new_chat_member.status
+    if status == ChatMemberStatus.KICKED:
+        await mark_user_unreachable(update.chat.id, REACHABILITY_BLOCKED, "my_chat_member: kicked")
+    elif status == ChatMemberStatus.MEMBER:
+        await mark_user_reachable(update.chat.id)
+
+
 # Обработчик присоединения пользователей к каналу - дополнительная проверка безопасности
 @dp.chat_member()
 async def on_chat_member_update(update: ChatMemberUpdated):
@@ -2958,6 +2797,12 @@ async def on_chat_member_update(update: ChatMemberUpdated):
     if update.chat.id != CHANNEL_ID:
         return
     
+    # Таблица channel_members: фоновые задачи webhook_app.py читают статус оттуда, а не через get_chat_member
+    try:
+        await set_channel_member_status(update.new_chat_member.user.id, update.new_chat_member.status, "chat_member")
+    except Exception as e:
+        logger_bot.warning(f"⚠️ Не удалось сохранить статус участника канала {update.new_chat_member.user.id}: {e}")
+    
     # Проверяем, что пользователь присоединился (стал member)
     if update.new_chat_member.status == ChatMemberStatus.MEMBER:
         user_id = update.new_chat_member.user.id
@@ -2991,7 +2836,7 @@ async def on_chat_member_update(update: ChatMemberUpdated):
             
             # Отмечаем, что напоминание больше не нужно (пользователь вступил в канал)
             try:
-                async with aiosqlite.connect(DB_PATH) as db:
+                async with db_write() as db:
                     await db.execute(
                         "UPDATE invite_links SET reminder_sent = 1 WHERE telegram_user_id = ? AND reminder_sent = 0",
                         (user_id,)
@@ -3002,8 +2847,12 @@ async def on_chat_member_update(update: ChatMemberUpdated):
                 logger_bot.warning(f"⚠️ Не удалось обновить reminder_sent для пользователя {user_id}: {e}")
 
 
-async def main():
-    await init_db()
+async def start_bot_services() -> None:
+    """Фоновые службы бота: и при polling (main), и в объединенном режиме (webhook_app.py)"""
+    # Продолжаем рассылки, прерванные перезапуском
+    await broadcast_engine.resume()
+    # Хэши и метаданные приветственных видео - заранее, в фоне (первый /start не ждет ffprobe)
+    asyncio.create_task(media_registry.warm_up([WELCOME_VIDEO_RECORDING_PATH, WELCOME_VIDEO_PATH, WELCOME_VIDEO_GIF_PATH]))
     # Получаем имя бота из API для обновления RETURN_URL
     try:
         bot_info = await bot.get_me()
@@ -3013,6 +2862,19 @@ async def main():
         print(f"✅ Имя бота получено: @{BOT_USERNAME}")
     except Exception as e:
         print(f"⚠️ Не удалось получить имя бота из API: {e}, используем из .env")
+
+
+async def stop_bot_services() -> None:
+    await broadcast_engine.stop()
+
+
+async def main():
+    if BOT_UPDATES_MODE == "webhook":
+        raise SystemExit("BOT_UPDATES_MODE=webhook: обновления принимает webhook_app.py, bot.py отдельно не запускается - отключите telegram-bot.service (DEPLOYMENT.md)")
+    # Открываем пул соединений с БД (один раз на процесс)
+    await init_pool()
+    await init_db()
+    await start_bot_services()
     
     # КРИТИЧЕСКИ ВАЖНО: Удаляем webhook перед запуском polling
     # Иначе будет конфликт - нельзя использовать getUpdates пока активен webhook
@@ -3022,7 +2884,15 @@ async def main():
     except Exception as e:
         print(f"⚠️ Ошибка при удалении webhook: {e}")
     
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await stop_bot_services()
+        # Клиент ЮKassa есть, только если в этом процессе были оплаты
+        yookassa_async = sys.modules.get("yookassa_async")
+        if yookassa_async is not None:
+            await yookassa_async.close_yookassa_client()
+        await close_pool()
 
 
 if __name__ == "__main__":
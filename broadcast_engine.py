@@ -0,0 +1,349 @@
+"""
+Рассылки видео-обновления (/send_update, /send_update_from_excel)
+Задание и итоги по получателям хранятся в БД (broadcast_jobs, broadcast_recipients), незавершенные задания
+продолжаются после перезапуска; прогресс - одно редактируемое сообщение администратора
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Optional, Union
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+)
+from aiogram.types import ReplyKeyboardMarkup
+
+from config import (
+    BROADCAST_CONCURRENCY,
+    BROADCAST_MAX_ATTEMPTS,
+    BROADCAST_PROGRESS_INTERVAL_SECONDS,
+)
+from db import db_read, db_write
+from media_registry import media_registry, KIND_VIDEO
+from telegram_utils import send_priority, PRIORITY_BROADCAST, TIMEOUT_LONG
+
+logger = logging.getLogger(__name__)
+
+KIND_USERS = "users"  # Получатели - telegram_id из БД, меню персональное
+KIND_USERNAMES = "usernames"  # Получатели - @username из Excel, меню по умолчанию
+
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+
+STATUS_PENDING = "pending"
+STATUS_DELIVERED = "delivered"
+STATUS_BLOCKED = "blocked"
+STATUS_NOT_FOUND = "not_found"
+STATUS_FAILED = "failed"
+
+RESULT_STATUSES = (STATUS_DELIVERED, STATUS_BLOCKED, STATUS_NOT_FOUND, STATUS_FAILED)
+
+
+async def init_broadcast_tables(db) -> None:
+    """Создает таблицы заданий рассылки (вызывается из migrations.py)"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            text TEXT NOT NULL,
+            video_path TEXT NOT NULL,
+            admin_chat_id INTEGER NOT NULL,
+            progress_message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL,
+            created_at TEXT NOT NULL,
+            finished_at TEXT
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id INTEGER NOT NULL,
+            recipient TEXT NOT NULL,
+            chat_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            sent_at TEXT,
+            PRIMARY KEY (job_id, recipient),
+            FOREIGN KEY (job_id) REFERENCES broadcast_jobs(id)
+        )
+    """)
+    # Выборка следующей пачки получателей задания (rowid входит в индекс - ORDER BY rowid без сортировки)
+    await db.execute(
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending "
+        "ON broadcast_recipients(job_id) WHERE status = 'pending'"
+    )
+
+
+async def create_broadcast_job(
+    kind: str,
+    text: str,
+    video_path: str,
+    admin_chat_id: int,
+    recipients: list[Union[int, str]],
+) -> int:
+    """Сохраняет задание и его получателей (повторы в списке схлопываются); возвращает id задания"""
+    unique_recipients = list(dict.fromkeys(str(r) for r in recipients))
+    now = datetime.now(timezone.utc).isoformat()
+    async with db_write() as db:
+        cur = await db.execute(
+            """
+            INSERT INTO broadcast_jobs (kind, text, video_path, admin_chat_id, status, total, created_at)
+            VALUES (?, ?, ?, ?, 'running', ?, ?)
+            """,
+            (kind, text, video_path, admin_chat_id, len(unique_recipients), now)
+        )
+        job_id = cur.lastrowid
+        await db.executemany(
+            "INSERT INTO broadcast_recipients (job_id, recipient, chat_id) VALUES (?, ?, ?)",
+            [(job_id, r, int(r) if kind == KIND_USERS else None) for r in unique_recipients]
+        )
+        # Заблокировавшие бота (user_reachability) сразу получают итог blocked - без запроса к Telegram
+        await db.execute(
+            """
+            UPDATE broadcast_recipients SET status = 'blocked', error = 'user_reachability'
+            WHERE job_id = ? AND chat_id IN (SELECT telegram_id FROM user_reachability)
+            """,
+            (job_id,)
+        )
+        await db.commit()
+    return job_id
+
+
+async def get_broadcast_counts(job_id: int) -> dict[str, int]:
+    """Число получателей задания по статусам"""
+    counts = {STATUS_PENDING: 0, **{status: 0 for status in RESULT_STATUSES}}
+    async with db_read() as db:
+        cur = await db.execute(
+            "SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY status",
+            (job_id,)
+        )
+        for status, count in await cur.fetchall():
+            counts[status] = count
+    return counts
+
+
+def _format_progress(job: dict, counts: dict[str, int], finished: bool, elapsed: float) -> str:
+    done = sum(counts[status] for status in RESULT_STATUSES)
+    header = "✅ <b>Рассылка завершена!</b>" if finished else "⏳ <b>Идет рассылка обновления</b>"
+    lines = [
+        f"{header} (#{job['id']})\n",
+        f"📈 Обработано: {done}/{job['total']}",
+        f"✅ Успешно: {counts[STATUS_DELIVERED]}",
+        f"🚫 Заблокировали бота: {counts[STATUS_BLOCKED]}",
+    ]
+    if job["kind"] == KIND_USERNAMES or counts[STATUS_NOT_FOUND]:
+        lines.append(f"🔍 Пользователь не найден: {counts[STATUS_NOT_FOUND]}")
+    lines.append(f"❌ Ошибки: {counts[STATUS_FAILED]}")
+    if not finished and done and elapsed > 0:
+        rate = done / elapsed
+        lines.append(f"\n⚡ {rate:.1f} сообщ./с, осталось ~{int((job['total'] - done) / rate)} с")
+    return "\n".join(lines)
+
+
+class BroadcastEngine:
+    """Выполняет задания рассылки: параллельная отправка, итоги в БД, прогресс в сообщении администратора"""
+
+    def __init__(
+        self,
+        bot: Bot,
+        menu_factory: Callable[[Optional[int]], Awaitable[ReplyKeyboardMarkup]],
+        concurrency: int = BROADCAST_CONCURRENCY,
+    ):
+        self.bot = bot
+        self._menu_factory = menu_factory
+        self.concurrency = concurrency
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def start(self, job_id: int) -> bool:
+        """Запускает задание в фоне; False - оно уже выполняется"""
+        if job_id in self._tasks:
+            return False
+        # Все сообщения рассылки (и задачи, созданные внутри) - с приоритетом рассылки
+        with send_priority(PRIORITY_BROADCAST):
+            task = asyncio.create_task(self._run_job(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job_id, None))
+        return True
+
+    async def resume(self) -> int:
+        """Продолжает задания, прерванные перезапуском; возвращает их число
+        Получатель, которому отправка шла в момент падения, получит сообщение повторно"""
+        async with db_read() as db:
+            cur = await db.execute("SELECT id FROM broadcast_jobs WHERE status = ? ORDER BY id", (JOB_RUNNING,))
+            job_ids = [row[0] for row in await cur.fetchall()]
+        for job_id in job_ids:
+            logger.info(f"🔄 Продолжаю рассылку #{job_id} после перезапуска")
+            self.start(job_id)
+        return len(job_ids)
+
+    async def stop(self) -> None:
+        """Останавливает рассылки; неотправленные получатели останутся pending до resume"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _load_job(self, job_id: int) -> Optional[dict]:
+        async with db_read() as db:
+            cur = await db.execute(
+                "SELECT id, kind, text, video_path, admin_chat_id, progress_message_id, total "
+                "FROM broadcast_jobs WHERE id = ?",
+                (job_id,)
+            )
+            row = await cur.fetchone()
+        if row is None:
+            return None
+        keys = ("id", "kind", "text", "video_path", "admin_chat_id", "progress_message_id", "total")
+        return dict(zip(keys, row))
+
+    async def _fetch_pending(self, job_id: int, limit: int) -> list[tuple[str, Optional[int], int]]:
+        async with db_read() as db:
+            cur = await db.execute(
+                "SELECT recipient, chat_id, attempts FROM broadcast_recipients "
+                "WHERE job_id = ? AND status = 'pending' ORDER BY rowid LIMIT ?",
+                (job_id, limit)
+            )
+            return await cur.fetchall()
+
+    async def _run_job(self, job_id: int) -> None:
+        try:
+            job = await self._load_job(job_id)
+            if job is None:
+                logger.error(f"❌ Рассылка #{job_id} не найдена")
+                return
+            started = time.monotonic()
+            last_progress = 0.0
+            await self._report(job, finished=False, elapsed=0.0)
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            async def deliver(recipient: str, chat_id: Optional[int], attempts: int):
+                async with semaphore:
+                    return (recipient, *await self._deliver(job, recipient, chat_id, attempts))
+
+            while True:
+                batch = await self._fetch_pending(job_id, self.concurrency * 4)
+                if not batch:
+                    break
+                results = await asyncio.gather(*(deliver(*row) for row in batch))
+                await self._save_results(job_id, results)
+                if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL_SECONDS:
+                    last_progress = time.monotonic()
+                    await self._report(job, finished=False, elapsed=last_progress - started)
+
+            async with db_write() as db:
+                await db.execute(
+                    "UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ?",
+                    (JOB_DONE, datetime.now(timezone.utc).isoformat(), job_id)
+                )
+                await db.commit()
+            counts = await self._report(job, finished=True, elapsed=time.monotonic() - started)
+            logger.info(
+                f"✅ Рассылка #{job_id} завершена за {time.monotonic() - started:.1f} с: "
+                + ", ".join(f"{status}={counts[status]}" for status in RESULT_STATUSES)
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка рассылки #{job_id}: {e}", exc_info=True)
+
+    async def _save_results(self, job_id: int, results: list[tuple]) -> None:
+        now = datetime.now(timezone.utc).isoformat()
+        async with db_write() as db:
+            await db.executemany(
+                "UPDATE broadcast_recipients SET status = ?, chat_id = COALESCE(?, chat_id), attempts = ?, "
+                "error = ?, sent_at = ? WHERE job_id = ? AND recipient = ?",
+                [
+                    (status, chat_id, attempts, error, now if status == STATUS_DELIVERED else None, job_id, recipient)
+                    for recipient, status, chat_id, attempts, error in results
+                ]
+            )
+            await db.commit()
+
+    async def _resolve_chat_id(self, recipient: str) -> Union[int, str]:
+        """@username -> chat_id; если Telegram не отдает чат, отправляем по username напрямую"""
+        try:
+            return (await self.bot.get_chat(recipient)).id
+        except TelegramRetryAfter:
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось получить chat для {recipient}, пробую отправить напрямую: {e}")
+            return recipient
+
+    async def _deliver(
+        self, job: dict, recipient: str, chat_id: Optional[int], attempts: int
+    ) -> tuple[str, Optional[int], int, Optional[str]]:
+        """Отправляет видео одному получателю; возвращает (статус, chat_id, попытки, ошибка)"""
+        error: Optional[str] = None
+        while attempts < BROADCAST_MAX_ATTEMPTS:
+            attempts += 1
+            try:
+                target = chat_id if chat_id is not None else await self._resolve_chat_id(recipient)
+                if isinstance(target, int):
+                    chat_id = target
+                menu = await self._menu_factory(chat_id if job["kind"] == KIND_USERS else None)
+                await self._send_video(job, target, menu)
+                return STATUS_DELIVERED, chat_id, attempts, None
+            except TelegramRetryAfter as e:
+                # Планировщик уже притормозил отправку; сама попытка не считается
+                attempts -= 1
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError as e:
+                return STATUS_BLOCKED, chat_id, attempts, str(e)[:500]
+            except TelegramBadRequest as e:
+                message = str(e).lower()
+                if "not found" in message or "deactivated" in message:
+                    return STATUS_NOT_FOUND, chat_id, attempts, str(e)[:500]
+                return STATUS_FAILED, chat_id, attempts, str(e)[:500]
+            except TelegramNetworkError as e:
+                error = str(e)[:500]
+                await asyncio.sleep(2 * attempts)
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка рассылки #{job['id']} получателю {recipient}: {e}")
+                return STATUS_FAILED, chat_id, attempts, str(e)[:500]
+        return STATUS_FAILED, chat_id, attempts, error
+
+    async def _send_video(self, job: dict, chat_id: Union[int, str], menu: ReplyKeyboardMarkup) -> None:
+        # Видео загружается один раз (media_registry), остальным получателям - по file_id
+        await media_registry.send(job["video_path"], KIND_VIDEO, lambda video: self.bot.send_video(
+            chat_id=chat_id,
+            video=video,
+            caption=job["text"],
+            parse_mode="HTML",
+            reply_markup=menu,
+            request_timeout=TIMEOUT_LONG,
+        ))
+
+    async def _report(self, job: dict, finished: bool, elapsed: float) -> dict[str, int]:
+        """Создает или обновляет сообщение администратора с прогрессом"""
+        counts = await get_broadcast_counts(job["id"])
+        text = _format_progress(job, counts, finished, elapsed)
+        try:
+            if job["progress_message_id"] is None:
+                sent = await self.bot.send_message(job["admin_chat_id"], text, parse_mode="HTML")
+                job["progress_message_id"] = sent.message_id
+                async with db_write() as db:
+                    await db.execute(
+                        "UPDATE broadcast_jobs SET progress_message_id = ? WHERE id = ?",
+                        (sent.message_id, job["id"])
+                    )
+                    await db.commit()
+            else:
+                await self.bot.edit_message_text(
+                    text, chat_id=job["admin_chat_id"], message_id=job["progress_message_id"], parse_mode="HTML"
+                )
+        except TelegramBadRequest as e:
+            if "not modified" not in str(e).lower():
+                logger.warning(f"⚠️ Не удалось обновить прогресс рассылки #{job['id']}: {e}")
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось обновить прогресс рассылки #{job['id']}: {e}")
+        return counts
+
+    def stats(self) -> dict:
+        return {"running_jobs": sorted(self._tasks), "concurrency": self.concurrency}
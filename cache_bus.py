@@ -0,0 +1,153 @@
+"""
+Межпроцессная инвалидация кэша
+bot.py (polling) и webhook_app.py (uvicorn) - разные процессы со своими кэшами в db.py.
+Процесс, изменивший данные пользователя, пишет тег ("user:123") в таблицу cache_invalidations,
+а остальные процессы дешево следят за PRAGMA data_version на отдельном соединении и, когда
+в БД кто-то закоммитил изменения, дочитывают новые записи журнала и удаляют свои записи кэша.
+Задержка распространения - порядка CACHE_BUS_POLL_SECONDS.
+"""
+import asyncio
+import logging
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+
+import aiosqlite
+
+from config import CACHE_BUS_POLL_SECONDS, CACHE_BUS_RETENTION_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Тег "очистить весь кэш"
+CLEAR_ALL_TAG = "*"
+
+
+class CacheInvalidationBus:
+    """Журнал инвалидаций в SQLite + опрос PRAGMA data_version"""
+
+    def __init__(self, on_invalidate: Callable[[str], object], poll_interval: float = CACHE_BUS_POLL_SECONDS):
+        self._on_invalidate = on_invalidate
+        self.poll_interval = poll_interval
+        # Идентификатор процесса: свои же записи журнала не применяем повторно
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._conn: Optional[aiosqlite.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pending: set[str] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = False
+        self._last_id = 0
+        self._data_version: Optional[int] = None
+        self._last_prune = 0.0
+        self.published = 0
+        self.received = 0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self, connect: Callable[[], Awaitable[aiosqlite.Connection]]) -> None:
+        """Открывает отдельное соединение и запускает фоновую задачу"""
+        if self.running:
+            return
+        # Таблица cache_invalidations создается миграцией (migrations.py)
+        self._conn = await connect()
+        cur = await self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM cache_invalidations")
+        self._last_id = (await cur.fetchone())[0]
+        self._data_version = await self._read_data_version()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"✅ Шина инвалидации кэша запущена (процесс {self.origin})")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            # Останавливаем флагом, а не cancel(): wait_for в 3.11 может проглотить отмену,
+            # если событие сработало одновременно с ней
+            self._stopping = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if self._conn is not None:
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось отправить последние инвалидации кэша: {e}")
+            await self._conn.close()
+            self._conn = None
+
+    def publish(self, tag: str) -> None:
+        """Сообщает другим процессам, что записи с тегом устарели (отправка - в фоновой задаче)"""
+        if not self.running:
+            return
+        self._pending.add(tag)
+        self._wakeup.set()
+
+    async def _read_data_version(self) -> int:
+        cur = await self._conn.execute("PRAGMA data_version")
+        return (await cur.fetchone())[0]
+
+    async def _flush(self) -> None:
+        if not self._pending:
+            return
+        tags, self._pending = self._pending, set()
+        if CLEAR_ALL_TAG in tags:
+            tags = {CLEAR_ALL_TAG}
+        now = time.time()
+        try:
+            await self._conn.executemany(
+                "INSERT INTO cache_invalidations (tag, origin, created_at) VALUES (?, ?, ?)",
+                [(tag, self.origin, now) for tag in tags]
+            )
+            await self._conn.commit()
+            self.published += len(tags)
+        except Exception:
+            self._pending |= tags
+            raise
+
+    async def _poll(self) -> None:
+        # data_version меняется, только когда изменения закоммитило другое соединение
+        data_version = await self._read_data_version()
+        if data_version == self._data_version:
+            return
+        self._data_version = data_version
+        cur = await self._conn.execute(
+            "SELECT id, tag, origin FROM cache_invalidations WHERE id > ? ORDER BY id",
+            (self._last_id,)
+        )
+        for row_id, tag, origin in await cur.fetchall():
+            self._last_id = row_id
+            if origin == self.origin:
+                continue
+            self.received += 1
+            self._on_invalidate(tag)
+
+    async def _prune(self) -> None:
+        now = time.time()
+        if now - self._last_prune < CACHE_BUS_RETENTION_SECONDS:
+            return
+        self._last_prune = now
+        await self._conn.execute(
+            "DELETE FROM cache_invalidations WHERE created_at < ?",
+            (now - CACHE_BUS_RETENTION_SECONDS,)
+        )
+        await self._conn.commit()
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                if self._stopping:
+                    return
+                await self._flush()
+                await self._poll()
+                await self._prune()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка шины инвалидации кэша: {e}")
+                await asyncio.sleep(self.poll_interval)
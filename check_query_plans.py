@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Регрессионная проверка планов горячих фоновых запросов (EXPLAIN QUERY PLAN)
+Создает временную БД через migrations.py, заполняет ее данными и проверяет, что каждый запрос
+идет по ожидаемому индексу, а не полным сканированием таблицы.
+
+SQL запросов - общие константы queries.py, которые выполняют webhook_app.py / db.py / webhook_inbox.py /
+invite_link_pool.py, поэтому проверяется тот же SQL, что работает. Новый горячий запрос - в queries.py и сюда.
+
+Запуск: python check_query_plans.py  (код выхода 1, если хотя бы один запрос сканирует таблицу)
+"""
+import asyncio
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import aiosqlite
+
+import queries
+from epoch_columns import to_epoch_ms
+from migrations import migrate_database
+
+ROWS = 3000
+
+NOW_MS = to_epoch_ms(datetime.now(timezone.utc))
+HOUR_MS = 60 * 60 * 1000
+
+# (название, SQL, параметры, ожидаемый индекс) - SQL берется из queries.py, тот же, что выполняется в коде
+HOT_QUERIES = [
+    (
+        "get_expired_pending_payments",
+        queries.EXPIRED_PENDING_PAYMENTS,
+        (NOW_MS - HOUR_MS // 6, NOW_MS - 24 * HOUR_MS),
+        "idx_payments_pending_created_ms",
+    ),
+    (
+        "load_subscription_deadlines (старт)",
+        queries.SUBSCRIPTION_DEADLINES,
+        (),
+        "idx_subscriptions_unnotified_expires_ms",
+    ),
+    (
+        "load_subscription_deadlines (сверка)",
+        queries.SUBSCRIPTION_DEADLINES + queries.SUBSCRIPTION_DEADLINES_UNTIL,
+        (NOW_MS + HOUR_MS,),
+        "idx_subscriptions_unnotified_expires_ms",
+    ),
+    (
+        "get_expired_subscriptions",
+        queries.EXPIRED_SUBSCRIPTIONS,
+        (NOW_MS - 1000 * HOUR_MS,),
+        "idx_subscriptions_expires_at_ms",
+    ),
+    (
+        "get_subscriptions_expiring_soon",
+        queries.SUBSCRIPTIONS_EXPIRING_SOON,
+        (NOW_MS + 2 * HOUR_MS, NOW_MS + 26 * HOUR_MS),
+        "idx_subscriptions_",
+    ),
+    (
+        "check_channel_join_reminders",
+        queries.CHANNEL_JOIN_REMINDERS,
+        (NOW_MS - HOUR_MS, NOW_MS),
+        "idx_invite_links_reminder_due_ms",
+    ),
+    (
+        "reconcile_channel_members",
+        queries.CHANNEL_MEMBERS_TO_RECONCILE,
+        (NOW_MS, NOW_MS - 24 * HOUR_MS, 100),
+        "idx_subscriptions_",
+    ),
+    (
+        "InviteLinkPool.take (ссылка за этот платеж)",
+        queries.INVITE_LINK_FOR_PAYMENT,
+        (7, "pay7"),
+        "idx_invite_links_user_id",
+    ),
+    (
+        "InviteLinkPool.take",
+        queries.INVITE_LINK_POOL_TAKE,
+        ("assigned", 7, "pay7", datetime.now(timezone.utc).isoformat(), NOW_MS, NOW_MS + HOUR_MS, 1, "pool"),
+        "idx_invite_links_pool",
+    ),
+    (
+        "InviteLinkPool.apply_expire_dates",
+        queries.INVITE_LINK_EXPIRE_PENDING,
+        (),
+        "idx_invite_links_expire_pending",
+    ),
+    (
+        "check_bonus_week_transition_to_production",
+        queries.BONUS_WEEK_SUBSCRIPTIONS,
+        (),
+        "idx_subscriptions_started_ms",
+    ),
+    (
+        "get_active_pending_payment",
+        queries.ACTIVE_PENDING_PAYMENT,
+        (7, NOW_MS - HOUR_MS // 6),
+        "idx_payments_",
+    ),
+    (
+        "get_all_active_subscriptions",
+        queries.ACTIVE_SUBSCRIPTIONS,
+        (NOW_MS,),
+        "idx_subscriptions_",
+    ),
+    (
+        "get_all_active_subscriptions (рассылка)",
+        queries.ACTIVE_SUBSCRIPTIONS + queries.ACTIVE_SUBSCRIPTIONS_REACHABLE_ONLY,
+        (NOW_MS,),
+        "idx_subscriptions_",
+    ),
+    (
+        "cleanup_old_payments",
+        queries.CLEANUP_OLD_PAYMENTS,
+        (NOW_MS - 90 * 24 * HOUR_MS,),
+        "idx_payments_created_at_ms",
+    ),
+    (
+        "cleanup_old_processed_payments",
+        queries.CLEANUP_OLD_PROCESSED_PAYMENTS,
+        (NOW_MS - 90 * 24 * HOUR_MS,),
+        "idx_processed_payments_processed_at_ms",
+    ),
+    (
+        "WebhookInbox._fetch_ready",
+        queries.WEBHOOK_INBOX_READY,
+        (datetime.now(timezone.utc).isoformat(), 16),
+        "idx_webhook_inbox_status",
+    ),
+]
+
+# Полное сканирование таблицы: "SCAN payments" / "SCAN s" без "USING ... INDEX"
+_FULL_SCAN = re.compile(r"^SCAN \w+$")
+
+
+async def seed(db) -> None:
+    """Данные примерно в пропорциях рабочей БД: большинство подписок истекло, мало pending-платежей"""
+    now = datetime.now(timezone.utc)
+    users, subs, payments, links, inbox = [], [], [], [], []
+    for i in range(ROWS):
+        expires_at = now + timedelta(hours=i % 720 - 600)
+        starts_at = expires_at - timedelta(days=30) if i % 3 else None
+        created_at = now - timedelta(minutes=i * 7)
+        users.append((i, f"user{i}", created_at.isoformat(), i % 2))
+        subs.append((
+            i, expires_at.isoformat(), starts_at.isoformat() if starts_at else None,
+            to_epoch_ms(expires_at), to_epoch_ms(starts_at), int(expires_at < now),
+        ))
+        status = "pending" if i % 20 == 0 else ("succeeded" if i % 2 else "canceled")
+        payments.append((i, f"pay{i}", status, created_at.isoformat(), to_epoch_ms(created_at)))
+        links.append((f"https://t.me/+link{i}", i, f"pay{i}", created_at.isoformat(), to_epoch_ms(created_at), int(i % 4 == 0), int(i % 2 == 0), "assigned"))
+        if i % 100 == 0:
+            links.append((f"https://t.me/+pool{i}", None, None, created_at.isoformat(), to_epoch_ms(created_at), 0, 0, "pool"))
+        inbox.append(("payment.succeeded", f"pay{i}", f"user:{i % 300}", "{}", "done" if i % 10 else "pending",
+                       now.isoformat(), now.isoformat()))
+    await db.executemany("INSERT INTO users (telegram_id, username, created_at, form_filled) VALUES (?, ?, ?, ?)", users)
+    await db.executemany(
+        "INSERT INTO subscriptions (telegram_id, expires_at, starts_at, expires_at_ms, starts_at_ms, subscription_expired_notified) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        subs
+    )
+    await db.executemany(
+        "INSERT INTO payments (telegram_id, payment_id, status, created_at, created_at_ms) VALUES (?, ?, ?, ?, ?)",
+        payments
+    )
+    await db.executemany(
+        "INSERT INTO invite_links (invite_link, telegram_user_id, payment_id, created_at, created_at_ms, revoked, reminder_sent, state) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        links
+    )
+    await db.executemany(
+        "INSERT INTO processed_payments (payment_id, processed_at, processed_at_ms) VALUES (?, ?, ?)",
+        [(p[1], p[3], p[4]) for p in payments if p[2] == "succeeded"]
+    )
+    await db.executemany(
+        "INSERT INTO webhook_inbox (event, object_id, order_key, payload, status, next_attempt_at, received_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        inbox
+    )
+    await db.commit()
+
+
+async def explain(db, sql: str, params) -> list[str]:
+    cur = await db.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+    return [row[3] for row in await cur.fetchall()]
+
+
+async def main() -> int:
+    path = os.path.join(tempfile.mkdtemp(prefix="query_plans_"), "plans.db")
+    await migrate_database(path)
+    failures = 0
+    async with aiosqlite.connect(path) as db:
+        await seed(db)
+        print("=" * 100)
+        print(f"🔍 ПЛАНЫ ГОРЯЧИХ ЗАПРОСОВ ({ROWS} строк в каждой таблице, без ANALYZE)")
+        print("=" * 100)
+        for name, sql, params, expected_index in HOT_QUERIES:
+            plan = await explain(db, sql, params)
+            problems = [step for step in plan if _FULL_SCAN.match(step)]
+            if not any(expected_index in step for step in plan):
+                problems.append(f"не используется индекс {expected_index}")
+            status = "❌" if problems else "✅"
+            failures += bool(problems)
+            print(f"{status} {name}")
+            for step in plan:
+                print(f"      {step}")
+            for problem in problems:
+                print(f"   ⚠️ {problem}")
+    print("=" * 100)
+    if failures:
+        print(f"❌ Запросов с полным сканированием или без ожидаемого индекса: {failures}")
+        return 1
+    print("✅ Все горячие запросы идут по индексам")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
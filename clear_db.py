@@ -5,10 +5,13 @@
 
 Для полной очистки БД (для тестов) используйте флаг --full
 """
+import asyncio
 import os
 import sqlite3
 import sys
 
+from migrations import migrate_database
+
 # Пытаемся загрузить .env, но не падаем если его нет
 try:
     from dotenv import load_dotenv
@@ -23,64 +26,14 @@ FULL_CLEAR = "--full" in sys.argv or "-f" in sys.argv
 
 def clear_old_data():
     """Очищает старые данные из БД"""
+    # Схема БД - общий путь миграций (migrations.py), как у bot.py и webhook_app.py
+    asyncio.run(migrate_database(DB_PATH))
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
     
     print("Очистка базы данных...")
     print(f"База данных: {DB_PATH}\n")
     
-    # Сначала создаем таблицы, если их нет (как в webhook_app.py и db.py)
-    print("Создание таблиц, если их нет...")
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS processed_payments (
-            payment_id TEXT PRIMARY KEY,
-            processed_at TEXT NOT NULL
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS approved_users (
-            telegram_user_id INTEGER PRIMARY KEY,
-            approved_at TEXT NOT NULL
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS invite_links (
-            invite_link TEXT PRIMARY KEY,
-            telegram_user_id INTEGER NOT NULL,
-            payment_id TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            revoked INTEGER DEFAULT 0,
-            FOREIGN KEY (telegram_user_id) REFERENCES approved_users(telegram_user_id)
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            telegram_id INTEGER PRIMARY KEY,
-            username TEXT,
-            created_at TEXT NOT NULL
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS subscriptions (
-            telegram_id INTEGER PRIMARY KEY,
-            expires_at TEXT,
-            starts_at TEXT,
-            auto_renewal_enabled INTEGER DEFAULT 0,
-            saved_payment_method_id TEXT,
-            subscription_expired_notified INTEGER DEFAULT 0,
-            FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
-        )
-    """)
-    cur.execute("""
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER NOT NULL,
-            payment_id TEXT NOT NULL UNIQUE,
-            status TEXT NOT NULL,
-            created_at TEXT NOT NULL
-        )
-    """)
-    conn.commit()
     print("✅ Таблицы проверены/созданы\n")
     
     # Проверяем наличие данных перед очисткой
@@ -157,7 +110,7 @@ def clear_old_data():
     if FULL_CLEAR:
         print("\n✅ Полная очистка завершена! БД готова для тестов.")
     else:
-    print("\n✅ Очистка завершена!")
+        print("\n✅ Очистка завершена!")
         print("\n💡 Для полной очистки (включая подписки и платежи) используйте:")
         print("   python3 clear_db.py --full")
 
@@ -22,6 +22,7 @@ SUBSCRIPTION_EXPIRING_NOTIFICATION_WINDOW_HOURS = 24  # Окно для увед
 CHECK_EXPIRED_PAYMENTS_INTERVAL_SECONDS = 60  # Проверка истекших платежей (секунды) - проверка каждую минуту для точного уведомления через 10 минут
 CHECK_EXPIRED_SUBSCRIPTIONS_INTERVAL_SECONDS = 10  # Проверка истекших подписок (секунды) - уменьшено для точного срабатывания
 CHECK_EXPIRING_SUBSCRIPTIONS_INTERVAL_SECONDS = 3600  # Проверка истекающих подписок (секунды)
+EXPIRY_SCHEDULER_RESYNC_SECONDS = 300  # Сверка расписания истечений с БД (изменения, сделанные процессом бота)
 
 # Ограничения для уведомлений
 MAX_NOTIFIED_USERS_CACHE_SIZE = 100  # Максимальный размер кэша уведомленных пользователей
@@ -34,6 +35,54 @@ MAX_ANIMATION_DURATION_SECONDS = 20  # Максимальная длительн
 # Сумма платежа
 PAYMENT_AMOUNT_RUB = "2990.00"  # Сумма платежа в рублях (продакшн режим)
 
+# HTTP-клиент ЮKassa (yookassa_async.py)
+YOOKASSA_REQUEST_TIMEOUT_SECONDS = 15  # Таймаут одного запроса к API ЮKassa
+YOOKASSA_MAX_CONNECTIONS = 20  # Максимум одновременных keep-alive соединений с API ЮKassa
+YOOKASSA_MAX_ATTEMPTS = 3  # Попыток запроса при сетевой ошибке или ответе 202 (как в SDK)
+
+# Очередь webhook'ов ЮKassa (webhook_inbox.py)
+WEBHOOK_INBOX_WORKERS = 4  # Сколько уведомлений обрабатывается параллельно (разных пользователей)
+WEBHOOK_INBOX_MAX_ATTEMPTS = 8  # Попыток обработки уведомления, после чего оно помечается failed
+WEBHOOK_INBOX_RETRY_BASE_SECONDS = 5  # Начальная задержка повтора (удваивается с каждой попыткой)
+WEBHOOK_INBOX_RETRY_MAX_SECONDS = 600  # Максимальная задержка повтора
+WEBHOOK_INBOX_POLL_SECONDS = 1  # Как часто диспетчер проверяет отложенные повторы
+PAYMENT_CLAIM_TIMEOUT_SECONDS = 600  # Через сколько захват платежа (processed_payments.state='claimed') считается зависшим
+
+# Лимиты Telegram Bot API (планировщик исходящих сообщений, telegram_utils.py)
+# Общий лимит Telegram (~30 сообщений/с) - на токен бота, поэтому делится между процессами
+TELEGRAM_BOT_MESSAGES_PER_SECOND = 18  # bot.py: ответы пользователям и рассылки
+TELEGRAM_WEBHOOK_MESSAGES_PER_SECOND = 10  # webhook_app.py: подтверждения оплаты и фоновые уведомления
+TELEGRAM_CHAT_MESSAGES_PER_SECOND = 1  # В один личный чат
+TELEGRAM_CHAT_BURST = 3  # Сколько сообщений подряд можно отправить в личный чат без ожидания
+TELEGRAM_GROUP_MESSAGES_PER_MINUTE = 20  # В одну группу/канал
+
+# Прием обновлений Telegram
+# polling - bot.py отдельным процессом (getUpdates), webhook_app.py обрабатывает только заявки на вступление;
+# webhook - один процесс: webhook_app.py принимает все обновления на /telegram/webhook и передает их
+# в Dispatcher из bot.py (общие бот, пул соединений с БД и кэш; bot.py отдельно не запускается)
+BOT_UPDATES_MODE = os.getenv("BOT_UPDATES_MODE", "polling")
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")  # Публичный URL /telegram/webhook; пусто - webhook установлен вручную
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")  # Сверяется с заголовком X-Telegram-Bot-Api-Secret-Token; при webhook обязателен
+TELEGRAM_UPDATES_SHUTDOWN_TIMEOUT_SECONDS = 10  # Сколько при остановке ждать обработки уже принятых обновлений
+
+# Рассылки /send_update и /send_update_from_excel (broadcast_engine.py)
+BROADCAST_CONCURRENCY = 8  # Сколько получателей обрабатывается одновременно (темп все равно задают лимиты Telegram)
+BROADCAST_MAX_ATTEMPTS = 3  # Попыток на получателя при сетевых ошибках
+BROADCAST_PROGRESS_INTERVAL_SECONDS = 5  # Как часто обновлять сообщение администратора с прогрессом
+
+# Пул заранее созданных ссылок-приглашений в канал (invite_link_pool.py)
+INVITE_LINK_POOL_SIZE = 20  # Сколько свободных ссылок держать наготове
+INVITE_LINK_POOL_CHECK_INTERVAL_SECONDS = 300  # Как часто проверять пул, если ссылки не выдавались
+
+# Статус пользователей в канале (таблица channel_members, сверка в webhook_app.py)
+CHANNEL_MEMBERS_RECONCILE_INTERVAL_SECONDS = 3600  # Как часто сверять channel_members с Telegram
+CHANNEL_MEMBERS_RECONCILE_BATCH = 100  # Сколько пользователей проверять через get_chat_member за одну сверку
+CHANNEL_MEMBERS_RECONCILE_MAX_AGE_HOURS = 24  # Статус старше этого перепроверяется при сверке
+
+# Межпроцессная инвалидация кэша db.py (cache_bus.py)
+CACHE_BUS_POLL_SECONDS = 0.5  # Как часто проверять PRAGMA data_version на изменения из другого процесса
+CACHE_BUS_RETENTION_SECONDS = 3600  # Сколько хранить записи журнала cache_invalidations
+
 # ================== БОНУСНАЯ НЕДЕЛЯ ==================
 # Фиксированные даты бонусной недели
 # КРИТИЧЕСКИ ВАЖНО: Дата окончания должна быть одинаковой для ВСЕХ пользователей
@@ -80,16 +129,7 @@ def _set_bonus_week_start_to_db(start_time: datetime) -> None:
     try:
         conn = sqlite3.connect(DB_PATH)
         cursor = conn.cursor()
-        # Создаем таблицу если её нет
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS bonus_week_config (
-                id INTEGER PRIMARY KEY DEFAULT 1,
-                start_time TEXT NOT NULL,
-                updated_at TEXT NOT NULL,
-                CHECK (id = 1)
-            )
-        """)
-        # Сохраняем время
+        # Таблица bonus_week_config создается миграциями (migrations.py)
         cursor.execute("""
             INSERT OR REPLACE INTO bonus_week_config (id, start_time, updated_at)
             VALUES (1, ?, ?)
@@ -103,14 +143,19 @@ def _set_bonus_week_start_to_db(start_time: datetime) -> None:
 # Инициализация времени начала бонусной недели
 # КРИТИЧЕСКИ ВАЖНО: Используем время, которое УЖЕ есть в БД (если есть)
 # НЕ изменяем существующее время в БД - это сохранит правильное время для уже зарегистрированных пользователей
-# Если в БД нет времени - используем вычисленное время от даты окончания (только для первого запуска)
-_BONUS_WEEK_START = _get_bonus_week_start_from_db()
-if _BONUS_WEEK_START is None:
-    # Если в БД нет времени - устанавливаем вычисленное время от даты окончания
-    # Это гарантирует, что новые пользователи получат правильное время
-    _BONUS_WEEK_START = BONUS_WEEK_START_DATE
-    _set_bonus_week_start_to_db(_BONUS_WEEK_START)
-# Если в БД УЖЕ есть время - НЕ меняем его! Используем существующее для всех пользователей
+# Если в БД нет времени - используем вычисленное время от даты окончания; в БД его записывает
+# миграция seed_bonus_week_start (migrations.py) - импорт config ничего не пишет в БД
+# Импорт config и не читает БД: бот и webhook_app получают время из db.init_db() (через пул соединений),
+# скрипты без init_db - синхронным чтением при первом вызове get_bonus_week_start()
+_BONUS_WEEK_START: Optional[datetime] = None
+
+
+def set_bonus_week_start(start_time: Optional[datetime]) -> None:
+    """Запоминает время начала бонусной недели, прочитанное из БД (None - в БД времени нет)"""
+    global _BONUS_WEEK_START
+    if start_time is not None and start_time.tzinfo is None:
+        start_time = start_time.replace(tzinfo=timezone.utc)
+    _BONUS_WEEK_START = start_time or BONUS_WEEK_START_DATE
 
 def reset_bonus_week():
     """Сбрасывает начало бонусной недели (для тестирования)"""
@@ -128,6 +173,8 @@ PRODUCTION_DURATION_DAYS = 30.0  # Обычная длительность по
 
 # Автопродление
 AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES = 120  # Интервал между попытками автопродления (2 часа = 120 минут)
+AUTO_RENEWAL_CONCURRENCY = 20  # Сколько пользователей обрабатывается одновременно при массовом истечении подписок (renewal_engine.py)
+AUTO_RENEWAL_WEBHOOK_WAIT_SECONDS = 30  # Сколько ждать webhook с результатом автоплатежа, прежде чем спросить статус в API
 
 # ================== ФУНКЦИИ ДЛЯ ОПРЕДЕЛЕНИЯ РЕЖИМА ==================
 def is_bonus_week_active() -> bool:
@@ -146,15 +193,11 @@ def is_bonus_week_active() -> bool:
 
 def get_bonus_week_start() -> datetime:
     """Возвращает время начала бонусной недели (читается из БД)"""
-    global _BONUS_WEEK_START
-    # Если время не установлено - читаем из БД
+    # Если время не установлено (процесс без db.init_db) - читаем из БД
     if _BONUS_WEEK_START is None:
-        _BONUS_WEEK_START = _get_bonus_week_start_from_db()
-        if _BONUS_WEEK_START is None:
-            # КРИТИЧЕСКИ ВАЖНО: Используем фиксированное время начала из BONUS_WEEK_START_DATE
-            # Это гарантирует, что ВСЕ пользователи имеют одинаковое время начала бонусной недели
-            _BONUS_WEEK_START = BONUS_WEEK_START_DATE
-            _set_bonus_week_start_to_db(_BONUS_WEEK_START)
+        # КРИТИЧЕСКИ ВАЖНО: Если в БД времени нет - используем фиксированное время начала из BONUS_WEEK_START_DATE
+        # Это гарантирует, что ВСЕ пользователи имеют одинаковое время начала бонусной недели
+        set_bonus_week_start(_get_bonus_week_start_from_db())
     return _BONUS_WEEK_START
 
 def get_bonus_week_end() -> datetime:
@@ -0,0 +1,197 @@
+"""
+Общее ядро бота и webhook_app.py: тексты кнопок и главное меню пользователя
+Модуль не зависит от FastAPI, YooKassa и openpyxl - bot.py строит меню, не загружая webhook_app.py
+(раньше первое же меню тянуло в процесс бота весь webhook_app со всеми его зависимостями).
+Состояние подписки - db.get_user_state, цены и режим бонусной недели - config.py,
+форматирование сроков - utils.py.
+"""
+import logging
+from datetime import datetime, timezone
+
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
+
+from config import is_bonus_week_active, get_bonus_week_end
+from db import get_user_state
+from user_locks import user_lock
+
+logger = logging.getLogger(__name__)
+
+BTN_PAY_1 = "💳 Получить доступ"  # Показывается если нет подписки
+BTN_MANAGE_SUB = "⚙️ Управление доступом"  # Показывается если есть подписка
+BTN_CANCEL_SUB = "❌ Отменить доступ и отключить автопродление"  # Показывается в меню управления если автопродление включено
+BTN_RESUME_SUB = "▶️ Возобновить доступ"  # Показывается в меню управления если автопродление отключено
+BTN_STATUS_1 = "📊 Статус доступа"
+BTN_ABOUT_1 = "ℹ️ О проекте"
+BTN_CHECK_1 = "🔍 Проверить оплату"
+BTN_SUPPORT = "💬 Поддержка"
+BTN_FILL_FORM = "📝 Заполнить данные"  # Кнопка для заполнения формы
+
+# Кнопки для бонусной недели
+BTN_BONUS_WEEK = "🎁 Бонус в честь запуска канала Наиля Хасанова"
+BTN_BACK_TO_MENU = "◀️ Назад в меню"
+BTN_DISABLE_AUTO_RENEWAL = "❌ Отказаться от автопродления"
+BTN_REMOVE_CARD = "💳 Отвязать карту"
+
+
+async def get_main_menu_for_user(telegram_id: int) -> ReplyKeyboardMarkup:
+    """Меню пользователя; строится под user_lock, чтобы не читать состояние посреди активации/продления"""
+    async with user_lock(telegram_id):
+        return await _build_main_menu_for_user(telegram_id)
+
+
+async def _build_main_menu_for_user(telegram_id: int) -> ReplyKeyboardMarkup:
+    """Создает главное меню для пользователя с учетом статуса подписки"""
+    # Кэш не очищаем: записи пользователя инвалидируются при изменении (в т.ч. из процесса бота через cache_bus)
+    # Состояние пользователя читаем одним запросом (подписка, автопродление, попытки)
+    state = await get_user_state(telegram_id)
+    now = datetime.now(timezone.utc)
+    has_active_subscription = state.has_active_subscription(now)
+    auto_renewal_enabled = state.auto_renewal_enabled
+    attempts = state.auto_renewal_attempts
+    
+    # КРИТИЧЕСКИ ВАЖНО: Если автопродление отключено после 3 неудачных попыток,
+    # НЕ меняем has_active_subscription здесь - это будет обработано ниже в "боевом режиме"
+    # (логика "боевого режима" будет применена после проверки bonus_week_ended)
+    
+    show_manage_button = has_active_subscription and auto_renewal_enabled
+    
+    # КРИТИЧЕСКИ ВАЖНО: Показываем бонусное меню ТОЛЬКО если:
+    # 1. Бонусная неделя активна (is_bonus_week_active() = True)
+    # 2. У пользователя НЕТ активной подписки с автопродлением (show_manage_button = False)
+    # Если бонусная неделя закончилась - ВСЕГДА показываем продакшн меню, независимо от статуса автопродления
+    # КРИТИЧЕСКИ ВАЖНО: Проверяем окончание бонусной недели ПО ВРЕМЕНИ - это приоритетная проверка
+    bonus_week_end = get_bonus_week_end()
+    if bonus_week_end.tzinfo is None:
+        bonus_week_end = bonus_week_end.replace(tzinfo=timezone.utc)
+    
+    # КРИТИЧЕСКИ ВАЖНО: Если бонусная неделя закончилась, но еще идут попытки автопродления (attempts > 0 и attempts < 3),
+    # меню НЕ должно меняться - оно должно оставаться прежним до завершения всех попыток
+    bonus_week_ended = now > bonus_week_end
+    # auto_renewal_in_progress = True если автопродление включено, есть попытки (но меньше 3), и бонусная неделя закончилась
+    auto_renewal_in_progress = auto_renewal_enabled and attempts > 0 and attempts < 3 and bonus_week_ended
+    
+    # КРИТИЧЕСКИ ВАЖНО: Если автопродление успешно (attempts = 0 и есть активная подписка),
+    # значит автопродление прошло успешно - показываем БОЕВОЙ РЕЖИМ (продакшн меню)
+    if bonus_week_ended and attempts == 0 and has_active_subscription and auto_renewal_enabled:
+        # Автопродление успешно - БОЕВОЙ РЕЖИМ
+        bonus_week_active = False
+        logger.info(f"⚔️ Автопродление успешно завершено для пользователя {telegram_id} - БОЕВОЙ РЕЖИМ (продакшн меню)")
+    elif bonus_week_ended and not auto_renewal_in_progress:
+        # Бонусная неделя закончилась и попытки завершены - БОЕВОЙ РЕЖИМ
+        # ВАЖНО: Это включает случай с 3 неудачными попытками - тоже БОЕВОЙ РЕЖИМ
+        bonus_week_active = False
+        if not auto_renewal_enabled and attempts >= 3:
+            logger.info(f"⚔️ Бонусная неделя закончилась, 3 неудачные попытки для пользователя {telegram_id} - БОЕВОЙ РЕЖИМ")
+        else:
+            logger.info(f"⚔️ Бонусная неделя закончилась по времени: now={now.isoformat()}, bonus_week_end={bonus_week_end.isoformat()}, попытки завершены - БОЕВОЙ РЕЖИМ")
+    elif auto_renewal_in_progress:
+        # Бонусная неделя закончилась, но еще идут попытки автопродления
+        # ВАЖНО: Показываем бонусное меню только если у пользователя нет активной подписки
+        # Если есть активная подписка, показываем меню "Управление доступом"
+        bonus_week_active = True
+        logger.info(f"🔍 Бонусная неделя закончилась, но идут попытки автопродления (attempts={attempts}/3) - has_active_subscription={has_active_subscription}")
+    else:
+        # Только если бонусная неделя еще не закончилась по времени, проверяем is_bonus_week_active()
+        bonus_week_active = is_bonus_week_active()
+        if bonus_week_active:
+            logger.info(f"🔍 Бонусная неделя активна: now={now.isoformat()}, bonus_week_end={bonus_week_end.isoformat()}")
+    
+    # Логируем состояние для диагностики
+    logger.info(f"🔍 get_main_menu_for_user для {telegram_id}: bonus_week_active={bonus_week_active}, has_active_subscription={has_active_subscription}, show_manage_button={show_manage_button}, auto_renewal_enabled={auto_renewal_enabled}, attempts={attempts}")
+    
+    if bonus_week_active:
+        # КРИТИЧЕСКИ ВАЖНО: Во время попыток автопродления (auto_renewal_in_progress) 
+        # меню НЕ должно меняться - показываем то же меню, что было до начала попыток
+        # Если у пользователя было "Управление доступом" - показываем его
+        # Если у пользователя было бонусное меню - показываем его
+        if auto_renewal_in_progress:
+            # Идут попытки автопродления - КРИТИЧЕСКИ ВАЖНО: 
+            # ВСЕГДА показываем "Управление доступом" + "О проекте" во время попыток автопродления,
+            # даже если подписка уже истекла (expires_at <= now)
+            # Потому что попытки автопродления означают, что у пользователя была активная подписка
+            # и идет процесс её продления
+            keyboard = [
+                [KeyboardButton(text=BTN_MANAGE_SUB)],
+                [KeyboardButton(text=BTN_ABOUT_1)],
+            ]
+            logger.info(f"🔍 Пользователь {telegram_id}: попытки автопродления (attempts={attempts}/3) - показываем меню 'Управление доступом'")
+            return ReplyKeyboardMarkup(
+                keyboard=keyboard,
+                resize_keyboard=True,
+            )
+        elif show_manage_button:
+            # У пользователя есть активная подписка с автопродлением - показываем "Управление доступом"
+            keyboard = [
+                [KeyboardButton(text=BTN_MANAGE_SUB)],
+                [KeyboardButton(text=BTN_ABOUT_1)],
+            ]
+            return ReplyKeyboardMarkup(
+                keyboard=keyboard,
+                resize_keyboard=True,
+            )
+        elif has_active_subscription and not auto_renewal_enabled:
+            # КРИТИЧЕСКИ ВАЖНО: Если в бонусной неделе у пользователя есть активная подписка,
+            # но автопродление отключено - показываем ТОЛЬКО "О проекте"
+            keyboard = [
+                [KeyboardButton(text=BTN_ABOUT_1)],
+            ]
+            return ReplyKeyboardMarkup(
+                keyboard=keyboard,
+                resize_keyboard=True,
+            )
+        else:
+            # У пользователя нет активной подписки - показываем бонусное меню
+            logger.info(f"🎁 Пользователь {telegram_id}: показываем БОНУСНОЕ меню (нет подписки, бонусная неделя активна)")
+            keyboard = [
+                [KeyboardButton(text=BTN_BONUS_WEEK)],
+                [KeyboardButton(text=BTN_ABOUT_1)],
+            ]
+            return ReplyKeyboardMarkup(
+                keyboard=keyboard,
+                resize_keyboard=True,
+            )
+    
+    # Бонусная неделя закончилась - ВСЕГДА показываем продакшн меню, независимо от статуса автопродления
+    
+    # has_active_subscription, auto_renewal_enabled и attempts уже получены из снимка state выше
+    
+    # КРИТИЧЕСКИ ВАЖНО: Определяем БОЕВОЙ РЕЖИМ
+    # БОЕВОЙ РЕЖИМ активируется если бонусная неделя закончилась
+    # В боевом режиме ВСЕГДА показываем полное продакшн меню
+    is_battle_mode = bonus_week_ended
+    
+    if is_battle_mode:
+        logger.info(f"⚔️ БОЕВОЙ РЕЖИМ для пользователя {telegram_id}: бонусная неделя закончилась (has_active_subscription={has_active_subscription}, attempts={attempts})")
+    
+    # Показываем "Управление доступом" только если подписка активна И автопродление включено
+    show_manage_button = has_active_subscription and auto_renewal_enabled
+    
+    # В БОЕВОМ РЕЖИМЕ показываем полное продакшн меню
+    if is_battle_mode:
+        # БОЕВОЙ РЕЖИМ: если есть активная подписка - показываем "Управление доступом", иначе "Получить доступ"
+        payment_button = BTN_MANAGE_SUB if has_active_subscription else BTN_PAY_1
+        
+        keyboard = [
+            [KeyboardButton(text=payment_button)],
+            [KeyboardButton(text=BTN_STATUS_1)],
+            [KeyboardButton(text=BTN_ABOUT_1)],
+            [KeyboardButton(text=BTN_CHECK_1)],
+            [KeyboardButton(text=BTN_SUPPORT)],
+        ]
+        logger.info(f"⚔️ БОЕВОЙ РЕЖИМ для пользователя {telegram_id}: показываем полное продакшн меню с '{payment_button}'")
+    else:
+        # Обычный режим: если есть активная подписка с автопродлением - показываем "Управление доступом", иначе "Получить доступ"
+        payment_button = BTN_MANAGE_SUB if show_manage_button else BTN_PAY_1
+        
+        keyboard = [
+            [KeyboardButton(text=payment_button)],
+            [KeyboardButton(text=BTN_STATUS_1)],
+            [KeyboardButton(text=BTN_ABOUT_1)],
+            [KeyboardButton(text=BTN_CHECK_1)],
+            [KeyboardButton(text=BTN_SUPPORT)],
+        ]
+    
+    return ReplyKeyboardMarkup(
+        keyboard=keyboard,
+        resize_keyboard=True,
+    )
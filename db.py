@@ -1,143 +1,266 @@
 import os
+import asyncio
 import aiosqlite
 import logging
-from datetime import datetime, timedelta
-from typing import Optional
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Optional
 from dotenv import load_dotenv
 import logging
 
+from expiry_scheduler import expiry_scheduler
+from cache_bus import CLEAR_ALL_TAG, CacheInvalidationBus
+from config import set_bonus_week_start
+from epoch_columns import from_epoch_ms, now_ms, to_epoch_ms
+from migrations import run_migrations
+import queries
+from tagged_cache import TaggedCache
+
 load_dotenv()
 
 DB_PATH = os.getenv("DB_PATH", "bot.db")
 logger = logging.getLogger(__name__)
 
-# Кэш для частых запросов (TTL 60 секунд)
-_cache = {}
+# Кэш для частых запросов: LRU с TTL 60 секунд, записи помечены тегом пользователя "user:{telegram_id}"
+DB_CACHE_MAX_ENTRIES = int(os.getenv("DB_CACHE_MAX_ENTRIES", "20000"))
 _cache_ttl = 60
+_cache = TaggedCache(maxsize=DB_CACHE_MAX_ENTRIES, ttl=_cache_ttl)
+
+
+def _user_tag(telegram_id: int) -> str:
+    return f"user:{int(telegram_id)}"
+
 
 def _get_cached(key: str):
     """Получает значение из кэша если оно еще актуально"""
-    if key in _cache:
-        value, timestamp = _cache[key]
-        if (datetime.utcnow() - timestamp).total_seconds() < _cache_ttl:
-            return value
-        del _cache[key]
-    return None
+    return _cache.get(key)
+
+
+def _set_cached(key: str, value, telegram_id: Optional[int] = None):
+    """Сохраняет значение в кэш (с тегом пользователя, если он указан)"""
+    _cache.set(key, value, tags=(_user_tag(telegram_id),) if telegram_id is not None else ())
+
 
-def _set_cached(key: str, value):
-    """Сохраняет значение в кэш"""
-    _cache[key] = (value, datetime.utcnow())
+def invalidate_user_cache(telegram_id: int) -> int:
+    """Удаляет из кэша только записи этого пользователя (вызывать после записи его данных)
+    Инвалидация рассылается и другим процессам через шину cache_bus"""
+    tag = _user_tag(telegram_id)
+    _cache_bus.publish(tag)
+    return _cache.invalidate_tag(tag)
+
+
+def _apply_remote_invalidation(tag: str) -> None:
+    """Инвалидация, пришедшая из другого процесса"""
+    if tag == CLEAR_ALL_TAG:
+        _cache.clear()
+    else:
+        _cache.invalidate_tag(tag)
+
+
+_cache_bus = CacheInvalidationBus(_apply_remote_invalidation)
+
+
+def get_cache_stats() -> dict:
+    """Счетчики кэша: попадания, промахи, вытеснения"""
+    return _cache.stats()
 
 def _clear_cache():
-    """Очищает весь кэш"""
+    """Очищает весь кэш (для изменений, затрагивающих всех пользователей; для одного - invalidate_user_cache)"""
+    _cache_bus.publish(CLEAR_ALL_TAG)
     _cache.clear()
 
-async def init_db() -> None:
-    """Инициализирует базу данных и создает индексы для оптимизации"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        # Включаем WAL режим для лучшей производительности
-        await db.execute("PRAGMA journal_mode=WAL")
-        await db.execute("PRAGMA synchronous=NORMAL")
-        await db.execute("PRAGMA cache_size=10000")
-        await db.execute("PRAGMA temp_store=MEMORY")
-        
-        # Создаем таблицы
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_id INTEGER PRIMARY KEY,
-                username TEXT,
-                created_at TEXT NOT NULL
-                         )
-                         """)
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                telegram_id INTEGER PRIMARY KEY,
-                expires_at TEXT,
-                starts_at TEXT,
-                auto_renewal_enabled INTEGER DEFAULT 0,
-                saved_payment_method_id TEXT,
-                subscription_expired_notified INTEGER DEFAULT 0,
-                FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
-                             )
-                         """)
-        
-        # Добавляем колонку subscription_expired_notified, если её нет
-        try:
-            await db.execute("ALTER TABLE subscriptions ADD COLUMN subscription_expired_notified INTEGER DEFAULT 0")
-            await db.commit()
-        except Exception:
-            pass
-        
-        # Добавляем колонки для отслеживания попыток автопродления
-        try:
-            await db.execute("ALTER TABLE subscriptions ADD COLUMN auto_renewal_attempts INTEGER DEFAULT 0")
-            await db.commit()
-        except Exception:
-            pass
-        
-        try:
-            await db.execute("ALTER TABLE subscriptions ADD COLUMN last_auto_renewal_attempt_at TEXT")
-            await db.commit()
-        except Exception:
-            pass
-        
-        # Добавляем колонки для работы с формой заполнения данных
-        try:
-            await db.execute("ALTER TABLE users ADD COLUMN form_token TEXT")
-            await db.commit()
-        except Exception:
-            pass
-        
+
+# ================== ПУЛ СОЕДИНЕНИЙ ==================
+# Один писатель (SQLite всё равно сериализует запись) и N читателей (в WAL читатели не блокируют писателя)
+DB_POOL_READERS = int(os.getenv("DB_POOL_READERS", "4"))  # Количество соединений для чтения
+
+# PRAGMA, которые применяются к КАЖДОМУ соединению пула (раньше выставлялись только в init_db)
+_CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=10000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA busy_timeout=5000",  # bot.py и webhook_app.py пишут в одну БД из разных процессов
+)
+
+# Соединение, которое уже держит текущая задача: (задача, соединение, is_writer)
+# Нужно, чтобы вложенные db_read()/db_write() в одной задаче не ждали сами себя
+_held_connection: ContextVar = ContextVar("_held_connection", default=None)
+
+
+class _ConnectionPool:
+    """Пул постоянных соединений aiosqlite: один писатель и N читателей"""
+
+    def __init__(self, path: str, readers: int):
+        self.path = path
+        self.readers_count = max(1, readers)
+        self.loop = None
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_lock = asyncio.Lock()
+        self._readers: Optional[asyncio.Queue] = None
+        self._all_readers: list[aiosqlite.Connection] = []
+        self._open_lock = asyncio.Lock()
+        self._opened = False
+
+    async def _connect(self, readonly: bool) -> aiosqlite.Connection:
+        conn = aiosqlite.connect(self.path)
+        # Соединения пула живут весь процесс: поток не должен мешать завершению скриптов,
+        # которые открыли пул лениво и не вызвали close_pool()
+        worker = getattr(conn, "_thread", None)
+        if worker is not None:
+            worker.daemon = True
+        conn = await conn
+        for pragma in _CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        if readonly:
+            # Защита от случайной записи через соединение для чтения
+            await conn.execute("PRAGMA query_only=ON")
+        return conn
+
+    async def open(self) -> None:
+        async with self._open_lock:
+            if self._opened:
+                return
+            self.loop = asyncio.get_running_loop()
+            self._writer = await self._connect(readonly=False)
+            self._readers = asyncio.Queue()
+            for _ in range(self.readers_count):
+                conn = await self._connect(readonly=True)
+                self._all_readers.append(conn)
+                self._readers.put_nowait(conn)
+            self._opened = True
+            logger.info(f"✅ Пул соединений БД открыт: {self.path} (1 писатель, {self.readers_count} читателей)")
+
+    async def close(self) -> None:
+        async with self._open_lock:
+            if not self._opened:
+                return
+            self._opened = False
+            async with self._writer_lock:
+                await self._writer.close()
+            for conn in self._all_readers:
+                await conn.close()
+            self._all_readers.clear()
+            logger.info("✅ Пул соединений БД закрыт")
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        async with self._writer_lock:
+            conn = self._writer
+            try:
+                yield conn
+                if conn.in_transaction:
+                    await conn.commit()
+            except BaseException:
+                if conn.in_transaction:
+                    await conn.rollback()
+                raise
+            finally:
+                conn.row_factory = None
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        conn = await self._readers.get()
         try:
-            await db.execute("ALTER TABLE users ADD COLUMN form_filled INTEGER DEFAULT 0")
-            await db.commit()
-        except Exception:
-            pass
-        
+            yield conn
+        finally:
+            conn.row_factory = None
+            self._readers.put_nowait(conn)
+
+
+_pool: Optional[_ConnectionPool] = None
+
+
+async def init_pool(path: Optional[str] = None, readers: int = DB_POOL_READERS) -> None:
+    """Открывает пул соединений (вызывается один раз при старте процесса)"""
+    global _pool
+    if _pool is not None and _pool._opened:
+        return
+    pool = _ConnectionPool(path or DB_PATH, readers)
+    # Схема приводится к актуальной версии до открытия пула и шины инвалидации
+    await run_migrations(lambda: pool._connect(readonly=False))
+    _pool = pool
+    await _pool.open()
+    # Шина инвалидации кэша между процессами работает на отдельном соединении
+    pool = _pool
+    await _cache_bus.start(lambda: pool._connect(readonly=False))
+
+
+async def close_pool() -> None:
+    """Закрывает пул соединений (при остановке процесса)"""
+    global _pool
+    await _cache_bus.stop()
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
+async def _get_pool() -> _ConnectionPool:
+    """Возвращает открытый пул; открывает его лениво (для скриптов без init_pool)"""
+    global _pool
+    if _pool is not None and _pool._opened and _pool.loop is not asyncio.get_running_loop():
+        # Пул был открыт в другом event loop (например, повторный asyncio.run в скрипте)
+        _pool = None
+    if _pool is None:
+        _pool = _ConnectionPool(DB_PATH, DB_POOL_READERS)
+    if not _pool._opened:
+        await _pool.open()
+    return _pool
+
+
+def _current_held():
+    held = _held_connection.get()
+    if held is not None and held[0] is asyncio.current_task():
+        return held
+    return None
+
+
+@asynccontextmanager
+async def db_write() -> AsyncIterator[aiosqlite.Connection]:
+    """Соединение для записи из пула (коммит при выходе, откат при исключении)"""
+    held = _current_held()
+    if held is not None and held[2]:
+        # Вложенный вызов в той же задаче - используем то же соединение и ту же транзакцию
+        yield held[1]
+        return
+    pool = await _get_pool()
+    async with pool.writer() as conn:
+        token = _held_connection.set((asyncio.current_task(), conn, True))
         try:
-            await db.execute("ALTER TABLE users ADD COLUMN form_filled_at TEXT")
-            await db.commit()
-        except Exception:
-            pass
-        
-        # Создаем индекс для быстрого поиска по токену
+            yield conn
+        finally:
+            _held_connection.reset(token)
+
+
+@asynccontextmanager
+async def db_read() -> AsyncIterator[aiosqlite.Connection]:
+    """Соединение для чтения из пула"""
+    held = _current_held()
+    if held is not None:
+        # Внутри db_write() читаем через писателя, чтобы видеть свои незакоммиченные изменения
+        yield held[1]
+        return
+    pool = await _get_pool()
+    async with pool.reader() as conn:
+        token = _held_connection.set((asyncio.current_task(), conn, False))
         try:
-            await db.execute("CREATE INDEX IF NOT EXISTS idx_users_form_token ON users(form_token)")
-            await db.commit()
-        except Exception:
-            pass
-        
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_id INTEGER NOT NULL,
-                payment_id TEXT NOT NULL UNIQUE,
-                status TEXT NOT NULL,
-                created_at TEXT NOT NULL
-                         )
-                         """)
-
-        # Создаем индексы для оптимизации запросов
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_telegram_id ON payments(telegram_id)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_created_at ON payments(created_at)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_payments_telegram_status ON payments(telegram_id, status)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_expires_at ON subscriptions(expires_at)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_auto_renewal ON subscriptions(auto_renewal_enabled)")
-        
-        # Создаем таблицу для хранения времени начала бонусной недели
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS bonus_week_config (
-                id INTEGER PRIMARY KEY DEFAULT 1,
-                start_time TEXT NOT NULL,
-                updated_at TEXT NOT NULL,
-                CHECK (id = 1)
-            )
-        """)
-        
-        await db.commit()
-        logger.info("✅ База данных инициализирована с оптимизациями")
+            yield conn
+        finally:
+            _held_connection.reset(token)
+
+
+async def init_db() -> None:
+    """Доводит схему БД до актуальной версии (migrations.py); при актуальной схеме - одна проверка версии"""
+    # WAL и остальные PRAGMA выставляются на каждое соединение пула (см. _CONNECTION_PRAGMAS)
+    pool = await _get_pool()
+    await run_migrations(lambda: pool._connect(readonly=False))
+    # Время начала бонусной недели - в config.py (импорт config больше не читает БД синхронно)
+    async with db_read() as db:
+        cursor = await db.execute("SELECT start_time FROM bonus_week_config WHERE id = 1")
+        row = await cursor.fetchone()
+    set_bonus_week_start(datetime.fromisoformat(row[0]) if row and row[0] else None)
 
 
 async def ensure_user(telegram_id: int, username: Optional[str]) -> None:
@@ -146,7 +269,7 @@ async def ensure_user(telegram_id: int, username: Optional[str]) -> None:
     if _get_cached(cache_key):
         return
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         # Проверяем, существует ли пользователь
         cursor = await db.execute(
             "SELECT telegram_id FROM users WHERE telegram_id = ?",
@@ -189,7 +312,9 @@ async def ensure_user(telegram_id: int, username: Optional[str]) -> None:
                 )
         
         await db.commit()
-    _set_cached(cache_key, True)
+    # Строка users могла появиться только что - снимок get_user_state устарел
+    invalidate_user_cache(telegram_id)
+    _set_cached(cache_key, True, telegram_id)
 
 
 async def get_subscription_expires_at(telegram_id: int) -> Optional[datetime]:
@@ -199,22 +324,19 @@ async def get_subscription_expires_at(telegram_id: int) -> Optional[datetime]:
     if cached is not None:
         return cached
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute(
-            "SELECT expires_at FROM subscriptions WHERE telegram_id = ?",
+            "SELECT expires_at_ms FROM subscriptions WHERE telegram_id = ?",
             (telegram_id,)
         )
         row = await cur.fetchone()
 
-    if not row or not row[0]:
+    if not row or row[0] is None:
         return None
 
-    try:
-        result = datetime.fromisoformat(row[0])
-        _set_cached(cache_key, result)
-        return result
-    except ValueError:
-        return None
+    result = from_epoch_ms(row[0])
+    _set_cached(cache_key, result, telegram_id)
+    return result
 
 
 async def get_subscription_starts_at(telegram_id: int) -> Optional[datetime]:
@@ -224,22 +346,19 @@ async def get_subscription_starts_at(telegram_id: int) -> Optional[datetime]:
     if cached is not None:
         return cached
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute(
-            "SELECT starts_at FROM subscriptions WHERE telegram_id = ?",
+            "SELECT starts_at_ms FROM subscriptions WHERE telegram_id = ?",
             (telegram_id,)
         )
         row = await cur.fetchone()
 
-    if not row or not row[0]:
+    if not row or row[0] is None:
         return None
 
-    try:
-        result = datetime.fromisoformat(row[0])
-        _set_cached(cache_key, result)
-        return result
-    except ValueError:
-        return None
+    result = from_epoch_ms(row[0])
+    _set_cached(cache_key, result, telegram_id)
+    return result
 
 
 async def get_subscription_info(telegram_id: int) -> Optional[dict]:
@@ -249,10 +368,10 @@ async def get_subscription_info(telegram_id: int) -> Optional[dict]:
     if cached is not None:
         return cached
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute(
             """
-            SELECT expires_at, starts_at, auto_renewal_enabled, saved_payment_method_id, subscription_expired_notified
+            SELECT expires_at_ms, starts_at_ms, auto_renewal_enabled, saved_payment_method_id, subscription_expired_notified
             FROM subscriptions WHERE telegram_id = ?
             """,
             (telegram_id,)
@@ -263,13 +382,120 @@ async def get_subscription_info(telegram_id: int) -> Optional[dict]:
         return None
     
     result = {
-        'expires_at': datetime.fromisoformat(row[0]) if row[0] else None,
-        'starts_at': datetime.fromisoformat(row[1]) if row[1] else None,
+        'expires_at': from_epoch_ms(row[0]),
+        'starts_at': from_epoch_ms(row[1]),
         'auto_renewal_enabled': bool(row[2]),
         'saved_payment_method_id': row[3],
         'subscription_expired_notified': bool(row[4])
     }
-    _set_cached(cache_key, result)
+    _set_cached(cache_key, result, telegram_id)
+    return result
+
+
+def _parse_db_datetime(value: Optional[str]) -> Optional[datetime]:
+    """Разбирает время из БД (ISO строка) в datetime; некорректные значения -> None"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+async def get_subscription_states(telegram_ids: list[int]) -> dict[int, dict]:
+    """Получает состояние подписок многих пользователей одним запросом (для фоновых задач)
+    Возвращает {telegram_id: {...}} - те же ключи, что get_subscription_info, плюс
+    auto_renewal_attempts и last_auto_renewal_attempt_at"""
+    states = {}
+    ids = list(dict.fromkeys(telegram_ids))
+    # Ограничение SQLite на количество параметров в запросе - читаем пачками
+    chunk_size = 500
+    async with db_read() as db:
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            cur = await db.execute(
+                f"""
+                SELECT telegram_id, expires_at_ms, starts_at_ms, auto_renewal_enabled, saved_payment_method_id,
+                       subscription_expired_notified, auto_renewal_attempts, last_auto_renewal_attempt_at
+                FROM subscriptions WHERE telegram_id IN ({','.join('?' * len(chunk))})
+                """,
+                chunk
+            )
+            for row in await cur.fetchall():
+                states[row[0]] = {
+                    'expires_at': from_epoch_ms(row[1]),
+                    'starts_at': from_epoch_ms(row[2]),
+                    'auto_renewal_enabled': bool(row[3]),
+                    'saved_payment_method_id': row[4],
+                    'subscription_expired_notified': bool(row[5]),
+                    'auto_renewal_attempts': int(row[6]) if row[6] is not None else 0,
+                    'last_auto_renewal_attempt_at': _parse_db_datetime(row[7]),
+                }
+    return states
+
+
+@dataclass(frozen=True, slots=True)
+class UserState:
+    """Снимок состояния пользователя (users + subscriptions + approved_users), читается одним запросом"""
+    telegram_id: int
+    exists: bool = False
+    form_filled: bool = False
+    is_allowed: bool = False
+    expires_at: Optional[datetime] = None
+    starts_at: Optional[datetime] = None
+    auto_renewal_enabled: bool = False
+    auto_renewal_attempts: int = 0
+    saved_payment_method_id: Optional[str] = None
+    subscription_expired_notified: bool = False
+    last_auto_renewal_attempt_at: Optional[datetime] = None
+
+    def has_active_subscription(self, now: Optional[datetime] = None) -> bool:
+        """Подписка активна на момент now (по умолчанию - сейчас, UTC)"""
+        if self.expires_at is None:
+            return False
+        expires_at = self.expires_at
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=timezone.utc)
+        return expires_at > (now or datetime.now(timezone.utc))
+
+
+async def get_user_state(telegram_id: int) -> UserState:
+    """Получает снимок состояния пользователя одним запросом по первичным ключам (с кэшированием)
+    Используется построением меню и обработчиками вместо нескольких отдельных запросов"""
+    cache_key = f"user_state_{telegram_id}"
+    cached = _get_cached(cache_key)
+    if cached is not None:
+        return cached
+
+    async with db_read() as db:
+        cur = await db.execute(
+            """
+            SELECT u.telegram_id IS NOT NULL, u.form_filled, a.telegram_user_id IS NOT NULL,
+                   s.expires_at_ms, s.starts_at_ms, s.auto_renewal_enabled, s.auto_renewal_attempts,
+                   s.saved_payment_method_id, s.subscription_expired_notified, s.last_auto_renewal_attempt_at
+            FROM (SELECT ? AS telegram_id) AS k
+            LEFT JOIN users u ON u.telegram_id = k.telegram_id
+            LEFT JOIN subscriptions s ON s.telegram_id = k.telegram_id
+            LEFT JOIN approved_users a ON a.telegram_user_id = k.telegram_id
+            """,
+            (telegram_id,)
+        )
+        row = await cur.fetchone()
+
+    result = UserState(
+        telegram_id=telegram_id,
+        exists=bool(row[0]),
+        form_filled=row[1] == 1,
+        is_allowed=bool(row[2]),
+        expires_at=from_epoch_ms(row[3]),
+        starts_at=from_epoch_ms(row[4]),
+        auto_renewal_enabled=bool(row[5]),
+        auto_renewal_attempts=int(row[6]) if row[6] is not None else 0,
+        saved_payment_method_id=row[7],
+        subscription_expired_notified=bool(row[8]),
+        last_auto_renewal_attempt_at=_parse_db_datetime(row[9]),
+    )
+    _set_cached(cache_key, result, telegram_id)
     return result
 
 
@@ -279,7 +505,7 @@ async def activate_subscription_days(telegram_id: int, days: float = 30.0) -> tu
     starts_at = datetime.now(timezone.utc)
     expires_at = starts_at + timedelta(days=days)
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         # Гарантируем, что юзер существует
         await db.execute(
             "INSERT OR IGNORE INTO users (telegram_id, username, created_at) VALUES (?, ?, ?)",
@@ -289,20 +515,24 @@ async def activate_subscription_days(telegram_id: int, days: float = 30.0) -> tu
         # Upsert подписки
         await db.execute(
             """
-            INSERT INTO subscriptions (telegram_id, expires_at, starts_at, subscription_expired_notified)
-            VALUES (?, ?, ?, 0) ON CONFLICT(telegram_id) DO
+            INSERT INTO subscriptions (telegram_id, expires_at, starts_at, expires_at_ms, starts_at_ms,
+                                       subscription_expired_notified)
+            VALUES (?, ?, ?, ?, ?, 0) ON CONFLICT(telegram_id) DO
             UPDATE SET expires_at=excluded.expires_at, starts_at=excluded.starts_at,
+                       expires_at_ms=excluded.expires_at_ms, starts_at_ms=excluded.starts_at_ms,
                        auto_renewal_enabled=COALESCE(subscriptions.auto_renewal_enabled, 0),
                        saved_payment_method_id=COALESCE(subscriptions.saved_payment_method_id, NULL),
                        subscription_expired_notified=0
             """,
-            (telegram_id, expires_at.isoformat(), starts_at.isoformat())
+            (telegram_id, expires_at.isoformat(), starts_at.isoformat(), to_epoch_ms(expires_at), to_epoch_ms(starts_at))
         )
         await db.commit()
         
         # Очищаем кэш для этого пользователя
-        _clear_cache()
+        invalidate_user_cache(telegram_id)
     
+    # Новый дедлайн истечения (действует в процессе, где запущен планировщик)
+    expiry_scheduler.schedule(telegram_id, expires_at)
     return starts_at, expires_at
 
 
@@ -313,14 +543,14 @@ async def get_saved_payment_method_id(telegram_id: int) -> Optional[str]:
     if cached is not None:
         return cached
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute(
             "SELECT saved_payment_method_id FROM subscriptions WHERE telegram_id = ?",
             (telegram_id,)
         )
         row = await cur.fetchone()
     result = row[0] if row and row[0] else None
-    _set_cached(cache_key, result)
+    _set_cached(cache_key, result, telegram_id)
     return result
 
 
@@ -331,20 +561,20 @@ async def is_auto_renewal_enabled(telegram_id: int) -> bool:
     if cached is not None:
         return cached
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute(
             "SELECT auto_renewal_enabled FROM subscriptions WHERE telegram_id = ?",
             (telegram_id,)
         )
         row = await cur.fetchone()
     result = bool(row and row[0]) if row else False
-    _set_cached(cache_key, result)
+    _set_cached(cache_key, result, telegram_id)
     return result
 
 
 async def set_auto_renewal(telegram_id: int, enabled: bool, payment_method_id: Optional[str] = None) -> bool:
     """Включает/выключает автопродление (оптимизированная версия)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         if enabled:
             if payment_method_id:
                 await db.execute(
@@ -369,24 +599,26 @@ async def set_auto_renewal(telegram_id: int, enabled: bool, payment_method_id: O
                 (0, telegram_id)
             )
         await db.commit()
-        _clear_cache()  # Очищаем кэш после изменения
+        invalidate_user_cache(telegram_id)  # Очищаем кэш после изменения
+    # Истекшую подписку нужно пересмотреть сразу (например, прекратить попытки автопродления)
+    expiry_scheduler.touch(telegram_id)
     return True
 
 
 async def save_payment_method(telegram_id: int, payment_method_id: str) -> None:
     """Сохраняет payment_method_id (оптимизированная версия)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await db.execute(
             "UPDATE subscriptions SET saved_payment_method_id = ? WHERE telegram_id = ?",
             (payment_method_id, telegram_id)
         )
         await db.commit()
-        _clear_cache()
+        invalidate_user_cache(telegram_id)
 
 
 async def delete_payment_method(telegram_id: int) -> bool:
     """Удаляет сохраненный способ оплаты (оптимизированная версия)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         cur = await db.execute(
             "SELECT saved_payment_method_id FROM subscriptions WHERE telegram_id = ?",
             (telegram_id,)
@@ -401,23 +633,25 @@ async def delete_payment_method(telegram_id: int) -> bool:
             (telegram_id,)
         )
         await db.commit()
-        _clear_cache()
-        return True
+        invalidate_user_cache(telegram_id)
+    expiry_scheduler.touch(telegram_id)
+    return True
 
 
 async def save_payment(telegram_id: int, payment_id: str, status: str = "pending") -> None:
     """Сохраняет платеж (оптимизированная версия)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    created_at = datetime.now(timezone.utc)
+    async with db_write() as db:
         await db.execute(
-            "INSERT OR IGNORE INTO payments (telegram_id, payment_id, status, created_at) VALUES (?, ?, ?, ?)",
-            (telegram_id, payment_id, status, datetime.utcnow().isoformat())
+            "INSERT OR IGNORE INTO payments (telegram_id, payment_id, status, created_at, created_at_ms) VALUES (?, ?, ?, ?, ?)",
+            (telegram_id, payment_id, status, created_at.isoformat(), to_epoch_ms(created_at))
         )
         await db.commit()
 
 
 async def update_payment_status(payment_id: str, status: str) -> None:
     """Обновляет статус платежа (оптимизированная версия)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await db.execute(
             "UPDATE payments SET status = ? WHERE payment_id = ?",
             (status, payment_id)
@@ -427,7 +661,7 @@ async def update_payment_status(payment_id: str, status: str) -> None:
 
 async def get_latest_payment_id(telegram_id: int) -> Optional[str]:
     """Получает последний payment_id (оптимизированная версия с индексом)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute(
             "SELECT payment_id FROM payments WHERE telegram_id = ? ORDER BY id DESC LIMIT 1",
             (telegram_id,)
@@ -438,15 +672,10 @@ async def get_latest_payment_id(telegram_id: int) -> Optional[str]:
 
 async def get_active_pending_payment(telegram_id: int, minutes: int = 10) -> Optional[tuple[str, str]]:
     """Получает активный pending платеж (оптимизированная версия)"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cutoff_time = (datetime.utcnow() - timedelta(minutes=minutes)).isoformat()
+    async with db_read() as db:
+        cutoff_time = now_ms() - minutes * 60 * 1000
         cur = await db.execute(
-            """
-            SELECT payment_id, created_at 
-            FROM payments 
-            WHERE telegram_id = ? AND status = 'pending' AND created_at > ?
-            ORDER BY id DESC LIMIT 1
-            """,
+            queries.ACTIVE_PENDING_PAYMENT,
             (telegram_id, cutoff_time)
         )
         row = await cur.fetchone()
@@ -461,45 +690,128 @@ async def is_user_allowed(telegram_user_id: int) -> bool:
         return cached
     
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_read() as db:
             cur = await db.execute(
                 "SELECT 1 FROM approved_users WHERE telegram_user_id = ?",
                 (telegram_user_id,)
             )
             row = await cur.fetchone()
             result = row is not None
-            _set_cached(cache_key, result)
+            _set_cached(cache_key, result, telegram_user_id)
             return result
     except Exception:
         return False
 
 
+# ================== ДОСТУПНОСТЬ ЛИЧНЫХ ЧАТОВ ==================
+# user_reachability: строка только у недоступных чатов. Пишется из ответов Telegram (Forbidden / chat not found)
+# и из my_chat_member (бот заблокирован / разблокирован), снимается также входящим личным сообщением или нажатием кнопки;
+# читается перед каждой отправкой (кэш) и в SQL фоновых задач
+REACHABILITY_BLOCKED = "blocked"
+REACHABILITY_NOT_FOUND = "not_found"
+
+
+async def is_user_reachable(telegram_id: int) -> bool:
+    """Можно ли писать пользователю (с кэшированием; изменения инвалидируют кэш во всех процессах)"""
+    cache_key = f"reachable_{telegram_id}"
+    cached = _get_cached(cache_key)
+    if cached is not None:
+        return cached
+    async with db_read() as db:
+        cur = await db.execute("SELECT 1 FROM user_reachability WHERE telegram_id = ?", (telegram_id,))
+        result = await cur.fetchone() is None
+    _set_cached(cache_key, result, telegram_id)
+    return result
+
+
+async def mark_user_unreachable(telegram_id: int, status: str, reason: Optional[str] = None) -> None:
+    """Помечает личный чат недоступным (blocked / not_found)"""
+    async with db_write() as db:
+        cur = await db.execute(
+            """
+            INSERT INTO user_reachability (telegram_id, status, reason, updated_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(telegram_id) DO UPDATE SET status = excluded.status, reason = excluded.reason, updated_at = excluded.updated_at
+            WHERE user_reachability.status != excluded.status
+            """,
+            (telegram_id, status, (reason or "")[:500], datetime.now(timezone.utc).isoformat())
+        )
+        await db.commit()
+    if cur.rowcount:
+        logger.info(f"🚫 Пользователь {telegram_id} недоступен ({status}): {reason}")
+    invalidate_user_cache(telegram_id)
+
+
+async def mark_user_reachable(telegram_id: int) -> bool:
+    """Снимает отметку недоступности (пользователь разблокировал бота или написал ему); True - отметка была"""
+    async with db_write() as db:
+        cur = await db.execute("DELETE FROM user_reachability WHERE telegram_id = ?", (telegram_id,))
+        await db.commit()
+    invalidate_user_cache(telegram_id)
+    if cur.rowcount:
+        logger.info(f"✅ Пользователь {telegram_id} снова доступен")
+    return cur.rowcount > 0
+
+
+# ================== УЧАСТНИКИ КАНАЛА ==================
+# channel_members: последний известный статус пользователя в канале (ChatMemberStatus).
+# Пишется из chat_member (bot.py), одобренных заявок, банов/разбанов и сверки через get_chat_member;
+# нет строки - статус неизвестен
+CHANNEL_MEMBER_STATUSES = ("member", "administrator", "creator")
+CHANNEL_MEMBER_KICKED = "kicked"
+CHANNEL_MEMBER_LEFT = "left"
+
+
+async def set_channel_member_status(telegram_id: int, status: str, source: str) -> None:
+    """Сохраняет статус пользователя в канале (source - откуда известен: chat_member, join_request, ban, ...)"""
+    status = getattr(status, "value", status)  # ChatMemberStatus -> строка
+    now = datetime.now(timezone.utc)
+    async with db_write() as db:
+        await db.execute(
+            """
+            INSERT INTO channel_members (telegram_id, status, source, updated_at, updated_at_ms) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(telegram_id) DO UPDATE SET
+                status = excluded.status, source = excluded.source,
+                updated_at = excluded.updated_at, updated_at_ms = excluded.updated_at_ms
+            """,
+            (telegram_id, status, source, now.isoformat(), to_epoch_ms(now))
+        )
+        await db.commit()
+
+
+async def get_channel_member_status(telegram_id: int) -> Optional[str]:
+    """Последний известный статус пользователя в канале; None - неизвестен"""
+    async with db_read() as db:
+        cur = await db.execute("SELECT status FROM channel_members WHERE telegram_id = ?", (telegram_id,))
+        row = await cur.fetchone()
+    return row[0] if row else None
+
+
 async def set_subscription_expired_notified(telegram_id: int, notified: bool = True) -> None:
     """Помечает, что уведомление об истечении подписки было отправлено"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await db.execute(
             "UPDATE subscriptions SET subscription_expired_notified = ? WHERE telegram_id = ?",
             (1 if notified else 0, telegram_id)
         )
         await db.commit()
-        _clear_cache()
+        invalidate_user_cache(telegram_id)
 
 
-async def get_all_active_subscriptions() -> list[tuple[int, str]]:
-    """Получает все активные подписки (telegram_id, expires_at)"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        now = datetime.utcnow().isoformat()
-        cur = await db.execute(
-            "SELECT telegram_id, expires_at FROM subscriptions WHERE expires_at > ?",
-            (now,)
-        )
+async def get_all_active_subscriptions(reachable_only: bool = False) -> list[tuple[int, datetime]]:
+    """Получает все активные подписки (telegram_id, expires_at - timezone-aware UTC)
+    reachable_only - без пользователей, заблокировавших бота (для рассылки уведомлений)"""
+    query = queries.ACTIVE_SUBSCRIPTIONS
+    if reachable_only:
+        query += queries.ACTIVE_SUBSCRIPTIONS_REACHABLE_ONLY
+    async with db_read() as db:
+        cur = await db.execute(query, (now_ms(),))
         rows = await cur.fetchall()
-    return [(row[0], row[1]) for row in rows]
+    return [(row[0], from_epoch_ms(row[1])) for row in rows]
 
 
 async def get_subscription_expired_notified(telegram_id: int) -> bool:
     """Проверяет, было ли отправлено уведомление об истечении подписки"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute(
             "SELECT subscription_expired_notified FROM subscriptions WHERE telegram_id = ?",
             (telegram_id,)
@@ -510,7 +822,7 @@ async def get_subscription_expired_notified(telegram_id: int) -> bool:
 
 async def get_auto_renewal_attempts(telegram_id: int) -> int:
     """Получает количество попыток автопродления"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute(
             "SELECT auto_renewal_attempts FROM subscriptions WHERE telegram_id = ?",
             (telegram_id,)
@@ -521,7 +833,7 @@ async def get_auto_renewal_attempts(telegram_id: int) -> int:
 
 async def increment_auto_renewal_attempts(telegram_id: int) -> None:
     """Увеличивает счетчик попыток автопродления и обновляет время последней попытки"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         now = datetime.utcnow().isoformat()
         await db.execute(
             """
@@ -533,12 +845,12 @@ async def increment_auto_renewal_attempts(telegram_id: int) -> None:
             (now, telegram_id)
         )
         await db.commit()
-    _clear_cache()
+    invalidate_user_cache(telegram_id)
 
 
 async def reset_auto_renewal_attempts(telegram_id: int) -> None:
     """Сбрасывает счетчик попыток автопродления"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await db.execute(
             """
             UPDATE subscriptions 
@@ -549,12 +861,12 @@ async def reset_auto_renewal_attempts(telegram_id: int) -> None:
             (telegram_id,)
         )
         await db.commit()
-    _clear_cache()
+    invalidate_user_cache(telegram_id)
 
 
 async def get_last_auto_renewal_attempt_at(telegram_id: int) -> Optional[datetime]:
     """Получает время последней попытки автопродления"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cur = await db.execute(
             "SELECT last_auto_renewal_attempt_at FROM subscriptions WHERE telegram_id = ?",
             (telegram_id,)
@@ -571,7 +883,7 @@ async def get_last_auto_renewal_attempt_at(telegram_id: int) -> Optional[datetim
 async def get_telegram_user_id_by_invite_link(invite_link: str) -> Optional[int]:
     """Получает telegram_user_id по invite_link (оптимизированная версия)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_read() as db:
             cur = await db.execute(
                 "SELECT telegram_user_id FROM invite_links WHERE invite_link = ? AND revoked = 0",
                 (invite_link,)
@@ -586,7 +898,7 @@ async def get_telegram_user_id_by_invite_link(invite_link: str) -> Optional[int]
 async def get_invite_link(telegram_id: int) -> Optional[str]:
     """Получает последнюю активную ссылку-приглашение (оптимизированная версия)"""
     try:
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_read() as db:
             cur = await db.execute(
                 "SELECT name FROM sqlite_master WHERE type='table' AND name='invite_links'"
             )
@@ -618,13 +930,10 @@ async def cleanup_old_payments(days: int = 90) -> int:
     Удаляет старые платежи старше N дней (кроме успешных)
     Возвращает количество удаленных записей
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        cutoff_date = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    async with db_write() as db:
+        cutoff_date = to_epoch_ms(datetime.now(timezone.utc) - timedelta(days=days))
         cur = await db.execute(
-            """
-            DELETE FROM payments 
-            WHERE created_at < ? AND status NOT IN ('succeeded', 'pending')
-            """,
+            queries.CLEANUP_OLD_PAYMENTS,
             (cutoff_date,)
         )
         deleted = cur.rowcount
@@ -638,12 +947,12 @@ async def cleanup_old_invite_links(days: int = 180) -> int:
     Удаляет старые отозванные ссылки старше N дней
     Возвращает количество удаленных записей
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        cutoff_date = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    async with db_write() as db:
+        cutoff_date = to_epoch_ms(datetime.now(timezone.utc) - timedelta(days=days))
         cur = await db.execute(
             """
             DELETE FROM invite_links 
-            WHERE revoked = 1 AND created_at < ?
+            WHERE revoked = 1 AND created_at_ms < ?
             """,
             (cutoff_date,)
         )
@@ -658,10 +967,10 @@ async def cleanup_old_processed_payments(days: int = 90) -> int:
     Удаляет старые записи processed_payments старше N дней
     Возвращает количество удаленных записей
     """
-    async with aiosqlite.connect(DB_PATH) as db:
-        cutoff_date = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    async with db_write() as db:
+        cutoff_date = to_epoch_ms(datetime.now(timezone.utc) - timedelta(days=days))
         cur = await db.execute(
-            "DELETE FROM processed_payments WHERE processed_at < ?",
+            queries.CLEANUP_OLD_PROCESSED_PAYMENTS,
             (cutoff_date,)
         )
         deleted = cur.rowcount
@@ -688,7 +997,7 @@ import hashlib
 
 async def get_or_create_form_token(telegram_id: int) -> str:
     """Получает существующий токен формы или создает новый для пользователя"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         # Проверяем, есть ли уже токен
         cursor = await db.execute(
             "SELECT form_token FROM users WHERE telegram_id = ?",
@@ -711,7 +1020,7 @@ async def get_or_create_form_token(telegram_id: int) -> str:
         )
         await db.commit()
         
-        _clear_cache()  # Очищаем кэш
+        invalidate_user_cache(telegram_id)  # Очищаем кэш
         return token
 
 
@@ -731,7 +1040,7 @@ async def is_form_filled(telegram_id: int, force_refresh: bool = False) -> bool:
             return cached
     
     # Читаем из БД (всегда актуальные данные)
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cursor = await db.execute(
             "SELECT form_filled FROM users WHERE telegram_id = ?",
             (telegram_id,)
@@ -740,13 +1049,13 @@ async def is_form_filled(telegram_id: int, force_refresh: bool = False) -> bool:
         
         result = bool(row and row[0] == 1) if row else False
         # ВСЕГДА кэшируем результат (даже при force_refresh), чтобы следующий запрос был быстрым
-        _set_cached(cache_key, result)
+        _set_cached(cache_key, result, telegram_id)
         return result
 
 
 async def get_user_by_form_token(token: str) -> Optional[tuple[int, bool]]:
     """Находит пользователя по токену формы. Возвращает (telegram_id, form_filled) или None"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cursor = await db.execute(
             "SELECT telegram_id, form_filled FROM users WHERE form_token = ?",
             (token,)
@@ -761,23 +1070,19 @@ async def get_user_by_form_token(token: str) -> Optional[tuple[int, bool]]:
 
 async def mark_form_as_filled(telegram_id: int) -> None:
     """Отмечает форму как заполненную для пользователя"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await db.execute(
             "UPDATE users SET form_filled = 1, form_filled_at = ? WHERE telegram_id = ?",
             (datetime.utcnow().isoformat(), telegram_id)
         )
         await db.commit()
         
-        # Очищаем кэш для этого конкретного пользователя
+        # Очищаем кэш этого пользователя
         cache_key = f"form_filled_{telegram_id}"
-        if cache_key in _cache:
-            del _cache[cache_key]
-        
-        # Также очищаем весь кэш на всякий случай
-        _clear_cache()
+        invalidate_user_cache(telegram_id)
         
         # Сразу устанавливаем правильное значение в кэш
-        _set_cached(cache_key, True)
+        _set_cached(cache_key, True, telegram_id)
 
 
 async def get_users_list() -> list[dict]:
@@ -785,42 +1090,34 @@ async def get_users_list() -> list[dict]:
     from datetime import timezone
     now = datetime.now(timezone.utc)
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cursor = await db.execute("""
             SELECT 
                 u.telegram_id,
                 u.username,
-                s.expires_at,
+                s.expires_at_ms,
                 s.starts_at,
                 s.auto_renewal_enabled
             FROM users u
             LEFT JOIN subscriptions s ON u.telegram_id = s.telegram_id
             ORDER BY 
                 CASE 
-                    WHEN s.expires_at IS NOT NULL AND datetime(s.expires_at) > datetime(?) THEN 1
+                    WHEN s.expires_at_ms > ? THEN 1
                     ELSE 2
                 END,
-                s.expires_at DESC,
+                s.expires_at_ms DESC,
                 u.created_at DESC
-        """, (now.isoformat(),))
+        """, (to_epoch_ms(now),))
         
         rows = await cursor.fetchall()
         
         users_list = []
         for row in rows:
-            telegram_id, username, expires_at_str, starts_at_str, auto_renewal_enabled = row
+            telegram_id, username, expires_at_ms, starts_at_str, auto_renewal_enabled = row
             
             # Определяем статус подписки
-            is_active = False
-            expires_at = None
-            if expires_at_str:
-                try:
-                    expires_at = datetime.fromisoformat(expires_at_str)
-                    if expires_at.tzinfo is None:
-                        expires_at = expires_at.replace(tzinfo=timezone.utc)
-                    is_active = expires_at > now
-                except (ValueError, TypeError):
-                    pass
+            expires_at = from_epoch_ms(expires_at_ms)
+            is_active = expires_at is not None and expires_at > now
             
             users_list.append({
                 'telegram_id': telegram_id,
@@ -837,7 +1134,7 @@ async def get_users_list() -> list[dict]:
 async def get_bonus_week_start_time() -> Optional[datetime]:
     """Получает время начала бонусной недели из базы данных"""
     from datetime import timezone
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_read() as db:
         cursor = await db.execute(
             "SELECT start_time FROM bonus_week_config WHERE id = 1"
         )
@@ -866,7 +1163,7 @@ async def set_bonus_week_start_time(start_time: datetime) -> None:
     start_time_str = start_time.isoformat()
     updated_at_str = datetime.now(timezone.utc).isoformat()
     
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         # Используем INSERT OR REPLACE для обновления существующей записи
         await db.execute(
             """
@@ -0,0 +1,125 @@
+"""
+Целочисленные колонки времени (миллисекунды Unix epoch, UTC)
+Исторически время хранится ISO-строками вперемешку: наивный datetime.utcnow().isoformat()
+и timezone-aware "...+00:00". Строки с разным форматом нельзя корректно сравнивать в SQL,
+а datetime(expires_at) в WHERE отключает индекс.
+
+Для каждой такой колонки заводится теневая INTEGER-колонка *_ms:
+- код db.py/webhook_app.py пишет обе колонки и фильтрует/сортирует только по *_ms (индексы по *_ms);
+- триггеры заполняют *_ms, если ISO-колонку изменил кто-то другой (скрипты обслуживания, старый процесс);
+- существующие строки заполняются пачками (backfill_epoch_columns), не блокируя запись надолго.
+ISO-колонки остаются для совместимости (отчеты, скрипты), но источник истины для сравнений - *_ms.
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Таблица -> [(ISO-колонка, теневая колонка в миллисекундах)]
+EPOCH_COLUMNS = {
+    "subscriptions": [("expires_at", "expires_at_ms"), ("starts_at", "starts_at_ms")],
+    "payments": [("created_at", "created_at_ms")],
+    "invite_links": [("created_at", "created_at_ms")],
+    "processed_payments": [("processed_at", "processed_at_ms")],
+}
+
+BACKFILL_BATCH_SIZE = 2000
+
+
+def to_epoch_ms(value: Optional[datetime]) -> Optional[int]:
+    """datetime -> миллисекунды UTC (наивный datetime считается UTC, как и везде в проекте)"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(round(value.timestamp() * 1000))
+
+
+def from_epoch_ms(value: Optional[int]) -> Optional[datetime]:
+    """Миллисекунды UTC -> timezone-aware datetime (UTC)"""
+    if value is None:
+        return None
+    return datetime.fromtimestamp(value / 1000, tz=timezone.utc)
+
+
+def now_ms() -> int:
+    return to_epoch_ms(datetime.now(timezone.utc))
+
+
+def iso_to_ms_sql(column: str) -> str:
+    """SQL-выражение ISO-строка -> миллисекунды; julianday понимает и наивный, и "+00:00" формат,
+    для некорректных строк возвращает NULL"""
+    return f"CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)"
+
+
+async def _table_columns(db, table: str) -> set[str]:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in await cur.fetchall()}
+
+
+async def ensure_epoch_columns(db, tables) -> None:
+    """Добавляет колонки *_ms, индексы по ним и триггеры синхронизации для существующих таблиц из tables
+    Вызывается внутри транзакции инициализации схемы (db_write)"""
+    for table in tables:
+        columns = await _table_columns(db, table)
+        if not columns:
+            continue  # Таблица еще не создана этим процессом
+        for iso_col, ms_col in EPOCH_COLUMNS[table]:
+            if ms_col not in columns:
+                await db.execute(f"ALTER TABLE {table} ADD COLUMN {ms_col} INTEGER")
+            await db.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{ms_col} ON {table}({ms_col})")
+            expr = iso_to_ms_sql(f"NEW.{iso_col}")
+            # Вставка без *_ms (старый код/скрипты) - вычисляем из ISO
+            await db.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{ms_col}_insert
+                AFTER INSERT ON {table}
+                WHEN NEW.{iso_col} IS NOT NULL AND NEW.{ms_col} IS NULL
+                BEGIN
+                    UPDATE {table} SET {ms_col} = {expr} WHERE rowid = NEW.rowid;
+                END
+            """)
+            # ISO-колонку изменили, а *_ms оставили прежней - пересчитываем
+            await db.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_{table}_{ms_col}_update
+                AFTER UPDATE OF {iso_col} ON {table}
+                WHEN NEW.{iso_col} IS NOT OLD.{iso_col} AND NEW.{ms_col} IS OLD.{ms_col}
+                BEGIN
+                    UPDATE {table} SET {ms_col} = {expr} WHERE rowid = NEW.rowid;
+                END
+            """)
+
+
+async def backfill_epoch_columns(db_write, tables, batch_size: int = BACKFILL_BATCH_SIZE) -> int:
+    """Заполняет *_ms у строк, записанных до появления колонок. Пачками по batch_size строк,
+    каждая пачка - отдельная короткая транзакция, чтобы другой процесс мог писать между ними.
+    db_write - фабрика соединения на запись (db.db_write). Возвращает количество обновленных строк"""
+    total = 0
+    for table in tables:
+        for iso_col, ms_col in EPOCH_COLUMNS[table]:
+            expr = iso_to_ms_sql(iso_col)
+            while True:
+                async with db_write() as db:
+                    if not await _table_columns(db, table):
+                        break
+                    cur = await db.execute(
+                        f"""
+                        UPDATE {table} SET {ms_col} = {expr}
+                        WHERE rowid IN (
+                            SELECT rowid FROM {table}
+                            WHERE {ms_col} IS NULL AND {iso_col} IS NOT NULL AND {expr} IS NOT NULL
+                            LIMIT ?
+                        )
+                        """,
+                        (batch_size,)
+                    )
+                    await db.commit()
+                    updated = cur.rowcount
+                total += updated
+                if updated < batch_size:
+                    break
+                await asyncio.sleep(0)
+    if total:
+        logger.info(f"✅ Заполнены колонки времени в миллисекундах: {total} строк")
+    return total
@@ -0,0 +1,143 @@
+"""
+Планировщик сроков истечения подписок
+Хранит в памяти min-heap дедлайнов (expires_at и время следующей попытки автопродления),
+чтобы фоновая задача спала ровно до ближайшего дедлайна, а не сканировала таблицу каждые 10 секунд
+"""
+import asyncio
+import heapq
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _to_timestamp(when: datetime) -> float:
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.timestamp()
+
+
+class ExpiryScheduler:
+    """Min-heap дедлайнов по telegram_id с ленивым удалением устаревших записей"""
+
+    def __init__(self):
+        self._heap: list[tuple[float, int]] = []
+        # Актуальный дедлайн пользователя; None - пользователь известен, но ждать нечего
+        self._deadlines: dict[int, Optional[float]] = {}
+        # expires_at, по которому пользователь уже обработан: сверка не ставит его в очередь повторно
+        self._processed: dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self.active = False  # Включается в процессе, где запущена фоновая задача (webhook_app)
+
+    def load(self, rows) -> None:
+        """Заполняет расписание при старте: rows = [(telegram_id, expires_at), ...]"""
+        self._heap.clear()
+        self._deadlines.clear()
+        self._processed.clear()
+        for telegram_id, expires_at in rows:
+            if expires_at is None:
+                continue
+            ts = _to_timestamp(expires_at)
+            self._deadlines[telegram_id] = ts
+            self._heap.append((ts, telegram_id))
+        heapq.heapify(self._heap)
+        self.active = True
+        self._wakeup.set()
+        logger.info(f"✅ Расписание истечения подписок загружено: {len(self._heap)} дедлайнов")
+
+    def schedule(self, telegram_id: int, when: Optional[datetime]) -> None:
+        """Устанавливает (или переносит) дедлайн пользователя"""
+        if not self.active:
+            return
+        if when is None:
+            self._deadlines[telegram_id] = None
+            return
+        ts = _to_timestamp(when)
+        self._deadlines[telegram_id] = ts
+        heapq.heappush(self._heap, (ts, telegram_id))
+        if self._heap[0][0] == ts:
+            # Новый дедлайн стал ближайшим - будим ожидающую задачу
+            self._wakeup.set()
+
+    def merge(self, rows) -> None:
+        """Сверка с БД: rows = [(telegram_id, expires_at), ...]
+        Добавляет новых пользователей и переносит дедлайн, если в БД он раньше; уже обработанных
+        возвращает в расписание, только если expires_at в БД изменился (подписку продлил другой процесс - bot.py)"""
+        for telegram_id, expires_at in rows:
+            if expires_at is None:
+                continue
+            ts = _to_timestamp(expires_at)
+            processed = self._processed.get(telegram_id)
+            if processed is not None:
+                # Бонусная подписка или ожидание следующей попытки автопродления - повторять обработку незачем
+                if ts != processed:
+                    del self._processed[telegram_id]
+                    self.schedule(telegram_id, expires_at)
+                continue
+            # None - пользователь уже обработан и ждать было нечего: дедлайн из БД назначен заново
+            known = self._deadlines.get(telegram_id)
+            if known is None or ts < known:
+                self.schedule(telegram_id, expires_at)
+
+    def mark_processed(self, telegram_id: int, expires_at: Optional[datetime]) -> None:
+        """Запоминает expires_at, по которому пользователь обработан (сверка merge его пропустит)"""
+        if not self.active or expires_at is None:
+            return
+        self._processed[telegram_id] = _to_timestamp(expires_at)
+
+    def touch(self, telegram_id: int) -> None:
+        """Просит пересмотреть пользователя немедленно (например, изменились настройки автопродления)
+        Если подписка ещё активна, обработчик просто вернёт её дедлайн на expires_at"""
+        if self._deadlines.get(telegram_id) is not None:
+            self.schedule(telegram_id, datetime.now(timezone.utc))
+
+    def cancel(self, telegram_id: int) -> None:
+        """Убирает пользователя из расписания (подписка удалена)"""
+        self._deadlines.pop(telegram_id, None)
+        self._processed.pop(telegram_id, None)
+
+    def next_deadline(self) -> Optional[float]:
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def __len__(self) -> int:
+        return sum(1 for ts in self._deadlines.values() if ts is not None)
+
+    def _drop_stale(self) -> None:
+        while self._heap:
+            ts, telegram_id = self._heap[0]
+            if self._deadlines.get(telegram_id) == ts:
+                return
+            heapq.heappop(self._heap)
+
+    def _pop_due(self, now: float) -> list[int]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            ts, telegram_id = heapq.heappop(self._heap)
+            if self._deadlines.get(telegram_id) != ts:
+                continue  # Дедлайн был перенесён
+            # Пользователь остаётся известным, пока обработчик не назначит новый дедлайн
+            self._deadlines[telegram_id] = None
+            due.append(telegram_id)
+        return due
+
+    async def wait_due(self, max_wait: float) -> list[int]:
+        """Спит до ближайшего дедлайна (но не дольше max_wait) и возвращает наступившие telegram_id"""
+        wait_until = time.time() + max_wait
+        while True:
+            now = time.time()
+            due = self._pop_due(now)
+            if due or now >= wait_until:
+                return due
+            next_ts = self.next_deadline()
+            delay = wait_until - now if next_ts is None else min(next_ts, wait_until) - now
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+
+expiry_scheduler = ExpiryScheduler()
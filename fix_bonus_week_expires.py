@@ -3,16 +3,21 @@
 Скрипт для исправления дат окончания подписок в БД
 Устанавливает одинаковую дату окончания (14.01.2026 10:58:42 UTC) для всех подписок, созданных во время бонусной недели
 """
+import asyncio
 import os
 import sqlite3
 from datetime import datetime, timezone
 
+from migrations import migrate_database
+
 # Пытаемся прочитать DB_PATH из переменных окружения или используем стандартный путь
 DB_PATH = os.getenv("DB_PATH", "/opt/bot_telegram/bot.db")
 BONUS_WEEK_END = datetime(2026, 1, 14, 10, 58, 42, tzinfo=timezone.utc)
 
 def fix_bonus_week_expires():
     """Исправляет даты окончания подписок для бонусной недели"""
+    # Схема БД - общий путь миграций (migrations.py); триггеры обновят expires_at_ms вместе с expires_at
+    asyncio.run(migrate_database(DB_PATH))
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
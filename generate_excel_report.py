@@ -881,11 +881,16 @@ def create_summary_sheet(wb, conn):
     ws.cell(row=row, column=2, value=user_count)
     row += 1
     
+    # Сравниваем по expires_at_ms (мс epoch UTC): ISO-строки в БД разного формата
+    # и не сравниваются корректно с datetime('now')
+    now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    day_ms = 24 * 60 * 60 * 1000
+    
     # Количество активных подписок
     cur.execute("""
         SELECT COUNT(*) FROM subscriptions 
-        WHERE expires_at > datetime('now', 'utc')
-    """)
+        WHERE expires_at_ms > ?
+    """, (now_ms,))
     active_subs = cur.fetchone()[0]
     ws.cell(row=row, column=1, value="Активных подписок:")
     ws.cell(row=row, column=2, value=active_subs)
@@ -894,8 +899,8 @@ def create_summary_sheet(wb, conn):
     # Истекших подписок
     cur.execute("""
         SELECT COUNT(*) FROM subscriptions 
-        WHERE expires_at <= datetime('now', 'utc')
-    """)
+        WHERE expires_at_ms <= ?
+    """, (now_ms,))
     expired_subs = cur.fetchone()[0]
     ws.cell(row=row, column=1, value="Истекших подписок:")
     ws.cell(row=row, column=2, value=expired_subs)
@@ -904,9 +909,9 @@ def create_summary_sheet(wb, conn):
     # Подписок истекает в течение 24 часов
     cur.execute("""
         SELECT COUNT(*) FROM subscriptions 
-        WHERE expires_at > datetime('now', 'utc')
-        AND expires_at <= datetime('now', '+1 day', 'utc')
-    """)
+        WHERE expires_at_ms > ?
+        AND expires_at_ms <= ?
+    """, (now_ms, now_ms + day_ms))
     expiring_24h = cur.fetchone()[0]
     ws.cell(row=row, column=1, value="Истекает в течение 24 часов:")
     ws.cell(row=row, column=2, value=expiring_24h)
@@ -915,9 +920,9 @@ def create_summary_sheet(wb, conn):
     # Подписок истекает в течение 7 дней
     cur.execute("""
         SELECT COUNT(*) FROM subscriptions 
-        WHERE expires_at > datetime('now', 'utc')
-        AND expires_at <= datetime('now', '+7 days', 'utc')
-    """)
+        WHERE expires_at_ms > ?
+        AND expires_at_ms <= ?
+    """, (now_ms, now_ms + 7 * day_ms))
     expiring_7d = cur.fetchone()[0]
     ws.cell(row=row, column=1, value="Истекает в течение 7 дней:")
     ws.cell(row=row, column=2, value=expiring_7d)
@@ -1004,10 +1009,10 @@ def create_summary_sheet(wb, conn):
     
     # Средняя длительность активных подписок
     cur.execute("""
-        SELECT AVG((julianday(expires_at) - julianday(starts_at))) 
+        SELECT AVG((expires_at_ms - starts_at_ms) / 86400000.0) 
         FROM subscriptions 
-        WHERE expires_at > datetime('now', 'utc') AND starts_at IS NOT NULL
-    """)
+        WHERE expires_at_ms > ? AND starts_at_ms IS NOT NULL
+    """, (now_ms,))
     avg_duration = cur.fetchone()[0]
     if avg_duration:
         ws.cell(row=row, column=1, value="Средняя длительность активных подписок (дн.):")
@@ -0,0 +1,186 @@
+"""
+Пул заранее созданных ссылок-приглашений в канал (строки invite_links со state='pool')
+Оплативший пользователь получает готовую ссылку без обращения к Telegram; пул пополняется в фоне
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+
+from config import INVITE_LINK_POOL_SIZE, INVITE_LINK_POOL_CHECK_INTERVAL_SECONDS
+from db import db_read, db_write
+from epoch_columns import from_epoch_ms, to_epoch_ms
+import queries
+from telegram_utils import TelegramSendScheduler, safe_create_invite_link, PRIORITY_BROADCAST
+
+logger = logging.getLogger(__name__)
+
+STATE_POOL = "pool"
+STATE_ASSIGNED = "assigned"
+
+
+class InviteLinkPool:
+    """Свободные ссылки с заявкой на вступление в invite_links и фоновое пополнение"""
+
+    def __init__(self, size: int = INVITE_LINK_POOL_SIZE):
+        self.size = size
+        self._bot: Optional[Bot] = None
+        self._chat_id: Optional[int] = None
+        self._scheduler: Optional[TelegramSendScheduler] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self.assigned = 0
+        self.misses = 0
+        self.created = 0
+
+    def start(self, bot: Bot, chat_id: int, scheduler: Optional[TelegramSendScheduler] = None) -> None:
+        """Запускает пополнение пула (один раз на процесс)"""
+        self._bot = bot
+        self._chat_id = chat_id
+        self._scheduler = scheduler
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    async def link_for_payment(self, telegram_id: int, payment_id: str) -> Optional[str]:
+        """Ссылка, уже выданная пользователю за этот платеж; None - еще не выдавалась"""
+        async with db_read() as db:
+            cur = await db.execute(queries.INVITE_LINK_FOR_PAYMENT, (telegram_id, payment_id))
+            row = await cur.fetchone()
+        return row[0] if row else None
+
+    async def take(self, telegram_id: int, payment_id: str, expire_date: Optional[datetime] = None) -> Optional[str]:
+        """Выдает пользователю свободную ссылку пула; None - пул пуст
+        Повторная обработка того же платежа получает уже выданную за него ссылку, а не новую.
+        Срок действия (expire_date) сохраняется вместе с выдачей и выставляется в Telegram фоновой задачей пула"""
+        now = datetime.now(timezone.utc)
+        async with db_write() as db:
+            cur = await db.execute(queries.INVITE_LINK_FOR_PAYMENT, (telegram_id, payment_id))
+            row = await cur.fetchone()
+            if row is not None:
+                logger.info(f"🔗 Ссылка за платеж {payment_id} уже выдана пользователю {telegram_id}, выдаем ее же")
+                return row[0]
+            cur = await db.execute(
+                queries.INVITE_LINK_POOL_TAKE,
+                (
+                    STATE_ASSIGNED, telegram_id, payment_id, now.isoformat(), to_epoch_ms(now),
+                    to_epoch_ms(expire_date), int(expire_date is not None), STATE_POOL,
+                )
+            )
+            row = await cur.fetchone()
+            await db.commit()
+        # Пополнение пула и срок действия выданной ссылки - в фоновой задаче
+        self._wakeup.set()
+        if row is None:
+            self.misses += 1
+            logger.warning(f"⚠️ Пул ссылок пуст, ссылка для пользователя {telegram_id} будет создана напрямую")
+            return None
+        self.assigned += 1
+        return row[0]
+
+    async def apply_expire_dates(self) -> int:
+        """Выставляет выданным ссылкам срок действия = срок подписки (как у ссылок, создаваемых напрямую)
+        Не получилось - ссылка остается в очереди до следующего тика; возвращает количество примененных"""
+        async with db_read() as db:
+            cur = await db.execute(queries.INVITE_LINK_EXPIRE_PENDING)
+            rows = await cur.fetchall()
+        applied = 0
+        for invite_link, expire_date_ms in rows:
+            expire_date = from_epoch_ms(expire_date_ms)
+            try:
+                if expire_date <= datetime.now(timezone.utc):
+                    # Подписка уже закончилась (процесс был остановлен) - ссылка больше не нужна
+                    await self._bot.revoke_chat_invite_link(chat_id=self._chat_id, invite_link=invite_link)
+                else:
+                    await self._bot.edit_chat_invite_link(
+                        chat_id=self._chat_id,
+                        invite_link=invite_link,
+                        expire_date=expire_date,
+                        creates_join_request=True,
+                    )
+            except TelegramBadRequest as e:
+                # Ссылка уже недействительна в Telegram - выставлять нечего
+                logger.warning(f"⚠️ Срок действия ссылки из пула не выставлен, ссылка недействительна: {e}")
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось выставить срок действия ссылки из пула, повторим позже: {e}")
+                continue
+            async with db_write() as db:
+                await db.execute("UPDATE invite_links SET expire_date_pending = 0 WHERE invite_link = ?", (invite_link,))
+                await db.commit()
+            applied += 1
+        return applied
+
+    async def available(self) -> int:
+        async with db_read() as db:
+            cur = await db.execute(
+                "SELECT COUNT(*) FROM invite_links WHERE state = ? AND revoked = 0", (STATE_POOL,)
+            )
+            return (await cur.fetchone())[0]
+
+    async def refill(self) -> int:
+        """Досоздает ссылки до size; возвращает количество созданных"""
+        created = 0
+        missing = self.size - await self.available()
+        for _ in range(max(missing, 0)):
+            if self._scheduler is not None:
+                # Общий лимит запросов процесса: оплаты и уведомления идут раньше пополнения
+                await self._scheduler.acquire(self._chat_id, PRIORITY_BROADCAST)
+            invite_link = await safe_create_invite_link(
+                bot=self._bot,
+                chat_id=self._chat_id,
+                creates_join_request=True,
+            )
+            if not invite_link:
+                break  # Telegram недоступен - попробуем на следующем тике
+            now = datetime.now(timezone.utc)
+            async with db_write() as db:
+                await db.execute(
+                    "INSERT INTO invite_links (invite_link, created_at, created_at_ms, state) VALUES (?, ?, ?, ?)",
+                    (invite_link, now.isoformat(), to_epoch_ms(now), STATE_POOL)
+                )
+                await db.commit()
+            created += 1
+        self.created += created
+        if created:
+            logger.info(f"🔗 Пул ссылок пополнен на {created} (цель {self.size})")
+        return created
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.apply_expire_dates()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка выставления срока действия ссылок пула: {e}")
+            try:
+                await self.refill()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка пополнения пула ссылок: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=INVITE_LINK_POOL_CHECK_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stats(self) -> dict:
+        return {
+            "available": await self.available(),
+            "size": self.size,
+            "assigned": self.assigned,
+            "misses": self.misses,
+            "created": self.created,
+        }
+
+
+invite_link_pool = InviteLinkPool()
@@ -0,0 +1,262 @@
+"""
+Реестр загруженных в Telegram файлов (приветственное видео /start, видео рассылок)
+Хранит file_id и метаданные видео (ffprobe) по sha256 содержимого: файл загружается и анализируется один раз
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Optional, Union
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+
+from db import db_read, db_write
+
+logger = logging.getLogger(__name__)
+
+KIND_VIDEO = "video"
+KIND_ANIMATION = "animation"
+KIND_DOCUMENT = "document"
+
+HASH_CHUNK_SIZE = 1024 * 1024
+FFPROBE_TIMEOUT_SECONDS = 10
+
+
+@dataclass(frozen=True)
+class VideoMetadata:
+    width: Optional[int]
+    height: Optional[int]
+    duration: Optional[float]
+
+
+async def init_media_table(db) -> None:
+    """Создает таблицу file_id (вызывается из migrations.py)"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS media_files (
+            content_hash TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            uploaded_at TEXT NOT NULL,
+            PRIMARY KEY (content_hash, kind)
+        )
+    """)
+
+
+async def init_media_metadata_table(db) -> None:
+    """Создает таблицу метаданных видео (вызывается из migrations.py)"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS media_metadata (
+            content_hash TEXT PRIMARY KEY,
+            width INTEGER,
+            height INTEGER,
+            duration REAL,
+            probed_at TEXT NOT NULL
+        )
+    """)
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def probe_video(path: str) -> Optional[VideoMetadata]:
+    """ffprobe первого видеопотока; None - ffprobe не установлен или не смог прочитать файл"""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", "-select_streams", "v:0",
+            "-show_entries", "stream=width,height,duration", "-of", "json", path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except OSError as e:
+        logger.warning(f"⚠️ ffprobe недоступен: {e}")
+        return None
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=FFPROBE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logger.warning(f"⚠️ ffprobe не уложился в {FFPROBE_TIMEOUT_SECONDS} с для {path}")
+        return None
+    if process.returncode != 0:
+        logger.warning(f"⚠️ ffprobe не смог прочитать {path}: {stderr.decode(errors='replace').strip()}")
+        return None
+    streams = json.loads(stdout or b"{}").get("streams") or []
+    if not streams:
+        return None
+    stream = streams[0]
+    return VideoMetadata(
+        width=int(stream["width"]) if stream.get("width") else None,
+        height=int(stream["height"]) if stream.get("height") else None,
+        duration=float(stream["duration"]) if stream.get("duration") else None,
+    )
+
+
+def _extract_file_id(message: Any, kind: str) -> Optional[str]:
+    """file_id из ответа Telegram (mp4, отправленный как animation, может вернуться и как document)"""
+    for attr in (kind, KIND_VIDEO, KIND_ANIMATION, KIND_DOCUMENT):
+        media = getattr(message, attr, None)
+        if media is not None:
+            return media.file_id
+    return None
+
+
+class MediaRegistry:
+    """Отправка локальных файлов через сохраненный file_id с загрузкой по необходимости"""
+
+    def __init__(self):
+        # path -> (size, mtime_ns, sha256): хэш пересчитывается только при изменении файла
+        self._hashes: dict[str, tuple[int, int, str]] = {}
+        self._file_ids: dict[tuple[str, str], str] = {}
+        self._upload_locks: dict[tuple[str, str], asyncio.Lock] = {}
+        # sha256 -> метаданные (None - ffprobe не смог, повторно не пробуем до изменения файла)
+        self._metadata: dict[str, Optional[VideoMetadata]] = {}
+        self._probe_locks: dict[str, asyncio.Lock] = {}
+        self.uploads = 0
+        self.reused = 0
+
+    async def file_hash(self, path: str) -> str:
+        """sha256 содержимого файла (чтение - в отдельном потоке, не блокируя event loop)"""
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        content_hash = await asyncio.to_thread(_sha256, path)
+        self._hashes[path] = (stat.st_size, stat.st_mtime_ns, content_hash)
+        return content_hash
+
+    async def get_file_id(self, content_hash: str, kind: str) -> Optional[str]:
+        key = (content_hash, kind)
+        if key in self._file_ids:
+            return self._file_ids[key]
+        async with db_read() as db:
+            cur = await db.execute(
+                "SELECT file_id FROM media_files WHERE content_hash = ? AND kind = ?",
+                (content_hash, kind)
+            )
+            row = await cur.fetchone()
+        if row:
+            self._file_ids[key] = row[0]
+            return row[0]
+        return None
+
+    async def _save_file_id(self, content_hash: str, kind: str, file_id: str, path: str) -> None:
+        self._file_ids[(content_hash, kind)] = file_id
+        async with db_write() as db:
+            await db.execute(
+                """
+                INSERT INTO media_files (content_hash, kind, file_id, path, size, uploaded_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(content_hash, kind) DO UPDATE SET
+                    file_id = excluded.file_id, path = excluded.path, uploaded_at = excluded.uploaded_at
+                """,
+                (content_hash, kind, file_id, path, os.path.getsize(path), datetime.now(timezone.utc).isoformat())
+            )
+            await db.commit()
+
+    async def _forget(self, content_hash: str, kind: str) -> None:
+        self._file_ids.pop((content_hash, kind), None)
+        async with db_write() as db:
+            await db.execute("DELETE FROM media_files WHERE content_hash = ? AND kind = ?", (content_hash, kind))
+            await db.commit()
+
+    async def send(
+        self,
+        path: str,
+        kind: str,
+        send: Callable[[Union[str, FSInputFile]], Awaitable[Any]],
+    ) -> Any:
+        """Отправляет файл: send(file_id) если он известен, иначе send(FSInputFile(path)) и сохраняет file_id
+        Ошибки send пробрасываются; TelegramBadRequest про файл при отправке по file_id - повод загрузить файл заново"""
+        content_hash = await self.file_hash(path)
+        key = (content_hash, kind)
+
+        file_id = await self.get_file_id(content_hash, kind)
+        if file_id is None:
+            lock = self._upload_locks.setdefault(key, asyncio.Lock())
+            async with lock:
+                file_id = await self.get_file_id(content_hash, kind)
+                if file_id is None:
+                    return await self._upload(path, content_hash, kind, send)
+
+        try:
+            result = await send(file_id)
+            self.reused += 1
+            return result
+        except TelegramBadRequest as e:
+            if "file" not in str(e).lower():
+                raise  # Ошибка не про файл (чат не найден и т.п.) - file_id остается
+            logger.warning(f"⚠️ Telegram отверг сохраненный file_id для {path} ({kind}): {e}, загружаю файл заново")
+        await self._forget(content_hash, kind)
+        async with self._upload_locks.setdefault(key, asyncio.Lock()):
+            # Пока ждали блокировку, файл мог загрузить заново другой отправитель
+            fresh_file_id = await self.get_file_id(content_hash, kind)
+            if fresh_file_id is not None and fresh_file_id != file_id:
+                return await send(fresh_file_id)
+            return await self._upload(path, content_hash, kind, send)
+
+    async def _upload(self, path: str, content_hash: str, kind: str, send: Callable) -> Any:
+        result = await send(FSInputFile(path))
+        self.uploads += 1
+        file_id = _extract_file_id(result, kind)
+        if file_id:
+            await self._save_file_id(content_hash, kind, file_id, path)
+            logger.info(f"✅ Файл {path} загружен в Telegram ({kind}), file_id сохранен")
+        return result
+
+    async def video_metadata(self, path: str) -> Optional[VideoMetadata]:
+        """Метаданные видео: из памяти, из media_metadata или (один раз на содержимое) через ffprobe"""
+        content_hash = await self.file_hash(path)
+        if content_hash in self._metadata:
+            return self._metadata[content_hash]
+        async with self._probe_locks.setdefault(content_hash, asyncio.Lock()):
+            if content_hash in self._metadata:
+                return self._metadata[content_hash]
+            async with db_read() as db:
+                cur = await db.execute(
+                    "SELECT width, height, duration FROM media_metadata WHERE content_hash = ?",
+                    (content_hash,)
+                )
+                row = await cur.fetchone()
+            if row:
+                metadata = VideoMetadata(*row)
+            else:
+                metadata = await probe_video(path)
+                if metadata is not None:
+                    async with db_write() as db:
+                        await db.execute(
+                            "INSERT OR REPLACE INTO media_metadata (content_hash, width, height, duration, probed_at) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (content_hash, metadata.width, metadata.height, metadata.duration,
+                             datetime.now(timezone.utc).isoformat())
+                        )
+                        await db.commit()
+                    logger.info(f"📐 Метаданные {path}: {metadata.width}x{metadata.height}, {metadata.duration} с")
+            self._metadata[content_hash] = metadata
+            return metadata
+
+    async def warm_up(self, paths: list[str]) -> None:
+        """Считает хэши и метаданные существующих файлов заранее (при старте), чтобы /start не ждал"""
+        for path in paths:
+            if not os.path.exists(path):
+                continue
+            try:
+                await self.video_metadata(path)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось подготовить метаданные {path}: {e}")
+
+    def stats(self) -> dict:
+        return {"uploads": self.uploads, "reused": self.reused, "known_file_ids": len(self._file_ids)}
+
+
+media_registry = MediaRegistry()
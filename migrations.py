@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+Версионные миграции схемы БД (PRAGMA user_version)
+Единый упорядоченный путь создания/изменения схемы для bot.py, webhook_app.py и скриптов обслуживания.
+Каждая миграция - пронумерованный шаг; номер последней примененной хранится в PRAGMA user_version,
+поэтому при актуальной схеме старт процесса - одна проверка версии.
+
+Шаг применяется в транзакции BEGIN IMMEDIATE вместе с обновлением user_version; версия
+перепроверяется внутри транзакции, так что два процесса, стартующие одновременно, не применят шаг дважды.
+"Онлайн" шаги (долгое заполнение данных) сами управляют транзакциями и выполняются пачками.
+
+Добавление миграции: новая функция + запись в конец MIGRATIONS. Уже выпущенные шаги не изменять.
+
+Запуск вручную: python migrations.py [путь_к_БД]
+"""
+import asyncio
+import logging
+import os
+import sys
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Awaitable, Callable
+
+import aiosqlite
+
+from epoch_columns import EPOCH_COLUMNS, backfill_epoch_columns, ensure_epoch_columns
+
+logger = logging.getLogger(__name__)
+
+
+async def _columns(db, table: str) -> set[str]:
+    cur = await db.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in await cur.fetchall()}
+
+
+async def _add_columns(db, table: str, columns: dict[str, str]) -> None:
+    """Добавляет недостающие колонки (БД, созданные старыми версиями кода, без user_version)"""
+    existing = await _columns(db, table)
+    for name, definition in columns.items():
+        if name not in existing:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+
+
+# ================== ШАГИ МИГРАЦИЙ ==================
+async def _base_schema(db) -> None:
+    """Основные таблицы и индексы (то, что раньше создавали init_db и init_webhook_tables)"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id INTEGER PRIMARY KEY,
+            username TEXT,
+            created_at TEXT NOT NULL,
+            form_token TEXT,
+            form_filled INTEGER DEFAULT 0,
+            form_filled_at TEXT
+        )
+    """)
+    await _add_columns(db, "users", {
+        "form_token": "TEXT",
+        "form_filled": "INTEGER DEFAULT 0",
+        "form_filled_at": "TEXT",
+    })
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            telegram_id INTEGER PRIMARY KEY,
+            expires_at TEXT,
+            starts_at TEXT,
+            auto_renewal_enabled INTEGER DEFAULT 0,
+            saved_payment_method_id TEXT,
+            subscription_expired_notified INTEGER DEFAULT 0,
+            auto_renewal_attempts INTEGER DEFAULT 0,
+            last_auto_renewal_attempt_at TEXT,
+            FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
+        )
+    """)
+    await _add_columns(db, "subscriptions", {
+        "subscription_expired_notified": "INTEGER DEFAULT 0",
+        "auto_renewal_attempts": "INTEGER DEFAULT 0",
+        "last_auto_renewal_attempt_at": "TEXT",
+    })
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            payment_id TEXT NOT NULL UNIQUE,
+            status TEXT NOT NULL,
+            created_at TEXT NOT NULL
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS bonus_week_config (
+            id INTEGER PRIMARY KEY DEFAULT 1,
+            start_time TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            CHECK (id = 1)
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS approved_users (
+            telegram_user_id INTEGER PRIMARY KEY,
+            approved_at TEXT NOT NULL
+        )
+    """)
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS processed_payments (
+            payment_id TEXT PRIMARY KEY,
+            processed_at TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'done',
+            claimed_at TEXT,
+            claimed_by TEXT
+        )
+    """)
+    await _add_columns(db, "processed_payments", {
+        # Старые записи (до атомарного захвата) - уже обработанные платежи
+        "state": "TEXT NOT NULL DEFAULT 'done'",
+        "claimed_at": "TEXT",
+        "claimed_by": "TEXT",
+    })
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS invite_links (
+            invite_link TEXT PRIMARY KEY,
+            telegram_user_id INTEGER NOT NULL,
+            payment_id TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            revoked INTEGER DEFAULT 0,
+            reminder_sent INTEGER DEFAULT 0,
+            FOREIGN KEY (telegram_user_id) REFERENCES approved_users(telegram_user_id)
+        )
+    """)
+    await _add_columns(db, "invite_links", {"reminder_sent": "INTEGER DEFAULT 0"})
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS daily_form_submissions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_id INTEGER NOT NULL,
+            username TEXT,
+            name TEXT NOT NULL,
+            phone TEXT NOT NULL,
+            email TEXT NOT NULL,
+            city TEXT NOT NULL,
+            gender TEXT NOT NULL,
+            activity TEXT NOT NULL,
+            privacy_accepted INTEGER DEFAULT 0,
+            offer_accepted INTEGER DEFAULT 0,
+            submitted_at TEXT NOT NULL
+        )
+    """)
+    for index_sql in (
+        "CREATE INDEX IF NOT EXISTS idx_users_form_token ON users(form_token)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_telegram_id ON payments(telegram_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_created_at ON payments(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_telegram_status ON payments(telegram_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_expires_at ON subscriptions(expires_at)",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_auto_renewal ON subscriptions(auto_renewal_enabled)",
+        "CREATE INDEX IF NOT EXISTS idx_invite_links_user_id ON invite_links(telegram_user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_invite_links_revoked ON invite_links(revoked)",
+        "CREATE INDEX IF NOT EXISTS idx_processed_payments_at ON processed_payments(processed_at)",
+        "CREATE INDEX IF NOT EXISTS idx_daily_form_submissions_at ON daily_form_submissions(submitted_at)",
+    ):
+        await db.execute(index_sql)
+
+
+async def _webhook_inbox(db) -> None:
+    """Очередь входящих уведомлений ЮKassa"""
+    from webhook_inbox import init_webhook_inbox_table
+    await init_webhook_inbox_table(db)
+
+
+async def _cache_invalidations(db) -> None:
+    """Журнал межпроцессной инвалидации кэша (cache_bus.py)"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS cache_invalidations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tag TEXT NOT NULL,
+            origin TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    """)
+
+
+async def _epoch_columns(db) -> None:
+    """Теневые INTEGER-колонки времени (мс epoch), индексы и триггеры синхронизации"""
+    await ensure_epoch_columns(db, EPOCH_COLUMNS)
+
+
+async def _epoch_backfill(connection_factory) -> None:
+    """Заполнение *_ms у старых строк - пачками, не держа блокировку записи"""
+    await backfill_epoch_columns(connection_factory, EPOCH_COLUMNS)
+
+
+async def _seed_bonus_week_start(db) -> None:
+    """Время начала бонусной недели по умолчанию (раньше записывал config.py при импорте)
+    Уже сохраненное время не меняется"""
+    from config import BONUS_WEEK_START_DATE
+    await db.execute(
+        "INSERT OR IGNORE INTO bonus_week_config (id, start_time, updated_at) VALUES (1, ?, ?)",
+        (BONUS_WEEK_START_DATE.isoformat(), datetime.now(timezone.utc).isoformat())
+    )
+
+
+async def _scheduler_indexes(db) -> None:
+    """Частичные/покрывающие индексы под предикаты фоновых задач (проверяются check_query_plans.py)
+    Индексы по ISO-колонкам времени больше не используются запросами (сравнения идут по *_ms) - удаляем.
+    Одноколоночные индексы по status/revoked удаляем тоже: без ANALYZE планировщик выбирает их
+    (равенство по столбцу) вместо частичных индексов и перебирает все pending/неотозванные строки"""
+    for index_sql in (
+        # get_expired_pending_payments: status='pending' AND created_at_ms BETWEEN (покрывающий)
+        """CREATE INDEX IF NOT EXISTS idx_payments_pending_created_ms
+           ON payments(created_at_ms, telegram_id, payment_id) WHERE status = 'pending'""",
+        # load_subscription_deadlines: неуведомленные подписки по expires_at_ms (покрывающий, telegram_id = rowid)
+        """CREATE INDEX IF NOT EXISTS idx_subscriptions_unnotified_expires_ms
+           ON subscriptions(expires_at_ms)
+           WHERE expires_at_ms IS NOT NULL AND COALESCE(subscription_expired_notified, 0) = 0""",
+        # check_channel_join_reminders: revoked=0 AND reminder_sent=0 AND created_at_ms <= ? ORDER BY created_at_ms
+        """CREATE INDEX IF NOT EXISTS idx_invite_links_reminder_due_ms
+           ON invite_links(created_at_ms, telegram_user_id) WHERE revoked = 0 AND reminder_sent = 0""",
+        # check_bonus_week_transition_to_production: starts_at_ms IS NOT NULL (покрывающий)
+        """CREATE INDEX IF NOT EXISTS idx_subscriptions_started_ms
+           ON subscriptions(starts_at_ms, expires_at_ms) WHERE starts_at_ms IS NOT NULL""",
+        "DROP INDEX IF EXISTS idx_payments_created_at",
+        "DROP INDEX IF EXISTS idx_subscriptions_expires_at",
+        "DROP INDEX IF EXISTS idx_processed_payments_at",
+        "DROP INDEX IF EXISTS idx_payments_status",
+        "DROP INDEX IF EXISTS idx_invite_links_revoked",
+    ):
+        await db.execute(index_sql)
+
+
+async def _broadcasts(db) -> None:
+    """Задания рассылок и итоги по получателям (broadcast_engine.py)"""
+    from broadcast_engine import init_broadcast_tables
+    await init_broadcast_tables(db)
+
+
+async def _media_files(db) -> None:
+    """file_id загруженных в Telegram файлов по хэшу содержимого (media_registry.py)"""
+    from media_registry import init_media_table
+    await init_media_table(db)
+
+
+async def _media_metadata(db) -> None:
+    """Метаданные видео (ширина, высота, длительность) по хэшу содержимого (media_registry.py)"""
+    from media_registry import init_media_metadata_table
+    await init_media_metadata_table(db)
+
+
+async def _user_reachability(db) -> None:
+    """Недоступные личные чаты (пользователь заблокировал бота / чат не найден)
+    Строка есть только у недоступных: отправки и фоновые выборки пропускают этих пользователей"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS user_reachability (
+            telegram_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            reason TEXT,
+            updated_at TEXT NOT NULL
+        )
+    """)
+
+
+async def _invite_link_pool(db) -> None:
+    """Пул заранее созданных ссылок (invite_link_pool.py): ссылка пула - строка invite_links с state='pool'
+    без пользователя и платежа, при выдаче одним UPDATE становится state='assigned'.
+    SQLite не снимает NOT NULL с колонки - таблица пересоздается с теми же данными, индексами и триггерами"""
+    await db.execute("""
+        CREATE TABLE invite_links_new (
+            invite_link TEXT PRIMARY KEY,
+            telegram_user_id INTEGER,
+            payment_id TEXT,
+            created_at TEXT NOT NULL,
+            revoked INTEGER DEFAULT 0,
+            reminder_sent INTEGER DEFAULT 0,
+            created_at_ms INTEGER,
+            state TEXT NOT NULL DEFAULT 'assigned',
+            FOREIGN KEY (telegram_user_id) REFERENCES approved_users(telegram_user_id)
+        )
+    """)
+    await db.execute("""
+        INSERT INTO invite_links_new (invite_link, telegram_user_id, payment_id, created_at, revoked, reminder_sent, created_at_ms)
+        SELECT invite_link, telegram_user_id, payment_id, created_at, revoked, reminder_sent, created_at_ms
+        FROM invite_links
+    """)
+    await db.execute("DROP TABLE invite_links")
+    await db.execute("ALTER TABLE invite_links_new RENAME TO invite_links")
+    await ensure_epoch_columns(db, ["invite_links"])
+    for index_sql in (
+        "CREATE INDEX IF NOT EXISTS idx_invite_links_user_id ON invite_links(telegram_user_id)",
+        # check_channel_join_reminders: только выданные ссылки
+        """CREATE INDEX IF NOT EXISTS idx_invite_links_reminder_due_ms
+           ON invite_links(created_at_ms, telegram_user_id)
+           WHERE revoked = 0 AND reminder_sent = 0 AND state = 'assigned'""",
+        # InviteLinkPool.take / refill: свободные ссылки пула, старые - первыми
+        """CREATE INDEX IF NOT EXISTS idx_invite_links_pool
+           ON invite_links(created_at_ms) WHERE state = 'pool' AND revoked = 0""",
+    ):
+        await db.execute(index_sql)
+
+
+async def _channel_members(db) -> None:
+    """Статус пользователей в канале по chat_member / одобренным заявкам / сверке get_chat_member
+    (вместо вызова get_chat_member на каждого пользователя в фоновых задачах)"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS channel_members (
+            telegram_id INTEGER PRIMARY KEY,
+            status TEXT NOT NULL,
+            source TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            updated_at_ms INTEGER NOT NULL
+        )
+    """)
+
+
+async def _invite_link_expiry(db) -> None:
+    """Срок действия выданной ссылки пула: пишется вместе с выдачей (take), в Telegram выставляется
+    фоновой задачей пула с повторами, пока не получится (expire_date_pending = 1)"""
+    await _add_columns(db, "invite_links", {
+        "expire_date_ms": "INTEGER",
+        "expire_date_pending": "INTEGER NOT NULL DEFAULT 0",
+    })
+    await db.execute(
+        """CREATE INDEX IF NOT EXISTS idx_invite_links_expire_pending
+           ON invite_links(invite_link) WHERE expire_date_pending = 1"""
+    )
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable
+    online: bool = False  # True - шаг сам управляет транзакциями (apply получает фабрику соединения)
+
+
+MIGRATIONS = [
+    Migration(1, "base_schema", _base_schema),
+    Migration(2, "webhook_inbox", _webhook_inbox),
+    Migration(3, "cache_invalidations", _cache_invalidations),
+    Migration(4, "epoch_columns", _epoch_columns),
+    Migration(5, "epoch_backfill", _epoch_backfill, online=True),
+    Migration(6, "seed_bonus_week_start", _seed_bonus_week_start),
+    Migration(7, "scheduler_indexes", _scheduler_indexes),
+    Migration(8, "broadcasts", _broadcasts),
+    Migration(9, "media_files", _media_files),
+    Migration(10, "media_metadata", _media_metadata),
+    Migration(11, "user_reachability", _user_reachability),
+    Migration(12, "invite_link_pool", _invite_link_pool),
+    Migration(13, "channel_members", _channel_members),
+    Migration(14, "invite_link_expiry", _invite_link_expiry),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+async def get_schema_version(db) -> int:
+    cur = await db.execute("PRAGMA user_version")
+    return (await cur.fetchone())[0]
+
+
+async def _apply(db, migration: Migration) -> bool:
+    """Применяет шаг, если его еще никто не применил; True - применен этим вызовом"""
+    if migration.online:
+        @asynccontextmanager
+        async def connection_factory():
+            yield db
+
+        await migration.apply(connection_factory)
+
+    await db.execute("BEGIN IMMEDIATE")
+    try:
+        if await get_schema_version(db) >= migration.version:
+            # Шаг применил другой процесс, пока мы ждали блокировку
+            await db.rollback()
+            return False
+        if not migration.online:
+            await migration.apply(db)
+        await db.execute(f"PRAGMA user_version = {migration.version}")
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
+    return True
+
+
+async def run_migrations(connect: Callable[[], Awaitable[aiosqlite.Connection]]) -> int:
+    """Доводит схему до SCHEMA_VERSION; connect - фабрика отдельного соединения на запись
+    Возвращает итоговую версию схемы"""
+    db = await connect()
+    try:
+        version = await get_schema_version(db)
+        if version >= SCHEMA_VERSION:
+            return version
+        for migration in MIGRATIONS:
+            if migration.version <= version:
+                continue
+            if await _apply(db, migration):
+                logger.info(f"✅ Миграция БД {migration.version} ({migration.name}) применена")
+            version = migration.version
+        return version
+    finally:
+        await db.close()
+
+
+async def migrate_database(path: str) -> int:
+    """Миграции для скриптов обслуживания (без пула соединений db.py)"""
+    async def connect():
+        db = await aiosqlite.connect(path)
+        await db.execute("PRAGMA busy_timeout=5000")
+        return db
+
+    return await run_migrations(connect)
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    db_path = sys.argv[1] if len(sys.argv) > 1 else os.getenv("DB_PATH", "bot.db")
+    final_version = asyncio.run(migrate_database(db_path))
+    print(f"✅ Схема БД {db_path}: версия {final_version} (актуальная {SCHEMA_VERSION})")
@@ -0,0 +1,75 @@
+"""
+Ожидание итогового статуса платежа по webhook ЮKassa
+Автопродление создает платеж и ждет, пока ЮKassa сообщит результат (payment.succeeded/payment.canceled).
+Вместо опроса API каждые полсекунды attempt_auto_renewal ждет future из реестра, а endpoint
+/yookassa/webhook разрешает его сразу при получении уведомления - до очереди webhook_inbox и до user_lock,
+который автопродление держит на время ожидания.
+
+Уведомление может прийти раньше, чем автопродление начнет ждать (платеж завершился во время ответа
+на создание) - такие статусы хранятся в небольшом буфере последних результатов.
+Статус из уведомления не проверен (тело webhook не подписано) - это только сигнал "пора спросить API":
+итоговый статус вызывающий код берет из API, в том числе если уведомление не пришло за отведенное время.
+
+Реестр действует в пределах процесса: ждать и получать webhook должен один процесс (webhook_app.py).
+"""
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_FINAL_STATUSES = ("succeeded", "canceled")
+
+
+class PaymentWaiters:
+    """Реестр future по payment_id, разрешаемых уведомлениями ЮKassa"""
+
+    def __init__(self, max_recent: int = 1000):
+        self._futures: dict[str, asyncio.Future] = {}
+        # Итоговые статусы, пришедшие, когда их еще никто не ждал
+        self._recent: OrderedDict[str, str] = OrderedDict()
+        self.max_recent = max_recent
+        self.resolved = 0
+        self.timeouts = 0
+
+    def __len__(self) -> int:
+        return len(self._futures)
+
+    def resolve(self, payment_id: str, status: Optional[str]) -> bool:
+        """Сообщает итоговый статус платежа; True - его кто-то ждал
+        Промежуточные статусы (pending, waiting_for_capture) игнорируются"""
+        if not payment_id or status not in PAYMENT_FINAL_STATUSES:
+            return False
+        future = self._futures.get(payment_id)
+        if future is not None and not future.done():
+            future.set_result(status)
+            self.resolved += 1
+            return True
+        self._recent[payment_id] = status
+        self._recent.move_to_end(payment_id)
+        while len(self._recent) > self.max_recent:
+            self._recent.popitem(last=False)
+        return False
+
+    async def wait(self, payment_id: str, timeout: float) -> Optional[str]:
+        """Ждет итоговый статус платежа из webhook; None - уведомление не пришло за timeout секунд"""
+        status = self._recent.pop(payment_id, None)
+        if status is not None:
+            self.resolved += 1
+            return status
+        future = self._futures.get(payment_id)
+        if future is None:
+            future = self._futures[payment_id] = asyncio.get_running_loop().create_future()
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.info(f"⏱️ Уведомление о платеже {payment_id} не пришло за {timeout:.0f} с")
+            return None
+        finally:
+            if self._futures.get(payment_id) is future:
+                del self._futures[payment_id]
+
+
+payment_waiters = PaymentWaiters()
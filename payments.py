@@ -5,28 +5,10 @@ from typing import Optional
 from dotenv import load_dotenv
 from yookassa import Configuration, Payment, Refund
 from config import SUBSCRIPTION_DAYS
+from utils import format_subscription_duration
 
 load_dotenv()
 
-def format_subscription_duration(days: float) -> str:
-    """Форматирует длительность подписки: показывает минуты если < 1 дня, иначе дни"""
-    if days < 1:
-        minutes = int(days * 1440)
-        if minutes == 1:
-            return "1 минута"
-        elif 2 <= minutes <= 4:
-            return f"{minutes} минуты"
-        else:
-            return f"{minutes} минут"
-    else:
-        days_int = int(days)
-        if days_int == 1:
-            return "1 день"
-        elif 2 <= days_int <= 4:
-            return f"{days_int} дня"
-        else:
-            return f"{days_int} дней"
-
 # Настройка ЮKassa из .env
 Configuration.account_id = os.getenv("YOOKASSA_SHOP_ID")
 Configuration.secret_key = os.getenv("YOOKASSA_SECRET_KEY")
@@ -35,26 +17,15 @@ if not Configuration.account_id or not Configuration.secret_key:
     raise RuntimeError("YOOKASSA_SHOP_ID / YOOKASSA_SECRET_KEY is missing in .env")
 
 
-def create_payment(
+def build_payment_payload(
     amount_rub: str,
     description: str,
     return_url: str,
     customer_email: str,
     telegram_user_id: int,
     enable_save_payment_method: bool = False,
-):
-    """
-    Создаёт платёж и возвращает (payment_id, confirmation_url)
-
-    ВАЖНО:
-    - customer_email нужен для чека (54-ФЗ)
-    - telegram_user_id кладём в metadata, чтобы webhook знал кому отправить инвайт
-    - payment_subject/payment_mode обязательны, иначе BadRequestError
-    - enable_save_payment_method: если True, пытается включить сохранение способа оплаты
-      (работает только если магазин настроен для автоплатежей в ЮKassa)
-    """
-    idempotence_key = str(uuid.uuid4())
-
+) -> dict:
+    """Формирует payload платежа (общий для синхронного и асинхронного клиента)"""
     payload = {
         "amount": {"value": amount_rub, "currency": "RUB"},
         "confirmation": {"type": "redirect", "return_url": return_url},
@@ -88,13 +59,44 @@ def create_payment(
     # save_payment_method: true - это условное сохранение (пользователь может выбрать на форме оплаты)
     if enable_save_payment_method:
         payload["save_payment_method"] = True  # Условное сохранение - пользователь выбирает на форме оплаты
+    return payload
+
+
+def is_save_payment_method_unsupported(error: Exception) -> bool:
+    """Ошибка из-за того, что магазин не настроен для автоплатежей (save_payment_method)"""
+    return "recurring" in str(error).lower() or "forbidden" in str(error).lower()
+
+
+def create_payment(
+    amount_rub: str,
+    description: str,
+    return_url: str,
+    customer_email: str,
+    telegram_user_id: int,
+    enable_save_payment_method: bool = False,
+):
+    """
+    Создаёт платёж и возвращает (payment_id, confirmation_url)
+
+    ВАЖНО:
+    - customer_email нужен для чека (54-ФЗ)
+    - telegram_user_id кладём в metadata, чтобы webhook знал кому отправить инвайт
+    - payment_subject/payment_mode обязательны, иначе BadRequestError
+    - enable_save_payment_method: если True, пытается включить сохранение способа оплаты
+      (работает только если магазин настроен для автоплатежей в ЮKassa)
+    """
+    idempotence_key = str(uuid.uuid4())
+
+    payload = build_payment_payload(
+        amount_rub, description, return_url, customer_email, telegram_user_id, enable_save_payment_method
+    )
 
     try:
         payment = Payment.create(payload, idempotence_key)
         return payment.id, payment.confirmation.confirmation_url
     except Exception as e:
         # Если ошибка связана с save_payment_method, пробуем без него
-        if enable_save_payment_method and ("recurring" in str(e).lower() or "forbidden" in str(e).lower()):
+        if enable_save_payment_method and is_save_payment_method_unsupported(e):
             print(f"⚠️ Магазин не настроен для автоплатежей, создаю платеж без save_payment_method: {e}")
             payload.pop("save_payment_method", None)
             payment = Payment.create(payload, idempotence_key)
@@ -118,23 +120,15 @@ def get_payment_url(payment_id: str) -> Optional[str]:
         return None
 
 
-def create_auto_payment(
+def build_auto_payment_payload(
     amount_rub: str,
     description: str,
     customer_email: str,
     telegram_user_id: int,
     payment_method_id: str,
-) -> tuple[str, str]:
-    """
-    Создает автоматический платеж с использованием сохраненного способа оплаты
-    Возвращает (payment_id, status)
-    
-    ВАЖНО: Эта функция используется для автопродления подписки
-    """
-    import uuid
-    idempotence_key = str(uuid.uuid4())
-    
-    payload = {
+) -> dict:
+    """Формирует payload автоплатежа по сохраненному способу оплаты"""
+    return {
         "amount": {"value": amount_rub, "currency": "RUB"},
         "capture": True,
         "description": description,
@@ -160,6 +154,24 @@ def create_auto_payment(
             ],
         },
     }
+
+
+def create_auto_payment(
+    amount_rub: str,
+    description: str,
+    customer_email: str,
+    telegram_user_id: int,
+    payment_method_id: str,
+) -> tuple[str, str]:
+    """
+    Создает автоматический платеж с использованием сохраненного способа оплаты
+    Возвращает (payment_id, status)
+    
+    ВАЖНО: Эта функция используется для автопродления подписки
+    """
+    idempotence_key = str(uuid.uuid4())
+    
+    payload = build_auto_payment_payload(amount_rub, description, customer_email, telegram_user_id, payment_method_id)
     
     try:
         payment = Payment.create(payload, idempotence_key)
@@ -0,0 +1,148 @@
+"""
+SQL горячих фоновых запросов
+Эти строки выполняют webhook_app.py, db.py, webhook_inbox.py и invite_link_pool.py, и их же
+check_query_plans.py проверяет через EXPLAIN QUERY PLAN - проверяется тот SQL, который работает.
+Модуль без зависимостей: его можно импортировать без токенов, aiogram и FastAPI.
+"""
+
+# webhook_app.get_expired_pending_payments: (cutoff_ms, since_ms)
+EXPIRED_PENDING_PAYMENTS = """
+    SELECT telegram_id, payment_id, created_at_ms,
+           NOT EXISTS (SELECT 1 FROM user_reachability r WHERE r.telegram_id = payments.telegram_id) AS reachable
+    FROM payments
+    WHERE status = 'pending'
+    AND created_at_ms < ?
+    AND created_at_ms > ?
+    """
+
+# webhook_app.load_subscription_deadlines; при сверке добавляется SUBSCRIPTION_DEADLINES_UNTIL
+SUBSCRIPTION_DEADLINES = """
+    SELECT telegram_id, expires_at_ms
+    FROM subscriptions
+    WHERE expires_at_ms IS NOT NULL
+    AND COALESCE(subscription_expired_notified, 0) = 0
+    """
+SUBSCRIPTION_DEADLINES_UNTIL = " AND expires_at_ms <= ?"
+
+# webhook_app.get_expired_subscriptions: (now_ms, [telegram_id ...])
+EXPIRED_SUBSCRIPTIONS = """
+    SELECT telegram_id, expires_at, auto_renewal_enabled, saved_payment_method_id, starts_at,
+           subscription_expired_notified, auto_renewal_attempts, last_auto_renewal_attempt_at, expires_at_ms
+    FROM subscriptions
+    WHERE expires_at_ms <= ?
+    """
+
+# webhook_app.get_subscriptions_expiring_soon: (start_ms, end_ms)
+SUBSCRIPTIONS_EXPIRING_SOON = """
+    SELECT telegram_id, expires_at_ms
+    FROM subscriptions
+    WHERE expires_at_ms >= ? AND expires_at_ms <= ?
+    AND telegram_id NOT IN (SELECT telegram_id FROM user_reachability)
+    """
+
+# webhook_app.check_channel_join_reminders: (reminder_time_ms, now_ms)
+CHANNEL_JOIN_REMINDERS = """
+    SELECT
+        il.invite_link,
+        il.telegram_user_id,
+        il.created_at,
+        il.reminder_sent,
+        s.expires_at,
+        s.saved_payment_method_id,
+        u.form_filled,
+        cm.status
+    FROM invite_links il
+    LEFT JOIN subscriptions s ON il.telegram_user_id = s.telegram_id
+    LEFT JOIN users u ON il.telegram_user_id = u.telegram_id
+    LEFT JOIN channel_members cm ON il.telegram_user_id = cm.telegram_id
+    WHERE il.revoked = 0
+    AND il.reminder_sent = 0
+    AND il.state = 'assigned'
+    AND il.created_at_ms <= ?
+    AND s.expires_at_ms > ?
+    AND il.telegram_user_id NOT IN (SELECT telegram_id FROM user_reachability)
+    ORDER BY il.created_at_ms ASC
+    """
+
+# webhook_app.reconcile_channel_members: (now_ms, stale_before_ms, limit)
+CHANNEL_MEMBERS_TO_RECONCILE = """
+    SELECT s.telegram_id
+    FROM subscriptions s
+    LEFT JOIN channel_members cm ON s.telegram_id = cm.telegram_id
+    WHERE s.expires_at_ms > ?
+    AND COALESCE(cm.updated_at_ms, 0) < ?
+    ORDER BY COALESCE(cm.updated_at_ms, 0) ASC
+    LIMIT ?
+    """
+
+# webhook_app.check_bonus_week_transition_to_production
+BONUS_WEEK_SUBSCRIPTIONS = """
+    SELECT telegram_id, expires_at_ms, starts_at_ms
+    FROM subscriptions
+    WHERE starts_at_ms IS NOT NULL
+    """
+
+# InviteLinkPool.take: (telegram_id, payment_id) - ссылка, уже выданная за этот платеж
+INVITE_LINK_FOR_PAYMENT = """
+    SELECT invite_link FROM invite_links
+    WHERE telegram_user_id = ? AND payment_id = ? AND revoked = 0
+    ORDER BY created_at_ms DESC
+    LIMIT 1
+    """
+
+# InviteLinkPool.take: (state_assigned, telegram_id, payment_id, created_at, created_at_ms,
+#                       expire_date_ms, expire_date_pending, state_pool)
+INVITE_LINK_POOL_TAKE = """
+    UPDATE invite_links
+    SET state = ?, telegram_user_id = ?, payment_id = ?, created_at = ?, created_at_ms = ?, reminder_sent = 0,
+        expire_date_ms = ?, expire_date_pending = ?
+    WHERE invite_link = (
+        SELECT invite_link FROM invite_links
+        WHERE state = ? AND revoked = 0
+        ORDER BY created_at_ms
+        LIMIT 1
+    )
+    RETURNING invite_link
+    """
+
+# InviteLinkPool.apply_expire_dates: выданные ссылки, срок действия которых еще не выставлен в Telegram
+INVITE_LINK_EXPIRE_PENDING = """
+    SELECT invite_link, expire_date_ms
+    FROM invite_links
+    WHERE expire_date_pending = 1
+    """
+
+# db.get_active_pending_payment: (telegram_id, cutoff_ms)
+ACTIVE_PENDING_PAYMENT = """
+    SELECT payment_id, created_at
+    FROM payments
+    WHERE telegram_id = ? AND status = 'pending' AND created_at_ms > ?
+    ORDER BY id DESC LIMIT 1
+    """
+
+# db.get_all_active_subscriptions: (now_ms,); для рассылки добавляется ACTIVE_SUBSCRIPTIONS_REACHABLE_ONLY
+ACTIVE_SUBSCRIPTIONS = "SELECT telegram_id, expires_at_ms FROM subscriptions WHERE expires_at_ms > ?"
+ACTIVE_SUBSCRIPTIONS_REACHABLE_ONLY = " AND telegram_id NOT IN (SELECT telegram_id FROM user_reachability)"
+
+# db.cleanup_old_payments: (cutoff_ms,)
+CLEANUP_OLD_PAYMENTS = """
+    DELETE FROM payments
+    WHERE created_at_ms < ? AND status NOT IN ('succeeded', 'pending')
+    """
+
+# db.cleanup_old_processed_payments: (cutoff_ms,)
+CLEANUP_OLD_PROCESSED_PAYMENTS = "DELETE FROM processed_payments WHERE processed_at_ms < ?"
+
+# WebhookInbox._fetch_ready: (now_iso, limit)
+WEBHOOK_INBOX_READY = """
+    SELECT w.id, w.order_key, w.payload, w.attempts
+    FROM webhook_inbox w
+    WHERE w.status = 'pending'
+      AND w.next_attempt_at <= ?
+      AND w.id = (
+          SELECT MIN(id) FROM webhook_inbox
+          WHERE order_key = w.order_key AND status IN ('pending', 'processing')
+      )
+    ORDER BY w.id
+    LIMIT ?
+    """
@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
+import asyncio
 import sqlite3
 
-conn = sqlite3.connect('/opt/bot_telegram/bot.db')
+from migrations import migrate_database
+
+DB_PATH = '/opt/bot_telegram/bot.db'
+
+# Схема БД - общий путь миграций (migrations.py), как у bot.py и webhook_app.py
+asyncio.run(migrate_database(DB_PATH))
+
+conn = sqlite3.connect(DB_PATH)
 cursor = conn.cursor()
 
 support_id = 8429417659
@@ -0,0 +1,105 @@
+"""
+Параллельная обработка истекших подписок (автопродление)
+Задания пользователей выполняются одновременно, но не больше concurrency; у пользователя - не больше одного задания
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Hashable, Optional
+
+from config import AUTO_RENEWAL_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+
+class RenewalEngine:
+    """Ограниченный по параллельности исполнитель заданий с ключом (telegram_id)"""
+
+    def __init__(self, concurrency: int = AUTO_RENEWAL_CONCURRENCY, name: str = "автопродление"):
+        self.concurrency = concurrency
+        self.name = name
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks: dict[Hashable, asyncio.Task] = {}
+        self._running = 0
+        self.completed = 0
+        self.failed = 0
+        self.skipped = 0
+        # Текущая волна: от первого задания после простоя до опустошения очереди
+        self._wave_started: Optional[float] = None
+        self._wave_done = 0
+        self._wave_max_wait = 0.0
+        self.last_wave: Optional[dict] = None
+
+    def __len__(self) -> int:
+        return len(self._tasks)
+
+    def pending(self, key: Hashable) -> bool:
+        """Есть ли у ключа задание в очереди или в работе"""
+        return key in self._tasks
+
+    def submit(self, key: Hashable, job: Callable[[], Awaitable[object]]) -> bool:
+        """Ставит задание в очередь; False - у ключа уже есть незавершенное задание"""
+        if key in self._tasks:
+            self.skipped += 1
+            return False
+        if self._wave_started is None:
+            self._wave_started = time.monotonic()
+        task = asyncio.create_task(self._run(key, job, time.monotonic()))
+        self._tasks[key] = task
+        return True
+
+    async def join(self) -> None:
+        """Ждет завершения всех поставленных заданий (бенчмарк, остановка процесса)"""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks.values()), return_exceptions=True)
+
+    async def _run(self, key: Hashable, job: Callable[[], Awaitable[object]], queued_at: float) -> None:
+        try:
+            async with self._semaphore:
+                self._wave_max_wait = max(self._wave_max_wait, time.monotonic() - queued_at)
+                self._running += 1
+                try:
+                    await job()
+                    self.completed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"❌ {self.name}: ошибка задания {key}: {e}", exc_info=True)
+                finally:
+                    self._running -= 1
+        finally:
+            del self._tasks[key]
+            self._wave_done += 1
+            if not self._tasks:
+                self._finish_wave()
+
+    def _finish_wave(self) -> None:
+        elapsed = time.monotonic() - self._wave_started
+        self.last_wave = {
+            "jobs": self._wave_done,
+            "seconds": round(elapsed, 3),
+            "per_second": round(self._wave_done / elapsed, 2) if elapsed > 0 else None,
+            "max_queue_wait_seconds": round(self._wave_max_wait, 3),
+        }
+        if self._wave_done > 1:
+            logger.info(
+                f"✅ {self.name}: обработано {self._wave_done} пользователей за {elapsed:.1f} с "
+                f"({self.last_wave['per_second']}/с, параллельно до {self.concurrency}, "
+                f"максимальное ожидание в очереди {self._wave_max_wait:.1f} с)"
+            )
+        self._wave_started = None
+        self._wave_done = 0
+        self._wave_max_wait = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "concurrency": self.concurrency,
+            "running": self._running,
+            "queued": len(self._tasks) - self._running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "skipped_duplicates": self.skipped,
+            "last_wave": self.last_wave,
+        }
+
+
+renewal_engine = RenewalEngine()
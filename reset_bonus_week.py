@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 """Скрипт для сброса бонусной недели"""
-from config import reset_bonus_week
+import asyncio
 
+from config import DB_PATH, reset_bonus_week
+from migrations import migrate_database
+
+# Таблица bonus_week_config создается миграциями
+asyncio.run(migrate_database(DB_PATH))
 reset_bonus_week()
 print("✅ Бонусная неделя сброшена")
 
@@ -3,9 +3,12 @@
 Скрипт для полной очистки базы данных
 ⚠️ ВНИМАНИЕ: Удалит ВСЕ данные из базы данных!
 """
+import asyncio
 import os
 import sqlite3
 
+from migrations import migrate_database
+
 # Пытаемся загрузить .env, но не падаем если его нет
 try:
     from dotenv import load_dotenv
@@ -23,6 +26,9 @@ def reset_database():
     
     # Резервные копии не создаются по запросу пользователя
     
+    # Схема БД - общий путь миграций (migrations.py), как у bot.py и webhook_app.py
+    asyncio.run(migrate_database(DB_PATH))
+    
     conn = sqlite3.connect(DB_PATH)
     cur = conn.cursor()
     
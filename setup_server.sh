@@ -40,7 +40,7 @@ if [ -f "requirements.txt" ]; then
     pip install -r requirements.txt
 else
     echo "⚠️ Файл requirements.txt не найден. Установка базовых зависимостей..."
-    pip install aiogram==3.23.0 aiosqlite==0.22.0 python-dotenv==1.0.1 yookassa==3.9.0 pytz==2024.1 fastapi==0.124.4 uvicorn==0.38.0
+    pip install aiogram==3.23.0 aiohttp==3.13.5 aiosqlite==0.22.0 python-dotenv==1.0.1 yookassa==3.9.0 pytz==2024.1 fastapi==0.124.4 uvicorn==0.38.0
 fi
 
 # Проверка наличия .env
@@ -0,0 +1,105 @@
+"""
+Ограниченный LRU-кэш с TTL и тегами
+Каждая запись может быть помечена тегами (например, "user:123"); invalidate_tag удаляет
+только записи этого тега, вместо того чтобы очищать весь кэш.
+Используется в db.py для кэша частых запросов по пользователю.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Iterable, Optional
+
+_MISSING = object()
+
+
+class TaggedCache:
+    """LRU + TTL кэш с инвалидацией по тегам и счетчиками попаданий/промахов/вытеснений"""
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (value, expires_at, tags); порядок OrderedDict = порядок использования (LRU в начале)
+        self._data: OrderedDict[Hashable, tuple[Any, float, tuple]] = OrderedDict()
+        self._tags: dict[str, set] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # Вытеснено по размеру (LRU)
+        self.expirations = 0  # Удалено по истечении TTL
+        self.invalidations = 0  # Удалено через invalidate/invalidate_tag/clear
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        entry = self._data.get(key)
+        return entry is not None and entry[1] > time.monotonic()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key, _MISSING)
+        if entry is _MISSING:
+            self.misses += 1
+            return default
+        value, expires_at, _ = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[str] = (), ttl: Optional[float] = None) -> None:
+        if key in self._data:
+            self._remove(key)
+        tags = tuple(tags)
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl), tags)
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize:
+            oldest_key = next(iter(self._data))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> bool:
+        if key not in self._data:
+            return False
+        self._remove(key)
+        self.invalidations += 1
+        return True
+
+    def invalidate_tag(self, tag: str) -> int:
+        """Удаляет все записи с тегом; возвращает количество удаленных"""
+        keys = self._tags.pop(tag, None)
+        if not keys:
+            return 0
+        for key in list(keys):
+            self._remove(key)
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def clear(self) -> None:
+        self.invalidations += len(self._data)
+        self._data.clear()
+        self._tags.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
+
+    def _remove(self, key: Hashable) -> None:
+        _, _, tags = self._data.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
@@ -1,12 +1,45 @@
 """
 Утилиты для безопасной работы с Telegram API
 Включает retry логику, обработку таймаутов и rate limiting
+
+Rate limiting - проактивный: все запросы отправки сообщений бота проходят через TelegramSendScheduler
+(request middleware сессии aiogram, поэтому сюда попадают и safe_*, и message.answer/bot.send_*).
+Планировщик соблюдает лимиты Telegram заранее, а не после 429:
+- ведро токенов на каждый чат (личный чат ~1 сообщение/с, группа/канал - 20 в минуту);
+- общее ведро на процесс; сообщения ждут общий токен в очереди по приоритету
+  (подтверждения оплаты -> ответы пользователю -> фоновые уведомления -> рассылки).
+Приоритет задается контекстом: with send_priority(PRIORITY_BROADCAST): ... (наследуется задачами, созданными внутри).
+
+Недоступные личные чаты (user_reachability в db.py) отсекаются до сети: ReachabilityMiddleware сразу
+поднимает ChatUnreachableError (подкласс TelegramForbiddenError), а Forbidden / "chat not found" от Telegram
+помечают чат недоступным. Отметку снимает my_chat_member (пользователь разблокировал бота), а также
+любое личное сообщение или нажатие кнопки от пользователя (IncomingReachabilityMiddleware).
 """
 import asyncio
+import heapq
+import itertools
 import logging
-from typing import Optional, Callable, Any
-from aiogram import Bot
-from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramAPIError
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Callable, Any, Hashable
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+)
+
+from config import (
+    TELEGRAM_CHAT_BURST,
+    TELEGRAM_CHAT_MESSAGES_PER_SECOND,
+    TELEGRAM_GROUP_MESSAGES_PER_MINUTE,
+)
+from db import REACHABILITY_BLOCKED, REACHABILITY_NOT_FOUND, is_user_reachable, mark_user_reachable, mark_user_unreachable
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +71,9 @@ async def safe_send_message(
                 reply_markup=reply_markup,
                 request_timeout=timeout
             )
+        except ChatUnreachableError:
+            logger.debug(f"⏭️ chat_id={chat_id} недоступен (user_reachability), сообщение не отправлено")
+            return None
         except TelegramRetryAfter as e:
             # Telegram просит подождать
             wait_time = e.retry_after
@@ -109,6 +145,9 @@ async def safe_send_video(
                 params["duration"] = duration
             
             return await bot.send_video(**params)
+        except ChatUnreachableError:
+            logger.debug(f"⏭️ chat_id={chat_id} недоступен (user_reachability), видео не отправлено")
+            return None
         except TelegramRetryAfter as e:
             wait_time = e.retry_after
             logger.warning(f"⚠️ Rate limit для видео chat_id={chat_id}, ждем {wait_time} секунд")
@@ -251,3 +290,206 @@ async def safe_bot_action(
     
     return None
 
+
+
+
+# ================== ПЛАНИРОВЩИК ИСХОДЯЩИХ СООБЩЕНИЙ ==================
+PRIORITY_PAYMENT = 0  # Подтверждения оплаты и ссылки доступа
+PRIORITY_INTERACTIVE = 1  # Ответы на действия пользователя (по умолчанию)
+PRIORITY_NOTIFICATION = 2  # Фоновые уведомления: истечение подписки, автопродление, напоминания
+PRIORITY_BROADCAST = 3  # Массовые рассылки
+
+_send_priority: ContextVar[int] = ContextVar("telegram_send_priority", default=PRIORITY_INTERACTIVE)
+
+# Методы Bot API, на которые действуют лимиты Telegram на сообщения
+RATE_LIMITED_METHODS = frozenset({
+    "sendMessage", "sendPhoto", "sendVideo", "sendAnimation", "sendDocument", "sendAudio", "sendVoice",
+    "sendVideoNote", "sendMediaGroup", "sendSticker", "sendLocation", "sendContact", "sendPoll",
+    "copyMessage", "copyMessages", "forwardMessage", "forwardMessages",
+})
+
+MAX_CHAT_BUCKETS = 10000  # Ведра давно не писавших чатов вытесняются (вытесненное ведро - снова полное)
+
+
+@contextmanager
+def send_priority(priority: int):
+    """Приоритет сообщений, отправляемых внутри блока (и в задачах, созданных внутри него)"""
+    token = _send_priority.set(priority)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity про запас
+    Токены можно резервировать в долг - reserve() возвращает, сколько ждать своей очереди"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        """Через сколько секунд будет доступен токен (0 - уже есть)"""
+        self._refill()
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def reserve(self) -> float:
+        """Забирает токен (при необходимости в долг); возвращает, сколько ждать до него"""
+        delay = self.delay()
+        self._tokens -= 1
+        return delay
+
+    def pause(self, seconds: float) -> None:
+        """Telegram ответил 429: следующий токен - не раньше чем через seconds"""
+        self._refill()
+        self._tokens = min(self._tokens, 1 - seconds * self.rate)
+
+
+class TelegramSendScheduler:
+    """Лимиты отправки сообщений на процесс: ведро на чат + общее ведро с очередью по приоритету"""
+
+    def __init__(self, global_rate: float, chat_rate: float = TELEGRAM_CHAT_MESSAGES_PER_SECOND,
+                 chat_burst: float = TELEGRAM_CHAT_BURST,
+                 group_rate: float = TELEGRAM_GROUP_MESSAGES_PER_MINUTE / 60):
+        self._global = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self._chats: OrderedDict[Hashable, TokenBucket] = OrderedDict()
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+        self._pump_task: Optional[asyncio.Task] = None
+        self.sent = {PRIORITY_PAYMENT: 0, PRIORITY_INTERACTIVE: 0, PRIORITY_NOTIFICATION: 0, PRIORITY_BROADCAST: 0}
+        self.retry_after_count = 0
+
+    def _chat_bucket(self, chat_id: Hashable) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Группы и каналы (отрицательный id или @username) - 20 сообщений в минуту
+            is_group = not isinstance(chat_id, int) or chat_id < 0
+            bucket = TokenBucket(self.group_rate, 1) if is_group else TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > MAX_CHAT_BUCKETS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def acquire(self, chat_id: Optional[Hashable], priority: Optional[int] = None) -> None:
+        """Ждет, пока сообщение в чат можно отправить, не превышая лимиты"""
+        if priority is None:
+            priority = _send_priority.get()
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id).reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        await future
+        self.sent[priority] = self.sent.get(priority, 0) + 1
+
+    async def _pump(self) -> None:
+        """Выдает общие токены ожидающим: сначала более важный приоритет, внутри него - по очереди"""
+        while self._waiters:
+            delay = self._global.delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue  # Отправитель отменен, пока ждал
+            self._global.reserve()
+            future.set_result(None)
+
+    def penalize(self, chat_id: Optional[Hashable], retry_after: float) -> None:
+        """Telegram все-таки ответил 429 - притормаживаем и чат, и весь процесс"""
+        self.retry_after_count += 1
+        self._global.pause(retry_after)
+        if chat_id is not None:
+            self._chat_bucket(chat_id).pause(retry_after)
+
+    def stats(self) -> dict:
+        return {
+            "waiting": len(self._waiters),
+            "sent": dict(self.sent),
+            "retry_after": self.retry_after_count,
+        }
+
+
+class SendRateLimitMiddleware(BaseRequestMiddleware):
+    """Request middleware aiogram: запросы отправки сообщений ждут токен TelegramSendScheduler"""
+
+    def __init__(self, scheduler: TelegramSendScheduler):
+        self.scheduler = scheduler
+
+    async def __call__(self, make_request, bot: Bot, method):
+        if method.__api_method__ not in RATE_LIMITED_METHODS:
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        await self.scheduler.acquire(chat_id)
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            logger.warning(f"⚠️ Telegram ответил 429 несмотря на лимиты (chat_id={chat_id}), пауза {e.retry_after} с")
+            self.scheduler.penalize(chat_id, e.retry_after)
+            raise
+
+
+class ChatUnreachableError(TelegramForbiddenError):
+    """Запрос не отправлялся: личный чат помечен недоступным в user_reachability"""
+
+
+class ReachabilityMiddleware(BaseRequestMiddleware):
+    """Request middleware aiogram: не пишет в недоступные личные чаты и запоминает новые недоступные"""
+
+    async def __call__(self, make_request, bot: Bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        # Только личные чаты (положительный id) и только отправка сообщений
+        if method.__api_method__ not in RATE_LIMITED_METHODS or not isinstance(chat_id, int) or chat_id <= 0:
+            return await make_request(bot, method)
+        if not await is_user_reachable(chat_id):
+            raise ChatUnreachableError(method=method, message="Forbidden: chat is marked unreachable (user_reachability)")
+        try:
+            return await make_request(bot, method)
+        except TelegramForbiddenError as e:
+            await mark_user_unreachable(chat_id, REACHABILITY_BLOCKED, e.message)
+            raise
+        except TelegramBadRequest as e:
+            if "chat not found" in e.message.lower():
+                await mark_user_unreachable(chat_id, REACHABILITY_NOT_FOUND, e.message)
+            raise
+
+
+class IncomingReachabilityMiddleware(BaseMiddleware):
+    """Outer middleware диспетчера: пользователь написал в личный чат или нажал кнопку - чат снова доступен
+    (my_chat_member при разблокировке приходит не всегда). Проверка отметки идет через кэш is_user_reachable"""
+
+    async def __call__(self, handler, event, data):
+        chat = data.get("event_chat")
+        if chat is not None and chat.type == "private":
+            try:
+                if not await is_user_reachable(chat.id):
+                    await mark_user_reachable(chat.id)
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось снять отметку недоступности чата {chat.id}: {e}")
+        return await handler(event, data)
+
+
+def install_send_scheduler(bot: Bot, global_rate: float) -> TelegramSendScheduler:
+    """Подключает к сессии бота проверку доступности чатов и планировщик исходящих сообщений
+    Недоступные чаты отсекаются раньше, чем запрос займет токен планировщика; возвращает планировщик (для статистики)"""
+    scheduler = TelegramSendScheduler(global_rate)
+    # Первый подключенный middleware - внешний
+    bot.session.middleware(ReachabilityMiddleware())
+    bot.session.middleware(SendRateLimitMiddleware(scheduler))
+    return scheduler
@@ -0,0 +1,75 @@
+"""
+Блокировки по telegram_id
+Операции над одним пользователем (активация подписки из webhook, автопродление,
+обработка истечения подписки, построение меню) выполняются строго по очереди,
+поэтому ждать "пока обновится БД" через asyncio.sleep больше не нужно:
+следующая операция начинается только после того, как предыдущая закоммитила изменения.
+
+Блокировка действует в пределах процесса. Порядок захвата: сначала user_lock, потом db_write() -
+не берите user_lock, удерживая соединение на запись, иначе возможна взаимная блокировка.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Hashable, Optional
+
+# Ключи, уже удерживаемые задачей: повторный захват того же ключа в ней же не блокирует
+# Вместе с ключами хранится задача-владелец: задачи, созданные под блокировкой, наследуют контекст,
+# но блокировку не держат
+_held_keys: ContextVar[Optional[tuple[asyncio.Task, frozenset]]] = ContextVar("held_user_locks", default=None)
+
+
+def _current_held() -> frozenset:
+    """Ключи, удерживаемые именно текущей задачей"""
+    held = _held_keys.get()
+    if held is not None and held[0] is asyncio.current_task():
+        return held[1]
+    return frozenset()
+
+
+class KeyedLock:
+    """Набор asyncio.Lock по ключу; неиспользуемые блокировки удаляются, чтобы словарь не рос"""
+
+    def __init__(self):
+        self._locks: dict[Hashable, asyncio.Lock] = {}
+        self._users: dict[Hashable, int] = {}
+
+    def locked(self, key: Hashable) -> bool:
+        lock = self._locks.get(key)
+        return lock is not None and lock.locked()
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable) -> AsyncIterator[None]:
+        held = _current_held()
+        if key in held:
+            # Вложенный вызов в той же задаче (например, меню строится во время активации)
+            yield
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            async with lock:
+                token = _held_keys.set((asyncio.current_task(), held | {key}))
+                try:
+                    yield
+                finally:
+                    _held_keys.reset(token)
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key]
+                del self._locks[key]
+
+
+user_locks = KeyedLock()
+
+
+def user_lock(telegram_id: int):
+    """Сериализует операции над пользователем: async with user_lock(telegram_id): ..."""
+    return user_locks(int(telegram_id))
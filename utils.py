@@ -30,3 +30,22 @@ def format_datetime_moscow(dt: datetime) -> str:
     
     return f"{day} {month} {year} и {time_str} по МСК"
 
+
+def format_subscription_duration(days: float) -> str:
+    """Форматирует длительность подписки: показывает минуты если < 1 дня, иначе дни"""
+    if days < 1:
+        minutes = int(days * 1440)
+        if minutes == 1:
+            return "1 минута"
+        elif 2 <= minutes <= 4:
+            return f"{minutes} минуты"
+        else:
+            return f"{minutes} минут"
+    else:
+        days_int = int(days)
+        if days_int == 1:
+            return "1 день"
+        elif 2 <= days_int <= 4:
+            return f"{days_int} дня"
+        else:
+            return f"{days_int} дней"
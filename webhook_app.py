@@ -1,14 +1,13 @@
 import os
 import aiosqlite
 import asyncio
+import hmac
 from datetime import datetime, timedelta, timezone
+from typing import Optional
 import logging
-import smtplib
 import tempfile
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+import uuid
+from functools import partial
 
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import HTMLResponse
@@ -17,14 +16,12 @@ from fastapi.templating import Jinja2Templates
 from pathlib import Path
 from dotenv import load_dotenv
 from aiogram import Bot
-from aiogram.types import ChatJoinRequest, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import ChatJoinRequest, Update
 from aiogram.enums import ChatMemberStatus
-from yookassa import Payment, Configuration
+from yookassa import Configuration
 from yookassa.domain.notification import WebhookNotificationFactory
-from openpyxl import Workbook
-from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 
-from utils import format_datetime_moscow
+from utils import format_datetime_moscow, format_subscription_duration
 from config import (
     PAYMENT_LINK_VALID_MINUTES,
     SUBSCRIPTION_DAYS,
@@ -33,8 +30,10 @@ from config import (
     CHECK_EXPIRED_PAYMENTS_INTERVAL_SECONDS,
     CHECK_EXPIRED_SUBSCRIPTIONS_INTERVAL_SECONDS,
     CHECK_EXPIRING_SUBSCRIPTIONS_INTERVAL_SECONDS,
+    EXPIRY_SCHEDULER_RESYNC_SECONDS,
     MAX_NOTIFIED_USERS_CACHE_SIZE,
     PAYMENT_AMOUNT_RUB,
+    PAYMENT_CLAIM_TIMEOUT_SECONDS,
     is_bonus_week_active,
     get_bonus_week_end,
     get_current_subscription_price,
@@ -45,28 +44,44 @@ from config import (
     vremya_sms,
     BONUS_WEEK_PRICE_RUB,
     AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES,
+    AUTO_RENEWAL_WEBHOOK_WAIT_SECONDS,
+    TELEGRAM_WEBHOOK_MESSAGES_PER_SECOND,
+    TELEGRAM_BOT_MESSAGES_PER_SECOND,
+    BOT_UPDATES_MODE,
+    TELEGRAM_WEBHOOK_URL,
+    TELEGRAM_WEBHOOK_SECRET,
+    TELEGRAM_UPDATES_SHUTDOWN_TIMEOUT_SECONDS,
+    CHANNEL_MEMBERS_RECONCILE_INTERVAL_SECONDS,
+    CHANNEL_MEMBERS_RECONCILE_BATCH,
+    CHANNEL_MEMBERS_RECONCILE_MAX_AGE_HOURS,
 )
-from db import is_user_allowed, cleanup_old_data
-from telegram_utils import safe_send_message, safe_create_invite_link
-
-def format_subscription_duration(days: float) -> str:
-    """Форматирует длительность подписки: показывает минуты если < 1 дня, иначе дни"""
-    if days < 1:
-        minutes = int(days * 1440)
-        if minutes == 1:
-            return "1 минута"
-        elif 2 <= minutes <= 4:
-            return f"{minutes} минуты"
-        else:
-            return f"{minutes} минут"
-    else:
-        days_int = int(days)
-        if days_int == 1:
-            return "1 день"
-        elif 2 <= days_int <= 4:
-            return f"{days_int} дня"
-        else:
-            return f"{days_int} дней"
+from db import is_user_allowed, cleanup_old_data, init_db, init_pool, close_pool, db_read, db_write, invalidate_user_cache
+from db import (
+    get_channel_member_status,
+    set_channel_member_status,
+    CHANNEL_MEMBER_STATUSES,
+    CHANNEL_MEMBER_KICKED,
+    CHANNEL_MEMBER_LEFT,
+)
+from epoch_columns import from_epoch_ms, now_ms, to_epoch_ms
+from telegram_utils import (
+    safe_send_message,
+    safe_create_invite_link,
+    install_send_scheduler,
+    send_priority,
+    PRIORITY_PAYMENT,
+    PRIORITY_NOTIFICATION,
+    PRIORITY_BROADCAST,
+)
+from expiry_scheduler import expiry_scheduler
+from yookassa_async import find_payment, close_yookassa_client
+from webhook_inbox import WebhookInbox, enqueue_notification, cleanup_old_inbox
+from user_locks import user_lock
+from payment_waiters import payment_waiters, PAYMENT_FINAL_STATUSES
+from renewal_engine import renewal_engine
+from invite_link_pool import invite_link_pool
+import queries
+from core import get_main_menu_for_user
 
 # Настройка логирования
 logging.basicConfig(
@@ -110,6 +125,18 @@ app.mount("/static", StaticFiles(directory=str(BASE_DIR / "static")), name="stat
 templates = Jinja2Templates(directory=str(BASE_DIR / "templates"))
 
 bot = Bot(token=BOT_TOKEN)
+# Все отправки идут через планировщик с лимитами Telegram: подтверждения оплаты - впереди уведомлений;
+# в заблокировавших бота пользователей - не уходят вовсе (user_reachability)
+# В объединенном режиме (BOT_UPDATES_MODE=webhook) отдельного процесса bot.py нет - весь лимит бота здесь
+send_scheduler = install_send_scheduler(
+    bot,
+    TELEGRAM_WEBHOOK_MESSAGES_PER_SECOND + TELEGRAM_BOT_MESSAGES_PER_SECOND if BOT_UPDATES_MODE == "webhook"
+    else TELEGRAM_WEBHOOK_MESSAGES_PER_SECOND
+)
+
+# Объединенный режим: модуль bot.py (обработчики и Dispatcher) загружается при старте, обновления - из /telegram/webhook
+telegram_bot_app = None
+_telegram_update_tasks: set[asyncio.Task] = set()
 
 # Запускаем фоновые задачи для проверки истекших платежей и подписок
 async def cleanup_old_data_task():
@@ -121,6 +148,7 @@ async def cleanup_old_data_task():
         try:
             logger.info("🧹 Запуск очистки старых данных...")
             deleted = await cleanup_old_data()
+            deleted += await cleanup_old_inbox(days=30)
             logger.info(f"✅ Очистка завершена, удалено {deleted} записей")
             # Запускаем очистку раз в день (24 часа)
             await asyncio.sleep(86400)
@@ -133,20 +161,81 @@ async def cleanup_old_data_task():
 @app.on_event("startup")
 async def startup_event():
     """Запускаем фоновые задачи при старте приложения"""
+    # В объединенном режиме /telegram/webhook получает все обновления бота: без секрета их мог бы подделать кто угодно
+    if BOT_UPDATES_MODE == "webhook" and not TELEGRAM_WEBHOOK_SECRET:
+        raise SystemExit("BOT_UPDATES_MODE=webhook: задайте TELEGRAM_WEBHOOK_SECRET (сверяется с заголовком X-Telegram-Bot-Api-Secret-Token)")
+    # Открываем пул соединений с БД (один раз на процесс)
+    await init_pool(DB_PATH)
     # Инициализируем таблицы
     await init_webhook_tables()
-    # Запускаем фоновые задачи
-    asyncio.create_task(check_expired_payments())
-    asyncio.create_task(check_expired_subscriptions())
-    asyncio.create_task(check_subscriptions_expiring_soon())
-    asyncio.create_task(check_bonus_week_ending_soon())  # Уведомления о окончании бонусной недели
-    asyncio.create_task(check_bonus_week_transition_to_production())  # Уведомления о переходе в продакшн режим
-    asyncio.create_task(cleanup_old_data_task())  # Добавляем задачу очистки
-    asyncio.create_task(daily_form_summary_task())  # Ежедневная сводка по заполненным формам
-    asyncio.create_task(check_channel_join_reminders())  # Напоминания о вступлении в канал
+    # Запускаем фоновые задачи (их сообщения - с приоритетом фоновых уведомлений, задачи наследуют контекст)
+    with send_priority(PRIORITY_NOTIFICATION):
+        asyncio.create_task(check_expired_payments())
+        asyncio.create_task(check_expired_subscriptions())
+        asyncio.create_task(check_subscriptions_expiring_soon())
+        asyncio.create_task(check_bonus_week_ending_soon())  # Уведомления о окончании бонусной недели
+        asyncio.create_task(check_bonus_week_transition_to_production())  # Уведомления о переходе в продакшн режим
+        asyncio.create_task(cleanup_old_data_task())  # Добавляем задачу очистки
+        asyncio.create_task(daily_form_summary_task())  # Ежедневная сводка по заполненным формам
+        asyncio.create_task(check_channel_join_reminders())  # Напоминания о вступлении в канал
+        asyncio.create_task(reconcile_channel_members())  # Сверка channel_members с Telegram
+    await yookassa_inbox.start()  # Воркеры очереди webhook'ов ЮKassa
+    invite_link_pool.start(bot, CHANNEL_ID, send_scheduler)  # Ссылки в канал наготове для оплативших
+    if BOT_UPDATES_MODE == "webhook":
+        await start_telegram_dispatcher()
     logger.info("✅ Фоновые задачи проверки истекших платежей и подписок запущены")
 
 
+async def start_telegram_dispatcher() -> None:
+    """Объединенный режим: обработчики bot.py работают в этом процессе (общие бот, пул БД и кэш),
+    Telegram присылает обновления на /telegram/webhook вместо getUpdates в отдельном процессе"""
+    global telegram_bot_app
+    import bot as bot_app  # Только в этом режиме: при polling bot.py - отдельный процесс
+    await bot_app.start_bot_services()
+    telegram_bot_app = bot_app
+    if TELEGRAM_WEBHOOK_URL:
+        await bot.set_webhook(
+            url=TELEGRAM_WEBHOOK_URL,
+            secret_token=TELEGRAM_WEBHOOK_SECRET,
+            allowed_updates=bot_app.dp.resolve_used_update_types(),
+        )
+        logger.info(f"✅ Webhook Telegram установлен: {TELEGRAM_WEBHOOK_URL}")
+    logger.info("✅ Обработчики bot.py подключены, обновления Telegram принимаются на /telegram/webhook")
+
+
+async def _feed_telegram_update(update: Update) -> None:
+    try:
+        await telegram_bot_app.dp.feed_update(bot, update)
+    except Exception as e:
+        logger.error(f"❌ Ошибка обработки обновления Telegram {update.update_id}: {e}")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Останавливаем очередь webhook'ов и пополнение пула ссылок, закрываем HTTP-сессию ЮKassa и пул соединений с БД"""
+    await yookassa_inbox.stop()
+    await invite_link_pool.stop()
+    if telegram_bot_app is not None:
+        await _drain_telegram_updates()
+        await telegram_bot_app.stop_bot_services()
+    await close_yookassa_client()
+    await close_pool()
+
+
+async def _drain_telegram_updates() -> None:
+    """Ждет обработчики уже принятых обновлений (не дольше TELEGRAM_UPDATES_SHUTDOWN_TIMEOUT_SECONDS),
+    оставшиеся отменяет - до закрытия пула соединений с БД, которым они пользуются"""
+    tasks = list(_telegram_update_tasks)
+    if not tasks:
+        return
+    _, pending = await asyncio.wait(tasks, timeout=TELEGRAM_UPDATES_SHUTDOWN_TIMEOUT_SECONDS)
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    if pending:
+        logger.warning(f"⚠️ При остановке прервана обработка {len(pending)} обновлений Telegram")
+
+
 # ================== CUSTOM FORM ENDPOINTS ==================
 
 async def send_form_data_email(telegram_id: int, form_data: dict) -> bool:
@@ -160,6 +249,9 @@ async def send_form_data_email(telegram_id: int, form_data: dict) -> bool:
     Returns:
         True если успешно, False иначе
     """
+    import smtplib
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
     if not SMTP_USER or not SMTP_PASSWORD:
         logger.warning("⚠️ SMTP настройки не заданы, пропускаем отправку email")
         return False
@@ -168,7 +260,7 @@ async def send_form_data_email(telegram_id: int, form_data: dict) -> bool:
         # Получаем username пользователя из БД
         username = "не указан"
         try:
-            async with aiosqlite.connect(DB_PATH) as db:
+            async with db_read() as db:
                 cursor = await db.execute(
                     "SELECT username FROM users WHERE telegram_id = ?",
                     (telegram_id,)
@@ -250,11 +342,13 @@ async def save_form_data_to_excel(telegram_id: int, form_data: dict) -> str:
     Returns:
         Путь к созданному Excel файлу или None при ошибке
     """
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
     try:
         # Получаем username пользователя из БД
         username = None
         try:
-            async with aiosqlite.connect(DB_PATH) as db:
+            async with db_read() as db:
                 cursor = await db.execute(
                     "SELECT username FROM users WHERE telegram_id = ?",
                     (telegram_id,)
@@ -376,7 +470,7 @@ async def save_form_to_daily_table(telegram_id: int, form_data: dict) -> bool:
         # Получаем username пользователя из БД
         username = None
         try:
-            async with aiosqlite.connect(DB_PATH) as db:
+            async with db_read() as db:
                 cursor = await db.execute(
                     "SELECT username FROM users WHERE telegram_id = ?",
                     (telegram_id,)
@@ -388,7 +482,7 @@ async def save_form_to_daily_table(telegram_id: int, form_data: dict) -> bool:
             logger.warning(f"⚠️ Не удалось получить username: {e}")
         
         # Сохраняем данные в таблицу
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_write() as db:
             await db.execute("""
                 INSERT INTO daily_form_submissions (
                     telegram_id, username, name, phone, email, city, gender, 
@@ -458,7 +552,7 @@ async def send_daily_form_summary() -> bool:
         twenty_four_hours_ago = (datetime.now(timezone.utc) - timedelta(hours=24)).isoformat()
         
         # Получаем все записи за последние 24 часа
-        async with aiosqlite.connect(DB_PATH) as db:
+        async with db_read() as db:
             db.row_factory = aiosqlite.Row
             cursor = await db.execute("""
                 SELECT * FROM daily_form_submissions 
@@ -484,7 +578,7 @@ async def send_daily_form_summary() -> bool:
         
         # Удаляем старые записи (старше 24 часов) после успешной отправки
         if success:
-            async with aiosqlite.connect(DB_PATH) as db:
+            async with db_write() as db:
                 await db.execute("""
                     DELETE FROM daily_form_submissions 
                     WHERE submitted_at < ?
@@ -518,6 +612,8 @@ async def create_daily_summary_excel(rows: list) -> str:
     Returns:
         Путь к созданному Excel файлу или None при ошибке
     """
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
     try:
         wb = Workbook()
         ws = wb.active
@@ -636,6 +732,11 @@ async def send_daily_summary_email(excel_path: str, count: int) -> bool:
     Returns:
         True если успешно, False иначе
     """
+    import smtplib
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.base import MIMEBase
+    from email import encoders
     if not SMTP_USER or not SMTP_PASSWORD:
         logger.warning("⚠️ SMTP настройки не заданы, пропускаем отправку сводки")
         return False
@@ -706,6 +807,11 @@ async def send_excel_file_email(excel_path: str) -> bool:
     Returns:
         True если успешно, False иначе
     """
+    import smtplib
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.base import MIMEBase
+    from email import encoders
     if not SMTP_USER or not SMTP_PASSWORD:
         logger.warning("⚠️ SMTP настройки не заданы, пропускаем отправку Excel")
         return False
@@ -1114,7 +1220,7 @@ async def yandex_form_webhook(request: Request):
             logger.warning("⚠️ Токен не найден. Используем fallback - ищем последнего пользователя, который недавно нажал кнопку.")
             from datetime import datetime, timedelta, timezone
             thirty_minutes_ago = (datetime.now(timezone.utc) - timedelta(minutes=30)).isoformat()
-            async with aiosqlite.connect(DB_PATH) as db:
+            async with db_read() as db:
                 cursor = await db.execute(
                     "SELECT telegram_id FROM users WHERE form_filled = 0 AND created_at > ? ORDER BY created_at DESC LIMIT 1",
                     (thirty_minutes_ago,)
@@ -1225,7 +1331,7 @@ async def payment_return(request: Request):
     # Если есть payment_id, получаем tg_user_id из метаданных платежа
     if payment_id:
         try:
-            payment = Payment.find_one(payment_id)
+            payment = await find_payment(payment_id)
             meta = payment.metadata or {}
             tg_user_id = meta.get("telegram_user_id")
             logger.info(f"📋 Получен tg_user_id из метаданных платежа: {tg_user_id}")
@@ -1258,7 +1364,7 @@ async def payment_return(request: Request):
         # Если есть payment_id, проверяем статус платежа
         if payment_id:
             try:
-                payment = Payment.find_one(payment_id)
+                payment = await find_payment(payment_id)
                 current_status = payment.status
                 logger.info(f"📋 Статус платежа {payment_id}: {current_status}")
                 
@@ -1297,102 +1403,121 @@ async def payment_return(request: Request):
 
 # ================== DB (ОПТИМИЗИРОВАННЫЕ ASYNC ФУНКЦИИ) ==================
 async def init_webhook_tables():
-    """Инициализирует таблицы для webhook (вызывается один раз при старте)"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS processed_payments (
-            payment_id TEXT PRIMARY KEY,
-            processed_at TEXT NOT NULL
-        )
-    """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS approved_users (
-            telegram_user_id INTEGER PRIMARY KEY,
-            approved_at TEXT NOT NULL
-        )
-    """)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS invite_links (
-            invite_link TEXT PRIMARY KEY,
-            telegram_user_id INTEGER NOT NULL,
-            payment_id TEXT NOT NULL,
-            created_at TEXT NOT NULL,
-            revoked INTEGER DEFAULT 0,
-            reminder_sent INTEGER DEFAULT 0,
-            FOREIGN KEY (telegram_user_id) REFERENCES approved_users(telegram_user_id)
-        )
-    """)
-        # Добавляем поле reminder_sent, если его нет
-        try:
-            await db.execute("ALTER TABLE invite_links ADD COLUMN reminder_sent INTEGER DEFAULT 0")
-            await db.commit()
-        except Exception:
-            pass
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS daily_form_submissions (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER NOT NULL,
-            username TEXT,
-            name TEXT NOT NULL,
-            phone TEXT NOT NULL,
-            email TEXT NOT NULL,
-            city TEXT NOT NULL,
-            gender TEXT NOT NULL,
-            activity TEXT NOT NULL,
-            privacy_accepted INTEGER DEFAULT 0,
-            offer_accepted INTEGER DEFAULT 0,
-            submitted_at TEXT NOT NULL
-        )
-    """)
-        # Создаем индексы для оптимизации
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_invite_links_user_id ON invite_links(telegram_user_id)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_invite_links_revoked ON invite_links(revoked)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_processed_payments_at ON processed_payments(processed_at)")
-        await db.execute("CREATE INDEX IF NOT EXISTS idx_daily_form_submissions_at ON daily_form_submissions(submitted_at)")
-        await db.commit()
+    """Доводит схему БД до актуальной версии (таблицы webhook теперь создаются миграциями migrations.py)"""
+    await init_db()
 
 
 async def already_processed(payment_id: str) -> bool:
-    """Проверяет, был ли платеж уже обработан (async версия)"""
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT 1 FROM processed_payments WHERE payment_id = ?", (payment_id,))
+    """Проверяет, был ли платеж уже обработан или обрабатывается прямо сейчас (async версия)"""
+    async with db_read() as db:
+        cur = await db.execute(
+            "SELECT 1 FROM processed_payments WHERE payment_id = ? AND state != 'failed'",
+            (payment_id,)
+        )
         row = await cur.fetchone()
     return row is not None
 
 
+async def claim_payment(payment_id: str, claim_token: str) -> bool:
+    """Атомарно захватывает платеж для обработки. True - захват наш, False - платеж уже обработан
+    или его обрабатывает другой воркер/процесс. Захват, зависший дольше PAYMENT_CLAIM_TIMEOUT_SECONDS,
+    и неудачная обработка (failed) захватываются заново"""
+    now = datetime.now(timezone.utc)
+    # У захваченной записи processed_at_ms = время захвата
+    stale_before = to_epoch_ms(now - timedelta(seconds=PAYMENT_CLAIM_TIMEOUT_SECONDS))
+    async with db_write() as db:
+        cur = await db.execute(
+            """
+            INSERT INTO processed_payments (payment_id, processed_at, processed_at_ms, state, claimed_at, claimed_by)
+            VALUES (?, ?, ?, 'claimed', ?, ?)
+            ON CONFLICT(payment_id) DO UPDATE SET
+                state = 'claimed', processed_at = excluded.processed_at, processed_at_ms = excluded.processed_at_ms,
+                claimed_at = excluded.claimed_at, claimed_by = excluded.claimed_by
+            WHERE processed_payments.state = 'failed'
+               OR (processed_payments.state = 'claimed' AND processed_payments.processed_at_ms < ?)
+            """,
+            (payment_id, now.isoformat(), to_epoch_ms(now), now.isoformat(), claim_token, stale_before)
+        )
+        await db.commit()
+        return cur.rowcount > 0
+
+
+async def release_payment_claim(payment_id: str, claim_token: str):
+    """Помечает захваченный нами платеж как failed, чтобы повторная обработка могла его захватить"""
+    async with db_write() as db:
+        await db.execute(
+            "UPDATE processed_payments SET state = 'failed' "
+            "WHERE payment_id = ? AND state = 'claimed' AND claimed_by = ?",
+            (payment_id, claim_token)
+        )
+        await db.commit()
+
+
 async def mark_processed(payment_id: str):
     """Помечает платеж как обработанный (async версия)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    now = datetime.now(timezone.utc)
+    async with db_write() as db:
         await db.execute(
-        "INSERT OR IGNORE INTO processed_payments(payment_id, processed_at) VALUES (?, ?)",
-        (payment_id, datetime.now(timezone.utc).isoformat())
-    )
+            """
+            INSERT INTO processed_payments (payment_id, processed_at, processed_at_ms, state) VALUES (?, ?, ?, 'done')
+            ON CONFLICT(payment_id) DO UPDATE SET
+                state = 'done', processed_at = excluded.processed_at, processed_at_ms = excluded.processed_at_ms
+            WHERE processed_payments.state != 'done'
+            """,
+            (payment_id, now.isoformat(), to_epoch_ms(now))
+        )
         await db.commit()
 
 
 async def allow_user(tg_user_id: int):
     """Добавляет пользователя в список одобренных (async версия)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await db.execute(
         "INSERT OR REPLACE INTO approved_users(telegram_user_id, approved_at) VALUES (?, ?)",
         (tg_user_id, datetime.now(timezone.utc).isoformat())
     )
         await db.commit()
+    invalidate_user_cache(tg_user_id)
 
 
 async def save_invite_link(invite_link: str, telegram_user_id: int, payment_id: str):
     """Сохраняет информацию о созданной ссылке-приглашении (async версия)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    created_at = datetime.now(timezone.utc)
+    async with db_write() as db:
         await db.execute(
-        "INSERT OR REPLACE INTO invite_links(invite_link, telegram_user_id, payment_id, created_at, reminder_sent) VALUES (?, ?, ?, ?, 0)",
-        (invite_link, telegram_user_id, payment_id, datetime.now(timezone.utc).isoformat())
+        "INSERT OR REPLACE INTO invite_links(invite_link, telegram_user_id, payment_id, created_at, created_at_ms, reminder_sent) VALUES (?, ?, ?, ?, ?, 0)",
+        (invite_link, telegram_user_id, payment_id, created_at.isoformat(), to_epoch_ms(created_at))
     )
         await db.commit()
 
 
+async def fetch_channel_member_status(telegram_id: int) -> Optional[str]:
+    """Статус пользователя в канале через get_chat_member с сохранением в channel_members; None - Telegram не ответил"""
+    try:
+        chat_member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=telegram_id)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось проверить статус пользователя {telegram_id} в канале: {e}")
+        return None
+    await set_channel_member_status(telegram_id, chat_member.status, "get_chat_member")
+    return getattr(chat_member.status, "value", chat_member.status)
+
+
+async def ban_channel_member(telegram_id: int) -> None:
+    """Бан в канале навсегда (пока не оплатит снова); уже забаненного (по channel_members) повторно не баним"""
+    if await get_channel_member_status(telegram_id) == CHANNEL_MEMBER_KICKED:
+        logger.info(f"ℹ️ Пользователь {telegram_id} уже забанен в канале - запрос к Telegram не нужен")
+        return
+    await bot.ban_chat_member(
+        chat_id=CHANNEL_ID,
+        user_id=telegram_id,
+        until_date=None  # Бан навсегда
+    )
+    await set_channel_member_status(telegram_id, CHANNEL_MEMBER_KICKED, "ban")
+
+
 async def revoke_invite_link(invite_link: str):
     """Помечает ссылку как отозванную (async версия)"""
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with db_write() as db:
         await db.execute(
         "UPDATE invite_links SET revoked = 1 WHERE invite_link = ?",
         (invite_link,)
@@ -1400,206 +1525,6 @@ async def revoke_invite_link(invite_link: str):
         await db.commit()
 
 
-async def get_main_menu_for_user(telegram_id: int) -> ReplyKeyboardMarkup:
-    """Создает главное меню для пользователя с учетом статуса подписки"""
-    # ВАЖНО: Очищаем кэш перед проверкой, чтобы получить актуальные данные
-    from db import _clear_cache
-    _clear_cache()
-    
-    # Сначала проверяем наличие активной подписки
-    from db import get_subscription_expires_at, is_auto_renewal_enabled, get_auto_renewal_attempts
-    from datetime import timezone
-    expires_at = await get_subscription_expires_at(telegram_id)
-    now = datetime.now(timezone.utc)
-    if expires_at and expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
-    has_active_subscription = expires_at and expires_at > now
-    auto_renewal_enabled = await is_auto_renewal_enabled(telegram_id)
-    
-    # Получаем количество попыток для проверки
-    attempts = await get_auto_renewal_attempts(telegram_id)
-    
-    # КРИТИЧЕСКИ ВАЖНО: Если автопродление отключено после 3 неудачных попыток,
-    # НЕ меняем has_active_subscription здесь - это будет обработано ниже в "боевом режиме"
-    # (логика "боевого режима" будет применена после проверки bonus_week_ended)
-    
-    # КРИТИЧЕСКИ ВАЖНО: Во время попыток автопродления (attempts > 0 и attempts < 3)
-    # считаем, что у пользователя была активная подписка, даже если она уже истекла
-    # Это нужно для правильного отображения меню "Управление доступом" во время попыток
-    had_active_subscription_during_attempts = has_active_subscription or (attempts > 0 and attempts < 3 and auto_renewal_enabled)
-    
-    show_manage_button = has_active_subscription and auto_renewal_enabled
-    
-    # КРИТИЧЕСКИ ВАЖНО: Показываем бонусное меню ТОЛЬКО если:
-    # 1. Бонусная неделя активна (is_bonus_week_active() = True)
-    # 2. У пользователя НЕТ активной подписки с автопродлением (show_manage_button = False)
-    # Если бонусная неделя закончилась - ВСЕГДА показываем продакшн меню, независимо от статуса автопродления
-    # КРИТИЧЕСКИ ВАЖНО: Проверяем окончание бонусной недели ПО ВРЕМЕНИ - это приоритетная проверка
-    from config import get_bonus_week_end
-    bonus_week_end = get_bonus_week_end()
-    if bonus_week_end.tzinfo is None:
-        bonus_week_end = bonus_week_end.replace(tzinfo=timezone.utc)
-    
-    # КРИТИЧЕСКИ ВАЖНО: Если бонусная неделя закончилась, но еще идут попытки автопродления (attempts > 0 и attempts < 3),
-    # меню НЕ должно меняться - оно должно оставаться прежним до завершения всех попыток
-    bonus_week_ended = now > bonus_week_end
-    attempts = await get_auto_renewal_attempts(telegram_id)
-    # auto_renewal_in_progress = True если автопродление включено, есть попытки (но меньше 3), и бонусная неделя закончилась
-    auto_renewal_in_progress = auto_renewal_enabled and attempts > 0 and attempts < 3 and bonus_week_ended
-    
-    # КРИТИЧЕСКИ ВАЖНО: Если автопродление успешно (attempts = 0 и есть активная подписка),
-    # значит автопродление прошло успешно - показываем БОЕВОЙ РЕЖИМ (продакшн меню)
-    if bonus_week_ended and attempts == 0 and has_active_subscription and auto_renewal_enabled:
-        # Автопродление успешно - БОЕВОЙ РЕЖИМ
-        bonus_week_active = False
-        logger.info(f"⚔️ Автопродление успешно завершено для пользователя {telegram_id} - БОЕВОЙ РЕЖИМ (продакшн меню)")
-    elif bonus_week_ended and not auto_renewal_in_progress:
-        # Бонусная неделя закончилась и попытки завершены - БОЕВОЙ РЕЖИМ
-        # ВАЖНО: Это включает случай с 3 неудачными попытками - тоже БОЕВОЙ РЕЖИМ
-        bonus_week_active = False
-        if not auto_renewal_enabled and attempts >= 3:
-            logger.info(f"⚔️ Бонусная неделя закончилась, 3 неудачные попытки для пользователя {telegram_id} - БОЕВОЙ РЕЖИМ")
-        else:
-            logger.info(f"⚔️ Бонусная неделя закончилась по времени: now={now.isoformat()}, bonus_week_end={bonus_week_end.isoformat()}, попытки завершены - БОЕВОЙ РЕЖИМ")
-    elif auto_renewal_in_progress:
-        # Бонусная неделя закончилась, но еще идут попытки автопродления
-        # ВАЖНО: Показываем бонусное меню только если у пользователя нет активной подписки
-        # Если есть активная подписка, показываем меню "Управление доступом"
-        bonus_week_active = True
-        logger.info(f"🔍 Бонусная неделя закончилась, но идут попытки автопродления (attempts={attempts}/3) - has_active_subscription={has_active_subscription}")
-    else:
-        # Только если бонусная неделя еще не закончилась по времени, проверяем is_bonus_week_active()
-        bonus_week_active = is_bonus_week_active()
-        if bonus_week_active:
-            logger.info(f"🔍 Бонусная неделя активна: now={now.isoformat()}, bonus_week_end={bonus_week_end.isoformat()}")
-    
-    # Логируем состояние для диагностики
-    logger.info(f"🔍 get_main_menu_for_user для {telegram_id}: bonus_week_active={bonus_week_active}, has_active_subscription={has_active_subscription}, show_manage_button={show_manage_button}, auto_renewal_enabled={auto_renewal_enabled}, attempts={attempts}")
-    
-    if bonus_week_active:
-        # КРИТИЧЕСКИ ВАЖНО: Во время попыток автопродления (auto_renewal_in_progress) 
-        # меню НЕ должно меняться - показываем то же меню, что было до начала попыток
-        # Если у пользователя было "Управление доступом" - показываем его
-        # Если у пользователя было бонусное меню - показываем его
-        if auto_renewal_in_progress:
-            # Идут попытки автопродления - КРИТИЧЕСКИ ВАЖНО: 
-            # ВСЕГДА показываем "Управление доступом" + "О проекте" во время попыток автопродления,
-            # даже если подписка уже истекла (expires_at <= now)
-            # Потому что попытки автопродления означают, что у пользователя была активная подписка
-            # и идет процесс её продления
-            BTN_MANAGE_SUB = "⚙️ Управление доступом"
-            BTN_ABOUT_1 = "ℹ️ О проекте"
-            keyboard = [
-                [KeyboardButton(text=BTN_MANAGE_SUB)],
-                [KeyboardButton(text=BTN_ABOUT_1)],
-            ]
-            logger.info(f"🔍 Пользователь {telegram_id}: попытки автопродления (attempts={attempts}/3) - показываем меню 'Управление доступом'")
-            return ReplyKeyboardMarkup(
-                keyboard=keyboard,
-                resize_keyboard=True,
-            )
-        elif show_manage_button:
-            # У пользователя есть активная подписка с автопродлением - показываем "Управление доступом"
-            BTN_MANAGE_SUB = "⚙️ Управление доступом"
-            BTN_ABOUT_1 = "ℹ️ О проекте"
-            keyboard = [
-                [KeyboardButton(text=BTN_MANAGE_SUB)],
-                [KeyboardButton(text=BTN_ABOUT_1)],
-            ]
-            return ReplyKeyboardMarkup(
-                keyboard=keyboard,
-                resize_keyboard=True,
-            )
-        elif has_active_subscription and not auto_renewal_enabled:
-            # КРИТИЧЕСКИ ВАЖНО: Если в бонусной неделе у пользователя есть активная подписка,
-            # но автопродление отключено - показываем ТОЛЬКО "О проекте"
-            BTN_ABOUT_1 = "ℹ️ О проекте"
-            keyboard = [
-                [KeyboardButton(text=BTN_ABOUT_1)],
-            ]
-            return ReplyKeyboardMarkup(
-                keyboard=keyboard,
-                resize_keyboard=True,
-            )
-        else:
-            # У пользователя нет активной подписки - показываем бонусное меню
-            BTN_BONUS_WEEK = "🎁 Бонус в честь запуска канала Наиля Хасанова"
-            BTN_ABOUT_1 = "ℹ️ О проекте"
-            logger.info(f"🎁 Пользователь {telegram_id}: показываем БОНУСНОЕ меню (нет подписки, бонусная неделя активна)")
-            keyboard = [
-                [KeyboardButton(text=BTN_BONUS_WEEK)],
-                [KeyboardButton(text=BTN_ABOUT_1)],
-            ]
-            return ReplyKeyboardMarkup(
-                keyboard=keyboard,
-                resize_keyboard=True,
-            )
-    
-    # Бонусная неделя закончилась - ВСЕГДА показываем продакшн меню, независимо от статуса автопродления
-    
-    # Константы кнопок (должны совпадать с bot.py)
-    BTN_PAY_1 = "💳 Получить доступ"
-    BTN_MANAGE_SUB = "⚙️ Управление доступом"
-    BTN_STATUS_1 = "📊 Статус доступа"
-    BTN_ABOUT_1 = "ℹ️ О проекте"
-    BTN_CHECK_1 = "🔍 Проверить оплату"
-    BTN_SUPPORT = "💬 Поддержка"
-    
-    # Проверяем наличие активной подписки
-    from db import get_subscription_expires_at, is_auto_renewal_enabled, get_auto_renewal_attempts
-    expires_at = await get_subscription_expires_at(telegram_id)
-    now = datetime.now(timezone.utc)
-    # Убеждаемся, что expires_at имеет timezone для сравнения
-    if expires_at and expires_at.tzinfo is None:
-        expires_at = expires_at.replace(tzinfo=timezone.utc)
-    has_active_subscription = expires_at and expires_at > now
-    
-    # Проверяем, включено ли автопродление
-    auto_renewal_enabled = await is_auto_renewal_enabled(telegram_id)
-    
-    # КРИТИЧЕСКИ ВАЖНО: Определяем БОЕВОЙ РЕЖИМ
-    # БОЕВОЙ РЕЖИМ активируется если бонусная неделя закончилась
-    # В боевом режиме ВСЕГДА показываем полное продакшн меню
-    attempts = await get_auto_renewal_attempts(telegram_id)
-    is_battle_mode = bonus_week_ended
-    
-    if is_battle_mode:
-        logger.info(f"⚔️ БОЕВОЙ РЕЖИМ для пользователя {telegram_id}: бонусная неделя закончилась (has_active_subscription={has_active_subscription}, attempts={attempts})")
-    
-    # Показываем "Управление доступом" только если подписка активна И автопродление включено
-    show_manage_button = has_active_subscription and auto_renewal_enabled
-    
-    # В БОЕВОМ РЕЖИМЕ показываем полное продакшн меню
-    if is_battle_mode:
-        # БОЕВОЙ РЕЖИМ: если есть активная подписка - показываем "Управление доступом", иначе "Получить доступ"
-        payment_button = BTN_MANAGE_SUB if has_active_subscription else BTN_PAY_1
-        
-        keyboard = [
-            [KeyboardButton(text=payment_button)],
-            [KeyboardButton(text=BTN_STATUS_1)],
-            [KeyboardButton(text=BTN_ABOUT_1)],
-            [KeyboardButton(text=BTN_CHECK_1)],
-            [KeyboardButton(text=BTN_SUPPORT)],
-        ]
-        logger.info(f"⚔️ БОЕВОЙ РЕЖИМ для пользователя {telegram_id}: показываем полное продакшн меню с '{payment_button}'")
-    else:
-        # Обычный режим: если есть активная подписка с автопродлением - показываем "Управление доступом", иначе "Получить доступ"
-        payment_button = BTN_MANAGE_SUB if show_manage_button else BTN_PAY_1
-        
-        keyboard = [
-            [KeyboardButton(text=payment_button)],
-            [KeyboardButton(text=BTN_STATUS_1)],
-            [KeyboardButton(text=BTN_ABOUT_1)],
-            [KeyboardButton(text=BTN_CHECK_1)],
-            [KeyboardButton(text=BTN_SUPPORT)],
-        ]
-    
-    return ReplyKeyboardMarkup(
-        keyboard=keyboard,
-        resize_keyboard=True,
-    )
-
-
 async def activate_subscription(telegram_id: int, days: int = 30) -> tuple[datetime, datetime]:
     """Активирует подписку на N дней (асинхронная версия для webhook)
     Возвращает (starts_at, expires_at)"""
@@ -1607,33 +1532,37 @@ async def activate_subscription(telegram_id: int, days: int = 30) -> tuple[datet
     starts_at = datetime.now(timezone.utc)
     expires_at = starts_at + timedelta(days=days)
     
-    async with aiosqlite.connect(DB_PATH) as db_conn:
-        # гарантируем, что юзер существует
-        await db_conn.execute(
-            "INSERT OR IGNORE INTO users (telegram_id, username, created_at) VALUES (?, ?, ?)",
-            (telegram_id, None, datetime.now(timezone.utc).isoformat())
-        )
+    async with user_lock(telegram_id):
+        async with db_write() as db_conn:
+            # гарантируем, что юзер существует
+            await db_conn.execute(
+                "INSERT OR IGNORE INTO users (telegram_id, username, created_at) VALUES (?, ?, ?)",
+                (telegram_id, None, datetime.now(timezone.utc).isoformat())
+            )
         
-        # upsert подписки (сохраняем дату начала и окончания)
-        # При активации новой подписки сбрасываем флаг subscription_expired_notified
-        await db_conn.execute(
-            """
-            INSERT INTO subscriptions (telegram_id, expires_at, starts_at, subscription_expired_notified)
-            VALUES (?, ?, ?, 0) ON CONFLICT(telegram_id) DO
-            UPDATE SET expires_at=excluded.expires_at, starts_at=excluded.starts_at,
-                       subscription_expired_notified=0
-            """,
-            (telegram_id, expires_at.isoformat(), starts_at.isoformat())
-        )
-        await db_conn.commit()
-        logger.info(f"💾 Подписка сохранена в БД: telegram_id={telegram_id}, expires_at={expires_at.isoformat()}, starts_at={starts_at.isoformat()}")
-    
+            # upsert подписки (сохраняем дату начала и окончания)
+            # При активации новой подписки сбрасываем флаг subscription_expired_notified
+            await db_conn.execute(
+                """
+                INSERT INTO subscriptions (telegram_id, expires_at, starts_at, expires_at_ms, starts_at_ms,
+                                           subscription_expired_notified)
+                VALUES (?, ?, ?, ?, ?, 0) ON CONFLICT(telegram_id) DO
+                UPDATE SET expires_at=excluded.expires_at, starts_at=excluded.starts_at,
+                           expires_at_ms=excluded.expires_at_ms, starts_at_ms=excluded.starts_at_ms,
+                           subscription_expired_notified=0
+                """,
+                (telegram_id, expires_at.isoformat(), starts_at.isoformat(), to_epoch_ms(expires_at), to_epoch_ms(starts_at))
+            )
+            await db_conn.commit()
+            logger.info(f"💾 Подписка сохранена в БД: telegram_id={telegram_id}, expires_at={expires_at.isoformat()}, starts_at={starts_at.isoformat()}")
+        invalidate_user_cache(telegram_id)
+        expiry_scheduler.schedule(telegram_id, expires_at)
     return starts_at, expires_at
 
 
 async def update_payment_status_async(payment_id: str, status: str):
     """Обновляет статус платежа (асинхронная версия)"""
-    async with aiosqlite.connect(DB_PATH) as db_conn:
+    async with db_write() as db_conn:
         await db_conn.execute(
             "UPDATE payments SET status = ? WHERE payment_id = ?",
             (status, payment_id)
@@ -1641,65 +1570,79 @@ async def update_payment_status_async(payment_id: str, status: str):
         await db_conn.commit()
 
 
+async def update_payment_statuses_async(updates: list[tuple[str, str]]) -> None:
+    """Обновляет статусы нескольких платежей одной транзакцией: updates = [(payment_id, status), ...]"""
+    if not updates:
+        return
+    async with db_write() as db_conn:
+        await db_conn.executemany(
+            "UPDATE payments SET status = ? WHERE payment_id = ?",
+            [(status, payment_id) for payment_id, status in updates]
+        )
+        await db_conn.commit()
+
+
+async def fetch_payment_statuses(payments: list[tuple[str, datetime]]) -> dict[str, str]:
+    """Актуальные статусы платежей из ЮKassa: payments = [(payment_id, created_at), ...]
+    Один постраничный Payment.list по диапазону created_at вместо find_payment на каждый платеж;
+    платежи, которых почему-то нет в списке, запрашиваются по одному"""
+    if not payments:
+        return {}
+    from yookassa_async import list_payments_created_between
+    created = [created_at for _, created_at in payments]
+    # Запас на расхождение часов и округление created_at в API
+    listed = await list_payments_created_between(min(created) - timedelta(minutes=1), max(created) + timedelta(minutes=1))
+    wanted = {payment_id for payment_id, _ in payments}
+    statuses = {payment.id: payment.status for payment in listed if payment.id in wanted}
+    for payment_id in wanted - statuses.keys():
+        try:
+            statuses[payment_id] = (await find_payment(payment_id)).status
+        except Exception as e:
+            logger.error(f"❌ Ошибка проверки платежа {payment_id}: {e}")
+    return statuses
+
+
 async def has_active_subscription(telegram_id: int) -> bool:
     """Проверяет, есть ли у пользователя активная подписка"""
-    from datetime import timezone
-    async with aiosqlite.connect(DB_PATH) as db_conn:
+    async with db_read() as db_conn:
         cursor = await db_conn.execute(
-            "SELECT expires_at FROM subscriptions WHERE telegram_id = ?",
+            "SELECT expires_at_ms FROM subscriptions WHERE telegram_id = ?",
             (telegram_id,)
         )
         row = await cursor.fetchone()
-        
-        if not row or not row[0]:
-            return False
-        
-        try:
-            from datetime import timezone
-            expires_at = datetime.fromisoformat(row[0])
-            # Если expires_at не имеет timezone, добавляем UTC
-            if expires_at.tzinfo is None:
-                expires_at = expires_at.replace(tzinfo=timezone.utc)
-            now = datetime.now(timezone.utc)
-            return expires_at > now
-        except ValueError:
-            return False
+    return bool(row and row[0] is not None and row[0] > now_ms())
 
 
 async def get_expired_pending_payments():
     """Получает список платежей со статусом pending, которые старше N минут"""
-    async with aiosqlite.connect(DB_PATH) as db_conn:
+    async with db_read() as db_conn:
         # Платежи старше N минут со статусом pending (НЕ canceled и НЕ expired)
-        cutoff_time = (datetime.now(timezone.utc) - timedelta(minutes=PAYMENT_LINK_VALID_MINUTES)).isoformat()
+        now = datetime.now(timezone.utc)
+        cutoff_time = to_epoch_ms(now - timedelta(minutes=PAYMENT_LINK_VALID_MINUTES))
+        # Статусы сверяются у всех платежей; reachable = 0 - уведомление об истечении ссылки не отправляем
         cursor = await db_conn.execute(
-            """
-            SELECT telegram_id, payment_id, created_at 
-            FROM payments 
-            WHERE status = 'pending' 
-            AND created_at < ?
-            AND created_at > ?
-            """,
-            (cutoff_time, (datetime.now(timezone.utc) - timedelta(hours=24)).isoformat())  # Только за последние 24 часа
+            queries.EXPIRED_PENDING_PAYMENTS,
+            (cutoff_time, to_epoch_ms(now - timedelta(hours=24)))  # Только за последние 24 часа
         )
         rows = await cursor.fetchall()
         return rows
 
 
-async def get_expired_subscriptions():
-    """Получает список подписок, которые истекли"""
-    async with aiosqlite.connect(DB_PATH) as db_conn:
+async def get_expired_subscriptions(telegram_ids: Optional[list[int]] = None):
+    """Получает список подписок, которые истекли (если передан telegram_ids - только среди этих пользователей)
+    Вместе с флагом уведомления и попытками автопродления, чтобы не делать отдельных запросов на каждого пользователя"""
+    async with db_read() as db_conn:
         now = datetime.now(timezone.utc)
         now_iso = now.isoformat()
+        query = queries.EXPIRED_SUBSCRIPTIONS
+        params = [to_epoch_ms(now)]
+        if telegram_ids is not None:
+            if not telegram_ids:
+                return []
+            query += f" AND telegram_id IN ({','.join('?' * len(telegram_ids))})"
+            params.extend(telegram_ids)
         # Подписки, которые уже истекли (проверяем с небольшим запасом для точности)
-        cursor = await db_conn.execute(
-            """
-            SELECT telegram_id, expires_at, auto_renewal_enabled, saved_payment_method_id, starts_at
-            FROM subscriptions 
-            WHERE expires_at IS NOT NULL 
-            AND expires_at <= ?
-            """,
-            (now_iso,)
-        )
+        cursor = await db_conn.execute(query, params)
         rows = await cursor.fetchall()
         logger.debug(f"🔍 get_expired_subscriptions: найдено {len(rows)} истекших подписок (now={now_iso})")
         for row in rows:
@@ -1707,29 +1650,46 @@ async def get_expired_subscriptions():
         return rows
 
 
+async def load_subscription_deadlines(until: Optional[datetime] = None, telegram_ids: Optional[list[int]] = None) -> list[tuple[int, datetime]]:
+    """Загружает дедлайны (telegram_id, expires_at) подписок, по которым еще не отправлено уведомление об истечении
+    until - только подписки, истекающие не позже этого времени (сверка по индексу expires_at)"""
+    query = queries.SUBSCRIPTION_DEADLINES
+    params = []
+    if until is not None:
+        query += queries.SUBSCRIPTION_DEADLINES_UNTIL
+        params.append(to_epoch_ms(until))
+    if telegram_ids is not None:
+        if not telegram_ids:
+            return []
+        query += f" AND telegram_id IN ({','.join('?' * len(telegram_ids))})"
+        params.extend(telegram_ids)
+    async with db_read() as db_conn:
+        cursor = await db_conn.execute(query, params)
+        rows = await cursor.fetchall()
+    return [(telegram_id, from_epoch_ms(expires_at_ms)) for telegram_id, expires_at_ms in rows]
+
+
 async def get_subscriptions_expiring_soon():
     """Получает список подписок, которые истекают через N дней (для уведомления)"""
-    async with aiosqlite.connect(DB_PATH) as db_conn:
+    async with db_read() as db_conn:
         now = datetime.now(timezone.utc)
         # Подписки, которые истекают через N дней (с небольшой погрешностью)
         target_date = now + timedelta(days=SUBSCRIPTION_EXPIRING_NOTIFICATION_DAYS)
         # Проверяем подписки, которые истекают в течение окна уведомления
-        start_date = target_date.isoformat()
-        end_date = (target_date + timedelta(hours=SUBSCRIPTION_EXPIRING_NOTIFICATION_WINDOW_HOURS)).isoformat()
+        start_date = to_epoch_ms(target_date)
+        end_date = to_epoch_ms(target_date + timedelta(hours=SUBSCRIPTION_EXPIRING_NOTIFICATION_WINDOW_HOURS))
         cursor = await db_conn.execute(
-            """
-            SELECT telegram_id, expires_at 
-            FROM subscriptions 
-            WHERE expires_at >= ? AND expires_at <= ?
-            """,
+            queries.SUBSCRIPTIONS_EXPIRING_SOON,
             (start_date, end_date)
         )
         rows = await cursor.fetchall()
-        return rows
+        return [(telegram_id, from_epoch_ms(expires_at_ms)) for telegram_id, expires_at_ms in rows]
 
 
 async def check_expired_payments():
-    """Проверяет истекшие платежи и уведомляет пользователей ровно через 10 минут после создания"""
+    """Проверяет истекшие платежи и уведомляет пользователей ровно через 10 минут после создания
+    Статусы всех подходящих платежей сверяются с ЮKassa одним запросом списка за тик (fetch_payment_statuses),
+    изменения статусов записываются в БД одной транзакцией"""
     notified_payments = set()  # Отслеживаем, для каких платежей уже отправлено уведомление
     
     while True:
@@ -1738,70 +1698,76 @@ async def check_expired_payments():
             
             expired_payments = await get_expired_pending_payments()
             
-            for telegram_id, payment_id, created_at in expired_payments:
+            # Платежи, у которых сейчас наступил момент уведомления: (telegram_id, payment_id, created_at, минут с создания)
+            due_payments = []
+            for telegram_id, payment_id, created_at_ms, reachable in expired_payments:
                 # Пропускаем, если уведомление уже было отправлено для этого платежа
                 if payment_id in notified_payments:
                     continue
                 
                 # Проверяем точное время истечения - должно быть ровно 10 минут (с погрешностью ±1 минута)
-                time_since_creation = None  # Инициализируем переменную
-                try:
-                    created_at_dt = datetime.fromisoformat(created_at)
-                    now = datetime.now(timezone.utc)
-                    time_since_creation = (now - created_at_dt).total_seconds() / 60  # в минутах
-                    
-                    # Проверяем, что прошло ровно 10 минут (с погрешностью ±1 минута из-за интервала проверки)
-                    # Это гарантирует, что уведомление будет отправлено в течение 1-2 минут после истечения 10 минут
-                    if time_since_creation < PAYMENT_LINK_VALID_MINUTES - 1:
-                        # Еще не истекло, пропускаем
-                        continue
-                    if time_since_creation > PAYMENT_LINK_VALID_MINUTES + 2:
-                        # Уже прошло больше 12 минут, пропускаем (чтобы не отправлять повторно)
-                        notified_payments.add(payment_id)
-                        continue
-                except Exception as time_error:
-                    logger.warning(f"⚠️ Ошибка проверки времени для платежа {payment_id}: {time_error}")
-                    # Продолжаем обработку, если не удалось проверить время
-                    # time_since_creation остается None
+                created_at_dt = from_epoch_ms(created_at_ms)
+                time_since_creation = (datetime.now(timezone.utc) - created_at_dt).total_seconds() / 60  # в минутах
                 
-                # Проверяем актуальный статус платежа в ЮKassa
+                # Проверяем, что прошло ровно 10 минут (с погрешностью ±1 минута из-за интервала проверки)
+                # Это гарантирует, что уведомление будет отправлено в течение 1-2 минут после истечения 10 минут
+                if time_since_creation < PAYMENT_LINK_VALID_MINUTES - 1:
+                    # Еще не истекло, пропускаем
+                    continue
+                if time_since_creation > PAYMENT_LINK_VALID_MINUTES + 2:
+                    # Уже прошло больше 12 минут, пропускаем (чтобы не отправлять повторно)
+                    notified_payments.add(payment_id)
+                    continue
+                due_payments.append((telegram_id, payment_id, created_at_dt, time_since_creation, reachable))
+            
+            if not due_payments:
+                continue
+            
+            # Актуальные статусы в ЮKassa - одним запросом списка на все платежи тика
+            statuses = await fetch_payment_statuses([(payment_id, created_at) for _, payment_id, created_at, _, _ in due_payments])
+            
+            # Сверка с БД: pending в ЮKassa -> expired (ссылка истекла), иначе - статус из ЮKassa (например, canceled)
+            status_updates = []
+            still_pending = []
+            for telegram_id, payment_id, _, time_since_creation, reachable in due_payments:
+                current_status = statuses.get(payment_id)
+                if current_status is None:
+                    continue  # Статус не получен - проверим на следующем тике
+                if current_status == "pending":
+                    status_updates.append((payment_id, "expired"))
+                    if reachable:
+                        still_pending.append((telegram_id, payment_id, time_since_creation))
+                    else:
+                        notified_payments.add(payment_id)  # Пользователь заблокировал бота - уведомлять некого
+                else:
+                    status_updates.append((payment_id, current_status))
+                    notified_payments.add(payment_id)  # Помечаем как обработанный
+            await update_payment_statuses_async(status_updates)
+            
+            for telegram_id, payment_id, time_since_creation in still_pending:
                 try:
-                    payment = Payment.find_one(payment_id)
-                    current_status = payment.status
+                    # ПРОВЕРЯЕМ: есть ли у пользователя активная подписка
+                    has_active = await has_active_subscription(telegram_id)
                     
-                    # Если платеж все еще pending (не оплачен), уведомляем пользователя
-                    if current_status == "pending":
-                        # ПРОВЕРЯЕМ: есть ли у пользователя активная подписка
-                        has_active = await has_active_subscription(telegram_id)
-                        
-                        if has_active:
-                            # Если подписка активна - просто обновляем статус, не отправляем уведомление
-                            await update_payment_status_async(payment_id, "expired")
-                            notified_payments.add(payment_id)  # Помечаем как обработанный
-                            logger.info(f"ℹ️ Платеж {payment_id} истек, но у пользователя {telegram_id} уже есть активная подписка - уведомление не отправлено")
-                        else:
-                            # Обновляем статус на expired
-                            await update_payment_status_async(payment_id, "expired")
-                            
-                            # Уведомляем пользователя только если нет активной подписки (ОДИН РАЗ)
-                            result = await safe_send_message(
-                                bot=bot,
-                                chat_id=telegram_id,
-                                text=f"⏰ Срок действия ссылки на оплату истёк\n\n"
-                                    "Вы открыли ссылку на оплату, но не завершили платёж.\n"
-                                    f"Ссылка была действительна {PAYMENT_LINK_VALID_MINUTES} минут.\n\n"
-                                    "Для оплаты доступа нажмите кнопку 💳 Получить доступ и перейдите по новой ссылке."
-                                )
-                            if result:
-                                notified_payments.add(payment_id)  # Помечаем, что уведомление отправлено
-                                time_text = f"{time_since_creation:.1f}" if time_since_creation is not None else "неизвестно"
-                                logger.info(f"✅ Отправлено уведомление об истечении ссылки пользователю {telegram_id} для платежа {payment_id} (один раз, через {time_text} минут после создания)")
-                            else:
-                                logger.warning(f"⚠️ Не удалось отправить уведомление об истечении ссылки пользователю {telegram_id}")
-                    else:
-                        # Если статус изменился (например, на canceled), обновляем в БД
-                        await update_payment_status_async(payment_id, current_status)
+                    if has_active:
+                        # Если подписка активна - статус уже обновлен, не отправляем уведомление
                         notified_payments.add(payment_id)  # Помечаем как обработанный
+                        logger.info(f"ℹ️ Платеж {payment_id} истек, но у пользователя {telegram_id} уже есть активная подписка - уведомление не отправлено")
+                    else:
+                        # Уведомляем пользователя только если нет активной подписки (ОДИН РАЗ)
+                        result = await safe_send_message(
+                            bot=bot,
+                            chat_id=telegram_id,
+                            text=f"⏰ Срок действия ссылки на оплату истёк\n\n"
+                                "Вы открыли ссылку на оплату, но не завершили платёж.\n"
+                                f"Ссылка была действительна {PAYMENT_LINK_VALID_MINUTES} минут.\n\n"
+                                "Для оплаты доступа нажмите кнопку 💳 Получить доступ и перейдите по новой ссылке."
+                            )
+                        if result:
+                            notified_payments.add(payment_id)  # Помечаем, что уведомление отправлено
+                            logger.info(f"✅ Отправлено уведомление об истечении ссылки пользователю {telegram_id} для платежа {payment_id} (один раз, через {time_since_creation:.1f} минут после создания)")
+                        else:
+                            logger.warning(f"⚠️ Не удалось отправить уведомление об истечении ссылки пользователю {telegram_id}")
                         
                 except Exception as e:
                     logger.error(f"❌ Ошибка проверки платежа {payment_id}: {e}")
@@ -1834,15 +1800,12 @@ async def check_subscriptions_expiring_soon():
             # Получаем подписки, которые истекают через N дней
             expiring_subs = await get_subscriptions_expiring_soon()
             
-            for telegram_id, expires_at_str in expiring_subs:
+            for telegram_id, expires_at in expiring_subs:
                 if telegram_id in notified_users:
                     continue
                     
                 try:
-                    expires_at = datetime.fromisoformat(expires_at_str)
                     now = datetime.now(timezone.utc)
-                    if expires_at.tzinfo is None:
-                        expires_at = expires_at.replace(tzinfo=timezone.utc)
                     days_left = (expires_at - now).days
                     
                     # Если осталось примерно N дней (с погрешностью ±1 день)
@@ -1899,8 +1862,13 @@ async def check_subscriptions_expiring_soon():
 
 async def attempt_auto_renewal(telegram_id: int, saved_payment_method_id: str, auto_amount: str, auto_duration: float, attempt_number: int) -> bool:
     """Выполняет одну попытку автопродления. Возвращает True если успешно, False если неудачно."""
+    async with user_lock(telegram_id):
+        return await _attempt_auto_renewal(telegram_id, saved_payment_method_id, auto_amount, auto_duration, attempt_number)
+
+
+async def _attempt_auto_renewal(telegram_id: int, saved_payment_method_id: str, auto_amount: str, auto_duration: float, attempt_number: int) -> bool:
     try:
-        from payments import create_auto_payment, get_payment_status
+        from yookassa_async import create_auto_payment, get_payment_status
         from db import activate_subscription_days, save_payment, update_payment_status, get_subscription_expires_at, increment_auto_renewal_attempts, reset_auto_renewal_attempts, set_auto_renewal
         
         CUSTOMER_EMAIL = os.getenv("PAYMENT_CUSTOMER_EMAIL", "test@example.com")
@@ -1908,7 +1876,7 @@ async def attempt_auto_renewal(telegram_id: int, saved_payment_method_id: str, a
         logger.info(f"🔄 Попытка {attempt_number} автопродления для пользователя {telegram_id}: {auto_amount} руб, {auto_duration} дней")
         
         # Создаем автоматический платеж
-        payment_id, payment_status = create_auto_payment(
+        payment_id, payment_status = await create_auto_payment(
             amount_rub=auto_amount,
             description=f"Автопродление доступа на канал ({format_subscription_duration(auto_duration)})",
             customer_email=CUSTOMER_EMAIL,
@@ -1919,11 +1887,20 @@ async def attempt_auto_renewal(telegram_id: int, saved_payment_method_id: str, a
         # Сохраняем платеж
         await save_payment(telegram_id, payment_id, status=payment_status)
         
-        # Ждем немного для обработки webhook
-        await asyncio.sleep(3)
-        
-        # Проверяем статус платежа
-        refreshed_status = get_payment_status(payment_id)
+        # Автоплатеж обычно сразу succeeded/canceled; если он еще в обработке - ждем webhook с результатом
+        # (payment_waiters разрешает /yookassa/webhook). Тело webhook не подписано, поэтому уведомление только
+        # будит ожидание, а итоговый статус всегда подтверждается в API; пока API не вернул итоговый статус,
+        # ждем до конца AUTO_RENEWAL_WEBHOOK_WAIT_SECONDS
+        refreshed_status = payment_status
+        if refreshed_status not in PAYMENT_FINAL_STATUSES:
+            wait_until = asyncio.get_running_loop().time() + AUTO_RENEWAL_WEBHOOK_WAIT_SECONDS
+            while True:
+                remaining = wait_until - asyncio.get_running_loop().time()
+                notified = await payment_waiters.wait(payment_id, remaining) if remaining > 0 else None
+                refreshed_status = await get_payment_status(payment_id)
+                logger.info(f"🔍 Статус автоплатежа {payment_id} запрошен в API: {refreshed_status} (уведомление: {notified})")
+                if refreshed_status in PAYMENT_FINAL_STATUSES or notified is None:
+                    break
         await update_payment_status(payment_id, refreshed_status)
         
         if refreshed_status == "succeeded":
@@ -1935,23 +1912,24 @@ async def attempt_auto_renewal(telegram_id: int, saved_payment_method_id: str, a
             
             # КРИТИЧЕСКИ ВАЖНО: Очищаем кэш ПОСЛЕ активации подписки и сброса попыток
             # Это гарантирует, что меню будет правильно сгенерировано
-            from db import _clear_cache
-            _clear_cache()
-            
-            # Даем время для обновления БД
-            await asyncio.sleep(0.5)
+            from db import invalidate_user_cache
+            invalidate_user_cache(telegram_id)
             
             # Выдаем новую ссылку после успешного автопродления
             subscription_expires_at = await get_subscription_expires_at(telegram_id)
             link_expire_date = subscription_expires_at if subscription_expires_at else (datetime.now(timezone.utc) + timedelta(days=auto_duration))
             
-            # Создаем только одну ссылку - сначала пробуем с creates_join_request=True
-            invite_link = await safe_create_invite_link(
-                bot=bot,
-                chat_id=CHANNEL_ID,
-                creates_join_request=True,
-                expire_date=link_expire_date
-            )
+            # Берем готовую ссылку из пула (уже сохранена за пользователем); пул пуст - создаем как раньше
+            invite_link = await invite_link_pool.take(telegram_id, payment_id, link_expire_date)
+            pooled_link = invite_link is not None
+            
+            if not invite_link:
+                invite_link = await safe_create_invite_link(
+                    bot=bot,
+                    chat_id=CHANNEL_ID,
+                    creates_join_request=True,
+                    expire_date=link_expire_date
+                )
             
             # Если не получилось создать с creates_join_request=True, пробуем без него
             if not invite_link:
@@ -1964,7 +1942,7 @@ async def attempt_auto_renewal(telegram_id: int, saved_payment_method_id: str, a
                 )
             
             # Сохраняем только одну ссылку
-            if invite_link:
+            if invite_link and not pooled_link:
                 await save_invite_link(invite_link, telegram_id, payment_id)
                 logger.info(f"✅ Создана и сохранена одна ссылка для пользователя {telegram_id} после успешного автопродления")
             
@@ -2016,8 +1994,7 @@ async def attempt_auto_renewal(telegram_id: int, saved_payment_method_id: str, a
             # Проверяем детали платежа для определения причины отказа
             insufficient_funds = False
             try:
-                from yookassa import Payment as YooPayment
-                payment_obj = YooPayment.find_one(payment_id)
+                payment_obj = await find_payment(payment_id)
                 if hasattr(payment_obj, 'cancellation_details') and payment_obj.cancellation_details:
                     cd = payment_obj.cancellation_details
                     reason = None
@@ -2055,11 +2032,7 @@ async def attempt_auto_renewal(telegram_id: int, saved_payment_method_id: str, a
                 
                 # Баним пользователя в канале СРАЗУ
                 try:
-                    await bot.ban_chat_member(
-                        chat_id=CHANNEL_ID,
-                        user_id=telegram_id,
-                        until_date=None  # Бан навсегда
-                    )
+                    await ban_channel_member(telegram_id)
                     logger.info(f"✅ Пользователь {telegram_id} забанен СРАЗУ после первой неудачной попытки автопродления")
                 except Exception as ban_error:
                     logger.warning(f"⚠️ Ошибка бана пользователя {telegram_id}: {ban_error}")
@@ -2067,8 +2040,8 @@ async def attempt_auto_renewal(telegram_id: int, saved_payment_method_id: str, a
                 from db import get_invite_link
                 # revoke_invite_link определена в webhook_app.py, не нужно импортировать
                 
-                from db import _clear_cache
-                _clear_cache()
+                from db import invalidate_user_cache
+                invalidate_user_cache(telegram_id)
                 
                 # КРИТИЧЕСКИ ВАЖНО: Меню НЕ должно меняться до завершения всех 3 попыток
                 # Используем текущее меню пользователя (которое определяется логикой auto_renewal_in_progress)
@@ -2094,8 +2067,8 @@ async def attempt_auto_renewal(telegram_id: int, saved_payment_method_id: str, a
             # Для попыток 2 и 3 (если они тоже неудачны) - отправляем уведомление, но без бана (бан уже был после первой попытки)
             elif attempts_after_failure > ban_threshold and attempts_after_failure < max_attempts:
                 logger.info(f"⚠️ Попытка {attempts_after_failure} из {max_attempts} неудачна для пользователя {telegram_id}. Отправляем уведомление (бан уже был после первой попытки)")
-                from db import _clear_cache
-                _clear_cache()
+                from db import invalidate_user_cache
+                invalidate_user_cache(telegram_id)
                 
                 # КРИТИЧЕСКИ ВАЖНО: Меню НЕ должно меняться до завершения всех 3 попыток
                 # Используем текущее меню пользователя (которое определяется логикой auto_renewal_in_progress)
@@ -2120,11 +2093,10 @@ async def attempt_auto_renewal(telegram_id: int, saved_payment_method_id: str, a
             # После 3-й неудачной попытки - окончательное отключение автопродления
             if attempts_after_failure >= max_attempts:
                 logger.info(f"🚨 ВСЕ {max_attempts} ПОПЫТКИ ЗАВЕРШЕНЫ для пользователя {telegram_id}! Окончательное отключение автопродления")
-                from db import set_auto_renewal
                 
                 await set_auto_renewal(telegram_id, False)
-                from db import _clear_cache
-                _clear_cache()
+                from db import invalidate_user_cache
+                invalidate_user_cache(telegram_id)
                 
                 # Получаем продакшн меню с "Оплатить доступ"
                 menu = await get_main_menu_for_user(telegram_id)
@@ -2170,6 +2142,166 @@ async def attempt_auto_renewal(telegram_id: int, saved_payment_method_id: str, a
         return False
 
 
+async def _process_bonus_subscription_transition(telegram_id: int, bonus_week_start: datetime, bonus_week_end: datetime) -> None:
+    """Переход одной бонусной подписки в продакшн режим (попытки автопродления, уведомление об истечении)
+    Выполняется в renewal_engine параллельно с другими пользователями. Состояние подписки читается
+    под user_lock: пока задание ждало в очереди, подписку могли продлить или уже обработать"""
+    from db import get_auto_renewal_attempts, get_subscription_states
+    try:
+        async with user_lock(telegram_id):
+            # Полная информация о подписке для автопродления
+            sub_info = (await get_subscription_states([telegram_id])).get(telegram_id)
+            if not sub_info:
+                return
+            expires_at = sub_info['expires_at']
+            starts_at = sub_info['starts_at']
+            now = datetime.now(timezone.utc)
+            
+            if expires_at is None or starts_at is None:
+                return
+        
+            # Проверяем, что это подписка из бонусной недели
+            is_bonus_subscription = False
+            if starts_at:
+                is_bonus_subscription = bonus_week_start <= starts_at <= bonus_week_end
+                logger.info(f"🔍 Проверка бонусной подписки для {telegram_id}: starts_at={starts_at.isoformat()}, bonus_week_start={bonus_week_start.isoformat()}, bonus_week_end={bonus_week_end.isoformat()}, is_bonus={is_bonus_subscription}")
+            elif expires_at:
+                # Если starts_at нет, проверяем по expires_at
+                time_diff = (expires_at - bonus_week_end).total_seconds() / 60
+                is_bonus_subscription = expires_at <= bonus_week_end or (0 <= time_diff <= 2)
+                logger.info(f"🔍 Проверка бонусной подписки для {telegram_id} (без starts_at): expires_at={expires_at.isoformat()}, bonus_week_end={bonus_week_end.isoformat()}, time_diff={time_diff:.1f} мин, is_bonus={is_bonus_subscription}")
+            else:
+                logger.warning(f"⚠️ Нет starts_at и expires_at для пользователя {telegram_id}")
+        
+            if not is_bonus_subscription:
+                logger.info(f"⏭️ Пропуск пользователя {telegram_id}: не бонусная подписка")
+                return
+        
+            logger.info(f"✅ Пользователь {telegram_id} имеет бонусную подписку, обрабатываем автопродление")
+        
+            # Получаем информацию об автопродлении
+            auto_renewal_enabled = sub_info.get('auto_renewal_enabled', False)
+            saved_payment_method_id = sub_info.get('saved_payment_method_id')
+        
+            # КРИТИЧЕСКИ ВАЖНО: Если автопродление отключено И нет сохраненного способа оплаты,
+            # проверяем, истекла ли подписка и отправляем уведомление об истечении доступа, баним пользователя и отзываем ссылку
+            # ВАЖНО: Это должно срабатывать ТОЛЬКО если автопродление действительно отключено,
+            # а не просто если нет saved_payment_method_id (так как автопродление может быть включено, но попытка еще не выполнена)
+            if not auto_renewal_enabled:
+                # Проверяем, истекла ли бонусная подписка
+                if expires_at and expires_at <= now:
+                    # Подписка истекла - отправляем уведомление, баним и отзываем ссылку
+                    from db import set_subscription_expired_notified, get_invite_link
+                    already_notified = sub_info.get('subscription_expired_notified', False)
+                
+                    # КРИТИЧЕСКИ ВАЖНО: Проверяем, не идут ли попытки автопродления
+                    # Если идут попытки, не отправляем это уведомление (оно будет отправлено в attempt_auto_renewal)
+                    attempts_check = sub_info.get('auto_renewal_attempts', 0)
+                    # Если автопродление включено, но попытки еще не начались или уже завершены, не отправляем уведомление здесь
+                    # Уведомление отправляется только если автопродление отключено
+                
+                    if not already_notified:
+                        # Получаем продакшн меню с "Оплатить доступ"
+                        menu = await get_main_menu_for_user(telegram_id)
+                    
+                        # Отправляем уведомление об истечении доступа
+                        await safe_send_message(
+                            bot=bot,
+                            chat_id=telegram_id,
+                            text=(
+                                "⏰ <b>Ваш доступ истек</b>\n\n"
+                                "Бонусная подписка закончилась.\n"
+                                "Для продления доступа нажмите кнопку 💳 Получить доступ."
+                            ),
+                            parse_mode="HTML",
+                            reply_markup=menu
+                        )
+                    
+                        # Отзываем ссылку пользователя
+                        user_invite_link = await get_invite_link(telegram_id)
+                        if user_invite_link:
+                            await revoke_invite_link(user_invite_link)
+                            logger.info(f"✅ Ссылка пользователя {telegram_id} отозвана из-за истечения бонусной подписки (автопродление отключено)")
+                    
+                        # Баним пользователя в канале
+                        try:
+                            await ban_channel_member(telegram_id)
+                            logger.info(f"✅ Пользователь {telegram_id} забанен в канале из-за истечения бонусной подписки (автопродление отключено)")
+                        except Exception as ban_error:
+                            logger.warning(f"⚠️ Ошибка бана пользователя {telegram_id}: {ban_error}")
+                    
+                        # Помечаем, что уведомление отправлено
+                        await set_subscription_expired_notified(telegram_id, True)
+                        logger.info(f"📧 Отправлено уведомление об истечении бонусной подписки пользователю {telegram_id} (автопродление отключено), пользователь забанен")
+                return
+        
+            # Информация о попытках
+            attempts = sub_info.get('auto_renewal_attempts', 0)
+            last_attempt_at = sub_info.get('last_auto_renewal_attempt_at')
+        
+            # КРИТИЧЕСКИ ВАЖНО: Убеждаемся, что last_attempt_at имеет timezone
+            if last_attempt_at and last_attempt_at.tzinfo is None:
+                last_attempt_at = last_attempt_at.replace(tzinfo=timezone.utc)
+        
+            # Определяем, нужно ли выполнить попытку автопродления
+            should_attempt = False
+            attempt_number = 0
+        
+            # Проверяем, истекла ли подписка
+            subscription_expired = expires_at and expires_at <= now
+        
+            if subscription_expired and attempts == 0:
+                # Первая попытка: СРАЗУ после истечения подписки
+                should_attempt = True
+                attempt_number = 1
+                logger.info(f"🔄 Первая попытка автопродления для пользователя {telegram_id} (подписка истекла {((now - expires_at).total_seconds() / 60):.1f} минут назад)")
+            elif attempts > 0 and attempts < 3:
+                # Проверяем, прошло ли достаточно времени с последней попытки
+                if last_attempt_at:
+                    try:
+                        time_since_last_attempt = (now - last_attempt_at).total_seconds() / 60
+                        if time_since_last_attempt >= AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES:  # Прошло минимум интервал автопродления
+                            should_attempt = True
+                            attempt_number = attempts + 1
+                            logger.info(f"🔄 Попытка {attempt_number} автопродления для пользователя {telegram_id} (прошло {time_since_last_attempt:.1f} минут с последней попытки)")
+                    except Exception as time_error:
+                        logger.warning(f"⚠️ Ошибка вычисления времени с последней попытки для пользователя {telegram_id}: {time_error}")
+                        # Если ошибка, проверяем, прошло ли достаточно времени (минимум интервал автопродления)
+                        if last_attempt_at:
+                            time_since_last_attempt = (now - last_attempt_at).total_seconds() / 60
+                            if time_since_last_attempt >= AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES:
+                                should_attempt = True
+                                attempt_number = attempts + 1
+                else:
+                    # Если last_attempt_at нет, но есть попытки - выполняем следующую попытку
+                    should_attempt = True
+                    attempt_number = attempts + 1
+                    logger.info(f"🔄 Попытка {attempt_number} автопродления для пользователя {telegram_id} (нет информации о последней попытке)")
+        
+            if should_attempt:
+                auto_amount = get_production_subscription_price()
+                auto_duration = get_production_subscription_duration()
+            
+                # Выполняем попытку автопродления
+                success = await attempt_auto_renewal(telegram_id, saved_payment_method_id, auto_amount, auto_duration, attempt_number)
+            
+                # Получаем актуальное количество попыток после attempt_auto_renewal
+                attempts_after = await get_auto_renewal_attempts(telegram_id)
+            
+                if success:
+                    # Успешно - меню уже обновлено в attempt_auto_renewal
+                    logger.info(f"✅ Автопродление успешно для пользователя {telegram_id}, попытка {attempt_number}")
+                elif attempts_after >= 3:
+                    # Все 3 попытки неудачны - бан и меню с "Оплатить доступ"
+                    # КРИТИЧЕСКИ ВАЖНО: Эта логика уже обработана в attempt_auto_renewal на 3 попытке
+                    # Здесь только логируем для отладки
+                    logger.info(f"✅ Все 3 попытки автопродления завершены для пользователя {telegram_id}, обработка выполнена в attempt_auto_renewal")
+    
+    except Exception as e:
+        logger.error(f"❌ Ошибка обработки пользователя {telegram_id}: {e}")
+        import traceback
+        traceback.print_exc()
+
 async def check_bonus_week_transition_to_production():
     """Проверяет переход в продакшн режим после окончания бонусной недели и выполняет автопродление:
     1. При окончании бонусной недели - первая попытка автопродления (сразу)
@@ -2206,196 +2338,29 @@ async def check_bonus_week_transition_to_production():
             # КРИТИЧЕСКИ ВАЖНО: Получаем ВСЕ подписки (включая истекшие), которые были созданы во время бонусной недели
             # Это необходимо, потому что когда бонусная неделя заканчивается, подписка уже истекла
             # и не попадает в get_all_active_subscriptions()
-            from db import get_subscription_info, get_last_auto_renewal_attempt_at, get_auto_renewal_attempts
-            async with aiosqlite.connect(DB_PATH) as db_conn:
-                cursor = await db_conn.execute(
-                    """
-                    SELECT telegram_id, expires_at, starts_at 
-                    FROM subscriptions 
-                    WHERE starts_at IS NOT NULL
-                    """,
-                )
+            from db import get_subscription_states
+            async with db_read() as db_conn:
+                cursor = await db_conn.execute(queries.BONUS_WEEK_SUBSCRIPTIONS)
                 all_subs = await cursor.fetchall()
             
             logger.info(f"🔍 check_bonus_week_transition_to_production: найдено {len(all_subs)} подписок с starts_at")
             
+            # Состояние всех подписок (автопродление, попытки, флаг уведомления) одним запросом вместо N
+            sub_states = await get_subscription_states([row[0] for row in all_subs])
+            
+            # Пользователи обрабатываются параллельно (renewal_engine): волна истечений в BONUS_WEEK_END_DATE
+            # не выстраивается в очередь по одному; пользователь с незавершенным заданием пропускается до следующего тика.
+            # Снимок только отсеивает пользователей, у которых заведомо ничего не наступило (подписка не истекла,
+            # попыток не было); решение задание принимает по состоянию, перечитанному под user_lock
             for row in all_subs:
-                telegram_id = row[0]
-                expires_at_str = row[1]
-                starts_at_str = row[2] if len(row) > 2 else None
-                try:
-                    if not expires_at_str:
-                        continue
-                    expires_at = datetime.fromisoformat(expires_at_str)
-                    if expires_at.tzinfo is None:
-                        expires_at = expires_at.replace(tzinfo=timezone.utc)
-                        
-                    # Используем starts_at из запроса, если есть
-                    if starts_at_str:
-                        starts_at = datetime.fromisoformat(starts_at_str)
-                        if starts_at.tzinfo is None:
-                            starts_at = starts_at.replace(tzinfo=timezone.utc)
-                    else:
-                        # Если starts_at нет в запросе, получаем из sub_info
-                        sub_info = await get_subscription_info(telegram_id)
-                        if not sub_info:
-                            continue
-                        starts_at = sub_info.get('starts_at')
-                        if starts_at and starts_at.tzinfo is None:
-                            starts_at = starts_at.replace(tzinfo=timezone.utc)
-                        if not starts_at:
-                            continue
-                    
-                    # Получаем полную информацию о подписке для автопродления
-                    sub_info = await get_subscription_info(telegram_id)
-                    if not sub_info:
-                        continue
-                    
-                    # Проверяем, что это подписка из бонусной недели
-                    is_bonus_subscription = False
-                    if starts_at:
-                        is_bonus_subscription = bonus_week_start <= starts_at <= bonus_week_end
-                        logger.info(f"🔍 Проверка бонусной подписки для {telegram_id}: starts_at={starts_at.isoformat()}, bonus_week_start={bonus_week_start.isoformat()}, bonus_week_end={bonus_week_end.isoformat()}, is_bonus={is_bonus_subscription}")
-                    elif expires_at:
-                        # Если starts_at нет, проверяем по expires_at
-                        time_diff = (expires_at - bonus_week_end).total_seconds() / 60
-                        is_bonus_subscription = expires_at <= bonus_week_end or (0 <= time_diff <= 2)
-                        logger.info(f"🔍 Проверка бонусной подписки для {telegram_id} (без starts_at): expires_at={expires_at.isoformat()}, bonus_week_end={bonus_week_end.isoformat()}, time_diff={time_diff:.1f} мин, is_bonus={is_bonus_subscription}")
-                    else:
-                        logger.warning(f"⚠️ Нет starts_at и expires_at для пользователя {telegram_id}")
-                    
-                    if not is_bonus_subscription:
-                        logger.info(f"⏭️ Пропуск пользователя {telegram_id}: не бонусная подписка")
-                        continue
-                    
-                    logger.info(f"✅ Пользователь {telegram_id} имеет бонусную подписку, обрабатываем автопродление")
-                    
-                    # Получаем информацию об автопродлении
-                    auto_renewal_enabled = sub_info.get('auto_renewal_enabled', False)
-                    saved_payment_method_id = sub_info.get('saved_payment_method_id')
-                    
-                    # КРИТИЧЕСКИ ВАЖНО: Если автопродление отключено И нет сохраненного способа оплаты,
-                    # проверяем, истекла ли подписка и отправляем уведомление об истечении доступа, баним пользователя и отзываем ссылку
-                    # ВАЖНО: Это должно срабатывать ТОЛЬКО если автопродление действительно отключено,
-                    # а не просто если нет saved_payment_method_id (так как автопродление может быть включено, но попытка еще не выполнена)
-                    if not auto_renewal_enabled:
-                        # Проверяем, истекла ли бонусная подписка
-                        if expires_at and expires_at <= now:
-                            # Подписка истекла - отправляем уведомление, баним и отзываем ссылку
-                            from db import get_subscription_expired_notified, set_subscription_expired_notified, get_invite_link, get_auto_renewal_attempts
-                            already_notified = await get_subscription_expired_notified(telegram_id)
-                            
-                            # КРИТИЧЕСКИ ВАЖНО: Проверяем, не идут ли попытки автопродления
-                            # Если идут попытки, не отправляем это уведомление (оно будет отправлено в attempt_auto_renewal)
-                            attempts_check = await get_auto_renewal_attempts(telegram_id)
-                            # Если автопродление включено, но попытки еще не начались или уже завершены, не отправляем уведомление здесь
-                            # Уведомление отправляется только если автопродление отключено
-                            
-                            if not already_notified:
-                                # Получаем продакшн меню с "Оплатить доступ"
-                                menu = await get_main_menu_for_user(telegram_id)
-                                
-                                # Отправляем уведомление об истечении доступа
-                                await safe_send_message(
-                                    bot=bot,
-                                    chat_id=telegram_id,
-                                    text=(
-                                        "⏰ <b>Ваш доступ истек</b>\n\n"
-                                        "Бонусная подписка закончилась.\n"
-                                        "Для продления доступа нажмите кнопку 💳 Получить доступ."
-                                    ),
-                                    parse_mode="HTML",
-                                    reply_markup=menu
-                                )
-                                
-                                # Отзываем ссылку пользователя
-                                user_invite_link = await get_invite_link(telegram_id)
-                                if user_invite_link:
-                                    await revoke_invite_link(user_invite_link)
-                                    logger.info(f"✅ Ссылка пользователя {telegram_id} отозвана из-за истечения бонусной подписки (автопродление отключено)")
-                                
-                                # Баним пользователя в канале
-                                try:
-                                    await bot.ban_chat_member(
-                                        chat_id=CHANNEL_ID,
-                                        user_id=telegram_id,
-                                        until_date=None  # Бан навсегда
-                                    )
-                                    logger.info(f"✅ Пользователь {telegram_id} забанен в канале из-за истечения бонусной подписки (автопродление отключено)")
-                                except Exception as ban_error:
-                                    logger.warning(f"⚠️ Ошибка бана пользователя {telegram_id}: {ban_error}")
-                                
-                                # Помечаем, что уведомление отправлено
-                                await set_subscription_expired_notified(telegram_id, True)
-                                logger.info(f"📧 Отправлено уведомление об истечении бонусной подписки пользователю {telegram_id} (автопродление отключено), пользователь забанен")
-                        continue
-                    
-                    # Получаем информацию о попытках
-                    attempts = await get_auto_renewal_attempts(telegram_id)
-                    last_attempt_at = await get_last_auto_renewal_attempt_at(telegram_id)
-                    
-                    # КРИТИЧЕСКИ ВАЖНО: Убеждаемся, что last_attempt_at имеет timezone
-                    if last_attempt_at and last_attempt_at.tzinfo is None:
-                        last_attempt_at = last_attempt_at.replace(tzinfo=timezone.utc)
-                    
-                    # Определяем, нужно ли выполнить попытку автопродления
-                    should_attempt = False
-                    attempt_number = 0
-                    
-                    # Проверяем, истекла ли подписка
-                    subscription_expired = expires_at and expires_at <= now
-                    
-                    if subscription_expired and attempts == 0:
-                        # Первая попытка: СРАЗУ после истечения подписки
-                        should_attempt = True
-                        attempt_number = 1
-                        logger.info(f"🔄 Первая попытка автопродления для пользователя {telegram_id} (подписка истекла {((now - expires_at).total_seconds() / 60):.1f} минут назад)")
-                    elif attempts > 0 and attempts < 3:
-                        # Проверяем, прошло ли достаточно времени с последней попытки
-                        if last_attempt_at:
-                            try:
-                                time_since_last_attempt = (now - last_attempt_at).total_seconds() / 60
-                                if time_since_last_attempt >= AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES:  # Прошло минимум интервал автопродления
-                                    should_attempt = True
-                                    attempt_number = attempts + 1
-                                    logger.info(f"🔄 Попытка {attempt_number} автопродления для пользователя {telegram_id} (прошло {time_since_last_attempt:.1f} минут с последней попытки)")
-                            except Exception as time_error:
-                                logger.warning(f"⚠️ Ошибка вычисления времени с последней попытки для пользователя {telegram_id}: {time_error}")
-                                # Если ошибка, проверяем, прошло ли достаточно времени (минимум интервал автопродления)
-                                if last_attempt_at:
-                                    time_since_last_attempt = (now - last_attempt_at).total_seconds() / 60
-                                    if time_since_last_attempt >= AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES:
-                                        should_attempt = True
-                                        attempt_number = attempts + 1
-                        else:
-                            # Если last_attempt_at нет, но есть попытки - выполняем следующую попытку
-                            should_attempt = True
-                            attempt_number = attempts + 1
-                            logger.info(f"🔄 Попытка {attempt_number} автопродления для пользователя {telegram_id} (нет информации о последней попытке)")
-                    
-                    if should_attempt:
-                        auto_amount = get_production_subscription_price()
-                        auto_duration = get_production_subscription_duration()
-                        
-                        # Выполняем попытку автопродления
-                        success = await attempt_auto_renewal(telegram_id, saved_payment_method_id, auto_amount, auto_duration, attempt_number)
-                        
-                        # Получаем актуальное количество попыток после attempt_auto_renewal
-                        attempts_after = await get_auto_renewal_attempts(telegram_id)
-                        
-                        if success:
-                            # Успешно - меню уже обновлено в attempt_auto_renewal
-                            logger.info(f"✅ Автопродление успешно для пользователя {telegram_id}, попытка {attempt_number}")
-                        elif attempts_after >= 3:
-                            # Все 3 попытки неудачны - бан и меню с "Оплатить доступ"
-                            # КРИТИЧЕСКИ ВАЖНО: Эта логика уже обработана в attempt_auto_renewal на 3 попытке
-                            # Здесь только логируем для отладки
-                            logger.info(f"✅ Все 3 попытки автопродления завершены для пользователя {telegram_id}, обработка выполнена в attempt_auto_renewal")
-                
-                except Exception as e:
-                    logger.error(f"❌ Ошибка обработки пользователя {telegram_id}: {e}")
-                    import traceback
-                    traceback.print_exc()
+                sub_info = sub_states.get(row[0])
+                if not sub_info:
+                    continue
+                if sub_info['auto_renewal_attempts'] == 0 and (sub_info['expires_at'] is None or sub_info['expires_at'] > now):
+                    continue
+                renewal_engine.submit(row[0], partial(
+                    _process_bonus_subscription_transition, row[0], bonus_week_start, bonus_week_end,
+                ))
             
         except Exception as e:
             logger.error(f"❌ Ошибка в фоновой задаче проверки перехода в продакшн режим: {e}")
@@ -2430,20 +2395,19 @@ async def check_bonus_week_ending_soon():
             
             # Получаем всех пользователей с активными подписками только если бонусная неделя еще активна
             from db import get_all_active_subscriptions
-            active_subs = await get_all_active_subscriptions()
+            active_subs = await get_all_active_subscriptions(reachable_only=True)
             
             # Проверяем, нужно ли отправлять уведомление (за vremya_sms минут до окончания)
             # Используем погрешность ±0.5 минуты для точности (чтобы не пропустить и не отправить слишком рано)
             # Проверяем, что осталось от vremya_sms-0.5 до vremya_sms+0.5 минут
             if vremya_sms - 0.5 <= minutes_until_end <= vremya_sms + 0.5:
                 logger.info(f"🔔 Время для уведомления о конце бонусной недели: minutes_until_end={minutes_until_end:.1f}, vremya_sms={vremya_sms}, bonus_week_end={bonus_week_end}, now={now}")
-                for telegram_id, expires_at_str in active_subs:
+                for telegram_id, expires_at in active_subs:
                     if telegram_id in notified_users:
                         continue
                     
                     try:
                         # Проверяем, что подписка истекает до окончания бонусной недели (это бонусная подписка)
-                        expires_at = datetime.fromisoformat(expires_at_str)
                         if expires_at <= bonus_week_end:
                             # Это подписка из бонусной недели
                             from db import is_auto_renewal_enabled
@@ -2529,43 +2493,25 @@ async def check_channel_join_reminders():
             reminder_time = now - timedelta(hours=REMINDER_INTERVAL_HOURS)
             
             # Получаем ссылки, которые были созданы более 1 часа назад, но напоминание еще не отправлялось
-            async with aiosqlite.connect(DB_PATH) as db:
-                cursor = await db.execute("""
-                    SELECT 
-                        il.invite_link,
-                        il.telegram_user_id,
-                        il.created_at,
-                        il.reminder_sent,
-                        s.expires_at,
-                        s.saved_payment_method_id,
-                        u.form_filled
-                    FROM invite_links il
-                    LEFT JOIN subscriptions s ON il.telegram_user_id = s.telegram_id
-                    LEFT JOIN users u ON il.telegram_user_id = u.telegram_id
-                    WHERE il.revoked = 0
-                    AND il.reminder_sent = 0
-                    AND il.created_at <= ?
-                    AND s.expires_at IS NOT NULL
-                    AND s.expires_at > datetime('now', 'utc')
-                    ORDER BY il.created_at ASC
-                """, (reminder_time.isoformat(),))
+            async with db_read() as db:
+                cursor = await db.execute(
+                    queries.CHANNEL_JOIN_REMINDERS, (to_epoch_ms(reminder_time), to_epoch_ms(now))
+                )
                 
                 links_to_check = await cursor.fetchall()
             
             logger.info(f"🔍 Проверка напоминаний о вступлении в канал: найдено {len(links_to_check)} ссылок для проверки")
             
             for link_row in links_to_check:
-                invite_link, telegram_id, created_at, reminder_sent, expires_at, saved_payment_method_id, form_filled = link_row
+                invite_link, telegram_id, created_at, reminder_sent, expires_at, saved_payment_method_id, form_filled, member_status = link_row
                 
                 try:
-                    # Проверяем, вступил ли пользователь в канал
-                    try:
-                        chat_member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=telegram_id)
-                        is_member = chat_member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]
-                    except Exception as member_error:
-                        # Если ошибка (пользователь не найден, заблокировал бота и т.д.) - считаем, что не вступил
-                        logger.warning(f"⚠️ Не удалось проверить статус пользователя {telegram_id} в канале: {member_error}")
-                        is_member = False
+                    # Проверяем, вступил ли пользователь в канал: статус из channel_members (chat_member в bot.py),
+                    # неизвестный статус - один раз спрашиваем Telegram и сохраняем
+                    # Если ошибка (пользователь не найден, заблокировал бота и т.д.) - считаем, что не вступил
+                    if member_status is None:
+                        member_status = await fetch_channel_member_status(telegram_id)
+                    is_member = member_status in CHANNEL_MEMBER_STATUSES
                     
                     # Проверяем условия для отправки напоминания:
                     # 1. Пользователь не вступил в канал
@@ -2587,9 +2533,9 @@ async def check_channel_join_reminders():
                                     logger.info(f"📧 Отправка напоминания о вступлении в канал пользователю {telegram_id}")
                                     
                                     # Получаем ссылку из БД
-                                    async with aiosqlite.connect(DB_PATH) as db_link:
+                                    async with db_read() as db_link:
                                         cursor_link = await db_link.execute(
-                                            "SELECT invite_link FROM invite_links WHERE telegram_user_id = ? AND revoked = 0 ORDER BY created_at DESC LIMIT 1",
+                                            "SELECT invite_link FROM invite_links WHERE telegram_user_id = ? AND revoked = 0 ORDER BY created_at_ms DESC LIMIT 1",
                                             (telegram_id,)
                                         )
                                         link_row = await cursor_link.fetchone()
@@ -2621,7 +2567,7 @@ async def check_channel_join_reminders():
                                     
                                     if success:
                                         # Отмечаем, что напоминание отправлено
-                                        async with aiosqlite.connect(DB_PATH) as db_update:
+                                        async with db_write() as db_update:
                                             await db_update.execute(
                                                 "UPDATE invite_links SET reminder_sent = 1 WHERE invite_link = ?",
                                                 (invite_link,)
@@ -2636,7 +2582,7 @@ async def check_channel_join_reminders():
                                 logger.warning(f"⚠️ Ошибка проверки даты окончания для пользователя {telegram_id}: {date_error}")
                     else:
                         # Пользователь уже вступил в канал - отмечаем, что напоминание не нужно
-                        async with aiosqlite.connect(DB_PATH) as db_update:
+                        async with db_write() as db_update:
                             await db_update.execute(
                                 "UPDATE invite_links SET reminder_sent = 1 WHERE invite_link = ?",
                                 (invite_link,)
@@ -2656,447 +2602,489 @@ async def check_channel_join_reminders():
             await asyncio.sleep(60)  # При ошибке ждем минуту перед следующей попыткой
 
 
-async def check_expired_subscriptions():
-    """Проверяет истекшие подписки и выполняет автопродление или отправляет ссылку на оплату"""
-    processed_users = {}  # {telegram_id: timestamp} - чтобы не отправлять несколько раз одному пользователю в течение короткого времени
-    
+async def reconcile_channel_members():
+    """Сверка channel_members с Telegram на низкой скорости: chat_member мог не дойти (бот был остановлен,
+    пользователь вступил до появления таблицы). За раз - не больше CHANNEL_MEMBERS_RECONCILE_BATCH пользователей
+    с активной подпиской: сначала с неизвестным статусом, затем давно не проверенные"""
     while True:
         try:
-            await asyncio.sleep(CHECK_EXPIRED_SUBSCRIPTIONS_INTERVAL_SECONDS)
+            await asyncio.sleep(CHANNEL_MEMBERS_RECONCILE_INTERVAL_SECONDS)
             
-            # ВАЖНО: Очищаем processed_users от записей старше 5 минут (чтобы можно было повторить попытку)
-            # НО: НЕ удаляем пользователей, для которых уже было отправлено уведомление об истечении доступа
-            # Это предотвращает повторную обработку и возможные нежелательные действия (например, автоматическую отправку /start)
-            now_check = datetime.now(timezone.utc)
-            expired_processed = []
-            for uid, ts in processed_users.items():
-                # Проверяем, было ли уже отправлено уведомление об истечении доступа
-                from db import get_subscription_expired_notified
-                already_notified = await get_subscription_expired_notified(uid)
-                
-                # НЕ удаляем пользователей, для которых уже было отправлено уведомление об истечении
-                if already_notified:
-                    logger.debug(f"🔒 Пользователь {uid} не будет удален из processed_users (уведомление об истечении уже отправлено)")
-                    continue
-                
-                # Убеждаемся, что ts имеет timezone
-                if isinstance(ts, str):
-                    ts_dt = datetime.fromisoformat(ts.replace('Z', '+00:00'))
-                else:
-                    ts_dt = ts
-                if ts_dt.tzinfo is None:
-                    ts_dt = ts_dt.replace(tzinfo=timezone.utc)
-                if (now_check - ts_dt).total_seconds() > 300:
-                    expired_processed.append(uid)
-            for uid in expired_processed:
-                del processed_users[uid]
-                logger.info(f"🔄 Удален пользователь {uid} из processed_users (прошло более 5 минут)")
+            stale_before_ms = now_ms() - CHANNEL_MEMBERS_RECONCILE_MAX_AGE_HOURS * 60 * 60 * 1000
+            async with db_read() as db:
+                cursor = await db.execute(
+                    queries.CHANNEL_MEMBERS_TO_RECONCILE, (now_ms(), stale_before_ms, CHANNEL_MEMBERS_RECONCILE_BATCH)
+                )
+                telegram_ids = [row[0] for row in await cursor.fetchall()]
             
-            # Проверяем подписки, которые истекли
-            expired_subs = await get_expired_subscriptions()
+            checked = 0
+            for telegram_id in telegram_ids:
+                # Общий лимит запросов процесса: оплаты и уведомления идут раньше сверки
+                await send_scheduler.acquire(None, PRIORITY_BROADCAST)
+                if await fetch_channel_member_status(telegram_id) is not None:
+                    checked += 1
+            if telegram_ids:
+                logger.info(f"👥 Сверка участников канала: проверено {checked} из {len(telegram_ids)}")
+        except Exception as e:
+            logger.error(f"❌ Ошибка сверки участников канала: {e}")
+            await asyncio.sleep(60)
+
+
+async def _process_expired_subscription(telegram_id: int) -> None:
+    """Обработка одной истекшей подписки: автопродление, бан/отзыв ссылки, уведомление об истечении
+    Выполняется в renewal_engine параллельно с другими пользователями. Состояние подписки читается
+    под user_lock: пока задание ждало в очереди, подписку могли продлить или уже обработать"""
+    # Когда пересмотреть пользователя снова (следующая попытка автопродления); None - больше не нужно
+    next_check_at = None
+    
+    # Под user_lock: активация из webhook и автопродление этого пользователя ждут завершения обработки
+    async with user_lock(telegram_id):
+        try:
+            rows = await get_expired_subscriptions([telegram_id])
+            if not rows:
+                # Подписка уже продлена - возвращаем пользователя в расписание по новому expires_at
+                logger.info(f"⏭️ Подписка пользователя {telegram_id} уже продлена - обработка истечения не нужна")
+                for uid, new_expires_at in await load_subscription_deadlines(telegram_ids=[telegram_id]):
+                    expiry_scheduler.schedule(uid, new_expires_at)
+                return
+            row = rows[0]
+            expires_at_str = row[1]
+            auto_renewal_enabled = bool(row[2])
+            saved_payment_method_id = row[3] or None
+            starts_at_str = row[4] or None  # Время начала подписки
+            already_notified_expired = bool(row[5])
+            # Текущее количество попыток; перечитывается из БД только после новой попытки автопродления
+            attempts_current = int(row[6]) if row[6] is not None else 0
+            last_attempt_at_str = row[7]
+            # Сверка расписания с БД не поставит пользователя в очередь снова, пока expires_at не изменится
+            expiry_scheduler.mark_processed(telegram_id, from_epoch_ms(row[8]))
             
-            # ВАЖНО: Бонусные подписки обрабатываются в check_bonus_week_transition_to_production()
-            # Эта функция обрабатывает только обычные истекшие подписки
+            logger.info(f"📋 Обработка подписки пользователя {telegram_id}: expires_at={expires_at_str}, starts_at={starts_at_str}, auto_renewal={auto_renewal_enabled}, saved_method={bool(saved_payment_method_id)}")
             
-            logger.info(f"🔍 Проверка подписок для автопродления: найдено {len(expired_subs)} подписок (только истекшие, бонусные обрабатываются отдельно)")
+            # КРИТИЧНО: Проверяем, было ли уже отправлено уведомление об истечении доступа
+            # Если да, НЕ обрабатываем пользователя повторно, чтобы избежать нежелательных действий
+            if already_notified_expired:
+                logger.info(f"🔒 Пользователь {telegram_id} уже получил уведомление об истечении доступа - пропускаем обработку (защита от повторных действий)")
+                return
             
-            for row in expired_subs:
-                telegram_id = row[0]
-                expires_at_str = row[1]
-                auto_renewal_enabled = bool(row[2]) if len(row) > 2 else False
-                saved_payment_method_id = row[3] if len(row) > 3 and row[3] else None
-                starts_at_str = row[4] if len(row) > 4 and row[4] else None  # Время начала подписки
-                
-                logger.info(f"📋 Обработка подписки пользователя {telegram_id}: expires_at={expires_at_str}, starts_at={starts_at_str}, auto_renewal={auto_renewal_enabled}, saved_method={bool(saved_payment_method_id)}")
-                
-                # КРИТИЧНО: Проверяем, было ли уже отправлено уведомление об истечении доступа
-                # Если да, НЕ обрабатываем пользователя повторно, чтобы избежать нежелательных действий
-                from db import get_subscription_expired_notified
-                already_notified_expired = await get_subscription_expired_notified(telegram_id)
-                if already_notified_expired:
-                    logger.info(f"🔒 Пользователь {telegram_id} уже получил уведомление об истечении доступа - пропускаем обработку (защита от повторных действий)")
-                    continue
-                
-                # Проверяем, был ли пользователь обработан недавно (в течение последних 2 минут)
-                if telegram_id in processed_users:
-                    time_since_processed = (now - processed_users[telegram_id]).total_seconds()
-                    if time_since_processed < 120:  # 2 минуты
-                        logger.info(f"⏭️ Пользователь {telegram_id} уже обработан {time_since_processed:.0f} секунд назад, пропускаем")
-                    continue
-                    # НЕ удаляем из processed_users автоматически - пусть остается до очистки выше
-                    logger.info(f"🔄 Пользователь {telegram_id} был обработан {time_since_processed:.0f} секунд назад, продолжаем обработку")
-                    
+            expires_at = datetime.fromisoformat(expires_at_str)
+            # Убеждаемся, что expires_at имеет timezone
+            if expires_at.tzinfo is None:
+                expires_at = expires_at.replace(tzinfo=timezone.utc)
+            now = datetime.now(timezone.utc)
+        
+            logger.info(f"⏰ Пользователь {telegram_id}: expires_at={expires_at}, now={now}, разница={(now - expires_at).total_seconds()} секунд")
+        
+            # КРИТИЧЕСКАЯ ПРОВЕРКА: Определяем, нужно ли выполнять автопродление
+            # Автопродление нужно выполнять если:
+            # 1. Подписка уже истекла (expires_at <= now) - для обычных подписок
+            # 2. Бонусная неделя закончилась и это бонусная подписка - даже если подписка еще не истекла
+            # Сначала получаем информацию о бонусной неделе
+            from config import get_bonus_week_start, get_bonus_week_end
+            bonus_week_start_check = get_bonus_week_start()
+            bonus_week_end_check = get_bonus_week_end()
+            if bonus_week_start_check.tzinfo is None:
+                bonus_week_start_check = bonus_week_start_check.replace(tzinfo=timezone.utc)
+            if bonus_week_end_check.tzinfo is None:
+                bonus_week_end_check = bonus_week_end_check.replace(tzinfo=timezone.utc)
+        
+            # Определяем, является ли это бонусная подписка
+            is_bonus_subscription_check = False
+            if starts_at_str:
                 try:
-                    expires_at = datetime.fromisoformat(expires_at_str)
-                    # Убеждаемся, что expires_at имеет timezone
-                    if expires_at.tzinfo is None:
-                        expires_at = expires_at.replace(tzinfo=timezone.utc)
-                    now = datetime.now(timezone.utc)
-                    
-                    logger.info(f"⏰ Пользователь {telegram_id}: expires_at={expires_at}, now={now}, разница={(now - expires_at).total_seconds()} секунд")
-                    
-                    # КРИТИЧЕСКАЯ ПРОВЕРКА: Определяем, нужно ли выполнять автопродление
-                    # Автопродление нужно выполнять если:
-                    # 1. Подписка уже истекла (expires_at <= now) - для обычных подписок
-                    # 2. Бонусная неделя закончилась и это бонусная подписка - даже если подписка еще не истекла
-                    # Сначала получаем информацию о бонусной неделе
-                    from config import get_bonus_week_start, get_bonus_week_end
-                    bonus_week_start_check = get_bonus_week_start()
-                    bonus_week_end_check = get_bonus_week_end()
-                    if bonus_week_start_check.tzinfo is None:
-                        bonus_week_start_check = bonus_week_start_check.replace(tzinfo=timezone.utc)
-                    if bonus_week_end_check.tzinfo is None:
-                        bonus_week_end_check = bonus_week_end_check.replace(tzinfo=timezone.utc)
+                    starts_at_check = datetime.fromisoformat(starts_at_str)
+                    if starts_at_check.tzinfo is None:
+                        starts_at_check = starts_at_check.replace(tzinfo=timezone.utc)
+                    is_bonus_subscription_check = bonus_week_start_check <= starts_at_check <= bonus_week_end_check
+                except Exception:
+                    pass
+            if not is_bonus_subscription_check and expires_at:
+                time_diff_check = (expires_at - bonus_week_end_check).total_seconds() / 60
+                is_bonus_subscription_check = expires_at <= bonus_week_end_check or (0 <= time_diff_check <= 2)
+        
+            # Проверяем, закончилась ли бонусная неделя
+            bonus_week_ended_check = not is_bonus_week_active()
+            if not bonus_week_ended_check and bonus_week_end_check:
+                time_since_bonus_end_check = (now - bonus_week_end_check).total_seconds() / 60
+                if time_since_bonus_end_check > 0:
+                    bonus_week_ended_check = True
+        
+            # КРИТИЧЕСКАЯ ПРОВЕРКА: Если это бонусная подписка, пропускаем её
+            # Бонусные подписки обрабатываются ТОЛЬКО в check_bonus_week_transition_to_production()
+            # Это предотвращает конфликт между двумя системами автопродления
+            if is_bonus_subscription_check:
+                logger.info(f"⏭️ Пропуск бонусной подписки пользователя {telegram_id} - обрабатывается в check_bonus_week_transition_to_production()")
+                return
+        
+            # Определяем, нужно ли выполнять автопродление
+            should_do_auto_renewal = False
+            if expires_at <= now:
+                # Подписка истекла - нужно автопродление (только для обычных подписок)
+                should_do_auto_renewal = True
+                logger.info(f"🔍 Подписка пользователя {telegram_id} истекла (expires_at={expires_at}, now={now}) - нужно автопродление")
+        
+            if should_do_auto_renewal:
+                auto_payment_failed = False
+                auto_payment_succeeded = False  # Флаг успешного автопродления
+            
+                # Проверяем, является ли это подписка из бонусной недели
+                from config import get_bonus_week_start
+                bonus_week_start = get_bonus_week_start()
+                bonus_week_end = get_bonus_week_end()
+                # Убеждаемся, что bonus_week_start и bonus_week_end имеют timezone
+                if bonus_week_start.tzinfo is None:
+                    bonus_week_start = bonus_week_start.replace(tzinfo=timezone.utc)
+                if bonus_week_end.tzinfo is None:
+                    bonus_week_end = bonus_week_end.replace(tzinfo=timezone.utc)
+            
+                # Определяем, является ли это подписка из бонусной недели
+                # Вариант 1: Проверяем по starts_at (если доступно) - подписка была создана во время бонусной недели
+                is_bonus_subscription = False
+                if starts_at_str:
+                    try:
+                        starts_at = datetime.fromisoformat(starts_at_str)
+                        if starts_at.tzinfo is None:
+                            starts_at = starts_at.replace(tzinfo=timezone.utc)
+                        # Подписка из бонусной недели, если она была создана во время бонусной недели
+                        is_bonus_subscription = bonus_week_start <= starts_at <= bonus_week_end
+                        logger.info(f"🔍 Проверка по starts_at: starts_at={starts_at}, bonus_week_start={bonus_week_start}, bonus_week_end={bonus_week_end}, is_bonus={is_bonus_subscription}")
+                    except Exception as e:
+                        logger.warning(f"⚠️ Ошибка парсинга starts_at для пользователя {telegram_id}: {e}")
+            
+                # Вариант 2: Если starts_at недоступно, проверяем по expires_at
+                # Подписка из бонусной недели, если она истекает до или в момент окончания бонусной недели
+                if not is_bonus_subscription and expires_at:
+                    # Подписка из бонусной недели, если она истекает до или в момент окончания бонусной недели
+                    # (с учетом погрешности в 2 минуты для подписок, созданных в конце бонусной недели)
+                    time_diff = (expires_at - bonus_week_end).total_seconds() / 60
+                    is_bonus_subscription = expires_at <= bonus_week_end or (0 <= time_diff <= 2)
+                    logger.info(f"🔍 Проверка по expires_at: expires_at={expires_at}, bonus_week_end={bonus_week_end}, time_diff={time_diff:.1f} мин, is_bonus={is_bonus_subscription}")
+            
+                bonus_week_ended = not is_bonus_week_active()
+            
+                # КРИТИЧЕСКАЯ ПРОВЕРКА: Если подписка истекает точно в момент окончания бонусной недели,
+                # и бонусная неделя уже закончилась, это тоже считается окончанием бонусной недели
+                # ВАЖНО: Также проверяем, что текущее время уже после окончания бонусной недели
+                if not bonus_week_ended and expires_at and bonus_week_end:
+                    # Проверяем, истекла ли подписка в момент или после окончания бонусной недели
+                    time_diff_from_bonus_end = (expires_at - bonus_week_end).total_seconds() / 60
+                    time_since_bonus_end = (now - bonus_week_end).total_seconds() / 60
+                    # Если бонусная неделя закончилась (now > bonus_week_end) и подписка истекает в момент или после окончания
+                    if time_since_bonus_end > 0 and (-1 <= time_diff_from_bonus_end <= 1):
+                        # Считаем, что бонусная неделя закончилась для этого пользователя
+                        bonus_week_ended = True
+                        logger.info(f"🔍 Подписка пользователя {telegram_id} истекает в момент окончания бонусной недели (разница: {time_diff_from_bonus_end:.1f} мин, прошло с окончания: {time_since_bonus_end:.1f} мин) - считаем, что бонусная неделя закончилась")
+            
+                # ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА: Если текущее время уже после окончания бонусной недели, считаем что она закончилась
+                if not bonus_week_ended and bonus_week_end:
+                    time_since_bonus_end = (now - bonus_week_end).total_seconds() / 60
+                    if time_since_bonus_end > 0:
+                        bonus_week_ended = True
+                        logger.info(f"🔍 Бонусная неделя закончилась {time_since_bonus_end:.1f} минут назад для пользователя {telegram_id} - считаем, что бонусная неделя закончилась")
+            
+                # КРИТИЧЕСКАЯ ПРОВЕРКА: Если это бонусная подписка и бонусная неделя закончилась,
+                # но подписка еще не истекла (expires_at > now), все равно считаем что нужно автопродление
+                # Это важно для случаев, когда подписка истекает после окончания бонусной недели
+                if is_bonus_subscription and bonus_week_ended and expires_at > now:
+                    logger.info(f"🔍 КРИТИЧЕСКАЯ СИТУАЦИЯ: Бонусная неделя закончилась, но подписка еще активна (expires_at={expires_at}, now={now}) - автопродление должно сработать")
+            
+                logger.info(f"🔍 Пользователь {telegram_id}: bonus_week_ended={bonus_week_ended}, is_bonus_subscription={is_bonus_subscription}, starts_at={starts_at_str}, expires_at={expires_at}, bonus_week_start={bonus_week_start}, bonus_week_end={bonus_week_end}, now={now}, auto_renewal={auto_renewal_enabled}, saved_method={bool(saved_payment_method_id)}")
+            
+                # ВАЖНО: Проверяем, что у пользователя есть хотя бы один успешный платеж в БД
+                # Это предотвращает автопродление для пользователей, которые никогда не платили
+                async with db_read() as db_check_payment:
+                    cursor_payment = await db_check_payment.execute(
+                        "SELECT COUNT(*) FROM payments WHERE telegram_id = ? AND status = 'succeeded'",
+                        (telegram_id,)
+                    )
+                    row_payment = await cursor_payment.fetchone()
+                    has_successful_payment = row_payment and row_payment[0] and row_payment[0] > 0
+            
+                if not has_successful_payment:
+                    logger.warning(f"⚠️ Пропуск автопродления для пользователя {telegram_id}: нет успешных платежей в БД (пользователь никогда не платил)")
+                    # Не выполняем автопродление, но продолжаем обработку для бана/уведомлений
+                    auto_payment_failed = True
+                # Проверяем, включено ли автопродление и есть ли сохраненный способ оплаты
+                elif auto_renewal_enabled and saved_payment_method_id:
+                    # КРИТИЧЕСКИ ВАЖНО: Для продакшн подписок используем механизм 3 попыток автопродления
+                    # аналогично бонусным подпискам
+                    try:
+                        from db import get_auto_renewal_attempts
                     
-                    # Определяем, является ли это бонусная подписка
-                    is_bonus_subscription_check = False
-                    if starts_at_str:
-                        try:
-                            starts_at_check = datetime.fromisoformat(starts_at_str)
-                            if starts_at_check.tzinfo is None:
-                                starts_at_check = starts_at_check.replace(tzinfo=timezone.utc)
-                            is_bonus_subscription_check = bonus_week_start_check <= starts_at_check <= bonus_week_end_check
-                        except Exception:
-                            pass
-                    if not is_bonus_subscription_check and expires_at:
-                        time_diff_check = (expires_at - bonus_week_end_check).total_seconds() / 60
-                        is_bonus_subscription_check = expires_at <= bonus_week_end_check or (0 <= time_diff_check <= 2)
+                        # Информация о попытках уже получена в get_expired_subscriptions
+                        attempts = attempts_current
+                        last_attempt_at = None
+                        if last_attempt_at_str:
+                            try:
+                                last_attempt_at = datetime.fromisoformat(last_attempt_at_str)
+                            except ValueError:
+                                last_attempt_at = None
                     
-                    # Проверяем, закончилась ли бонусная неделя
-                    bonus_week_ended_check = not is_bonus_week_active()
-                    if not bonus_week_ended_check and bonus_week_end_check:
-                        time_since_bonus_end_check = (now - bonus_week_end_check).total_seconds() / 60
-                        if time_since_bonus_end_check > 0:
-                            bonus_week_ended_check = True
+                        # КРИТИЧЕСКИ ВАЖНО: Убеждаемся, что last_attempt_at имеет timezone
+                        if last_attempt_at and last_attempt_at.tzinfo is None:
+                            last_attempt_at = last_attempt_at.replace(tzinfo=timezone.utc)
                     
-                    # КРИТИЧЕСКАЯ ПРОВЕРКА: Если это бонусная подписка, пропускаем её
-                    # Бонусные подписки обрабатываются ТОЛЬКО в check_bonus_week_transition_to_production()
-                    # Это предотвращает конфликт между двумя системами автопродления
-                    if is_bonus_subscription_check:
-                        logger.info(f"⏭️ Пропуск бонусной подписки пользователя {telegram_id} - обрабатывается в check_bonus_week_transition_to_production()")
-                        continue
+                        # Определяем, нужно ли выполнить попытку автопродления
+                        should_attempt = False
+                        attempt_number = 0
                     
-                    # Определяем, нужно ли выполнять автопродление
-                    should_do_auto_renewal = False
-                    if expires_at <= now:
-                        # Подписка истекла - нужно автопродление (только для обычных подписок)
-                        should_do_auto_renewal = True
-                        logger.info(f"🔍 Подписка пользователя {telegram_id} истекла (expires_at={expires_at}, now={now}) - нужно автопродление")
+                        # Проверяем, истекла ли подписка
+                        subscription_expired = expires_at <= now
                     
-                    if should_do_auto_renewal:
-                        auto_payment_failed = False
-                        auto_payment_succeeded = False  # Флаг успешного автопродления
-                        
-                        # Проверяем, является ли это подписка из бонусной недели
-                        from config import get_bonus_week_start
-                        bonus_week_start = get_bonus_week_start()
-                        bonus_week_end = get_bonus_week_end()
-                        # Убеждаемся, что bonus_week_start и bonus_week_end имеют timezone
-                        if bonus_week_start.tzinfo is None:
-                            bonus_week_start = bonus_week_start.replace(tzinfo=timezone.utc)
-                        if bonus_week_end.tzinfo is None:
-                            bonus_week_end = bonus_week_end.replace(tzinfo=timezone.utc)
-                        
-                        # Определяем, является ли это подписка из бонусной недели
-                        # Вариант 1: Проверяем по starts_at (если доступно) - подписка была создана во время бонусной недели
-                        is_bonus_subscription = False
-                        if starts_at_str:
-                            try:
-                                starts_at = datetime.fromisoformat(starts_at_str)
-                                if starts_at.tzinfo is None:
-                                    starts_at = starts_at.replace(tzinfo=timezone.utc)
-                                # Подписка из бонусной недели, если она была создана во время бонусной недели
-                                is_bonus_subscription = bonus_week_start <= starts_at <= bonus_week_end
-                                logger.info(f"🔍 Проверка по starts_at: starts_at={starts_at}, bonus_week_start={bonus_week_start}, bonus_week_end={bonus_week_end}, is_bonus={is_bonus_subscription}")
-                            except Exception as e:
-                                logger.warning(f"⚠️ Ошибка парсинга starts_at для пользователя {telegram_id}: {e}")
-                        
-                        # Вариант 2: Если starts_at недоступно, проверяем по expires_at
-                        # Подписка из бонусной недели, если она истекает до или в момент окончания бонусной недели
-                        if not is_bonus_subscription and expires_at:
-                            # Подписка из бонусной недели, если она истекает до или в момент окончания бонусной недели
-                            # (с учетом погрешности в 2 минуты для подписок, созданных в конце бонусной недели)
-                            time_diff = (expires_at - bonus_week_end).total_seconds() / 60
-                            is_bonus_subscription = expires_at <= bonus_week_end or (0 <= time_diff <= 2)
-                            logger.info(f"🔍 Проверка по expires_at: expires_at={expires_at}, bonus_week_end={bonus_week_end}, time_diff={time_diff:.1f} мин, is_bonus={is_bonus_subscription}")
-                        
-                        bonus_week_ended = not is_bonus_week_active()
-                        
-                        # КРИТИЧЕСКАЯ ПРОВЕРКА: Если подписка истекает точно в момент окончания бонусной недели,
-                        # и бонусная неделя уже закончилась, это тоже считается окончанием бонусной недели
-                        # ВАЖНО: Также проверяем, что текущее время уже после окончания бонусной недели
-                        if not bonus_week_ended and expires_at and bonus_week_end:
-                            # Проверяем, истекла ли подписка в момент или после окончания бонусной недели
-                            time_diff_from_bonus_end = (expires_at - bonus_week_end).total_seconds() / 60
-                            time_since_bonus_end = (now - bonus_week_end).total_seconds() / 60
-                            # Если бонусная неделя закончилась (now > bonus_week_end) и подписка истекает в момент или после окончания
-                            if time_since_bonus_end > 0 and (-1 <= time_diff_from_bonus_end <= 1):
-                                # Считаем, что бонусная неделя закончилась для этого пользователя
-                                bonus_week_ended = True
-                                logger.info(f"🔍 Подписка пользователя {telegram_id} истекает в момент окончания бонусной недели (разница: {time_diff_from_bonus_end:.1f} мин, прошло с окончания: {time_since_bonus_end:.1f} мин) - считаем, что бонусная неделя закончилась")
-                        
-                        # ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА: Если текущее время уже после окончания бонусной недели, считаем что она закончилась
-                        if not bonus_week_ended and bonus_week_end:
-                            time_since_bonus_end = (now - bonus_week_end).total_seconds() / 60
-                            if time_since_bonus_end > 0:
-                                bonus_week_ended = True
-                                logger.info(f"🔍 Бонусная неделя закончилась {time_since_bonus_end:.1f} минут назад для пользователя {telegram_id} - считаем, что бонусная неделя закончилась")
-                        
-                        # КРИТИЧЕСКАЯ ПРОВЕРКА: Если это бонусная подписка и бонусная неделя закончилась,
-                        # но подписка еще не истекла (expires_at > now), все равно считаем что нужно автопродление
-                        # Это важно для случаев, когда подписка истекает после окончания бонусной недели
-                        if is_bonus_subscription and bonus_week_ended and expires_at > now:
-                            logger.info(f"🔍 КРИТИЧЕСКАЯ СИТУАЦИЯ: Бонусная неделя закончилась, но подписка еще активна (expires_at={expires_at}, now={now}) - автопродление должно сработать")
-                        
-                        logger.info(f"🔍 Пользователь {telegram_id}: bonus_week_ended={bonus_week_ended}, is_bonus_subscription={is_bonus_subscription}, starts_at={starts_at_str}, expires_at={expires_at}, bonus_week_start={bonus_week_start}, bonus_week_end={bonus_week_end}, now={now}, auto_renewal={auto_renewal_enabled}, saved_method={bool(saved_payment_method_id)}")
-                        
-                        # ВАЖНО: Проверяем, что у пользователя есть хотя бы один успешный платеж в БД
-                        # Это предотвращает автопродление для пользователей, которые никогда не платили
-                        async with aiosqlite.connect(DB_PATH) as db_check_payment:
-                            cursor_payment = await db_check_payment.execute(
-                                "SELECT COUNT(*) FROM payments WHERE telegram_id = ? AND status = 'succeeded'",
-                                (telegram_id,)
-                            )
-                            row_payment = await cursor_payment.fetchone()
-                            has_successful_payment = row_payment and row_payment[0] and row_payment[0] > 0
-                        
-                        if not has_successful_payment:
-                            logger.warning(f"⚠️ Пропуск автопродления для пользователя {telegram_id}: нет успешных платежей в БД (пользователь никогда не платил)")
-                            # Не выполняем автопродление, но продолжаем обработку для бана/уведомлений
-                            auto_payment_failed = True
-                        # Проверяем, включено ли автопродление и есть ли сохраненный способ оплаты
-                        elif auto_renewal_enabled and saved_payment_method_id:
-                            # КРИТИЧЕСКИ ВАЖНО: Для продакшн подписок используем механизм 3 попыток автопродления
-                            # аналогично бонусным подпискам
-                            try:
-                                from db import get_auto_renewal_attempts, get_last_auto_renewal_attempt_at
-                                
-                                # Получаем информацию о попытках
-                                attempts = await get_auto_renewal_attempts(telegram_id)
-                                last_attempt_at = await get_last_auto_renewal_attempt_at(telegram_id)
-                                
-                                # КРИТИЧЕСКИ ВАЖНО: Убеждаемся, что last_attempt_at имеет timezone
-                                if last_attempt_at and last_attempt_at.tzinfo is None:
-                                    last_attempt_at = last_attempt_at.replace(tzinfo=timezone.utc)
-                                
-                                # Определяем, нужно ли выполнить попытку автопродления
-                                should_attempt = False
-                                attempt_number = 0
-                                
-                                # Проверяем, истекла ли подписка
-                                subscription_expired = expires_at <= now
-                                
-                                if subscription_expired and attempts == 0:
-                                    # Первая попытка: СРАЗУ после истечения подписки
-                                    should_attempt = True
-                                    attempt_number = 1
-                                    time_since_expiry = (now - expires_at).total_seconds() / 60
-                                    logger.info(f"🔄 Первая попытка автопродления для пользователя {telegram_id} (подписка истекла {time_since_expiry:.1f} минут назад)")
-                                elif attempts > 0 and attempts < 3:
-                                    # Проверяем, прошло ли достаточно времени с последней попытки
-                                    if last_attempt_at:
-                                        try:
-                                            time_since_last_attempt = (now - last_attempt_at).total_seconds() / 60
-                                            if time_since_last_attempt >= AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES:  # Прошло минимум интервал автопродления
-                                                should_attempt = True
-                                                attempt_number = attempts + 1
-                                                logger.info(f"🔄 Попытка {attempt_number} автопродления для пользователя {telegram_id} (прошло {time_since_last_attempt:.1f} минут с последней попытки)")
-                                        except Exception as time_error:
-                                            logger.warning(f"⚠️ Ошибка вычисления времени с последней попытки для пользователя {telegram_id}: {time_error}")
-                                            # Если ошибка, проверяем, прошло ли достаточно времени (минимум интервал автопродления)
-                                            if last_attempt_at:
-                                                time_since_last_attempt = (now - last_attempt_at).total_seconds() / 60
-                                                if time_since_last_attempt >= AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES:
-                                                    should_attempt = True
-                                                    attempt_number = attempts + 1
-                                    else:
-                                        # Если last_attempt_at нет, но есть попытки - выполняем следующую попытку
+                        if subscription_expired and attempts == 0:
+                            # Первая попытка: СРАЗУ после истечения подписки
+                            should_attempt = True
+                            attempt_number = 1
+                            time_since_expiry = (now - expires_at).total_seconds() / 60
+                            logger.info(f"🔄 Первая попытка автопродления для пользователя {telegram_id} (подписка истекла {time_since_expiry:.1f} минут назад)")
+                        elif attempts > 0 and attempts < 3:
+                            # Проверяем, прошло ли достаточно времени с последней попытки
+                            if last_attempt_at:
+                                try:
+                                    time_since_last_attempt = (now - last_attempt_at).total_seconds() / 60
+                                    if time_since_last_attempt >= AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES:  # Прошло минимум интервал автопродления
                                         should_attempt = True
                                         attempt_number = attempts + 1
-                                        logger.info(f"🔄 Попытка {attempt_number} автопродления для пользователя {telegram_id} (нет информации о последней попытке)")
-                                
-                                if should_attempt:
-                                    # Определяем цену и длительность для автопродления
-                                    auto_amount = get_production_subscription_price()
-                                    auto_duration = get_production_subscription_duration()
-                                    
-                                    logger.info(f"💼 Продакшн режим для пользователя {telegram_id}, попытка {attempt_number}, используем продакшн цены: {auto_amount} руб, {auto_duration} дней")
-                                    
-                                    # Выполняем попытку автопродления
-                                    success = await attempt_auto_renewal(telegram_id, saved_payment_method_id, auto_amount, auto_duration, attempt_number)
-                                    
-                                    # Получаем актуальное количество попыток после attempt_auto_renewal
-                                    attempts_after = await get_auto_renewal_attempts(telegram_id)
-                                    
-                                    if success:
-                                        # Успешно - меню уже обновлено в attempt_auto_renewal
-                                        logger.info(f"✅ Автопродление успешно для пользователя {telegram_id}, попытка {attempt_number}")
-                                        auto_payment_succeeded = True
-                                    elif attempts_after >= 3:
-                                        # Все 3 попытки неудачны - бан и меню с "Оплатить доступ"
-                                        # КРИТИЧЕСКИ ВАЖНО: Эта логика уже обработана в attempt_auto_renewal на 3 попытке
-                                        logger.info(f"✅ Все 3 попытки автопродления завершены для пользователя {telegram_id}, обработка выполнена в attempt_auto_renewal")
-                                        auto_payment_failed = True
-                                    else:
-                                        # Попытка не удалась, но еще есть попытки
-                                        auto_payment_failed = True
-                                        logger.info(f"⚠️ Попытка {attempt_number} автопродления не удалась для пользователя {telegram_id}, осталось {3 - attempts_after} попыток")
-                                else:
-                                    # Еще не время для попытки - НЕ пропускаем обработку, продолжаем для уведомлений
-                                    logger.info(f"⏸️ Еще не время для попытки автопродления для пользователя {telegram_id} (attempts={attempts})")
-                                    # НЕ устанавливаем auto_payment_failed, чтобы не банить во время попыток
-                                    # Но продолжаем обработку, чтобы можно было отправить уведомление если нужно
-                                    
-                            except Exception as auto_payment_error:
-                                logger.error(f"❌ Ошибка автоматического списания для пользователя {telegram_id}: {auto_payment_error}")
-                                auto_payment_failed = True
-                                
-                                # Автоматически отключаем автопродление при ошибке
-                                from db import set_auto_renewal
-                                await set_auto_renewal(telegram_id, False)
-                                logger.info(f"🔄 Автопродление автоматически отключено для пользователя {telegram_id} из-за ошибки автоплатежа")
-                        
-                        # Если автопродление не включено или не удалось, баним и отправляем ссылку на оплату
-                        # НО: если автопродление успешно (auto_payment_succeeded = True), НЕ баним пользователя
-                        # ВАЖНО: В бонусной неделе, если автопродление отключено, не баним до окончания бонусной недели
-                        # КРИТИЧЕСКИ ВАЖНО: Если автопродление включено, но нет saved_payment_method_id (например, для СберПей),
-                        # то auto_payment_failed должен быть True, чтобы отправить уведомление и забанить
-                        if auto_renewal_enabled and not saved_payment_method_id:
-                            # Автопродление включено, но нет сохраненного способа оплаты - считаем что автопродление не работает
-                            auto_payment_failed = True
-                            logger.warning(f"⚠️ Автопродление включено для пользователя {telegram_id}, но нет saved_payment_method_id - автопродление не может работать")
-                        
-                        if not auto_renewal_enabled or not saved_payment_method_id or auto_payment_failed:
-                            logger.info(f"🚫 Автопродление не работает для пользователя {telegram_id}: auto_renewal={auto_renewal_enabled}, saved_method={bool(saved_payment_method_id)}, failed={auto_payment_failed}")
-                            
-                            # Проверяем, активна ли бонусная неделя и является ли это подписка из бонусной недели
-                            bonus_week_end_check = get_bonus_week_end()
-                            if bonus_week_end_check.tzinfo is None:
-                                bonus_week_end_check = bonus_week_end_check.replace(tzinfo=timezone.utc)
-                            is_bonus_subscription_check = expires_at <= bonus_week_end_check if expires_at else False
-                            bonus_week_still_active = is_bonus_week_active()
-                            
-                            # Если это подписка из бонусной недели и автопродление отключено, НЕ баним до окончания бонусной недели
-                            # НО: Если бонусная неделя уже закончилась, баним даже если это была бонусная подписка
-                            # КРИТИЧЕСКИ ВАЖНО: Проверяем, идут ли попытки автопродления
-                            from db import get_auto_renewal_attempts
-                            attempts_check = await get_auto_renewal_attempts(telegram_id)
-                            is_auto_renewal_in_progress_check = auto_renewal_enabled and attempts_check > 0 and attempts_check < 3
-                            
-                            if is_bonus_subscription_check and not auto_renewal_enabled and not auto_payment_failed and bonus_week_still_active:
-                                logger.info(f"ℹ️ Пользователь {telegram_id} имеет подписку из бонусной недели с отключенным автопродлением - не баним до окончания бонусной недели (бонусная неделя еще активна)")
-                            elif is_auto_renewal_in_progress_check:
-                                # Идут попытки автопродления - НЕ отзываем ссылку и НЕ баним пользователя
-                                logger.info(f"🔄 Пользователь {telegram_id}: идут попытки автопродления (попытка {attempts_check}/3) - пользователь остается в канале, ссылка не отзывается")
+                                        logger.info(f"🔄 Попытка {attempt_number} автопродления для пользователя {telegram_id} (прошло {time_since_last_attempt:.1f} минут с последней попытки)")
+                                except Exception as time_error:
+                                    logger.warning(f"⚠️ Ошибка вычисления времени с последней попытки для пользователя {telegram_id}: {time_error}")
+                                    # Если ошибка, проверяем, прошло ли достаточно времени (минимум интервал автопродления)
+                                    if last_attempt_at:
+                                        time_since_last_attempt = (now - last_attempt_at).total_seconds() / 60
+                                        if time_since_last_attempt >= AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES:
+                                            should_attempt = True
+                                            attempt_number = attempts + 1
                             else:
-                                # Отзываем ссылку пользователя (делаем её невалидной) ТОЛЬКО если не идут попытки автопродления
-                                from db import get_invite_link
-                                user_invite_link = await get_invite_link(telegram_id)
-                                if user_invite_link:
-                                    await revoke_invite_link(user_invite_link)
-                                    logger.info(f"✅ Ссылка пользователя {telegram_id} отозвана из-за истечения подписки")
-                                
-                                # Баним пользователя в канале (удаляем из канала) ТОЛЬКО если:
-                                # 1. Автопродление не удалось (auto_payment_succeeded = False)
-                                # 2. И НЕТ активных попыток автопродления (attempts = 0 или attempts >= 3)
-                                # КРИТИЧЕСКИ ВАЖНО: Во время попыток автопродления (0 < attempts < 3) пользователь НЕ банится!
-                                from db import get_auto_renewal_attempts
-                                attempts = await get_auto_renewal_attempts(telegram_id)
-                                is_auto_renewal_in_progress = auto_renewal_enabled and attempts > 0 and attempts < 3
-                                
-                                if not auto_payment_succeeded and not is_auto_renewal_in_progress:
-                                    try:
-                                        await bot.ban_chat_member(
-                                            chat_id=CHANNEL_ID,
-                                            user_id=telegram_id,
-                                            until_date=None  # Бан навсегда (пока не оплатит снова)
-                                        )
-                                        logger.info(f"✅ Пользователь {telegram_id} забанен в канале из-за истечения подписки (попыток автопродления не осталось)")
-                                    except Exception as ban_error:
-                                        logger.warning(f"⚠️ Ошибка бана пользователя {telegram_id}: {ban_error}")
-                                elif is_auto_renewal_in_progress:
-                                    logger.info(f"🔄 Пользователь {telegram_id} остается в канале: идут попытки автопродления (попытка {attempts}/3)")
-                                else:
-                                    # Автопродление успешно - пользователь остается в канале
-                                    logger.info(f"✅ Автопродление успешно для пользователя {telegram_id}, пользователь остается в канале")
+                                # Если last_attempt_at нет, но есть попытки - выполняем следующую попытку
+                                should_attempt = True
+                                attempt_number = attempts + 1
+                                logger.info(f"🔄 Попытка {attempt_number} автопродления для пользователя {telegram_id} (нет информации о последней попытке)")
+                    
+                        if should_attempt:
+                            # Определяем цену и длительность для автопродления
+                            auto_amount = get_production_subscription_price()
+                            auto_duration = get_production_subscription_duration()
                         
-                        # КРИТИЧЕСКИ ВАЖНО: Уведомление "Автопродление отключено" больше не нужно,
-                        # так как теперь реализована логика 3 попыток автопродления.
-                        # Все необходимые уведомления отправляются в attempt_auto_renewal.
-                        # Этот блок удален, чтобы избежать дублирования уведомлений.
-                        # Отправляем уведомление об истечении доступа ТОЛЬКО если:
-                        # 1. Автопродление НЕ было успешным (auto_payment_succeeded = False)
-                        # 2. Автопродление отключено или не работает, ИЛИ автоплатеж не удался
-                        # КРИТИЧЕСКИ ВАЖНО: Отправляем уведомление об истечении доступа если:
-                        # 1. Автопродление НЕ было успешным (auto_payment_succeeded = False)
-                        # 2. И (автопродление отключено ИЛИ нет saved_payment_method_id ИЛИ все 3 попытки неудачны)
-                        # 3. И НЕ идут попытки автопродления
-                        from db import get_auto_renewal_attempts
-                        attempts_for_notification = await get_auto_renewal_attempts(telegram_id)
-                        is_auto_renewal_in_progress_for_notification = auto_renewal_enabled and attempts_for_notification > 0 and attempts_for_notification < 3
+                            logger.info(f"💼 Продакшн режим для пользователя {telegram_id}, попытка {attempt_number}, используем продакшн цены: {auto_amount} руб, {auto_duration} дней")
                         
-                        should_send_expired_notification = (
-                            not auto_payment_succeeded and 
-                            not is_auto_renewal_in_progress_for_notification and
-                            (not auto_renewal_enabled or not saved_payment_method_id or attempts_for_notification >= 3)
-                        )
+                            # Выполняем попытку автопродления
+                            success = await attempt_auto_renewal(telegram_id, saved_payment_method_id, auto_amount, auto_duration, attempt_number)
                         
-                        if should_send_expired_notification:
-                            # Отправляем уведомление об истечении доступа (только один раз, больше никогда)
-                            # Проверяем в БД, было ли уже отправлено уведомление
-                            from db import get_subscription_expired_notified, set_subscription_expired_notified
-                            
-                            already_notified = await get_subscription_expired_notified(telegram_id)
+                            # Получаем актуальное количество попыток после attempt_auto_renewal
+                            attempts_after = await get_auto_renewal_attempts(telegram_id)
+                            attempts_current = attempts_after
                         
-                            # Отправляем уведомление только если еще не отправляли
-                            if not already_notified:
-                                # ВАЖНО: Очищаем кэш и получаем актуальное меню (продакшн режим)
-                                from db import _clear_cache
-                                _clear_cache()
-                                menu = await get_main_menu_for_user(telegram_id)
-                                
-                                notification_text = "⏰ <b>Ваш доступ истек</b>\n\n"
-                                if attempts_for_notification >= 3:
-                                    notification_text += "❌ Все попытки автопродления не удались.\n\n"
-                                notification_text += "Для продления доступа нажмите кнопку 💳 Получить доступ."
-                                
-                                await safe_send_message(
-                                    bot=bot,
-                                    chat_id=telegram_id,
-                                    text=notification_text,
-                                    parse_mode="HTML",
-                                    reply_markup=menu
-                                )
-                                # Помечаем в БД, что уведомление отправлено (навсегда)
-                                await set_subscription_expired_notified(telegram_id, True)
-                                logger.info(f"📧 Отправлено уведомление об истечении доступа пользователю {telegram_id} с обновленным меню (один раз, сохранено в БД)")
-                                
-                                # КРИТИЧНО: Добавляем пользователя в processed_users НАВСЕГДА после отправки уведомления
-                                # Это предотвращает повторную обработку пользователя и возможные нежелательные действия
-                                processed_users[telegram_id] = datetime.now(timezone.utc)
-                                logger.info(f"✅ Пользователь {telegram_id} добавлен в processed_users после отправки уведомления об истечении (защита от повторной обработки)")
+                            if success:
+                                # Успешно - меню уже обновлено в attempt_auto_renewal
+                                logger.info(f"✅ Автопродление успешно для пользователя {telegram_id}, попытка {attempt_number}")
+                                auto_payment_succeeded = True
+                            elif attempts_after >= 3:
+                                # Все 3 попытки неудачны - бан и меню с "Оплатить доступ"
+                                # КРИТИЧЕСКИ ВАЖНО: Эта логика уже обработана в attempt_auto_renewal на 3 попытке
+                                logger.info(f"✅ Все 3 попытки автопродления завершены для пользователя {telegram_id}, обработка выполнена в attempt_auto_renewal")
+                                auto_payment_failed = True
                             else:
-                                logger.info(f"⏭️ Уведомление об истечении доступа уже было отправлено пользователю {telegram_id}, пропускаем")
-                                # Даже если уведомление уже было отправлено, добавляем в processed_users чтобы не обрабатывать повторно
-                                processed_users[telegram_id] = datetime.now(timezone.utc)
+                                # Попытка не удалась, но еще есть попытки
+                                auto_payment_failed = True
+                                next_check_at = datetime.now(timezone.utc) + timedelta(minutes=AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES)
+                                logger.info(f"⚠️ Попытка {attempt_number} автопродления не удалась для пользователя {telegram_id}, осталось {3 - attempts_after} попыток")
                         else:
-                            # Автопродление успешно или идут попытки - не отправляем уведомление об истечении
-                            logger.info(f"✅ Автопродление успешно или идут попытки для пользователя {telegram_id}, уведомление об истечении не отправляется")
-                        
-                        # Добавляем пользователя в processed_users с текущим временем (если еще не добавлен)
-                        if telegram_id not in processed_users:
-                            processed_users[telegram_id] = datetime.now(timezone.utc)
-                            logger.info(f"✅ Пользователь {telegram_id} добавлен в processed_users")
+                            # Еще не время для попытки - НЕ пропускаем обработку, продолжаем для уведомлений
+                            logger.info(f"⏸️ Еще не время для попытки автопродления для пользователя {telegram_id} (attempts={attempts})")
+                            if last_attempt_at:
+                                next_check_at = last_attempt_at + timedelta(minutes=AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES)
+                            # НЕ устанавливаем auto_payment_failed, чтобы не банить во время попыток
+                            # Но продолжаем обработку, чтобы можно было отправить уведомление если нужно
                         
-                except Exception as e:
-                    logger.error(f"❌ Ошибка обработки истекшей подписки для пользователя {telegram_id}: {e}")
+                    except Exception as auto_payment_error:
+                        logger.error(f"❌ Ошибка автоматического списания для пользователя {telegram_id}: {auto_payment_error}")
+                        auto_payment_failed = True
+                    
+                        # Автоматически отключаем автопродление при ошибке
+                        from db import set_auto_renewal
+                        await set_auto_renewal(telegram_id, False)
+                        logger.info(f"🔄 Автопродление автоматически отключено для пользователя {telegram_id} из-за ошибки автоплатежа")
             
-            # Очищаем обработанных пользователей при достижении лимита (оставляем только последние N)
-            if len(processed_users) > MAX_NOTIFIED_USERS_CACHE_SIZE:
-                # Сортируем по времени и оставляем только последние N
-                sorted_users = sorted(processed_users.items(), key=lambda x: x[1], reverse=True)
-                processed_users = dict(sorted_users[:MAX_NOTIFIED_USERS_CACHE_SIZE])
-                logger.info(f"🧹 Очищен processed_users, оставлено {len(processed_users)} записей")
+                # Если автопродление не включено или не удалось, баним и отправляем ссылку на оплату
+                # НО: если автопродление успешно (auto_payment_succeeded = True), НЕ баним пользователя
+                # ВАЖНО: В бонусной неделе, если автопродление отключено, не баним до окончания бонусной недели
+                # КРИТИЧЕСКИ ВАЖНО: Если автопродление включено, но нет saved_payment_method_id (например, для СберПей),
+                # то auto_payment_failed должен быть True, чтобы отправить уведомление и забанить
+                if auto_renewal_enabled and not saved_payment_method_id:
+                    # Автопродление включено, но нет сохраненного способа оплаты - считаем что автопродление не работает
+                    auto_payment_failed = True
+                    logger.warning(f"⚠️ Автопродление включено для пользователя {telegram_id}, но нет saved_payment_method_id - автопродление не может работать")
+            
+                if not auto_renewal_enabled or not saved_payment_method_id or auto_payment_failed:
+                    logger.info(f"🚫 Автопродление не работает для пользователя {telegram_id}: auto_renewal={auto_renewal_enabled}, saved_method={bool(saved_payment_method_id)}, failed={auto_payment_failed}")
+                
+                    # Проверяем, активна ли бонусная неделя и является ли это подписка из бонусной недели
+                    bonus_week_end_check = get_bonus_week_end()
+                    if bonus_week_end_check.tzinfo is None:
+                        bonus_week_end_check = bonus_week_end_check.replace(tzinfo=timezone.utc)
+                    is_bonus_subscription_check = expires_at <= bonus_week_end_check if expires_at else False
+                    bonus_week_still_active = is_bonus_week_active()
+                
+                    # Если это подписка из бонусной недели и автопродление отключено, НЕ баним до окончания бонусной недели
+                    # НО: Если бонусная неделя уже закончилась, баним даже если это была бонусная подписка
+                    # КРИТИЧЕСКИ ВАЖНО: Проверяем, идут ли попытки автопродления
+                    attempts_check = attempts_current
+                    is_auto_renewal_in_progress_check = auto_renewal_enabled and attempts_check > 0 and attempts_check < 3
+                
+                    if is_bonus_subscription_check and not auto_renewal_enabled and not auto_payment_failed and bonus_week_still_active:
+                        logger.info(f"ℹ️ Пользователь {telegram_id} имеет подписку из бонусной недели с отключенным автопродлением - не баним до окончания бонусной недели (бонусная неделя еще активна)")
+                    elif is_auto_renewal_in_progress_check:
+                        # Идут попытки автопродления - НЕ отзываем ссылку и НЕ баним пользователя
+                        logger.info(f"🔄 Пользователь {telegram_id}: идут попытки автопродления (попытка {attempts_check}/3) - пользователь остается в канале, ссылка не отзывается")
+                    else:
+                        # Отзываем ссылку пользователя (делаем её невалидной) ТОЛЬКО если не идут попытки автопродления
+                        from db import get_invite_link
+                        user_invite_link = await get_invite_link(telegram_id)
+                        if user_invite_link:
+                            await revoke_invite_link(user_invite_link)
+                            logger.info(f"✅ Ссылка пользователя {telegram_id} отозвана из-за истечения подписки")
+                    
+                        # Баним пользователя в канале (удаляем из канала) ТОЛЬКО если:
+                        # 1. Автопродление не удалось (auto_payment_succeeded = False)
+                        # 2. И НЕТ активных попыток автопродления (attempts = 0 или attempts >= 3)
+                        # КРИТИЧЕСКИ ВАЖНО: Во время попыток автопродления (0 < attempts < 3) пользователь НЕ банится!
+                        attempts = attempts_current
+                        is_auto_renewal_in_progress = auto_renewal_enabled and attempts > 0 and attempts < 3
+                    
+                        if not auto_payment_succeeded and not is_auto_renewal_in_progress:
+                            try:
+                                await ban_channel_member(telegram_id)
+                                logger.info(f"✅ Пользователь {telegram_id} забанен в канале из-за истечения подписки (попыток автопродления не осталось)")
+                            except Exception as ban_error:
+                                logger.warning(f"⚠️ Ошибка бана пользователя {telegram_id}: {ban_error}")
+                        elif is_auto_renewal_in_progress:
+                            logger.info(f"🔄 Пользователь {telegram_id} остается в канале: идут попытки автопродления (попытка {attempts}/3)")
+                        else:
+                            # Автопродление успешно - пользователь остается в канале
+                            logger.info(f"✅ Автопродление успешно для пользователя {telegram_id}, пользователь остается в канале")
+            
+                # КРИТИЧЕСКИ ВАЖНО: Уведомление "Автопродление отключено" больше не нужно,
+                # так как теперь реализована логика 3 попыток автопродления.
+                # Все необходимые уведомления отправляются в attempt_auto_renewal.
+                # Этот блок удален, чтобы избежать дублирования уведомлений.
+                # Отправляем уведомление об истечении доступа ТОЛЬКО если:
+                # 1. Автопродление НЕ было успешным (auto_payment_succeeded = False)
+                # 2. Автопродление отключено или не работает, ИЛИ автоплатеж не удался
+                # КРИТИЧЕСКИ ВАЖНО: Отправляем уведомление об истечении доступа если:
+                # 1. Автопродление НЕ было успешным (auto_payment_succeeded = False)
+                # 2. И (автопродление отключено ИЛИ нет saved_payment_method_id ИЛИ все 3 попытки неудачны)
+                # 3. И НЕ идут попытки автопродления
+                attempts_for_notification = attempts_current
+                is_auto_renewal_in_progress_for_notification = auto_renewal_enabled and attempts_for_notification > 0 and attempts_for_notification < 3
+            
+                should_send_expired_notification = (
+                    not auto_payment_succeeded and 
+                    not is_auto_renewal_in_progress_for_notification and
+                    (not auto_renewal_enabled or not saved_payment_method_id or attempts_for_notification >= 3)
+                )
+            
+                if should_send_expired_notification:
+                    # Отправляем уведомление об истечении доступа (только один раз, больше никогда)
+                    # Проверяем в БД, было ли уже отправлено уведомление
+                    from db import set_subscription_expired_notified
+                
+                    already_notified = already_notified_expired
+            
+                    # Отправляем уведомление только если еще не отправляли
+                    if not already_notified:
+                        # ВАЖНО: Очищаем кэш и получаем актуальное меню (продакшн режим)
+                        from db import invalidate_user_cache
+                        invalidate_user_cache(telegram_id)
+                        menu = await get_main_menu_for_user(telegram_id)
+                    
+                        notification_text = "⏰ <b>Ваш доступ истек</b>\n\n"
+                        if attempts_for_notification >= 3:
+                            notification_text += "❌ Все попытки автопродления не удались.\n\n"
+                        notification_text += "Для продления доступа нажмите кнопку 💳 Получить доступ."
+                    
+                        await safe_send_message(
+                            bot=bot,
+                            chat_id=telegram_id,
+                            text=notification_text,
+                            parse_mode="HTML",
+                            reply_markup=menu
+                        )
+                        # Помечаем в БД, что уведомление отправлено (навсегда)
+                        # После этого пользователь не возвращается в расписание до новой активации подписки
+                        await set_subscription_expired_notified(telegram_id, True)
+                        logger.info(f"📧 Отправлено уведомление об истечении доступа пользователю {telegram_id} с обновленным меню (один раз, сохранено в БД)")
+                    else:
+                        logger.info(f"⏭️ Уведомление об истечении доступа уже было отправлено пользователю {telegram_id}, пропускаем")
+                else:
+                    # Автопродление успешно или идут попытки - не отправляем уведомление об истечении
+                    logger.info(f"✅ Автопродление успешно или идут попытки для пользователя {telegram_id}, уведомление об истечении не отправляется")
+                    if is_auto_renewal_in_progress_for_notification and next_check_at is None:
+                        next_check_at = datetime.now(timezone.utc) + timedelta(minutes=AUTO_RENEWAL_ATTEMPT_INTERVAL_MINUTES)
+            
+                # Следующая попытка автопродления - по расписанию, а не на каждом тике
+                # (при успешном автопродлении новый дедлайн уже выставил activate_subscription_days)
+                if next_check_at is not None and not auto_payment_succeeded:
+                    expiry_scheduler.schedule(telegram_id, next_check_at)
+                    logger.info(f"⏰ Следующая проверка пользователя {telegram_id} запланирована на {next_check_at.isoformat()}")
+            
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки истекшей подписки для пользователя {telegram_id}: {e}")
+            # Повторяем обработку этого пользователя позже
+            expiry_scheduler.schedule(telegram_id, datetime.now(timezone.utc) + timedelta(seconds=CHECK_EXPIRED_SUBSCRIPTIONS_INTERVAL_SECONDS))
+
+async def check_expired_subscriptions():
+    """Проверяет истекшие подписки и выполняет автопродление или отправляет ссылку на оплату
+    Работает по расписанию дедлайнов (expiry_scheduler): спит ровно до ближайшего expires_at
+    или до следующей попытки автопродления, без сканирования всей таблицы каждые 10 секунд"""
+    # Загружаем дедлайны один раз при старте, дальше расписание обновляют
+    # activate_subscription_days / set_auto_renewal и сама эта задача
+    while True:
+        try:
+            expiry_scheduler.load(await load_subscription_deadlines())
+            break
+        except Exception as e:
+            logger.error(f"❌ Ошибка загрузки расписания истечения подписок: {e}")
+            await asyncio.sleep(CHECK_EXPIRED_SUBSCRIPTIONS_INTERVAL_SECONDS)
+    
+    next_resync_at = datetime.now(timezone.utc) + timedelta(seconds=EXPIRY_SCHEDULER_RESYNC_SECONDS)
+    
+    while True:
+        try:
+            wait_seconds = (next_resync_at - datetime.now(timezone.utc)).total_seconds()
+            due_ids = await expiry_scheduler.wait_due(max(wait_seconds, 0))
+            
+            # Периодическая сверка с БД по индексу expires_at: подхватываем подписки,
+            # созданные или измененные процессом бота (у него свое расписание не ведется)
+            now_check = datetime.now(timezone.utc)
+            if now_check >= next_resync_at:
+                expiry_scheduler.merge(await load_subscription_deadlines(
+                    until=now_check + timedelta(seconds=EXPIRY_SCHEDULER_RESYNC_SECONDS * 2)
+                ))
+                next_resync_at = now_check + timedelta(seconds=EXPIRY_SCHEDULER_RESYNC_SECONDS)
+            
+            if not due_ids:
+                continue
+            
+            # Проверяем подписки, которые истекли (только среди пользователей с наступившим дедлайном)
+            expired_subs = await get_expired_subscriptions(due_ids)
+            
+            # Дедлайн наступил, но подписка уже продлена - возвращаем пользователя в расписание по новому expires_at
+            expired_ids = {row[0] for row in expired_subs}
+            still_active_ids = [uid for uid in due_ids if uid not in expired_ids]
+            if still_active_ids:
+                for uid, new_expires_at in await load_subscription_deadlines(telegram_ids=still_active_ids):
+                    expiry_scheduler.schedule(uid, new_expires_at)
+            
+            # ВАЖНО: Бонусные подписки обрабатываются в check_bonus_week_transition_to_production()
+            # Эта функция обрабатывает только обычные истекшие подписки
+            
+            logger.info(f"🔍 Проверка подписок для автопродления: наступил дедлайн у {len(due_ids)} пользователей, истекших подписок {len(expired_subs)} (бонусные обрабатываются отдельно)")
+            
+            # Пользователи обрабатываются параллельно (renewal_engine); если задание пользователя еще в работе,
+            # новое не ставим, а переносим проверку, чтобы не потерять дедлайн, выставленный во время задания
+            for row in expired_subs:
+                if not renewal_engine.submit(row[0], partial(_process_expired_subscription, row[0])):
+                    expiry_scheduler.schedule(row[0], datetime.now(timezone.utc) + timedelta(seconds=CHECK_EXPIRED_SUBSCRIPTIONS_INTERVAL_SECONDS))
                     
         except Exception as e:
             logger.error(f"❌ Ошибка в фоновой задаче проверки подписок: {e}")
@@ -3106,6 +3094,8 @@ async def check_expired_subscriptions():
 # ================== YOOKASSA WEBHOOK ==================
 @app.post("/yookassa/webhook")
 async def yookassa_webhook(request: Request):
+    """Принимает уведомление ЮKassa: проверяет, сохраняет в webhook_inbox и сразу отвечает.
+    Обработка выполняется воркерами очереди (process_yookassa_notification)"""
     try:
         data = await request.json()
     except Exception:
@@ -3117,6 +3107,76 @@ async def yookassa_webhook(request: Request):
         logger.error(f"❌ Ошибка создания notification: {e}")
         raise HTTPException(status_code=400, detail="Bad YooKassa notification")
 
+    event = notification.event
+    object_id = notification.object.id
+    try:
+        queued = await enqueue_notification(data, event, object_id)
+    except Exception as e:
+        # Не отвечаем 200, чтобы ЮKassa повторила доставку
+        logger.error(f"❌ Не удалось сохранить уведомление {event} ({object_id}) в очередь: {e}")
+        raise HTTPException(status_code=500, detail="Inbox is unavailable")
+
+    if event in ("payment.succeeded", "payment.canceled"):
+        # Автопродление ждет результат своего платежа - будим его сразу, не дожидаясь очереди
+        # (очередь обрабатывает уведомление под user_lock, который автопродление держит во время ожидания).
+        # Статус из тела не проверен - автопродление перед активацией подтверждает его в API
+        payment_waiters.resolve(object_id, event.split(".", 1)[1])
+
+    if queued:
+        logger.info(f"📥 Уведомление {event} ({object_id}) поставлено в очередь")
+        yookassa_inbox.notify()
+    else:
+        logger.info(f"ℹ️ Уведомление {event} ({object_id}) уже есть в очереди - повторная доставка")
+    return {"ok": True, "queued": queued}
+
+
+@app.get("/yookassa/webhook/inbox")
+async def yookassa_webhook_inbox_stats():
+    """Глубина очереди webhook'ов и задержка обработки"""
+    return await yookassa_inbox.stats()
+
+
+@app.get("/renewals/stats")
+async def renewal_engine_stats():
+    """Очередь и пропускная способность обработки истекших подписок (renewal_engine)"""
+    return renewal_engine.stats()
+
+
+@app.get("/telegram/send/stats")
+async def telegram_send_stats():
+    """Очередь планировщика исходящих сообщений Telegram и число 429 от Telegram"""
+    return send_scheduler.stats()
+
+
+@app.get("/invite_links/pool/stats")
+async def invite_link_pool_stats():
+    """Свободные ссылки в пуле, выдачи и промахи (пул был пуст)"""
+    return await invite_link_pool.stats()
+
+
+async def process_yookassa_notification(data: dict) -> dict:
+    """Обрабатывает уведомление ЮKassa из webhook_inbox (исключение = повтор с задержкой)
+    Уведомление с telegram_user_id в metadata обрабатывается под user_lock этого пользователя"""
+    # Токен захвата платежа: при исключении снимаем только свой захват, чтобы повтор мог его получить
+    claim_token = uuid.uuid4().hex
+    try:
+        # Сообщения об оплате (подтверждение, ссылка доступа) отправляются раньше фоновых уведомлений
+        with send_priority(PRIORITY_PAYMENT):
+            telegram_user_id = ((data.get("object") or {}).get("metadata") or {}).get("telegram_user_id")
+            if telegram_user_id and str(telegram_user_id).isdigit():
+                async with user_lock(int(telegram_user_id)):
+                    return await _handle_yookassa_notification(data, claim_token)
+            return await _handle_yookassa_notification(data, claim_token)
+    except Exception:
+        payment_id = (data.get("object") or {}).get("id")
+        if data.get("event") == "payment.succeeded" and payment_id:
+            await release_payment_claim(payment_id, claim_token)
+        raise
+
+
+async def _handle_yookassa_notification(data: dict, claim_token: str) -> dict:
+    notification = WebhookNotificationFactory().create(data)
+
     payment_obj = notification.object
     payment_id = payment_obj.id
     event = notification.event
@@ -3150,7 +3210,7 @@ async def yookassa_webhook(request: Request):
         try:
             # Убеждаемся, что timezone импортирован
             from datetime import timezone
-            payment = Payment.find_one(payment_id)
+            payment = await find_payment(payment_id)
             meta = payment.metadata or {}
             tg_user_id = meta.get("telegram_user_id")
             
@@ -3174,7 +3234,7 @@ async def yookassa_webhook(request: Request):
                         payment_info = await get_active_pending_payment(tg_user_id, minutes=60)  # Ищем платежи за последний час
                         if payment_info and payment_info[0] == payment_id:
                             # Получаем created_at из БД
-                            async with aiosqlite.connect(DB_PATH) as db_conn:
+                            async with db_read() as db_conn:
                                 cursor = await db_conn.execute(
                                     "SELECT created_at FROM payments WHERE payment_id = ?",
                                     (payment_id,)
@@ -3223,7 +3283,7 @@ async def yookassa_webhook(request: Request):
                     return {"ok": True, "event": "payment.canceled", "ignored": "already_processed"}
                 
                 # КРИТИЧЕСКАЯ ПРОВЕРКА 3: Проверяем статус платежа в БД
-                async with aiosqlite.connect(DB_PATH) as db_check:
+                async with db_read() as db_check:
                     cursor = await db_check.execute(
                         "SELECT status FROM payments WHERE payment_id = ?",
                         (payment_id,)
@@ -3267,7 +3327,7 @@ async def yookassa_webhook(request: Request):
                             logger.warning(f"⚠️ Платеж {payment_id} был создан всего {time_since_creation:.1f} секунд назад - подозрительно, проверяем статус еще раз")
                             # Проверяем статус еще раз из API
                             try:
-                                refreshed_payment = Payment.find_one(payment_id)
+                                refreshed_payment = await find_payment(payment_id)
                                 if refreshed_payment.status == "succeeded":
                                     logger.info(f"✅ При повторной проверке платеж {payment_id} имеет статус 'succeeded' - игнорируем canceled")
                                     return {"ok": True, "event": "payment.canceled", "ignored": "succeeded_on_refresh"}
@@ -3402,7 +3462,7 @@ async def yookassa_webhook(request: Request):
                 # ФИНАЛЬНАЯ ПРОВЕРКА ПЕРЕД ОТПРАВКОЙ: еще раз проверяем статус из API
                 # Это защита от race condition - если платеж стал succeeded между проверками
                 try:
-                    final_payment_check = Payment.find_one(payment_id)
+                    final_payment_check = await find_payment(payment_id)
                     if final_payment_check.status == "succeeded":
                         logger.info(f"✅ ФИНАЛЬНАЯ ПРОВЕРКА: Платеж {payment_id} имеет статус 'succeeded' - игнорируем canceled")
                         return {"ok": True, "event": "payment.canceled", "ignored": "succeeded_on_final_check"}
@@ -3444,7 +3504,7 @@ async def yookassa_webhook(request: Request):
                     
                     # Для бонусных подписок отключаем автопродление только после 3 неудачных попыток
                     # Для обычных подписок отключаем сразу
-                    from db import set_auto_renewal, is_auto_renewal_enabled, _clear_cache
+                    from db import set_auto_renewal, is_auto_renewal_enabled, invalidate_user_cache
                     auto_renewal_was_enabled = await is_auto_renewal_enabled(tg_user_id)
                     
                     if is_bonus_subscription and attempts < 3:
@@ -3453,7 +3513,7 @@ async def yookassa_webhook(request: Request):
                     elif auto_renewal_was_enabled:
                         # Обычная подписка или все 3 попытки выполнены - отключаем автопродление
                         await set_auto_renewal(tg_user_id, False)
-                        _clear_cache()
+                        invalidate_user_cache(tg_user_id)
                         logger.info(f"🔄 Автопродление автоматически отключено для пользователя {tg_user_id} из-за отказа автоплатежа (попыток: {attempts}/3, бонусная: {is_bonus_subscription})")
                         
                         # Проверяем, была ли это недостаточность средств
@@ -3477,11 +3537,7 @@ async def yookassa_webhook(request: Request):
                         
                         # Баним пользователя в канале
                         try:
-                            await bot.ban_chat_member(
-                                chat_id=CHANNEL_ID,
-                                user_id=tg_user_id,
-                                until_date=None  # Бан навсегда
-                            )
+                            await ban_channel_member(tg_user_id)
                             logger.info(f"✅ Пользователь {tg_user_id} забанен в канале из-за неудачного автопродления")
                         except Exception as ban_error:
                             logger.warning(f"⚠️ Ошибка бана пользователя {tg_user_id}: {ban_error}")
@@ -3581,7 +3637,7 @@ async def yookassa_webhook(request: Request):
             
             if payment_id_refund:
                 # Получаем оригинальный платеж
-                payment = Payment.find_one(payment_id_refund)
+                payment = await find_payment(payment_id_refund)
                 meta = payment.metadata or {}
                 tg_user_id = meta.get("telegram_user_id")
                 
@@ -3605,7 +3661,7 @@ async def yookassa_webhook(request: Request):
                     
                     # Отключаем подписку пользователя при возврате
                     try:
-                        async with aiosqlite.connect(DB_PATH) as db_conn:
+                        async with db_write() as db_conn:
                             await db_conn.execute(
                                 "DELETE FROM subscriptions WHERE telegram_id = ?",
                                 (tg_user_id,)
@@ -3615,6 +3671,9 @@ async def yookassa_webhook(request: Request):
                                 (tg_user_id,)
                             )
                             await db_conn.commit()
+                        from db import invalidate_user_cache
+                        invalidate_user_cache(tg_user_id)
+                        expiry_scheduler.cancel(tg_user_id)
                         logger.info(f"✅ Подписка пользователя {tg_user_id} отменена из-за возврата")
                     except Exception as e:
                         logger.warning(f"⚠️ Ошибка отмены подписки: {e}")
@@ -3648,14 +3707,15 @@ async def yookassa_webhook(request: Request):
     if event != "payment.succeeded":
         return {"ok": True, "event": event}
 
-    # КРИТИЧЕСКАЯ ПРОВЕРКА: Проверяем, был ли платеж уже обработан
-    # Это предотвращает дублирование уведомлений и повторную активацию подписки
-    if await already_processed(payment_id):
-        logger.warning(f"⚠️ Платеж {payment_id} уже был обработан ранее - пропускаем повторную обработку")
+    # КРИТИЧЕСКАЯ ПРОВЕРКА: атомарно захватываем платеж (INSERT в processed_payments со state='claimed')
+    # Дальше идет только победитель; повторные доставки и параллельные воркеры/процессы выходят сразу,
+    # не обращаясь к API ЮKassa. Это предотвращает дублирование уведомлений и повторную активацию подписки
+    if not await claim_payment(payment_id, claim_token):
+        logger.warning(f"⚠️ Платеж {payment_id} уже обработан или обрабатывается - пропускаем повторную обработку")
         return {"ok": True, "duplicate": True}
 
     # Получаем актуальный статус платежа из API
-    payment = Payment.find_one(payment_id)
+    payment = await find_payment(payment_id)
     current_status = payment.status
     
     # ДЕТАЛЬНОЕ ЛОГИРОВАНИЕ ТИПА ПЛАТЕЖНОГО МЕТОДА ИЗ API
@@ -3728,7 +3788,7 @@ async def yookassa_webhook(request: Request):
     if not tg_user_id:
         logger.warning(f"⚠️ Нет telegram_user_id в метаданных платежа {payment_id}, пытаемся получить из БД")
         # Пытаемся получить правильный ID из БД
-        async with aiosqlite.connect(DB_PATH) as db_conn:
+        async with db_read() as db_conn:
             cursor = await db_conn.execute(
                 "SELECT telegram_id FROM payments WHERE payment_id = ?",
                 (payment_id,)
@@ -3750,7 +3810,7 @@ async def yookassa_webhook(request: Request):
     if tg_user_id_str.startswith('0') or len(tg_user_id_str) < 6:
         logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Подозрительный telegram_user_id: {tg_user_id} для платежа {payment_id}")
         # Пытаемся получить правильный ID из БД
-        async with aiosqlite.connect(DB_PATH) as db_conn:
+        async with db_read() as db_conn:
             cursor = await db_conn.execute(
                 "SELECT telegram_id FROM payments WHERE payment_id = ?",
                 (payment_id,)
@@ -3767,7 +3827,7 @@ async def yookassa_webhook(request: Request):
     logger.info(f"✅ Финальный telegram_user_id для обработки: {tg_user_id}")
 
     # Еще раз проверяем статус перед активацией подписки (на случай если изменился)
-    payment_refresh = Payment.find_one(payment_id)
+    payment_refresh = await find_payment(payment_id)
     if payment_refresh.status != "succeeded":
         logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Статус платежа {payment_id} изменился с succeeded на {payment_refresh.status} перед активацией подписки!")
         await mark_processed(payment_id)
@@ -3969,7 +4029,7 @@ async def yookassa_webhook(request: Request):
         expires_at = bonus_end  # Фиксированное время окончания бонусной недели (начало + 15 минут)
         logger.info(f"🎁 Установка подписки для бонусной недели: starts_at={starts_at.isoformat()} (момент оплаты), expires_at={expires_at.isoformat()} (фиксированное окончание), bonus_week_end={bonus_end.isoformat()}")
         
-        async with aiosqlite.connect(DB_PATH) as db_conn:
+        async with db_write() as db_conn:
             # гарантируем, что юзер существует
             await db_conn.execute(
                 "INSERT OR IGNORE INTO users (telegram_id, username, created_at) VALUES (?, ?, ?)",
@@ -3979,12 +4039,14 @@ async def yookassa_webhook(request: Request):
             # upsert подписки (сохраняем дату начала и окончания)
             await db_conn.execute(
                 """
-                INSERT INTO subscriptions (telegram_id, expires_at, starts_at, subscription_expired_notified)
-                VALUES (?, ?, ?, 0) ON CONFLICT(telegram_id) DO
+                INSERT INTO subscriptions (telegram_id, expires_at, starts_at, expires_at_ms, starts_at_ms,
+                                           subscription_expired_notified)
+                VALUES (?, ?, ?, ?, ?, 0) ON CONFLICT(telegram_id) DO
                 UPDATE SET expires_at=excluded.expires_at, starts_at=excluded.starts_at,
+                           expires_at_ms=excluded.expires_at_ms, starts_at_ms=excluded.starts_at_ms,
                            subscription_expired_notified=0
                 """,
-                (tg_user_id, expires_at.isoformat(), starts_at.isoformat())
+                (tg_user_id, expires_at.isoformat(), starts_at.isoformat(), to_epoch_ms(expires_at), to_epoch_ms(starts_at))
             )
             await db_conn.commit()
             logger.info(f"💾 Подписка сохранена в БД (бонусная неделя): telegram_id={tg_user_id}, expires_at={expires_at.isoformat()}, starts_at={starts_at.isoformat()}")
@@ -4001,7 +4063,7 @@ async def yookassa_webhook(request: Request):
             expires_at = starts_at + timedelta(minutes=1)
             logger.warning(f"⚠️ Длительность подписки слишком мала, устанавливаем минимум 1 минуту для пользователя {tg_user_id}")
         
-        async with aiosqlite.connect(DB_PATH) as db_conn:
+        async with db_write() as db_conn:
             # гарантируем, что юзер существует
             await db_conn.execute(
                 "INSERT OR IGNORE INTO users (telegram_id, username, created_at) VALUES (?, ?, ?)",
@@ -4011,26 +4073,27 @@ async def yookassa_webhook(request: Request):
             # upsert подписки (сохраняем дату начала и окончания)
             await db_conn.execute(
                 """
-                INSERT INTO subscriptions (telegram_id, expires_at, starts_at, subscription_expired_notified)
-                VALUES (?, ?, ?, 0) ON CONFLICT(telegram_id) DO
+                INSERT INTO subscriptions (telegram_id, expires_at, starts_at, expires_at_ms, starts_at_ms,
+                                           subscription_expired_notified)
+                VALUES (?, ?, ?, ?, ?, 0) ON CONFLICT(telegram_id) DO
                 UPDATE SET expires_at=excluded.expires_at, starts_at=excluded.starts_at,
+                           expires_at_ms=excluded.expires_at_ms, starts_at_ms=excluded.starts_at_ms,
                            subscription_expired_notified=0
                 """,
-                (tg_user_id, expires_at.isoformat(), starts_at.isoformat())
+                (tg_user_id, expires_at.isoformat(), starts_at.isoformat(), to_epoch_ms(expires_at), to_epoch_ms(starts_at))
             )
             await db_conn.commit()
             logger.info(f"💾 Подписка сохранена в БД (продакшн): telegram_id={tg_user_id}, expires_at={expires_at.isoformat()}, starts_at={starts_at.isoformat()}, duration={format_subscription_duration(subscription_duration)}")
     logger.info(f"✅ Подписка активирована для пользователя {tg_user_id} на {format_subscription_duration(subscription_duration)} (тип платежа: {payment_type_name})")
+    # Новый дедлайн истечения для фоновой задачи check_expired_subscriptions
+    expiry_scheduler.schedule(tg_user_id, expires_at)
     
     # КРИТИЧЕСКИ ВАЖНО: Очищаем кэш подписки сразу после активации
-    from db import _clear_cache
-    _clear_cache()
-    
-    # Даем небольшую задержку для гарантии, что БД обновилась
-    await asyncio.sleep(0.3)
+    from db import invalidate_user_cache
+    invalidate_user_cache(tg_user_id)
     
     # ПРОВЕРЯЕМ, что подписка действительно сохранена в БД
-    async with aiosqlite.connect(DB_PATH) as db_verify:
+    async with db_read() as db_verify:
         cursor_verify = await db_verify.execute(
             "SELECT expires_at FROM subscriptions WHERE telegram_id = ?",
             (tg_user_id,)
@@ -4047,7 +4110,7 @@ async def yookassa_webhook(request: Request):
         else:
             logger.error(f"❌ КРИТИЧЕСКАЯ ОШИБКА: Подписка НЕ найдена в БД для пользователя {tg_user_id} после активации!")
     
-    _clear_cache()
+    invalidate_user_cache(tg_user_id)
     
     # Проверяем, что подписка действительно активна после активации
     has_active_after = await has_active_subscription(tg_user_id)
@@ -4080,7 +4143,7 @@ async def yookassa_webhook(request: Request):
             
             # КРИТИЧЕСКИ ВАЖНО: Очищаем кэш ПОСЛЕ установки автопродления, чтобы обработчик "Управление доступом"
             # сразу видел актуальное значение автопродления
-            _clear_cache()
+            invalidate_user_cache(tg_user_id)
             
             # Уведомляем пользователя о сохранении способа оплаты и включении автопродления
             payment_method_name = "карта"  # По умолчанию
@@ -4170,14 +4233,19 @@ async def yookassa_webhook(request: Request):
     logger.info(f"🔄 Сброшен счетчик попыток автопродления и флаг уведомления об истечении для пользователя {tg_user_id} (новая оплата в продакшн режиме)")
 
     # Сначала проверяем и разбаниваем пользователя, если он был забанен
-    try:
-        await bot.unban_chat_member(
-            chat_id=CHANNEL_ID,
-            user_id=tg_user_id,
-            only_if_banned=True  # Разбаниваем только если был забанен
-        )
-    except Exception:
-        pass  # Игнорируем ошибки разбана
+    # (по channel_members известно, что не забанен - запрос к Telegram не нужен)
+    member_status = await get_channel_member_status(tg_user_id)
+    if member_status is None or member_status == CHANNEL_MEMBER_KICKED:
+        try:
+            await bot.unban_chat_member(
+                chat_id=CHANNEL_ID,
+                user_id=tg_user_id,
+                only_if_banned=True  # Разбаниваем только если был забанен
+            )
+            if member_status == CHANNEL_MEMBER_KICKED:
+                await set_channel_member_status(tg_user_id, CHANNEL_MEMBER_LEFT, "unban")
+        except Exception:
+            pass  # Игнорируем ошибки разбана
 
     # Получаем дату окончания подписки для установки expire_date ссылки
     from db import get_subscription_expires_at
@@ -4202,6 +4270,9 @@ async def yookassa_webhook(request: Request):
     # Отзываем старую ссылку, если она есть
     from db import get_invite_link
     old_invite_link = await get_invite_link(tg_user_id)
+    if old_invite_link and old_invite_link == await invite_link_pool.link_for_payment(tg_user_id, payment_id):
+        # Повторная обработка того же платежа (очередь webhook'ов): ссылка уже выдана за него, take() вернет ее же
+        old_invite_link = None
     if old_invite_link:
         logger.info(f"🔍 Найдена старая ссылка для пользователя {tg_user_id}, отзываем её перед созданием новой")
         try:
@@ -4211,6 +4282,7 @@ async def yookassa_webhook(request: Request):
             logger.warning(f"⚠️ Не удалось отозвать старую ссылку для пользователя {tg_user_id}: {revoke_error}")
     
     invite_link = None
+    pooled_link = False
     try:
         # Используем expires_at подписки как expire_date ссылки
         # Если подписка истекает через N дней, ссылка будет валидна N дней
@@ -4229,12 +4301,16 @@ async def yookassa_webhook(request: Request):
         # Создаем ссылку С заявкой на вступление для проверки владельца
         # ВАЖНО: member_limit нельзя использовать с creates_join_request=True
         # Защита от использования другими будет через проверку в обработчике заявок
-        invite_link = await safe_create_invite_link(
-            bot=bot,
+        # Сначала - готовая ссылка из пула (без обращения к Telegram), пул пуст - создаем ссылку сами
+        invite_link = await invite_link_pool.take(tg_user_id, payment_id, link_expire_date)
+        pooled_link = invite_link is not None
+        if not invite_link:
+            invite_link = await safe_create_invite_link(
+                bot=bot,
                 chat_id=CHANNEL_ID,
-            creates_join_request=True,  # С заявкой - для проверки владельца
-            expire_date=link_expire_date  # Ссылка действительна до окончания подписки пользователя
-        )
+                creates_join_request=True,  # С заявкой - для проверки владельца
+                expire_date=link_expire_date  # Ссылка действительна до окончания подписки пользователя
+            )
         
         if not invite_link:
             # Если не получилось с заявкой, пробуем без заявки с member_limit=1 (одноразовая ссылка)
@@ -4345,7 +4421,8 @@ async def yookassa_webhook(request: Request):
         # КРИТИЧЕСКИ ВАЖНО: Проверяем, что ссылка создана для правильного канала
         # Ссылка должна быть новой, не из базы данных
         logger.info(f"🔍 Проверка созданной ссылки для пользователя {tg_user_id}: CHANNEL_ID={CHANNEL_ID}, ссылка={invite_link[:100]}...")
-        await save_invite_link(invite_link, tg_user_id, payment_id)
+        if not pooled_link:  # Ссылка из пула уже сохранена за пользователем в take()
+            await save_invite_link(invite_link, tg_user_id, payment_id)
         
         # Форматируем даты для отображения
         # КРИТИЧЕСКИ ВАЖНО: Для бонусной недели expires_at всегда должен быть фиксированным временем окончания бонусной недели
@@ -4376,14 +4453,13 @@ async def yookassa_webhook(request: Request):
         # КРИТИЧЕСКИ ВАЖНО: ПРИНУДИТЕЛЬНО создаем правильное меню после успешной оплаты
         # НЕ полагаемся на get_main_menu_for_user - создаем меню напрямую
         # ВАЖНО: Это работает для ВСЕХ типов платежей (SberPay, СБП, банковская карта) одинаково
-        from db import _clear_cache
+        from db import invalidate_user_cache
         from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
         
-        _clear_cache()
-        await asyncio.sleep(0.3)  # Увеличиваем задержку для гарантии обновления БД
+        invalidate_user_cache(tg_user_id)
         
         # ПРОВЕРЯЕМ напрямую в БД, что подписка сохранена (для ВСЕХ типов платежей)
-        async with aiosqlite.connect(DB_PATH) as db_check:
+        async with db_read() as db_check:
             cursor = await db_check.execute(
                 "SELECT expires_at FROM subscriptions WHERE telegram_id = ?",
                 (tg_user_id,)
@@ -4571,14 +4647,13 @@ async def yookassa_webhook(request: Request):
             
             # ВАЖНО: Отправляем отдельное сообщение с обновленным меню для гарантированного обновления клавиатуры
             # Это необходимо, так как Telegram может не обновить меню автоматически
-            await asyncio.sleep(1.0)  # Увеличиваем задержку для гарантии, что БД обновилась
             
             # Получаем меню еще раз для гарантии актуальности
-            from db import _clear_cache
-            _clear_cache()
+            from db import invalidate_user_cache
+            invalidate_user_cache(tg_user_id)
             
             # Проверяем еще раз напрямую в БД
-            async with aiosqlite.connect(DB_PATH) as db_final_check:
+            async with db_read() as db_final_check:
                 cursor_final = await db_final_check.execute(
                     "SELECT expires_at FROM subscriptions WHERE telegram_id = ?",
                     (tg_user_id,)
@@ -4593,7 +4668,7 @@ async def yookassa_webhook(request: Request):
                     is_active_final = expires_at_final > now_final
                     logger.info(f"🔍 Финальная проверка БД перед обновлением меню: is_active={is_active_final}")
             
-            _clear_cache()
+            invalidate_user_cache(tg_user_id)
             
             # ВАЖНО: Принудительно создаем правильное меню для бонусной недели
             # КРИТИЧЕСКИ ВАЖНО: Всегда показываем "Управление доступом" после успешной оплаты
@@ -4722,21 +4797,40 @@ async def yookassa_webhook(request: Request):
     return {"ok": True, "payment_id": payment_id}
 
 
+yookassa_inbox = WebhookInbox(process_yookassa_notification)
+
+
 # ================== TELEGRAM WEBHOOK (для получения обновлений от Telegram) ==================
 @app.post("/telegram/webhook")
 async def telegram_webhook(request: Request):
     """
     Обработчик webhook от Telegram для получения обновлений (включая заявки на вступление)
+    В объединенном режиме все обновления уходят в Dispatcher из bot.py; ответ Telegram - сразу,
+    обработка идет в фоне (как handle_as_tasks при polling)
     """
+    # В объединенном режиме заголовок сверяется всегда (без секрета приложение не запускается)
+    if BOT_UPDATES_MODE == "webhook" or TELEGRAM_WEBHOOK_SECRET:
+        secret = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not TELEGRAM_WEBHOOK_SECRET or not hmac.compare_digest(secret, TELEGRAM_WEBHOOK_SECRET):
+            raise HTTPException(status_code=403, detail="Invalid secret token")
     try:
         data = await request.json()
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid JSON")
 
+    if telegram_bot_app is not None:
+        try:
+            update = Update.model_validate(data, context={"bot": bot})
+        except Exception:
+            raise HTTPException(status_code=400, detail="Invalid update")
+        task = asyncio.create_task(_feed_telegram_update(update))
+        _telegram_update_tasks.add(task)
+        task.add_done_callback(_telegram_update_tasks.discard)
+        return {"ok": True}
+
     # Обрабатываем заявку на вступление в канал
     if "chat_join_request" in data:
         try:
-            from aiogram.types import Update
             update = Update(**data)
             
             if update.chat_join_request:
@@ -4751,6 +4845,7 @@ async def telegram_webhook(request: Request):
                             chat_id=chat_id,
                             user_id=user_id
                         )
+                        await set_channel_member_status(user_id, ChatMemberStatus.MEMBER, "join_request")
                         return {"ok": True, "approved": True}
                     except Exception as e:
                         # Логируем ошибку, но не падаем
@@ -4798,6 +4893,7 @@ async def telegram_join_request(request: Request):
                     chat_id=chat_id or CHANNEL_ID,
                     user_id=user_id
                 )
+                await set_channel_member_status(user_id, ChatMemberStatus.MEMBER, "join_request")
                 return {"ok": True, "approved": True}
             except Exception as e:
                 logger.error(f"Error approving join request: {e}")
@@ -0,0 +1,279 @@
+"""
+Входящий ящик webhook'ов ЮKassa
+Endpoint только проверяет уведомление, сохраняет его в таблицу webhook_inbox и сразу отвечает 200.
+Тяжелая обработка (запросы к API, активация подписки, инвайты, сообщения в Telegram)
+выполняется ограниченным пулом фоновых воркеров:
+- уведомления одного пользователя (order_key) обрабатываются строго по очереди, в порядке получения
+- при исключении уведомление повторяется с экспоненциальной задержкой
+- записи в статусе processing при старте возвращаются в очередь (процесс упал посреди обработки)
+"""
+import asyncio
+import json
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Optional
+
+from config import (
+    WEBHOOK_INBOX_MAX_ATTEMPTS,
+    WEBHOOK_INBOX_POLL_SECONDS,
+    WEBHOOK_INBOX_RETRY_BASE_SECONDS,
+    WEBHOOK_INBOX_RETRY_MAX_SECONDS,
+    WEBHOOK_INBOX_WORKERS,
+)
+from db import db_read, db_write
+import queries
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = "pending"
+STATUS_PROCESSING = "processing"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+async def init_webhook_inbox_table(db) -> None:
+    """Создает таблицу входящих уведомлений (вызывается из init_webhook_tables)"""
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS webhook_inbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            event TEXT NOT NULL,
+            object_id TEXT NOT NULL,
+            order_key TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            received_at TEXT NOT NULL,
+            processed_at TEXT,
+            last_error TEXT
+        )
+    """)
+    # Повторная доставка того же события ЮKassa не создает вторую запись
+    await db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_webhook_inbox_event_object ON webhook_inbox(event, object_id)")
+    await db.execute("CREATE INDEX IF NOT EXISTS idx_webhook_inbox_status ON webhook_inbox(status, order_key, id)")
+
+
+def notification_order_key(data: dict) -> str:
+    """Ключ упорядочивания: telegram_user_id из metadata, иначе id платежа"""
+    obj = data.get("object") or {}
+    metadata = obj.get("metadata") or {}
+    telegram_user_id = metadata.get("telegram_user_id")
+    if telegram_user_id:
+        return f"user:{telegram_user_id}"
+    # У возврата metadata обычно нет - упорядочиваем по исходному платежу
+    return f"payment:{obj.get('payment_id') or obj.get('id')}"
+
+
+async def enqueue_notification(data: dict, event: str, object_id: str) -> bool:
+    """Сохраняет уведомление в ящик. Возвращает False, если такое событие уже было получено"""
+    now = datetime.now(timezone.utc).isoformat()
+    async with db_write() as db:
+        cur = await db.execute(
+            """
+            INSERT INTO webhook_inbox (event, object_id, order_key, payload, status, attempts, next_attempt_at, received_at)
+            VALUES (?, ?, ?, ?, 'pending', 0, ?, ?)
+            ON CONFLICT(event, object_id) DO UPDATE SET
+                status = 'pending', attempts = 0, next_attempt_at = excluded.next_attempt_at, last_error = NULL
+            WHERE webhook_inbox.status = 'failed'
+            """,
+            (event, object_id, notification_order_key(data), json.dumps(data, ensure_ascii=False), now, now)
+        )
+        await db.commit()
+        return cur.rowcount > 0
+
+
+async def cleanup_old_inbox(days: int = 30) -> int:
+    """Удаляет обработанные уведомления старше N дней"""
+    async with db_write() as db:
+        cutoff_date = (datetime.now(timezone.utc) - timedelta(days=days)).isoformat()
+        cur = await db.execute(
+            "DELETE FROM webhook_inbox WHERE status = 'done' AND processed_at < ?",
+            (cutoff_date,)
+        )
+        deleted = cur.rowcount
+        await db.commit()
+        logger.info(f"🧹 Удалено {deleted} старых записей webhook_inbox (старше {days} дней)")
+        return deleted
+
+
+def _parse_iso(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    return dt if dt.tzinfo else dt.replace(tzinfo=timezone.utc)
+
+
+class WebhookInbox:
+    """Пул воркеров, разбирающих webhook_inbox"""
+
+    def __init__(
+        self,
+        handler: Callable[[dict], Awaitable[dict]],
+        workers: int = WEBHOOK_INBOX_WORKERS,
+        max_attempts: int = WEBHOOK_INBOX_MAX_ATTEMPTS,
+    ):
+        self._handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self._slots = asyncio.Semaphore(workers)
+        self._busy_keys: set[str] = set()
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._tasks: set[asyncio.Task] = set()
+        self._last_lag_seconds: Optional[float] = None
+        self._processed = 0
+        self._failed = 0
+
+    async def start(self) -> None:
+        """Возвращает зависшие записи в очередь и запускает диспетчер"""
+        async with db_write() as db:
+            cur = await db.execute(
+                "UPDATE webhook_inbox SET status = 'pending' WHERE status = 'processing'"
+            )
+            if cur.rowcount:
+                logger.warning(f"⚠️ Возвращено в очередь {cur.rowcount} необработанных уведомлений ЮKassa")
+            await db.commit()
+        self._dispatcher = asyncio.create_task(self._dispatch_loop())
+        logger.info(f"✅ Очередь webhook ЮKassa запущена ({self.workers} воркеров)")
+
+    async def stop(self) -> None:
+        """Останавливает диспетчер; незавершенные записи будут повторены при следующем старте"""
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        for task in list(self._tasks):
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def notify(self) -> None:
+        """Будит диспетчер после записи нового уведомления"""
+        self._wakeup.set()
+
+    async def _fetch_ready(self, limit: int) -> list[tuple]:
+        """Самое раннее ожидающее уведомление каждого order_key, у которого подошло время попытки"""
+        now = datetime.now(timezone.utc).isoformat()
+        async with db_read() as db:
+            cur = await db.execute(queries.WEBHOOK_INBOX_READY, (now, limit))
+            return await cur.fetchall()
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            try:
+                self._wakeup.clear()
+                rows = await self._fetch_ready(self.workers * 4)
+                for row_id, order_key, payload, attempts in rows:
+                    if order_key in self._busy_keys:
+                        continue  # Предыдущее уведомление пользователя еще обрабатывается
+                    await self._slots.acquire()
+                    if not await self._claim(row_id):
+                        self._slots.release()
+                        continue  # Запись из устаревшей выборки уже взята в работу
+                    self._busy_keys.add(order_key)
+                    task = asyncio.create_task(self._run(row_id, order_key, payload, attempts + 1))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=WEBHOOK_INBOX_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка диспетчера очереди webhook: {e}", exc_info=True)
+                await asyncio.sleep(WEBHOOK_INBOX_POLL_SECONDS)
+
+    async def _claim(self, row_id: int) -> bool:
+        """Переводит запись pending -> processing; False, если её уже взяли"""
+        async with db_write() as db:
+            cur = await db.execute(
+                "UPDATE webhook_inbox SET status = 'processing', attempts = attempts + 1 "
+                "WHERE id = ? AND status = 'pending' AND next_attempt_at <= ?",
+                (row_id, datetime.now(timezone.utc).isoformat())
+            )
+            await db.commit()
+            return cur.rowcount > 0
+
+    async def _run(self, row_id: int, order_key: str, payload: str, attempts: int) -> None:
+        try:
+            try:
+                result = await self._handler(json.loads(payload))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await self._schedule_retry(row_id, attempts, e)
+                return
+
+            now = datetime.now(timezone.utc)
+            async with db_write() as db:
+                await db.execute(
+                    "UPDATE webhook_inbox SET status = 'done', processed_at = ?, last_error = NULL WHERE id = ?",
+                    (now.isoformat(), row_id)
+                )
+                cur = await db.execute("SELECT received_at FROM webhook_inbox WHERE id = ?", (row_id,))
+                row = await cur.fetchone()
+                await db.commit()
+            received_at = _parse_iso(row[0]) if row else None
+            if received_at:
+                self._last_lag_seconds = (now - received_at).total_seconds()
+            self._processed += 1
+            logger.info(f"✅ Уведомление #{row_id} ({order_key}) обработано: {result}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки уведомления #{row_id} из очереди: {e}", exc_info=True)
+        finally:
+            self._busy_keys.discard(order_key)
+            self._slots.release()
+            # Освободился ключ и слот - у этого пользователя могло ждать следующее уведомление
+            self._wakeup.set()
+
+    async def _schedule_retry(self, row_id: int, attempts: int, error: Exception) -> None:
+        if attempts >= self.max_attempts:
+            status = STATUS_FAILED
+            delay = 0
+            self._failed += 1
+            logger.error(f"❌ Уведомление #{row_id} не обработано после {attempts} попыток: {error}", exc_info=error)
+        else:
+            status = STATUS_PENDING
+            delay = min(WEBHOOK_INBOX_RETRY_BASE_SECONDS * 2 ** (attempts - 1), WEBHOOK_INBOX_RETRY_MAX_SECONDS)
+            logger.warning(f"⚠️ Ошибка обработки уведомления #{row_id} (попытка {attempts}/{self.max_attempts}), повтор через {delay} сек: {error}")
+        next_attempt_at = (datetime.now(timezone.utc) + timedelta(seconds=delay)).isoformat()
+        async with db_write() as db:
+            await db.execute(
+                "UPDATE webhook_inbox SET status = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                (status, next_attempt_at, str(error)[:1000], row_id)
+            )
+            await db.commit()
+
+    async def stats(self) -> dict:
+        """Глубина очереди и задержка обработки (для мониторинга)"""
+        async with db_read() as db:
+            cur = await db.execute(
+                "SELECT status, COUNT(*), MIN(received_at) FROM webhook_inbox "
+                "WHERE status IN ('pending', 'processing', 'failed') GROUP BY status"
+            )
+            rows = await cur.fetchall()
+        counts = {STATUS_PENDING: 0, STATUS_PROCESSING: 0, STATUS_FAILED: 0}
+        oldest = None
+        for status, count, min_received_at in rows:
+            counts[status] = count
+            received_at = _parse_iso(min_received_at)
+            if status != STATUS_FAILED and received_at and (oldest is None or received_at < oldest):
+                oldest = received_at
+        now = datetime.now(timezone.utc)
+        return {
+            "depth": counts[STATUS_PENDING] + counts[STATUS_PROCESSING],
+            "pending": counts[STATUS_PENDING],
+            "processing": counts[STATUS_PROCESSING],
+            "failed": counts[STATUS_FAILED],
+            "oldest_pending_age_seconds": round((now - oldest).total_seconds(), 3) if oldest else 0.0,
+            "last_processing_lag_seconds": round(self._last_lag_seconds, 3) if self._last_lag_seconds is not None else None,
+            "processed_since_start": self._processed,
+            "failed_since_start": self._failed,
+            "workers": self.workers,
+            "busy_workers": len(self._busy_keys),
+        }
@@ -0,0 +1,360 @@
+"""
+Асинхронный клиент ЮKassa
+Синхронный SDK yookassa открывает новую requests.Session на каждый вызов и блокирует event loop
+на всё время HTTPS-запроса. Здесь те же запросы идут через общий aiohttp.ClientSession
+с пулом keep-alive соединений и таймаутом на каждый вызов.
+Модульные функции повторяют API payments.py (create_payment, get_payment_status, ...), но их нужно await'ить.
+Запросы валидируются и ответы разбираются объектами самого SDK, поэтому результаты совместимы
+с Payment.find_one/Payment.create (payment.status, payment.confirmation.confirmation_url, ...).
+"""
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Optional
+
+import aiohttp
+from dotenv import load_dotenv
+from yookassa import Configuration, Payment
+from yookassa.domain.common.user_agent import UserAgent
+from yookassa.domain.exceptions import (
+    ApiError,
+    BadRequestError,
+    ForbiddenError,
+    GoneError,
+    InternalServerError,
+    NotFoundError,
+    ResponseProcessingError,
+    TooManyRequestsError,
+    UnauthorizedError,
+)
+from yookassa.domain.request.payment_request import PaymentRequest
+from yookassa.domain.request.refund_request import RefundRequest
+from yookassa.domain.response import PaymentListResponse, PaymentResponse, RefundResponse
+
+from config import YOOKASSA_MAX_ATTEMPTS, YOOKASSA_MAX_CONNECTIONS, YOOKASSA_REQUEST_TIMEOUT_SECONDS
+from payments import (
+    build_auto_payment_payload,
+    build_payment_payload,
+    is_save_payment_method_unsupported,
+)
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+API_ENDPOINT = "https://api.yookassa.ru/v3"
+
+_ERRORS_BY_HTTP_CODE = {
+    error.HTTP_CODE: error
+    for error in (
+        BadRequestError,
+        ForbiddenError,
+        NotFoundError,
+        TooManyRequestsError,
+        UnauthorizedError,
+        ResponseProcessingError,
+        InternalServerError,
+        GoneError,
+    )
+}
+
+
+class AsyncYooKassaClient:
+    """HTTP-клиент API ЮKassa поверх одного aiohttp.ClientSession на event loop"""
+
+    def __init__(
+        self,
+        shop_id: Optional[str] = None,
+        secret_key: Optional[str] = None,
+        timeout: float = YOOKASSA_REQUEST_TIMEOUT_SECONDS,
+        max_connections: int = YOOKASSA_MAX_CONNECTIONS,
+        max_attempts: int = YOOKASSA_MAX_ATTEMPTS,
+    ):
+        self._shop_id = shop_id
+        self._secret_key = secret_key
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_attempts = max_attempts
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _credentials(self) -> tuple[str, str]:
+        """Ключи берутся так же, как в payments.py: из .env или из уже настроенного Configuration"""
+        shop_id = self._shop_id or Configuration.account_id or os.getenv("YOOKASSA_SHOP_ID")
+        secret_key = self._secret_key or Configuration.secret_key or os.getenv("YOOKASSA_SECRET_KEY")
+        if not shop_id or not secret_key:
+            raise RuntimeError("YOOKASSA_SHOP_ID / YOOKASSA_SECRET_KEY is missing in .env")
+        return str(shop_id), str(secret_key)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Открывает сессию лениво; если event loop сменился, старую сессию использовать нельзя"""
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            shop_id, secret_key = self._credentials()
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=60,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                auth=aiohttp.BasicAuth(shop_id, secret_key),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={
+                    "Content-Type": "application/json",
+                    "YM-User-Agent": UserAgent().get_header_string(),
+                },
+            )
+            self._loop = loop
+        return self._session
+
+    async def close(self) -> None:
+        """Закрывает пул соединений (вызывается при остановке процесса)"""
+        if self._session is not None and not self._session.closed:
+            try:
+                await self._session.close()
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка при закрытии HTTP-сессии ЮKassa: {e}")
+        self._session = None
+        self._loop = None
+
+    async def _request(
+        self,
+        method: str,
+        path: str,
+        params: Optional[dict] = None,
+        body: Optional[dict] = None,
+        idempotence_key: Optional[str] = None,
+    ) -> dict:
+        """Выполняет запрос к API с повторами при сетевой ошибке и ответе 202 (как Retry в SDK)"""
+        headers = {"Idempotence-Key": idempotence_key} if idempotence_key else None
+        session = self._get_session()
+        last_error: Optional[Exception] = None
+
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                async with session.request(
+                    method, API_ENDPOINT + path, params=params, json=body, headers=headers
+                ) as response:
+                    if response.status == 200:
+                        return await response.json(content_type=None)
+                    try:
+                        error_data = await response.json(content_type=None)
+                    except (aiohttp.ContentTypeError, ValueError):
+                        error_data = {"description": await response.text()}
+                    error_class = _ERRORS_BY_HTTP_CODE.get(response.status, ApiError)
+                    if response.status != ResponseProcessingError.HTTP_CODE:
+                        raise error_class(error_data)
+                    # 202 - ЮKassa ещё обрабатывает запрос, повторяем через указанную паузу
+                    last_error = error_class(error_data)
+                    retry_after = error_data.get("retry_after") if isinstance(error_data, dict) else None
+                    delay = (retry_after / 1000) if retry_after else attempt
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                # Повтор безопасен: POST-запросы идут с тем же Idempotence-Key
+                last_error = e
+                delay = attempt
+                logger.warning(f"⚠️ Сетевая ошибка запроса {method} {path} к ЮKassa (попытка {attempt}/{self.max_attempts}): {e}")
+
+            if attempt < self.max_attempts:
+                await asyncio.sleep(delay)
+
+        raise last_error
+
+    async def find_payment(self, payment_id: str) -> PaymentResponse:
+        """Аналог Payment.find_one"""
+        if not isinstance(payment_id, str) or not payment_id:
+            raise ValueError("Invalid payment_id value")
+        return PaymentResponse(await self._request("GET", f"/payments/{payment_id}"))
+
+    async def list_payments(self, params: Optional[dict] = None) -> PaymentListResponse:
+        """Аналог Payment.list"""
+        return PaymentListResponse(await self._request("GET", "/payments", params=params or {}))
+
+    async def create_payment(self, payload: dict, idempotence_key: Optional[str] = None) -> PaymentResponse:
+        """Аналог Payment.create: payload проверяется тем же PaymentRequest, что и в SDK"""
+        request = Payment().add_default_cms_name(PaymentRequest(payload))
+        request.validate()
+        response = await self._request(
+            "POST", "/payments", body=dict(request), idempotence_key=idempotence_key or str(uuid.uuid4())
+        )
+        return PaymentResponse(response)
+
+    async def create_refund(self, payload: dict, idempotence_key: Optional[str] = None) -> RefundResponse:
+        """Аналог Refund.create"""
+        request = RefundRequest(payload)
+        request.validate()
+        response = await self._request(
+            "POST", "/refunds", body=dict(request), idempotence_key=idempotence_key or str(uuid.uuid4())
+        )
+        return RefundResponse(response)
+
+    async def find_refund(self, refund_id: str) -> RefundResponse:
+        """Аналог Refund.find_one"""
+        if not isinstance(refund_id, str) or not refund_id:
+            raise ValueError("Invalid refund_id value")
+        return RefundResponse(await self._request("GET", f"/refunds/{refund_id}"))
+
+
+yookassa_client = AsyncYooKassaClient()
+
+
+async def close_yookassa_client() -> None:
+    await yookassa_client.close()
+
+
+# ================== API, ПОВТОРЯЮЩЕЕ payments.py ==================
+
+async def find_payment(payment_id: str) -> PaymentResponse:
+    """Асинхронная замена Payment.find_one(payment_id)"""
+    return await yookassa_client.find_payment(payment_id)
+
+
+async def create_payment(
+    amount_rub: str,
+    description: str,
+    return_url: str,
+    customer_email: str,
+    telegram_user_id: int,
+    enable_save_payment_method: bool = False,
+):
+    """
+    Создаёт платёж и возвращает (payment_id, confirmation_url)
+    Асинхронный аналог payments.create_payment (тот же payload и тот же повтор без save_payment_method)
+    """
+    idempotence_key = str(uuid.uuid4())
+
+    payload = build_payment_payload(
+        amount_rub, description, return_url, customer_email, telegram_user_id, enable_save_payment_method
+    )
+
+    try:
+        payment = await yookassa_client.create_payment(payload, idempotence_key)
+        return payment.id, payment.confirmation.confirmation_url
+    except Exception as e:
+        # Если ошибка связана с save_payment_method, пробуем без него
+        if enable_save_payment_method and is_save_payment_method_unsupported(e):
+            logger.warning(f"⚠️ Магазин не настроен для автоплатежей, создаю платеж без save_payment_method: {e}")
+            payload.pop("save_payment_method", None)
+            # Тело запроса изменилось - нужен новый ключ идемпотентности
+            payment = await yookassa_client.create_payment(payload, str(uuid.uuid4()))
+            return payment.id, payment.confirmation.confirmation_url
+        raise
+
+
+async def get_payment_status(payment_id: str) -> str:
+    payment = await yookassa_client.find_payment(payment_id)
+    return payment.status
+
+
+LIST_PAGE_LIMIT = 100  # Максимальный размер страницы Payment.list в API ЮKassa
+
+
+def _api_datetime(value: datetime) -> str:
+    """Время в формате фильтров API ЮKassa: 2026-01-14T10:58:42.000Z"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+async def list_payments_created_between(since: datetime, until: datetime) -> list[PaymentResponse]:
+    """Все платежи магазина, созданные в [since, until], одним постраничным запросом Payment.list
+    (страницы по LIST_PAGE_LIMIT, переход по next_cursor)"""
+    params = {
+        "created_at.gte": _api_datetime(since),
+        "created_at.lte": _api_datetime(until),
+        "limit": LIST_PAGE_LIMIT,
+    }
+    payments: list[PaymentResponse] = []
+    while True:
+        page = await yookassa_client.list_payments(params)
+        payments.extend(page.items or [])
+        if not page.next_cursor:
+            return payments
+        # Следующая страница: те же фильтры + курсор
+        params = {**params, "cursor": page.next_cursor}
+
+
+async def get_payment_url(payment_id: str) -> Optional[str]:
+    """Получает URL для оплаты по payment_id"""
+    try:
+        payment = await yookassa_client.find_payment(payment_id)
+        if payment.confirmation and payment.confirmation.confirmation_url:
+            return payment.confirmation.confirmation_url
+        return None
+    except Exception:
+        return None
+
+
+async def create_auto_payment(
+    amount_rub: str,
+    description: str,
+    customer_email: str,
+    telegram_user_id: int,
+    payment_method_id: str,
+) -> tuple[str, str]:
+    """
+    Создает автоматический платеж с использованием сохраненного способа оплаты
+    Возвращает (payment_id, status)
+    """
+    payload = build_auto_payment_payload(amount_rub, description, customer_email, telegram_user_id, payment_method_id)
+
+    try:
+        payment = await yookassa_client.create_payment(payload, str(uuid.uuid4()))
+        payment_method_type = getattr(payment.payment_method, "type", None) if payment.payment_method else None
+        logger.info(f"🔍 Создан автоплатеж: payment_id={payment.id}, status={payment.status}, payment_method_id={payment_method_id}, тип: {payment_method_type}")
+        if payment.cancellation_details:
+            cd = payment.cancellation_details
+            logger.warning(f"⚠️ Детали отмены автоплатежа: party={getattr(cd, 'party', None)}, reason={getattr(cd, 'reason', None)}")
+        return payment.id, payment.status
+    except Exception as e:
+        logger.error(f"❌ Ошибка создания автоматического платежа: {e}", exc_info=True)
+        raise
+
+
+async def create_refund(
+    payment_id: str,
+    amount_rub: Optional[str] = None,
+    description: Optional[str] = None,
+) -> tuple[str, str]:
+    """
+    Создает возврат средств для платежа, возвращает (refund_id, status)
+    Асинхронный аналог payments.create_refund (те же проверки статуса и суммы)
+    """
+    try:
+        payment = await yookassa_client.find_payment(payment_id)
+    except Exception as e:
+        raise ValueError(f"Не удалось найти платеж {payment_id}: {e}")
+
+    if payment.status != "succeeded":
+        raise ValueError(f"Нельзя создать возврат для платежа со статусом {payment.status}. Требуется статус 'succeeded'")
+
+    if amount_rub is None:
+        amount_rub = getattr(payment.amount, "value", None)
+        if amount_rub is None:
+            raise ValueError("Не удалось определить сумму платежа")
+
+    payload = {
+        "amount": {"value": amount_rub, "currency": "RUB"},
+        "payment_id": payment_id,
+    }
+    if description:
+        payload["description"] = description
+
+    try:
+        refund = await yookassa_client.create_refund(payload, str(uuid.uuid4()))
+        logger.info(f"✅ Создан возврат: refund_id={refund.id}, payment_id={payment_id}, amount={amount_rub}, status={refund.status}")
+        return refund.id, refund.status
+    except Exception as e:
+        logger.error(f"❌ Ошибка создания возврата для платежа {payment_id}: {e}", exc_info=True)
+        raise
+
+
+async def get_refund_status(refund_id: str) -> str:
+    """Получает статус возврата по его ID"""
+    try:
+        refund = await yookassa_client.find_refund(refund_id)
+        return refund.status
+    except Exception as e:
+        raise ValueError(f"Не удалось найти возврат {refund_id}: {e}")